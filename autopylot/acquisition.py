@@ -0,0 +1,104 @@
+""" Interrupt driven sensor acquisition. The MPU-6050 pulls its INT pin
+high whenever a new sample is ready (data ready interrupt). A pigpio
+callback on that pin wakes up the sensor loop - so the loop only reads when
+there is new data instead of polling the sensor all the time. If no
+interrupt arrives within the timeout the loop reads anyway (fallback). """
+
+import logging
+import threading
+
+import autopylot.clock
+
+# pigpio.RISING_EDGE - the pi object is passed in, so pigpio itself is not
+# needed here
+RISING_EDGE = 0
+
+
+def tick_diff(first, second):
+	""" Microseconds from the pigpio tick first to second (the ticks wrap
+	around at 2^32) """
+	return (second - first) & 0xffffffff
+
+
+class DataReadySampler():
+	""" Waits for the data ready interrupts on the INT pin and keeps count
+	of missed (overrun or lost) interrupts, duplicate samples and timeouts.
+	The pi can be a pigpio.pi or a FakePi (autopylot.fakes). """
+
+	def __init__(self, pi, pin, sample_rate, timeout=None):
+		self.pi = pi
+		self.pin = int(pin)
+		self.period_us = 1e6 / sample_rate
+		# fallback: read anyway if there was no interrupt for 3 periods
+		self.timeout = timeout if timeout is not None else 3.0 / sample_rate
+		self._lock = threading.Lock()
+		# set with every interrupt - waited for on autopylot.clock
+		self._ready = threading.Event()
+		self._pending = 0
+		self._last_tick = None
+		self._consumed_tick = None
+		self.timestamp = 0.0  # seconds since the first sample (by tick)
+		self.interrupts = 0
+		self.missed = 0
+		self.duplicates = 0
+		self.timeouts = 0
+		self._callback = pi.callback(self.pin, RISING_EDGE, self._on_interrupt)
+		logging.info("Registered data ready interrupt on pin {!s} "
+					"({!s}Hz)".format(self.pin, sample_rate))
+
+	def _on_interrupt(self, gpio, level, tick):
+		""" pigpio callback (runs in the pigpio thread) """
+		with self._lock:
+			self.interrupts += 1
+			if self._last_tick is not None:
+				# more than one period since the last interrupt means the
+				# interrupts in between were lost
+				lost = round(tick_diff(self._last_tick, tick) /
+							self.period_us) - 1
+				if lost > 0:
+					self.missed += lost
+			self._last_tick = tick
+			self._pending += 1
+			self._ready.set()
+
+	def wait(self):
+		""" Blocks until a new sample is ready. Returns the pigpio tick of
+		the data ready interrupt - or None if the timeout passed without an
+		interrupt (read anyway and check for a duplicate). In both cases the
+		timestamp is updated. The timeout runs on autopylot.clock. """
+		autopylot.clock.wait(self._ready, self.timeout)
+		with self._lock:
+			self._ready.clear()
+			timed_out = not self._pending
+			if timed_out:
+				self.timeouts += 1
+				tick = self.pi.get_current_tick()
+			else:
+				if self._pending > 1:
+					# the loop was too slow - the older samples are gone
+					self.missed += self._pending - 1
+				self._pending = 0
+				tick = self._last_tick
+
+		if self._consumed_tick is not None:
+			self.timestamp += tick_diff(self._consumed_tick, tick) / 1e6
+		self._consumed_tick = tick
+		return None if timed_out else tick
+
+	def count_duplicate(self):
+		""" Counts a duplicate the reader detected itself (like the
+		ImuReader of autopylot.imu) """
+		self.duplicates += 1
+
+	def get_statistics(self):
+		""" Returns a dict of the interrupt / sample counters """
+		return {'interrupts': self.interrupts, 'missed': self.missed,
+				'duplicates': self.duplicates, 'timeouts': self.timeouts}
+
+	def cancel(self):
+		""" Removes the pigpio callback """
+		if self._callback is not None:
+			self._callback.cancel()
+			self._callback = None
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
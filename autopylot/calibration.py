@@ -0,0 +1,309 @@
+""" Calibration of the IMU (gyro bias, accelerometer scale / offset).
+The samples are collected at the full rate of the sensor and evaluated in
+one streaming pass (Welford's algorithm) - no sample list is kept.
+Calibrations are cached on disk per sensor and temperature, so a start
+only needs a short verification instead of a full calibration. """
+
+import os
+import math
+import json
+import time
+import logging
+
+GRAVITY = 9.80665  # m/s²
+# max. standard deviation allowed while calibrating - above this the device
+# was moved (or vibrates)
+GYRO_MOTION_LIMIT = 2.0  # °/s
+ACCEL_MOTION_LIMIT = 0.5  # m/s²
+
+
+class RunningStats():
+	""" Streaming mean, variance, min and max over a fixed number of axes
+	(Welford's algorithm) """
+
+	def __init__(self, axes=3):
+		self.count = 0
+		self.mean = [0.0] * axes
+		self.min = [math.inf] * axes
+		self.max = [-math.inf] * axes
+		self._m2 = [0.0] * axes
+
+	def add(self, values):
+		""" Adds one sample (a sequence with one value per axis) """
+		self.count += 1
+		count = self.count
+		mean = self.mean
+		m2 = self._m2
+		for axis, value in enumerate(values):
+			delta = value - mean[axis]
+			mean[axis] += delta / count
+			m2[axis] += delta * (value - mean[axis])
+			if value < self.min[axis]:
+				self.min[axis] = value
+			if value > self.max[axis]:
+				self.max[axis] = value
+
+	@property
+	def variance(self):
+		""" Sample variance per axis """
+		if self.count < 2:
+			return [0.0] * len(self.mean)
+		return [m2 / (self.count - 1) for m2 in self._m2]
+
+	@property
+	def std(self):
+		""" Standard deviation per axis """
+		return [math.sqrt(variance) for variance in self.variance]
+
+
+class ImuCalibration():
+	""" Calibration values of the IMU. The read path applies them as:
+	gyro = raw - gyro_bias and accel = raw * accel_scale - accel_offset.
+	The noise bands (min / max of the calibrated values at rest) can be
+	used as dead zone for the motion tracking. """
+
+	def __init__(self, gyro_bias=(0, 0, 0), accel_offset=(0, 0, 0),
+				accel_scale=(1, 1, 1), gyro_band=None, accel_band=None,
+				gyro_std=(0, 0, 0), accel_std=(0, 0, 0), temperature=None,
+				sample_count=0):
+		self.gyro_bias = [float(value) for value in gyro_bias]
+		self.accel_offset = [float(value) for value in accel_offset]
+		self.accel_scale = [float(value) for value in accel_scale]
+		# (min, max) lists of three values each
+		self.gyro_band = gyro_band
+		self.accel_band = accel_band
+		self.gyro_std = [float(value) for value in gyro_std]
+		self.accel_std = [float(value) for value in accel_std]
+		self.temperature = temperature
+		self.sample_count = sample_count
+
+	def correct_gyro(self, values):
+		""" Returns the calibrated gyro values (sequence of three) """
+		bias = self.gyro_bias
+		return [values[0] - bias[0], values[1] - bias[1], values[2] - bias[2]]
+
+	def correct_accel(self, values):
+		""" Returns the calibrated accel values (sequence of three) """
+		scale = self.accel_scale
+		offset = self.accel_offset
+		return [values[0] * scale[0] - offset[0],
+				values[1] * scale[1] - offset[1],
+				values[2] * scale[2] - offset[2]]
+
+	def apply_gyro(self, data):
+		""" Applies the calibration to the gyro data dict ['x', 'y', 'z'] """
+		corrected = self.correct_gyro((data['x'], data['y'], data['z']))
+		return {'x': corrected[0], 'y': corrected[1], 'z': corrected[2]}
+
+	def apply_accel(self, data):
+		""" Applies the calibration to the accel data dict ['x', 'y', 'z'] """
+		corrected = self.correct_accel((data['x'], data['y'], data['z']))
+		return {'x': corrected[0], 'y': corrected[1], 'z': corrected[2]}
+
+	def to_dict(self):
+		""" Returns the calibration as (json serializable) dict """
+		return {'gyro_bias': self.gyro_bias, 'accel_offset': self.accel_offset,
+				'accel_scale': self.accel_scale, 'gyro_band': self.gyro_band,
+				'accel_band': self.accel_band, 'gyro_std': self.gyro_std,
+				'accel_std': self.accel_std, 'temperature': self.temperature,
+				'sample_count': self.sample_count}
+
+	@classmethod
+	def from_dict(cls, values):
+		""" Creates a calibration from a dict (see to_dict) """
+		return cls(**values)
+
+	def __repr__(self):
+		return ("{!s}(gyro_bias={!r}, accel_offset={!r}, accel_scale={!r}, "
+				"temperature={!r})".format(self.__class__.__name__,
+										self.gyro_bias, self.accel_offset,
+										self.accel_scale, self.temperature))
+
+
+def estimate_accel_correction(mean):
+	""" Estimates the accel scale and offset from the mean acceleration of
+	a device at rest (in one orientation). The scale is the same for all
+	axes (|mean| should be 1g) and the offset is what is left on the axes
+	after removing gravity from the axis pointing (closest) up or down.
+	Returns (scale, offset) - three values each. """
+	norm = math.sqrt(sum(value * value for value in mean))
+	if norm == 0:
+		raise Exception("Accelerometer reads 0 on all axes - unable to "
+						"calibrate")
+	scale = GRAVITY / norm
+	gravity_axis = max(range(3), key=lambda axis: abs(mean[axis]))
+	expected = [0.0, 0.0, 0.0]
+	expected[gravity_axis] = math.copysign(GRAVITY, mean[gravity_axis])
+	offset = [value * scale - expected[axis]
+			for axis, value in enumerate(mean)]
+	return [scale] * 3, offset
+
+
+def calibrate(read_burst, sample_count=200, gyro_motion_limit=GYRO_MOTION_LIMIT,
+			accel_motion_limit=ACCEL_MOTION_LIMIT):
+	""" Calibrates the IMU. read_burst returns one raw sample as
+	(accel, gyro, temperature) - it is called sample_count times without
+	any delay. Raises an Exception if the device moved while calibrating
+	(standard deviation above the motion limits). Returns an ImuCalibration
+	object. """
+	gyro_stats = RunningStats()
+	accel_stats = RunningStats()
+	temperature = 0.0
+
+	start_time = time.perf_counter()
+	for _ in range(sample_count):
+		accel, gyro, temp = read_burst()
+		accel_stats.add(accel)
+		gyro_stats.add(gyro)
+		temperature += temp
+	elapsed = time.perf_counter() - start_time
+
+	gyro_std = gyro_stats.std
+	accel_std = accel_stats.std
+	if max(gyro_std) > gyro_motion_limit or max(accel_std) > accel_motion_limit:
+		raise Exception("Device moved while calibrating (std gyro: {!s}°/s, "
+						"accel: {!s}m/s²). Do not move the device while "
+						"calibrating".format(gyro_std, accel_std))
+
+	accel_scale, accel_offset = estimate_accel_correction(accel_stats.mean)
+	calibration = ImuCalibration(gyro_bias=gyro_stats.mean,
+								accel_offset=accel_offset,
+								accel_scale=accel_scale,
+								gyro_std=gyro_std, accel_std=accel_std,
+								temperature=temperature / sample_count,
+								sample_count=sample_count)
+	calibration.gyro_band = (calibration.correct_gyro(gyro_stats.min),
+							calibration.correct_gyro(gyro_stats.max))
+	calibration.accel_band = (calibration.correct_accel(accel_stats.min),
+							calibration.correct_accel(accel_stats.max))
+	logging.info("Calibrated IMU with {!s} samples in {:.3f}s: {!r}"
+				.format(sample_count, elapsed, calibration))
+	return calibration
+
+
+def interpolate(first, second, temperature):
+	""" Returns a calibration linearly interpolated (by temperature) between
+	two calibrations - the noise bands are taken from the wider one """
+	if first.temperature == second.temperature:
+		return first
+	weight = ((temperature - first.temperature) /
+			(second.temperature - first.temperature))
+
+	def mix(a, b):
+		return [x + (y - x) * weight for x, y in zip(a, b)]
+
+	def wider(a, b):
+		if a is None or b is None:
+			return a or b
+		return ([min(x, y) for x, y in zip(a[0], b[0])],
+				[max(x, y) for x, y in zip(a[1], b[1])])
+
+	return ImuCalibration(gyro_bias=mix(first.gyro_bias, second.gyro_bias),
+						accel_offset=mix(first.accel_offset,
+										second.accel_offset),
+						accel_scale=mix(first.accel_scale, second.accel_scale),
+						gyro_band=wider(first.gyro_band, second.gyro_band),
+						accel_band=wider(first.accel_band, second.accel_band),
+						gyro_std=[max(x, y) for x, y in zip(first.gyro_std,
+															second.gyro_std)],
+						accel_std=[max(x, y) for x, y in zip(first.accel_std,
+															second.accel_std)],
+						temperature=temperature)
+
+
+class CalibrationCache():
+	""" Calibrations stored on disk (json) - keyed by the sensor address and
+	binned by temperature (the bias of the MPU-6050 mostly depends on it).
+	Each bin holds the latest calibration made within its temperature
+	range. """
+
+	def __init__(self, filename, bin_width=5.0):
+		self.filename = filename
+		self.bin_width = float(bin_width)
+		self._sensors = {}
+		if os.path.exists(filename):
+			with open(filename) as cache_file:
+				self._sensors = json.load(cache_file)
+
+	def _bin(self, temperature):
+		return str(int(round(temperature / self.bin_width)))
+
+	def entries(self, address):
+		""" Returns all cached calibrations of the sensor (sorted by
+		temperature) """
+		entries = self._sensors.get(hex(address), {}).values()
+		return sorted((ImuCalibration.from_dict(entry) for entry in entries),
+					key=lambda calibration: calibration.temperature)
+
+	def store(self, address, calibration):
+		""" Stores the calibration (in the bin of its temperature) and writes
+		the cache file """
+		bins = self._sensors.setdefault(hex(address), {})
+		bins[self._bin(calibration.temperature)] = calibration.to_dict()
+		temp_filename = self.filename + '.tmp'
+		with open(temp_filename, 'w') as cache_file:
+			json.dump(self._sensors, cache_file, indent=1)
+		os.replace(temp_filename, self.filename)
+
+	def lookup(self, address, temperature):
+		""" Returns the calibration of the sensor for the given temperature -
+		interpolated between the two closest bins (or the closest one
+		outside of the cached temperature range). None if there is no
+		calibration for this sensor. """
+		entries = self.entries(address)
+		if not entries:
+			return None
+		if temperature <= entries[0].temperature:
+			return entries[0]
+		for first, second in zip(entries, entries[1:]):
+			if temperature <= second.temperature:
+				return interpolate(first, second, temperature)
+		return entries[-1]
+
+
+def verify(read_burst, calibration, sample_count=50,
+		gyro_tolerance=0.5, accel_tolerance=0.02):
+	""" Short check if the (cached) calibration still fits the sensor: the
+	calibrated gyro mean has to be within gyro_tolerance (°/s) of 0 and the
+	calibrated acceleration within accel_tolerance (relative) of 1g. The
+	device must not be moved meanwhile. Returns True or False. """
+	gyro_stats = RunningStats()
+	accel_stats = RunningStats()
+	for _ in range(sample_count):
+		accel, gyro, _ = read_burst()
+		gyro_stats.add(calibration.correct_gyro(gyro))
+		accel_stats.add(calibration.correct_accel(accel))
+
+	if max(gyro_stats.std) > GYRO_MOTION_LIMIT or \
+			max(accel_stats.std) > ACCEL_MOTION_LIMIT:
+		logging.warning("Device moved while verifying the calibration")
+		return False
+	if max(abs(value) for value in gyro_stats.mean) > gyro_tolerance:
+		logging.info("Calibration verification failed - gyro bias is off: "
+					"{!s}".format(gyro_stats.mean))
+		return False
+	gravity = math.sqrt(sum(value * value for value in accel_stats.mean))
+	if abs(gravity - GRAVITY) > GRAVITY * accel_tolerance:
+		logging.info("Calibration verification failed - gravity is off: "
+					"{!s}".format(gravity))
+		return False
+	return True
+
+
+def load_or_calibrate(read_burst, address, temperature, cache,
+					sample_count=200, verify_count=50):
+	""" Returns the cached calibration for the sensor at the current
+	temperature if a short verification passes. Otherwise a full
+	calibration is made and stored in the cache. """
+	calibration = cache.lookup(address, temperature)
+	if calibration is not None and verify(read_burst, calibration,
+										verify_count):
+		logging.info("Using cached calibration for sensor {!s} at {!s}°C"
+					.format(hex(address), temperature))
+		return calibration
+
+	calibration = calibrate(read_burst, sample_count)
+	cache.store(address, calibration)
+	return calibration
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
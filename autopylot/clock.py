@@ -0,0 +1,122 @@
+""" Time source of autopylot. All modules ask this module for the time
+(now, ticks) and to wait (sleep, spin, wait) instead of the time module -
+so a test can swap in a VirtualClock and simulate minutes of operation in
+milliseconds, with the same result on every run:
+
+	clock = autopylot.clock.VirtualClock()
+	previous = autopylot.clock.set_clock(clock)
+	try:
+		...  # sleep() / spin() / wait() advance the virtual time at once
+	finally:
+		autopylot.clock.set_clock(previous)
+
+The virtual time only moves when a waiting call (or advance()) moves it -
+so a simulation should run the waiting parts in one thread (i.e. step the
+loops instead of starting their threads). Benchmarks, budgets and the
+profiler measure the real CPU time and keep using time.perf_counter. """
+
+import time
+import threading
+
+
+class RealClock():
+	""" The wall clock (monotonic) """
+
+	def now(self):
+		""" Monotonic time in seconds """
+		return time.monotonic()
+
+	def sleep(self, seconds):
+		""" Waits the seconds (scheduler granularity) """
+		if seconds > 0:
+			time.sleep(seconds)
+
+	def spin(self, seconds):
+		""" Waits the seconds precisely (busy) - time.sleep is too coarse
+		for a few microseconds """
+		end = time.perf_counter() + seconds
+		while time.perf_counter() < end:
+			pass
+
+	def wait(self, event, timeout):
+		""" Waits until the threading.Event is set or the timeout passed -
+		returns True if the event is set """
+		return event.wait(timeout)
+
+
+class VirtualClock():
+	""" Clock which only moves when told to. sleep(), spin() and wait()
+	advance the time by the waited seconds and return at once. """
+
+	def __init__(self, start=0.0):
+		self._now = float(start)
+		self._lock = threading.Lock()
+
+	def now(self):
+		with self._lock:
+			return self._now
+
+	def advance(self, seconds):
+		""" Moves the time forward by the seconds """
+		if seconds < 0:
+			raise Exception("Time can not go backwards ({!s}s)"
+							.format(seconds))
+		with self._lock:
+			self._now += seconds
+
+	def sleep(self, seconds):
+		if seconds > 0:
+			self.advance(seconds)
+
+	def spin(self, seconds):
+		self.sleep(seconds)
+
+	def wait(self, event, timeout):
+		if not event.is_set() and timeout is not None:
+			self.sleep(timeout)
+		return event.is_set()
+
+
+_clock = RealClock()
+
+
+def get_clock():
+	""" Returns the clock in use """
+	return _clock
+
+
+def set_clock(clock):
+	""" Replaces the clock in use - returns the previous one """
+	global _clock
+	previous = _clock
+	_clock = clock
+	return previous
+
+
+def now():
+	""" Monotonic time in seconds of the clock in use """
+	return _clock.now()
+
+
+def ticks():
+	""" Monotonic microseconds of the clock in use - wraps at 2^32 like the
+	pigpio tick """
+	return int(_clock.now() * 1e6) & 0xffffffff
+
+
+def sleep(seconds):
+	""" Waits the seconds on the clock in use """
+	_clock.sleep(seconds)
+
+
+def spin(seconds):
+	""" Waits the seconds precisely on the clock in use """
+	_clock.spin(seconds)
+
+
+def wait(event, timeout):
+	""" Waits for the threading.Event (at most timeout seconds) on the clock
+	in use - returns True if the event is set """
+	return _clock.wait(event, timeout)
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
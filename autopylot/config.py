@@ -7,9 +7,17 @@ import configparser
 import logging
 import re
 
+import autopylot.logqueue
+import autopylot.orientation
+
 # TODO: add a validation for the configuration (if al values are set)
 # config_validation = {'ESC': }
 
+# space separated list of filter stages (see autopylot.filters)
+_FILTER_STAGE = ("(none|spike|median:[1-9][0-9]*|"
+				"(lowpass|notch|dynnotch)(:[0-9]+([.][0-9]+)?){1,2})")
+_FILTER_SPEC = "(?i){0}( +{0})*".format(_FILTER_STAGE)
+
 
 def verify_config_ini(config_ini):
 	""" Verifies the config.ini file (using regular expressions) - to avoid
@@ -18,24 +26,74 @@ def verify_config_ini(config_ini):
 		"AERO": {"propsize": "([1-9][0-9]+|[1-9])x[1-9]+(([.][1-9])*)"},
 		# TODO: add logical check -> i.e. maximum should be higher than min
 		"ESC": {"maximum": "[1-9][0-9]*",
-				"minimum": "[1-9][0-9]*"},
-		"MOTORS.PIN": {"motorfrontleft": "[1-9][0-9]{0,1}",
-					"motorfrontright": "[1-9][0-9]{0,1}",
-					"motorrearleft": "[1-9][0-9]{0,1}",
-					"motorrearright": "[1-9][0-9]{0,1}"},
-		"MOTORS.ROTATION": {"motorfrontleft": "(?i)(ccw|cw)",
-							"motorfrontright": "(?i)(ccw|cw)",
-							"motorrearleft": "(?i)(ccw|cw)",
-							"motorrearright": "(?i)(ccw|cw)"},
+				"minimum": "[1-9][0-9]*",
+				"protocol": "(?i)(pwm|oneshot125|multishot|dshot150)",
+				"rate": "[1-9][0-9]*"},
+		# the motor sections take any motor name (* = every key)
+		"MOTORS.PIN": {"*": "[1-9][0-9]{0,1}"},
+		"MOTORS.ROTATION": {"*": "(?i)(ccw|cw)"},
+		"MOTORS.POSITION": {"*": "[+-]?[0-9]+([.][0-9]+)?"},
 		# TODO add logical check to see if it is a valid posix filename
 		"LOG": {"level": "(?i)(critical|error|warning|info|debug|notset)",
-				"outputfile": "[a-zA-Z0-9]+.*"},
+				"outputfile": "[a-zA-Z0-9]+.*",
+				"queuesize": "[1-9][0-9]*",
+				"repeatwindow": "[0-9]+([.][0-9]+)?"},
+		"REALTIME": {"enabled": "(?i)(yes|no|on|off|true|false|1|0)",
+					"idlebudget": "[0-9]+([.][0-9]+)?",
+					"forcelimit": "[1-9][0-9]*"},
 		"PIGPIOD": {"samplerate": "(?i)(1|2|4|5|8|10)"},
-		"GYRO": {"address": "0x[0-9a-f]+",
-				# TODO add logical check to check that tiltfront and tiltleft
-				# are not the same
+		# one address per IMU - more than one are fused (autopylot.redundancy)
+		"GYRO": {"address": "0x[0-9a-f]+( *, *0x[0-9a-f]+)*",
+				# logical check (different axes) in verify_gyro
 				"tiltfront": "[+-][xyz]",
-				"tiltleft": "[+-][xyz]"}
+				"tiltleft": "[+-][xyz]",
+				"samplerate": "[1-9][0-9]*",
+				"intpin": "[1-9][0-9]{0,1}",
+				"mode": "(?i)(raw|dmp)",
+				"accelrange": "(2|4|8|16)",
+				"gyrorange": "(250|500|1000|2000)"},
+		"REDUNDANCY": {"gyrotolerance": "[0-9]+([.][0-9]+)?",
+						"acceltolerance": "[0-9]+([.][0-9]+)?",
+						"stucklimit": "[1-9][0-9]*",
+						"isolatelimit": "[1-9][0-9]*",
+						"recoverlimit": "[1-9][0-9]*"},
+		"CALIBRATION": {"cachefile": "[a-zA-Z0-9]+.*",
+						"binwidth": "[1-9][0-9]*([.][0-9]+)?"},
+		"ESTIMATOR": {"samplecount": "[1-9][0-9]*",
+					"deadzoneblur": "[0-9]+([.][0-9]+)?"},
+		"FILTER": {"gyro": _FILTER_SPEC,
+					"accel": _FILTER_SPEC},
+		"VIBRATION": {"window": "(32|64|128|256|512|1024|2048)",
+					"interval": "[1-9][0-9]*",
+					"minfrequency": "[1-9][0-9]*([.][0-9]+)?",
+					"budget": "[0-9]+([.][0-9]+)?"},
+		"MAGNETOMETER": {"type": "(?i)(none|hmc5883l|qmc5883l)",
+						"address": "0x[0-9a-f]+",
+						"rate": "[1-9][0-9]*([.][0-9]+)?"},
+		"FAILSAFE": {"timeout": "[1-9][0-9]*"},
+		"BAROMETER": {"type": "(?i)(none|bmp280)",
+					"address": "0x[0-9a-f]+",
+					"rate": "[1-9][0-9]*([.][0-9]+)?"},
+		"TRACING": {"enabled": "(?i)(yes|no|on|off|true|false|1|0)",
+					"capacity": "[1-9][0-9]*"},
+		"PROFILER": {"rate": "[1-9][0-9]*([.][0-9]+)?",
+					"outputfile": ".+",
+					"socket": ".+"},
+		"REMOTE": {"address": "[0-9.]+",
+					"port": "[1-9][0-9]*",
+					"rate": "[1-9][0-9]*([.][0-9]+)?",
+					"linktimeout": "[1-9][0-9]*",
+					"maxage": "[1-9][0-9]*",
+					"linkloss": "(?i)(hover|land|disarm)",
+					"landrate": "[0-9]+([.][0-9]+)?"},
+		"TELEMETRY": {"enabled": "(?i)(yes|no|on|off|true|false|1|0)",
+					"address": "(/.+|[a-zA-Z0-9.-]+:[1-9][0-9]*)",
+					"encoding": "(?i)(delta|quantized)",
+					"keyframeinterval": "[1-9][0-9]*",
+					"attitude": "[0-9]+([.][0-9]+)?",
+					"motors": "[0-9]+([.][0-9]+)?",
+					"sensors": "[0-9]+([.][0-9]+)?",
+					"loop": "[0-9]+([.][0-9]+)?"}
 	}
 
 	# instead of going through the checks we will iterate through the
@@ -43,16 +101,59 @@ def verify_config_ini(config_ini):
 	# 1. we detect a missing check
 	# 2. we are sure the whole config is checked
 	for section in config_ini.sections():
+		checks = verify_dict[section]
 		for key, value in config_ini[section].items():
-			matches = re.fullmatch(verify_dict[section][key], value)
+			matches = re.fullmatch(checks[key] if key in checks
+								else checks['*'], value)
 			if not matches:
 				raise Exception("Configuration is corrupted => "
 								"section: {!s}, key: {!s}, value: {!s}"
 								.format(section, key, value))
 				return False
+	verify_motors(config_ini)
+	verify_gyro(config_ini)
 	return True
 
 
+def _parse_addresses(value):
+	""" Returns the ints of a comma separated list of hexadecimal
+	addresses """
+	return [int(address, 16) for address in value.split(',')]
+
+
+def verify_gyro(config_ini):
+	""" Logical check of the mounting - tiltfront and tiltleft have to
+	make up a proper rotation (two different sensor axes) - and of the
+	addresses (no IMU twice) """
+	if 'GYRO' not in config_ini:
+		return
+	gyro = config_ini['GYRO']
+	addresses = _parse_addresses(gyro.get('address', '0x68'))
+	if len(set(addresses)) != len(addresses):
+		raise Exception("Configuration is corrupted => an IMU address is "
+						"given twice: {!s}".format(gyro['address']))
+	autopylot.orientation.mounting_matrix(gyro.get('tiltfront', '+y'),
+										gyro.get('tiltleft', '+x'))
+
+
+def verify_motors(config_ini):
+	""" Logical check of the frame - every motor (key of MOTORS.PIN) needs a
+	rotation (and a position if MOTORS.POSITION is given - otherwise the
+	default layout of get_motor_position is used), no pin twice """
+	if 'MOTORS.PIN' not in config_ini:
+		return
+	names = set(config_ini['MOTORS.PIN'])
+	for section in ('MOTORS.ROTATION', 'MOTORS.POSITION'):
+		if section in config_ini and set(config_ini[section]) != names:
+			raise Exception("Configuration is corrupted => section {!s} has "
+							"to list the same motors as MOTORS.PIN ({!s})"
+							.format(section, sorted(names)))
+	pins = list(config_ini['MOTORS.PIN'].values())
+	if len(set(pins)) != len(pins):
+		raise Exception("Configuration is corrupted => a pin is used by more "
+						"than one motor: {!s}".format(pins))
+
+
 config = configparser.ConfigParser()
 # TODO: find a better place for the config.ini file
 config.read(os.path.dirname(__file__) + '/config.ini')
@@ -76,52 +177,49 @@ def get_min_throttle():
 	return int(config['ESC']['minimum'])
 
 
-def get_motor_front_left_pin():
-	""" Returns the pin number (BMC) of the 1st motor (front left) """
-	return int(config['MOTORS.PIN']['motorfrontleft'])
+def get_esc_protocol():
+	""" Returns the output protocol of the ESCs (pwm, oneshot125, multishot
+	or dshot150) """
+	return config['ESC']['protocol'].lower()
 
 
-def get_motor_front_right_pin():
-	""" Returns the pin number (BMC) of the 2nd motor (front right) """
-	return int(config['MOTORS.PIN']['motorfrontright'])
+def get_esc_rate():
+	""" Returns the rate (Hz) the wave protocols are sent at """
+	return int(config['ESC']['rate'])
 
 
-def get_motor_rear_left_pin():
-	""" Returns the pin number (BMC) of the 4th motor (rear left) """
-	return int(config['MOTORS.PIN']['motorrearleft'])
+# positions of the quad X motors if MOTORS.POSITION is not given
+_QUAD_X_POSITIONS = {'motorfrontleft': -45.0, 'motorfrontright': 45.0,
+					'motorrearright': 135.0, 'motorrearleft': 225.0}
 
 
-def get_motor_rear_right_pin():
-	""" Returns the pin number (BMC) of the 3rd motor (rear right) """
-	return int(config['MOTORS.PIN']['motorrearright'])
+def get_motor_names():
+	""" Returns the names of all motors (in the order of MOTORS.PIN) """
+	return list(config['MOTORS.PIN'])
 
 
-def get_motor_front_left_rotation_is_cw():
-	""" Returns True or False if the rotation of the 1st motor (front left) is
-	clockwise """
-	rotation_str = config['MOTORS.ROTATION']['motorfrontleft'].lower()
-	return bool(True if rotation_str == 'cw' else False)
+def get_motor_pin(name):
+	""" Returns the pin number (BMC) of the motor """
+	return int(config['MOTORS.PIN'][name])
 
 
-def get_motor_front_right_rotation_is_cw():
-	""" Returns True or False if the rotation of the 2nd motor (front right) is
-	clockwise """
-	rotation_str = config['MOTORS.ROTATION']['motorfrontright'].lower()
+def get_motor_rotation_is_cw(name):
+	""" Returns True or False if the rotation of the motor is clockwise """
+	rotation_str = config['MOTORS.ROTATION'][name].lower()
 	return bool(True if rotation_str == 'cw' else False)
 
 
-def get_motor_rear_right_rotation_is_cw():
-	""" Returns True or False if the rotation of the 3rd motor (rear right) is
-	clockwise """
-	rotation_str = config['MOTORS.ROTATION']['motorrearright'].lower()
-	return bool(True if rotation_str == 'cw' else False)
-
-
-def get_motor_rear_left_rotation_is_cw():
-	""" Returns True or False if the rotation of the 4th motor (rear left) is
-	clockwise """
-	rotation_str = config['MOTORS.ROTATION']['motorrearleft'].lower()
-	return bool(True if rotation_str == 'cw' else False)
+def get_motor_position(name):
+	""" Returns the position of the motor - angle in degrees from the front,
+	clockwise seen from above. Without MOTORS.POSITION the motors of the
+	quad X keep their places - other motors are spread evenly (clockwise in
+	the order of MOTORS.PIN, the first one right of the front). """
+	if 'MOTORS.POSITION' in config:
+		return float(config['MOTORS.POSITION'][name])
+	names = get_motor_names()
+	if set(names) == set(_QUAD_X_POSITIONS):
+		return _QUAD_X_POSITIONS[name]
+	return 360.0 / len(names) * (names.index(name) + 0.5)
 
 
 def get_log_level():
@@ -149,6 +247,34 @@ def get_log_output_file():
 	return str(config['LOG']['outputfile'])
 
 
+def get_log_queue_size():
+	""" Returns how many log records may wait for the writer thread """
+	return int(config['LOG']['queuesize'])
+
+
+def get_log_repeat_window():
+	""" Returns the time (s) within which identical log messages are
+	collapsed """
+	return float(config['LOG']['repeatwindow'])
+
+
+def get_realtime_enabled():
+	""" Returns True if the control loop should run in real-time mode
+	(frozen heap, garbage collection in idle slots only) """
+	return config['REALTIME'].getboolean('enabled')
+
+
+def get_realtime_idle_budget():
+	""" Returns the minimal idle slot (ms) a garbage collection may run in """
+	return float(config['REALTIME']['idlebudget'])
+
+
+def get_realtime_force_limit():
+	""" Returns the number of new objects after which the youngest
+	generation is collected even without an idle slot """
+	return int(config['REALTIME']['forcelimit'])
+
+
 def get_pigpiod_sample_rate():
 	""" Returns the pigpiod sample rate (int) which should be used when
 	starting the daemon """
@@ -156,8 +282,15 @@ def get_pigpiod_sample_rate():
 
 
 def get_gyrosensor_address():
-	""" Returns a int of the hexadecimal address value """
-	return int(config['GYRO']['address'], 16)
+	""" Returns a int of the hexadecimal address value - the first (primary)
+	one if there are more IMUs """
+	return get_gyrosensor_addresses()[0]
+
+
+def get_gyrosensor_addresses():
+	""" Returns the addresses (ints) of all IMUs - the first is the
+	primary one (DMP, interrupt pin) """
+	return _parse_addresses(config['GYRO']['address'])
 
 
 def get_gyrosensor_tilt_front_axis():
@@ -172,13 +305,256 @@ def get_gyrosensor_tilt_left_axis():
 	return str(config['GYRO']['tiltleft'])
 
 
+def get_gyrosensor_mounting():
+	""" Returns the sensor to body rotation (3x3 matrix) of tiltfront and
+	tiltleft (see autopylot.orientation) """
+	return autopylot.orientation.mounting_matrix(
+		get_gyrosensor_tilt_front_axis(), get_gyrosensor_tilt_left_axis())
+
+
+def get_gyrosensor_sample_rate():
+	""" Returns the sample rate (Hz) of the gyrosensor - the filters are
+	designed for this rate as well """
+	return int(config['GYRO']['samplerate'])
+
+
+def get_gyrosensor_interrupt_pin():
+	""" Returns the pin number (BCM) connected to the INT pin of the
+	gyrosensor (data ready interrupt) """
+	return int(config['GYRO']['intpin'])
+
+
+def get_gyrosensor_mode():
+	""" Returns 'raw' (fusion on the Pi) or 'dmp' (fusion by the DMP of the
+	gyrosensor) """
+	return str(config['GYRO']['mode']).lower()
+
+
+def get_gyrosensor_accel_range():
+	""" Returns the full scale (±g) of the accelerometer """
+	return int(config['GYRO']['accelrange'])
+
+
+def get_gyrosensor_gyro_range():
+	""" Returns the full scale (±°/s) of the gyroscope """
+	return int(config['GYRO']['gyrorange'])
+
+
+def get_redundancy_gyro_tolerance():
+	""" Returns the max deviation (°/s) of a gyro sample from the vote of
+	the IMUs before it is rejected """
+	return float(config['REDUNDANCY']['gyrotolerance'])
+
+
+def get_redundancy_accel_tolerance():
+	""" Returns the max deviation (m/s²) of an accel sample from the vote
+	of the IMUs before it is rejected """
+	return float(config['REDUNDANCY']['acceltolerance'])
+
+
+def get_redundancy_stuck_limit():
+	""" Returns the number of unchanged samples in a row after which an IMU
+	counts as stuck (and is isolated) """
+	return int(config['REDUNDANCY']['stucklimit'])
+
+
+def get_redundancy_isolate_limit():
+	""" Returns the number of rejected samples in a row after which an IMU
+	is isolated """
+	return int(config['REDUNDANCY']['isolatelimit'])
+
+
+def get_redundancy_recover_limit():
+	""" Returns the number of consistent samples in a row after which an
+	isolated IMU is used again """
+	return int(config['REDUNDANCY']['recoverlimit'])
+
+
+def get_calibration_cache_file():
+	""" Returns the filename of the (IMU) calibration cache """
+	return str(config['CALIBRATION']['cachefile'])
+
+
+def get_calibration_bin_width():
+	""" Returns the width (in °C) of the temperature bins of the
+	calibration cache """
+	return float(config['CALIBRATION']['binwidth'])
+
+
+def get_gyro_filter_spec():
+	""" Returns the filter stages (string) for the gyroscope data """
+	return str(config['FILTER']['gyro'])
+
+
+def get_accel_filter_spec():
+	""" Returns the filter stages (string) for the acceleration data """
+	return str(config['FILTER']['accel'])
+
+
+def get_vibration_window():
+	""" Returns the number of gyro samples of one vibration analysis """
+	return int(config['VIBRATION']['window'])
+
+
+def get_vibration_interval():
+	""" Returns the number of gyro samples between two vibration
+	analysis passes """
+	return int(config['VIBRATION']['interval'])
+
+
+def get_vibration_min_frequency():
+	""" Returns the lowest frequency (Hz) considered a vibration """
+	return float(config['VIBRATION']['minfrequency'])
+
+
+def get_vibration_budget():
+	""" Returns the max. time (in seconds) one analysis pass may take """
+	return float(config['VIBRATION']['budget']) / 1000
+
+
+def get_failsafe_timeout():
+	""" Returns the time (ms) without a heartbeat of the control loop after
+	which the failsafe stops the motors """
+	return int(config['FAILSAFE']['timeout'])
+
+
+def get_magnetometer_type():
+	""" Returns the type of the magnetometer (hmc5883l, qmc5883l or none) """
+	return str(config['MAGNETOMETER']['type']).lower()
+
+
+def get_magnetometer_address():
+	""" Returns a int of the hexadecimal address value """
+	return int(config['MAGNETOMETER']['address'], 16)
+
+
+def get_magnetometer_rate():
+	""" Returns the rate (Hz) the magnetometer is read at """
+	return float(config['MAGNETOMETER']['rate'])
+
+
+def get_barometer_type():
+	""" Returns the type of the barometer (bmp280 or none) """
+	return str(config['BAROMETER']['type']).lower()
+
+
+def get_barometer_address():
+	""" Returns a int of the hexadecimal address value """
+	return int(config['BAROMETER']['address'], 16)
+
+
+def get_barometer_rate():
+	""" Returns the rate (Hz) the barometer is read at """
+	return float(config['BAROMETER']['rate'])
+
+
+def get_estimator_sample_count():
+	""" Returns the number of samples (at rest) the dead zone filters of the
+	estimator are set up with """
+	return int(config['ESTIMATOR']['samplecount'])
+
+
+def get_estimator_dead_zone_blur():
+	""" Returns the factor the dead zones are widened by (0.2 = 20%) """
+	return float(config['ESTIMATOR']['deadzoneblur'])
+
+
+def get_tracing_enabled():
+	""" Returns True if the motor commands should be traced (latency) """
+	return config['TRACING'].getboolean('enabled')
+
+
+def get_tracing_capacity():
+	""" Returns the number of commands the tracer keeps (the oldest are
+	overwritten) """
+	return int(config['TRACING']['capacity'])
+
+
+def get_profiler_rate():
+	""" Returns the rate (Hz) the sampling profiler captures the stacks """
+	return float(config['PROFILER']['rate'])
+
+
+def get_profiler_output_file():
+	""" Returns the file the profile (collapsed stacks) is written to """
+	return config['PROFILER']['outputfile']
+
+
+def get_profiler_socket():
+	""" Returns the path of the control socket of the profiler """
+	return config['PROFILER']['socket']
+
+
+def get_remote_address():
+	""" Returns the address the remote control receiver binds to """
+	return config['REMOTE']['address']
+
+
+def get_remote_port():
+	""" Returns the UDP port of the remote control link """
+	return int(config['REMOTE']['port'])
+
+
+def get_remote_rate():
+	""" Returns the rate (Hz) the remote setpoints are applied at """
+	return float(config['REMOTE']['rate'])
+
+
+def get_remote_link_timeout():
+	""" Returns the time (ms) without a valid setpoint until the link is
+	lost """
+	return int(config['REMOTE']['linktimeout'])
+
+
+def get_remote_max_age():
+	""" Returns the delay (ms) after which a setpoint is dropped as stale """
+	return int(config['REMOTE']['maxage'])
+
+
+def get_remote_link_loss_action():
+	""" Returns the action on a loss of link (hover, land or disarm) """
+	return config['REMOTE']['linkloss'].lower()
+
+
+def get_remote_land_rate():
+	""" Returns how fast (%/s) the throttle is lowered to land """
+	return float(config['REMOTE']['landrate'])
+
+
+def get_telemetry_enabled():
+	""" Returns True if the telemetry should be sent """
+	return config['TELEMETRY'].getboolean('enabled')
+
+
+def get_telemetry_address():
+	""" Returns where the telemetry is sent to - host:port (UDP) or the path
+	of a Unix datagram socket """
+	return config['TELEMETRY']['address']
+
+
+def get_telemetry_encoding():
+	""" Returns the telemetry encoding (delta or quantized) """
+	return config['TELEMETRY']['encoding'].lower()
+
+
+def get_telemetry_keyframe_interval():
+	""" Returns after how many (delta) frames a full frame is sent """
+	return int(config['TELEMETRY']['keyframeinterval'])
+
+
+def get_telemetry_rate(channel):
+	""" Returns the rate (Hz) of the telemetry channel (0 = off) """
+	return float(config['TELEMETRY'][channel])
+
+
 # configure the logging module (so all other modules are already
-# configured for logging)
+# configured for logging) - the records are written by a background thread
 log_level = get_log_level()
 log_output_file = get_log_output_file()
-logging.basicConfig(filename=log_output_file, level=log_level,
-					format="[%(asctime)s.%(msecs)03d] %(levelname)s "
-					"[%(name)s.%(funcName)s:%(lineno)d] %(message)s",
-					datefmt="%Y-%m-%d %H:%M:%S", )
+log_writer = autopylot.logqueue.configure(
+	log_output_file, log_level,
+	"[%(asctime)s.%(msecs)03d] %(levelname)s "
+	"[%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+	"%Y-%m-%d %H:%M:%S", get_log_queue_size(), get_log_repeat_window())
 
 # vim: tabstop=4 shiftwidth=4 noexpandtab
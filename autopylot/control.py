@@ -10,14 +10,20 @@ import logging
 import subprocess
 import enum
 import functools
+import contextlib
 
 # pip installed modules
 import psutil
+import numpy
 # import mpu6050
 import pigpio
 
 # my modules
 import autopylot.config
+import autopylot.frame
+import autopylot.failsafe
+import autopylot.tracing
+import autopylot.esc
 
 ###############################################################################
 # PRINCIPLE OF BEHAVIOR
@@ -47,7 +53,7 @@ class Motor():
 	already used by the Quadcopter class which will handle this """
 
 	def __init__(self, pi, pin, cw_rotation, start_signal, stop_signal,
-				min_throttle, max_throttle):
+				min_throttle, max_throttle, recorder=None, output=None):
 		if not pi:
 			raise Exception("Pi = None. Unable to take control over the motor")
 		self.pi = pi
@@ -63,6 +69,11 @@ class Motor():
 															self.max_throttle)
 		# the callback return object - do not change this - it is private!
 		self._gpio_callback = None
+		# optional FlightRecorder (autopylot.replay) for the motor commands
+		self._recorder = recorder
+		# ESC protocol (autopylot.esc) - the pulsewidths are sent through it
+		self.output = output if output is not None \
+			else autopylot.esc.PwmOutput(pi)
 		logging.info("Created new instance of {!s} class with following "
 					"attributes: {!s}".format(self.__class__.__name__,
 											self.__dict__))
@@ -74,21 +85,23 @@ class Motor():
 		""" Wrapper to verify that the motor is started - should be used
 		on functions / methods which send signals to the ESC """
 
-		def wrapper(self, *args):
+		@functools.wraps(func)
+		def wrapper(self, *args, **kwargs):
 			if not self._started:
 				raise Exception("Motor was not started (no start signal sent)."
 								" This could lead to damage of the hardware / "
 								"electronics or your environment.")
-			return func(self, *args)
+			return func(self, *args, **kwargs)
 		return wrapper
 
 	def check_throttle_change(func):
 		""" Wrapper to warn the user if the throttle change is too harsh
 		/ fast / could damage the motors """
 
-		def wrapper(self, *args):
+		@functools.wraps(func)
+		def wrapper(self, *args, **kwargs):
 			before_change = self.current_throttle
-			res = func(self, *args)
+			res = func(self, *args, **kwargs)
 			after_change = self.current_throttle
 			total_change = abs(before_change - after_change)
 			# total_change_perc = total_change * 100 / before_change
@@ -110,15 +123,21 @@ class Motor():
 		This is used to check if the communication is stable """
 		if self._gpio_callback is not None:
 			return
+		if self.output.waves:
+			# the wave protocols toggle the pin far too often for a
+			# callback on each edge
+			return
 
 		def callback_func(gpio, level, tick):
 			""" Callback for the gpio pin of the Motor. At the moment only
 			used to log timeout signals from the pigpio watchdog """
 			if level == pigpio.TIMEOUT:
+				# no tick in the message - so a burst of timeouts is
+				# collapsed by the log writer (autopylot.logqueue)
 				logging.warning("Timeout event triggered from watchdog on "
-								"pin: {!s} (tick: {!s}). Check the motor "
+								"pin: {!s}. Check the motor "
 								"responsiveness or adjust the watchdog."
-								.format(gpio, tick))
+								.format(gpio))
 
 		self._gpio_callback = self.pi.callback(self.pin, pigpio.EITHER_EDGE,
 											callback_func)
@@ -193,7 +212,7 @@ class Motor():
 		if self._started:
 			return False
 		try:
-			self.pi.set_servo_pulsewidth(self.pin, self.start_signal)
+			self.output.set_pulsewidth(self.pin, self.start_signal)
 			self._started = True
 			self._register_gpio_watchdog()
 			self.current_throttle = 0
@@ -213,10 +232,12 @@ class Motor():
 							"receiving stop signal...".format(self.pin))
 
 		try:
-			self.pi.set_servo_pulsewidth(self.pin, self.stop_signal)
+			self.output.set_pulsewidth(self.pin, self.stop_signal)
 			self._started = False
 			self._unregister_gpio_watchdog()
 			self.current_throttle = 0
+			if self._recorder is not None:
+				self._recorder.record_motor_command(self.pin, 0)
 			logging.info("Successfully sent stop signal ({!s}) "
 						"to the pin {!s}".format(self.stop_signal, self.pin))
 			return True
@@ -263,9 +284,11 @@ class Motor():
 		try:
 			actual_throttle_value = self._convert_percent_to_actual_value(
 				throttle)
-			self.pi.set_servo_pulsewidth(self.pin, actual_throttle_value)
+			self.output.set_pulsewidth(self.pin, actual_throttle_value)
 			current_throttle_before = self.current_throttle
 			self.current_throttle = throttle
+			if self._recorder is not None:
+				self._recorder.record_motor_command(self.pin, throttle)
 			logging.info("Successfully adjusted throttle from {!s}% to {!s}% "
 						"on pin {!s}".format(current_throttle_before,
 											self.current_throttle, self.pin))
@@ -277,7 +300,9 @@ class Motor():
 
 
 class Quadcopter():
-	""" Class to control the quadcopter """
+	""" Class to control the multicopter - the motors come from the frame
+	definition in the config.ini (autopylot.frame), so this works for any
+	number of motors (quad, hexa, octo in X or + layout) """
 
 	class TiltSide(enum.Enum):
 		""" Enum to indicate the side which to tilt """
@@ -286,14 +311,13 @@ class Quadcopter():
 		front_left = 3
 		front_right = 4
 
-	class MotorSide(enum.Enum):
-		""" Enum to indicate the motor """
-		front_right = 1
-		rear_right = 2
-		rear_left = 3
-		front_left = 4
+	# direction (degrees, see autopylot.frame) of the tilt sides
+	TILT_DIRECTIONS = {TiltSide.front: autopylot.frame.TILT_FRONT,
+					TiltSide.left: autopylot.frame.TILT_LEFT,
+					TiltSide.front_left: autopylot.frame.TILT_FRONT_LEFT,
+					TiltSide.front_right: autopylot.frame.TILT_FRONT_RIGHT}
 
-	def __init__(self):
+	def __init__(self, recorder=None, tracer=None, telemetry=None):
 		pigpiod_running = self._is_daemon_running()
 		if not pigpiod_running:
 			# self._start_pigpio_daeomon()
@@ -306,54 +330,46 @@ class Quadcopter():
 			raise Exception("Unable to connect to the GPIO pins. Is the daemon running?")
 
 		self.turned_on = False
+		# set once the failsafe cut off the motors - no throttle until
+		# turn_on() re-arms it
+		self.failsafe_tripped = False
 		self.min_throttle = autopylot.config.get_min_throttle()
 		self.max_throttle = autopylot.config.get_max_throttle()
 		# not sure about this value? Why 1000? Is this not motor specific?
 		# Shouldn't it be configurable?
 		self.start_signal = 1000
 		self.stop_signal = 0
-		self._motor_front_left = self._init_motor(
-			autopylot.config.get_motor_front_left_pin(),
-			autopylot.config.get_motor_front_left_rotation_is_cw())
-		self._motor_front_right = self._init_motor(
-			autopylot.config.get_motor_front_right_pin(),
-			autopylot.config.get_motor_front_right_rotation_is_cw())
-		self._motor_rear_left = self._init_motor(
-			autopylot.config.get_motor_rear_left_pin(),
-			autopylot.config.get_motor_rear_left_rotation_is_cw())
-		self._motor_rear_right = self._init_motor(
-			autopylot.config.get_motor_rear_right_pin(),
-			autopylot.config.get_motor_rear_right_rotation_is_cw())
+		# optional FlightRecorder (autopylot.replay) for the motor commands
+		self.recorder = recorder
+		# optional CommandTracer (autopylot.tracing) - opt-in, see [TRACING]
+		self.tracer = tracer
+		# motor bank - the motors are in the order of the frame arrays
+		self.frame = autopylot.frame.load_frame()
+		# ESC protocol of all motors (pwm or a pigpio wave - see [ESC])
+		self.output = autopylot.esc.create_output(self.pi, self.frame.pins)
+		self.motors = [self._init_motor(pin, spin > 0) for pin, spin
+					in zip(self.frame.pins, self.frame.spin)]
+		# optional TelemetryPublisher (autopylot.telemetry) - the motor
+		# outputs are sent with the heartbeat
+		self.telemetry = telemetry
+		if telemetry is not None:
+			telemetry.attach('motors', self._fill_throttles)
+		# kill switch in the pigpio daemon - armed while the motors are on
+		self.failsafe = autopylot.failsafe.Failsafe(
+			self.pi, {motor.pin: motor.stop_signal
+					for motor in self._for_each_motor()},
+			autopylot.config.get_failsafe_timeout(), self.output.waves)
 
 	def _init_motor(self, pin, cw_rotation):
 		""" Returns an initialized Motor object """
 		return Motor(self.pi, pin, cw_rotation, self.start_signal,
-					self.stop_signal, self.min_throttle, self.max_throttle)
+					self.stop_signal, self.min_throttle, self.max_throttle,
+					self.recorder, self.output)
 
 	def _check_motor_rotations(self):
-		""" Checks if the quadcopter will be able to stay still (rotation should
-		be cw + ccw + cw + ccw) """
-		if (self._motor_front_left.cw_rotation ==
-				self._motor_front_right.cw_rotation):
-			logging.critical("The two front motors should not be rotating "
-							"in the same direction (cw or ccw)")
-			return False
-		if (self._motor_rear_left.cw_rotation ==
-				self._motor_rear_right.cw_rotation):
-			logging.critical("The two rear motors should not be rotating "
-							"in the same direction (cw or ccw)")
-			return False
-		if (self._motor_front_left.cw_rotation ==
-				self._motor_rear_left.cw_rotation):
-			logging.critical("The two left motors (front and rear) should not "
-							"be rotating in the same direction (cw or ccw)")
-			return False
-		if (self._motor_front_right.cw_rotation ==
-				self._motor_rear_right.cw_rotation):
-			logging.critical("The two right motors (front and rear) should "
-							"not be rotating in the same direction "
-							"(cw or ccw)")
-			return False
+		""" Checks if the multicopter will be able to stay still (as many cw
+		as ccw motors - alternating around the frame) """
+		return self.frame.check_rotations()
 
 	def _is_daemon_running(self):
 		""" Searches for the pigpiod daemon process. Returns True if found
@@ -392,19 +408,93 @@ class Quadcopter():
 
 	def _for_each_motor(self):
 		""" Returns a list of all motors where you can iterate over """
-		return [self._motor_rear_left, self._motor_rear_right,
-				self._motor_front_left, self._motor_front_right]
+		return self.motors
+
+	def _begin_command(self, command):
+		""" Returns the trace ID of the command - a new one if the caller
+		did not create it (i.e. at the key press) or None if not traced """
+		if self.tracer is None:
+			return None
+		if command is None:
+			command = self.tracer.begin()
+		return command
+
+	def _mark_mixed(self, command):
+		""" Marks the command as mixed (throttle per motor computed) """
+		if self.tracer is not None:
+			self.tracer.mark(command, autopylot.tracing.MIXED)
+
+	@contextlib.contextmanager
+	def _send_batch(self, command):
+		""" Batch of motor commands (output.batch) which marks the command
+		as submitted right before pigpio gets it and as acknowledged after.
+		A wave protocol only sends the stored pulsewidths when the batch
+		exits - PWM sends each of them at once. """
+		if self.tracer is None:
+			with self.output.batch():
+				yield
+			return
+		if self.output.waves:
+			with self.output.batch():
+				yield
+				self.tracer.mark(command, autopylot.tracing.SUBMITTED)
+		else:
+			self.tracer.mark(command, autopylot.tracing.SUBMITTED)
+			with self.output.batch():
+				yield
+		self.tracer.mark(command, autopylot.tracing.ACKNOWLEDGED)
+
+	def _fill_throttles(self, values):
+		""" telemetry source of the motors channel """
+		for index, motor in enumerate(self.motors):
+			values[index] = motor.current_throttle
+
+	def _check_failsafe(self):
+		""" Returns False if the failsafe cut off the motors. The quad is
+		marked as off then and every motor command is refused until
+		turn_on() re-arms the failsafe. """
+		if not self.failsafe_tripped and self.failsafe.triggered:
+			self.failsafe_tripped = True
+			self.turned_on = False
+			# the script set the stop signals - the motors have to be
+			# started again
+			for motor in self._for_each_motor():
+				motor.send_stop_signal()
+			self.failsafe.disarm()
+		if self.failsafe_tripped:
+			logging.error("Refusing motor command - the failsafe cut off "
+						"the motors, turn them on again first")
+			return False
+		return True
+
+	def heartbeat(self):
+		""" Has to be called by the control loop every tick (at least every
+		failsafe timeout ms) while the motors are on - otherwise the
+		failsafe stops the motors. Returns False if it already did. """
+		alive = self._check_failsafe()
+		if alive:
+			self.failsafe.heartbeat()
+		if self.telemetry is not None:
+			self.telemetry.publish()
+		return alive
 
 	def turn_off(self):
 		""" Sends stop signal to each motor and stops the pigpio.pi object """
 		overall_success = True
 		try:
-			for motor in self._for_each_motor():
-				success = motor.send_stop_signal()
-				if not success:
-					logging.critical("Unable to stop motor: {!s}"
-									.format(motor.__dict__))
-					overall_success = False
+			# stop all motors at once first - the bookkeeping (and logging)
+			# of each motor follows
+			with self.output.batch():
+				for motor in self._for_each_motor():
+					self.output.set_pulsewidth(motor.pin, motor.stop_signal)
+			self.failsafe.disarm()
+			with self.output.batch():
+				for motor in self._for_each_motor():
+					success = motor.send_stop_signal()
+					if not success:
+						logging.critical("Unable to stop motor: {!s}"
+										.format(motor.__dict__))
+						overall_success = False
 			# self.pi.stop()
 			self.turned_on = False
 		except Exception as e:
@@ -414,15 +504,20 @@ class Quadcopter():
 		return overall_success
 
 	def turn_on(self):
-		""" Sends start signal to each motor """
+		""" Sends start signal to each motor - and (re-)arms the failsafe """
 		overall_success = True
 		try:
-			for motor in self._for_each_motor():
-				success = motor.send_start_signal()
-				if not success:
-					logging.critical("Unable to start motor: {!s}"
-									.format(motor.__dict__))
-					overall_success = False
+			if self.failsafe.triggered:
+				self.failsafe.disarm()
+			self.failsafe_tripped = False
+			with self.output.batch():
+				for motor in self._for_each_motor():
+					success = motor.send_start_signal()
+					if not success:
+						logging.critical("Unable to start motor: {!s}"
+										.format(motor.__dict__))
+						overall_success = False
+			self.failsafe.arm()
 			self.turned_on = True
 		except Exception as e:
 			logging.exception("Exception occurred while sending the start "
@@ -430,19 +525,24 @@ class Quadcopter():
 			overall_success = False
 		return overall_success
 
-	def change_overall_throttle(self, throttle):
+	def change_overall_throttle(self, throttle, command=None):
 		""" changes the overall throttle. Valid value is
 		from 0 to 100 """
+		if not self._check_failsafe():
+			return False
+		command = self._begin_command(command)
 		throttle = int(throttle)
 		overall_success = True
 		try:
-			for motor in self._for_each_motor():
-				success = motor.send_throttle(throttle)
-				if not success:
-					logging.critical("Unable to send throttle (%) adjustment "
-									"({!s}) to motor: {!s}"
-									.format(throttle, motor.__dict__))
-					overall_success = False
+			self._mark_mixed(command)
+			with self._send_batch(command):
+				for motor in self._for_each_motor():
+					success = motor.send_throttle(throttle)
+					if not success:
+						logging.critical("Unable to send throttle (%) "
+										"adjustment ({!s}) to motor: {!s}"
+										.format(throttle, motor.__dict__))
+						overall_success = False
 		except Exception as e:
 			logging.exception("Exception occured while sending throttle "
 							"adjustment to the motors: {!s}".format(e))
@@ -458,33 +558,52 @@ class Quadcopter():
 		return total_throttle
 
 
-	def request_throttle(self, motor_side):
-		""" return the throttle value of the motor """
-		if motor_side is self.MotorSide.front_left:
-			return self._motor_front_left.current_throttle
-		elif motor_side is self.MotorSide.front_right:
-			return self._motor_front_right.current_throttle
-		elif motor_side is self.MotorSide.rear_right:
-			return self._motor_rear_right.current_throttle
-		elif motor_side is self.MotorSide.rear_left:
-			return self._motor_rear_left.current_throttle
+	def request_throttle(self, name):
+		""" return the throttle value of the motor (name of the config.ini,
+		like motorfrontleft) """
+		return self.motors[self.frame.index(name)].current_throttle
 
 
-	def hover(self):
+	def _send_mix(self, base_throttle, mix, factor, command, clip=False):
+		""" Sends base_throttle + mix * factor (rounded) to the motors - mix
+		holds the coefficient per motor (a column of the mixing table).
+		With clip the throttles are limited to 0 - 100 (instead of being
+		rejected by the motor). Returns False if a motor did not take its
+		throttle. """
+		throttles = base_throttle + numpy.rint(mix * factor).astype(int)
+		if clip:
+			throttles = numpy.clip(throttles, 0, 100)
+		self._mark_mixed(command)
+		overall_success = True
+		# all motors change in the same frame of a wave protocol
+		with self._send_batch(command):
+			for motor, throttle in zip(self.motors, throttles):
+				if not motor.send_throttle(int(throttle)):
+					overall_success = False
+		return overall_success
+
+
+	def hover(self, command=None):
 		""" Reads the current throttle of each motor and sets them to an equal
 		level so the quadcopter should hover """
+		if not self._check_failsafe():
+			return False
+		command = self._begin_command(command)
 		overall_success = True
 		try:
 			total_throttle = self.request_total_throttle()
 
-			throttle_foreach = int(total_throttle / 4)
-			for motor in self._for_each_motor():
-				success = motor.send_throttle(throttle_foreach)
-				if not success:
-					logging.critical("Unable to send (absolute %) throttle "
-									"({!s}) to motor: {!s}"
-									.format(throttle_foreach, motor.__dict__))
-					overall_success = False
+			throttle_foreach = int(total_throttle / len(self.motors))
+			self._mark_mixed(command)
+			with self._send_batch(command):
+				for motor in self._for_each_motor():
+					success = motor.send_throttle(throttle_foreach)
+					if not success:
+						logging.critical("Unable to send (absolute %) "
+										"throttle ({!s}) to motor: {!s}"
+										.format(throttle_foreach,
+												motor.__dict__))
+						overall_success = False
 
 			if overall_success:
 				assert total_throttle == self.request_total_throttle(), "Total throttle should always stay consistent"
@@ -495,7 +614,7 @@ class Quadcopter():
 
 		return overall_success
 
-	def change_yaw(self, absolute_yaw):
+	def change_yaw(self, absolute_yaw, command=None):
 		""" Change the yaw - valid values are from -100 to 100 where 100 is thehighest possible yawing.
 		If the value is positive it will yaw clockwise and otherwise
 		counterclockwise. """
@@ -506,6 +625,9 @@ class Quadcopter():
 		# motors are already at 100% throttle... the yaw will still work but
 		# not as fast or with a bit of altitude lose
 		# Change each motor independently (because it could be tilted)
+		if not self._check_failsafe():
+			return False
+		command = self._begin_command(command)
 		absolute_yaw = int(absolute_yaw)
 		if absolute_yaw < -100 or absolute_yaw > 100:
 			logging.error("absolute_yaw exceeds +/- 100% ({!s})"
@@ -515,17 +637,12 @@ class Quadcopter():
 		overall_success = True
 		try:
 			total_throttle = self.request_total_throttle()
-			base_throttle = int(total_throttle / 4)
+			base_throttle = int(total_throttle / len(self.motors))
 			factor = int(base_throttle / 100 * absolute_yaw)
-			
-			for motor in self._for_each_motor():
-				new_throttle = None
-				if motor.cw_rotation:
-					new_throttle = base_throttle + factor
-				else:
-					new_throttle = base_throttle - factor
-
-				overall_success = motor.send_throttle(new_throttle)
+			# cw motors speed up, ccw motors slow down
+			overall_success = self._send_mix(base_throttle,
+											self.frame.yaw_mix, factor,
+											command)
 
 			if overall_success:
 				assert total_throttle == self.request_total_throttle(), "Total throttle should always stay consistent"
@@ -537,43 +654,27 @@ class Quadcopter():
 			return False
 		return overall_success
 
-	def change_tilt(self, side, adjustment):
+	def change_tilt(self, side, adjustment, command=None):
 		""" Change the tilt to the given side (front, left, frontleft,
-		frontright) - to use the opposite just use a negative value.
+		frontright - or any direction in degrees, see autopylot.frame) - to
+		use the opposite just use a negative value.
 		Valid values for adjustment: -100 to +100 (100 is maximum tilt).
 		I.e. you want to change tilt to rear you have to send: side=front
 		and a negative adjustment value """
 		# 100% tilt => one side is on full speed - other side is on zero speed
+		if not self._check_failsafe():
+			return False
+		command = self._begin_command(command)
 		adjustment = int(adjustment)
 		overall_success = True
 		try:
 			total_throttle = self.request_total_throttle()
-			base_throttle = int(total_throttle / 4)
+			base_throttle = int(total_throttle / len(self.motors))
 			factor = int(base_throttle / 100 * adjustment)
-
-			if side is self.TiltSide.front:
-				overall_success = self._motor_front_right.send_throttle(base_throttle - factor)
-				overall_success = self._motor_front_left.send_throttle(base_throttle - factor)
-				overall_success = self._motor_rear_right.send_throttle(base_throttle + factor)
-				overall_success = self._motor_rear_left.send_throttle(base_throttle + factor)
-
-			elif side is self.TiltSide.front_left:
-				overall_success = self._motor_front_right.send_throttle(base_throttle)
-				overall_success = self._motor_front_left.send_throttle(base_throttle - factor)
-				overall_success = self._motor_rear_right.send_throttle(base_throttle + factor)
-				overall_success = self._motor_rear_left.send_throttle(base_throttle)
-
-			elif side is self.TiltSide.front_right:
-				overall_success = self._motor_front_right.send_throttle(base_throttle - factor)
-				overall_success = self._motor_front_left.send_throttle(base_throttle)
-				overall_success = self._motor_rear_right.send_throttle(base_throttle)
-				overall_success = self._motor_rear_left.send_throttle(base_throttle + factor)
-			elif side is self.TiltSide.left:
-				overall_success = self._motor_front_right.send_throttle(base_throttle + factor)
-				overall_success = self._motor_front_left.send_throttle(base_throttle - factor)
-				overall_success = self._motor_rear_right.send_throttle(base_throttle + factor)
-				overall_success = self._motor_rear_left.send_throttle(base_throttle - factor)
-	
+			direction = self.TILT_DIRECTIONS.get(side, side)
+			overall_success = self._send_mix(
+				base_throttle, self.frame.tilt_mix(direction), factor,
+				command)
 
 			if overall_success:
 				assert total_throttle == self.request_total_throttle(), "Total throttle should always stay consistent"
@@ -583,4 +684,33 @@ class Quadcopter():
 			overall_success = False
 		return overall_success
 
+	def change_setpoint(self, throttle, roll, pitch, yaw, command=None):
+		""" Sets the overall throttle (0 to 100) together with the roll
+		(right side down), pitch (nose down) and yaw (clockwise) - each -100
+		to 100 like change_tilt and change_yaw. Unlike those the values are
+		absolute (not based on the current throttle), which is what a remote
+		control sends. Throttles beyond 0 - 100 are clipped (the motor at
+		the limit loses the rest of its adjustment). """
+		if not self._check_failsafe():
+			return False
+		command = self._begin_command(command)
+		throttle = int(throttle)
+		if throttle < 0 or throttle > 100:
+			logging.error("throttle exceeds 0 - 100% ({!s})".format(throttle))
+			return False
+		overall_success = True
+		try:
+			mix = (self.frame.tilt_mix(autopylot.frame.TILT_FRONT) *
+				int(throttle / 100 * pitch) -
+				self.frame.tilt_mix(autopylot.frame.TILT_LEFT) *
+				int(throttle / 100 * roll) +
+				self.frame.yaw_mix * int(throttle / 100 * yaw))
+			overall_success = self._send_mix(throttle, mix, 1, command,
+											clip=True)
+		except Exception as e:
+			logging.exception("Exception occured while changing the setpoint: "
+							"{!s}".format(e))
+			overall_success = False
+		return overall_success
+
 # vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,319 @@
+""" DMP (digital motion processor) mode of the MPU-6050. The DMP fuses the
+accel and gyro data on the chip and writes quaternions (plus the raw accel
+and the calibrated gyro data) into the FIFO - so the sensor fusion does not
+cost any CPU time on the Pi. This is a port of the parts of InvenSense's
+motion driver (cpp_rewrite/MotionSensor/inv_mpu_lib) the C++ port uses:
+firmware upload, feature configuration (6-axis quaternion, raw accel,
+calibrated gyro, gyro auto calibration), output rate and FIFO reads.
+
+The bus is smbus like - a ScheduledBus (autopylot.i2cbus) or a FakeI2CBus
+with a FakeDmpDevice (autopylot.fakes) that serves recorded packets. """
+
+import math
+import time
+import struct
+import logging
+import collections
+
+import autopylot.clock
+import autopylot.dmpfirmware
+
+# registers
+_SMPLRT_DIV = 0x19
+_CONFIG = 0x1a
+_FIFO_EN = 0x23
+_INT_ENABLE = 0x38
+_INT_STATUS = 0x3a
+_USER_CTRL = 0x6a
+_BANK_SEL = 0x6d
+_MEM_R_W = 0x6f
+_PRGM_START_H = 0x70
+_FIFO_COUNT_H = 0x72
+_FIFO_R_W = 0x74
+
+# register bits
+BIT_FIFO_RST = 0x04
+BIT_DMP_RST = 0x08
+BIT_FIFO_EN = 0x40
+BIT_DMP_EN = 0x80
+BIT_DMP_INT_EN = 0x02
+BIT_FIFO_OVERFLOW = 0x10
+
+BANK_SIZE = 256
+MAX_FIFO = 1024
+# firmware chunk size - divides the bank size (no bank crossings)
+LOAD_CHUNK = 16
+
+# DMP memory locations (dmpKey.h / inv_mpu_dmp_motion_driver.c)
+D_0_22 = 22 + 512
+D_0_104 = 104
+CFG_6 = 2753
+CFG_8 = 2718
+CFG_15 = 2727
+CFG_20 = 2224
+CFG_27 = 2742
+CFG_LP_QUAT = 2712
+CFG_MOTION_BIAS = 1208
+CFG_ANDROID_ORIENT_INT = 1853
+CFG_GYRO_RAW_DATA = 2722
+
+# the DMP always runs at 200Hz - the FIFO rate is 200Hz / n
+DMP_SAMPLE_RATE = 200
+GYRO_SF = 46850825 * 200 // DMP_SAMPLE_RATE
+
+GRAVITY = 9.80665
+QUATERNION_SCALE = float(1 << 30)
+# a quaternion has to have a length of 1 - the FIFO is misaligned if not
+# (q14 fixed point: 1 << 28 is a squared length of 1)
+_QUAT_MAG_SQ_NORMALIZED = 1 << 28
+_QUAT_ERROR_THRESH = 1 << 24
+
+_QUATERNION_FORMAT = struct.Struct('>4i')
+_VECTOR_FORMAT = struct.Struct('>3h')
+
+# quaternion (w, x, y, z), accel (x, y, z) in m/s², gyro (x, y, z) in °/s
+DmpPacket = collections.namedtuple('DmpPacket',
+								['quaternion', 'accel', 'gyro'])
+
+
+def pack_packet(quaternion, accel=None, gyro=None, accel_scale=4096.0,
+				gyro_scale=16.4):
+	""" Returns the FIFO packet (bytes) the DMP writes for the values -
+	quaternion (w, x, y, z), accel in m/s² and gyro in °/s (None = feature
+	disabled) """
+	data = _QUATERNION_FORMAT.pack(*(int(round(value * QUATERNION_SCALE))
+									for value in quaternion))
+	if accel is not None:
+		data += _VECTOR_FORMAT.pack(*(int(round(value / GRAVITY * accel_scale))
+									for value in accel))
+	if gyro is not None:
+		data += _VECTOR_FORMAT.pack(*(int(round(value * gyro_scale))
+									for value in gyro))
+	return data
+
+
+def quaternion_to_euler(quaternion):
+	""" Returns (yaw, pitch, roll) in degrees of the quaternion (w, x, y, z)
+	- the same conversion the C++ port uses (via the gravity vector) """
+	w, x, y, z = quaternion
+	gravity_x = 2 * (x * z - w * y)
+	gravity_y = 2 * (w * x + y * z)
+	gravity_z = w * w - x * x - y * y + z * z
+	yaw = math.atan2(2 * x * y - 2 * w * z, 2 * w * w + 2 * x * x - 1)
+	pitch = math.atan2(gravity_x, math.hypot(gravity_y, gravity_z))
+	roll = math.atan2(gravity_y, math.hypot(gravity_x, gravity_z))
+	return math.degrees(yaw), math.degrees(pitch), math.degrees(roll)
+
+
+class Dmp():
+	""" Controls the DMP of the MPU-6050 at address. The scales convert the
+	raw accel (LSB/g) and gyro (LSB/°/s) values - they have to match the
+	configured ranges (default: ±8g and ±2000°/s like the SensorData). """
+
+	def __init__(self, bus, address=0x68, accel_scale=4096.0,
+				gyro_scale=16.4):
+		self.bus = bus
+		self.address = address
+		self.accel_scale = accel_scale
+		self.gyro_scale = gyro_scale
+		self.loaded = False
+		self.enabled = False
+		self.rate = None
+		self.quaternion = False
+		self.send_accel = False
+		self.send_gyro = False
+		self.packet_length = 0
+		self.corrupted = 0
+		self.overflows = 0
+
+	def write_memory(self, memory_address, data):
+		""" Writes the bytes to the DMP memory - within one bank """
+		bank, start = memory_address >> 8, memory_address & 0xff
+		if start + len(data) > BANK_SIZE:
+			raise Exception("DMP memory write at {!s} crosses a bank "
+							"boundary".format(memory_address))
+		self.bus.write_i2c_block_data(self.address, _BANK_SEL, [bank, start])
+		self.bus.write_i2c_block_data(self.address, _MEM_R_W, list(data))
+
+	def read_memory(self, memory_address, length):
+		""" Reads length bytes of the DMP memory - within one bank """
+		bank, start = memory_address >> 8, memory_address & 0xff
+		if start + length > BANK_SIZE:
+			raise Exception("DMP memory read at {!s} crosses a bank "
+							"boundary".format(memory_address))
+		self.bus.write_i2c_block_data(self.address, _BANK_SEL, [bank, start])
+		return bytes(self.bus.read_i2c_block_data(self.address, _MEM_R_W,
+												length))
+
+	def load_firmware(self, firmware=autopylot.dmpfirmware.FIRMWARE,
+					start_address=autopylot.dmpfirmware.START_ADDRESS):
+		""" Uploads the firmware - every chunk is read back and verified.
+		The firmware can only be loaded once. """
+		if self.loaded:
+			raise Exception("DMP firmware is already loaded")
+		start_time = time.perf_counter()
+		for offset in range(0, len(firmware), LOAD_CHUNK):
+			chunk = firmware[offset:offset + LOAD_CHUNK]
+			self.write_memory(offset, chunk)
+			if self.read_memory(offset, len(chunk)) != bytes(chunk):
+				raise Exception("DMP firmware verification failed at {!s}"
+								.format(offset))
+		self.bus.write_i2c_block_data(self.address, _PRGM_START_H,
+									[start_address >> 8,
+									start_address & 0xff])
+		self.loaded = True
+		logging.info("Loaded the DMP firmware ({!s} bytes) in {:.0f}ms"
+					.format(len(firmware),
+							(time.perf_counter() - start_time) * 1000))
+
+	def configure(self, quaternion=True, accel=True, gyro=True,
+				gyro_calibration=True):
+		""" Enables the features - 6-axis quaternion, raw accel, (calibrated)
+		gyro and the gyro auto calibration (bias after 8s at rest) """
+		self.write_memory(D_0_104, GYRO_SF.to_bytes(4, 'big'))
+		# send sensor data to the FIFO
+		self.write_memory(CFG_15, [0xa3] +
+						([0xc0, 0xc8, 0xc2] if accel else [0xa3] * 3) +
+						([0xc4, 0xcc, 0xc6] if gyro else [0xa3] * 3) +
+						[0xa3] * 3)
+		# no gestures (tap, android orientation)
+		self.write_memory(CFG_27, [0xd8])
+		self.write_memory(CFG_20, [0xd8])
+		self.write_memory(CFG_ANDROID_ORIENT_INT, [0xd8])
+		if gyro_calibration:
+			self.write_memory(CFG_MOTION_BIAS, [0xb8, 0xaa, 0xb3, 0x8d, 0xb4,
+												0x98, 0x0d, 0x35, 0x5d])
+		else:
+			self.write_memory(CFG_MOTION_BIAS, [0xb8, 0xaa, 0xaa, 0xaa, 0xb0,
+												0x88, 0xc3, 0xc5, 0xc7])
+		if gyro:
+			if gyro_calibration:
+				self.write_memory(CFG_GYRO_RAW_DATA, [0xb2, 0x8b, 0xb6, 0x9b])
+			else:
+				self.write_memory(CFG_GYRO_RAW_DATA, [0xb0, 0x80, 0xb4, 0x90])
+		# 3-axis (gyro only) quaternion off, 6-axis quaternion on / off
+		self.write_memory(CFG_LP_QUAT, [0x8b] * 4)
+		self.write_memory(CFG_8, [0x20, 0x28, 0x30, 0x38] if quaternion
+						else [0xa3] * 4)
+
+		self.quaternion = quaternion
+		self.send_accel = accel
+		self.send_gyro = gyro
+		self.packet_length = (16 * quaternion) + (6 * accel) + (6 * gyro)
+		if self.enabled:
+			self.reset_fifo()
+
+	def set_rate(self, rate):
+		""" Sets the FIFO output rate (Hz) - 200Hz / n """
+		if rate <= 0 or rate > DMP_SAMPLE_RATE:
+			raise Exception("DMP rate {!s}Hz has to be between 1 and {!s}Hz"
+							.format(rate, DMP_SAMPLE_RATE))
+		divider = DMP_SAMPLE_RATE // rate - 1
+		self.write_memory(D_0_22, divider.to_bytes(2, 'big'))
+		self.write_memory(CFG_6, [0xfe, 0xf2, 0xab, 0xc4, 0xaa, 0xf1, 0xdf,
+								0xdf, 0xbb, 0xaf, 0xdf, 0xdf])
+		self.rate = DMP_SAMPLE_RATE / (divider + 1)
+
+	def enable(self):
+		""" Starts the DMP - the sensor samples at the fixed DMP rate and the
+		INT pin signals every FIFO packet """
+		if not self.loaded:
+			raise Exception("DMP firmware is not loaded")
+		self.bus.write_byte_data(self.address, _INT_ENABLE, 0x00)
+		self.bus.write_byte_data(self.address, _CONFIG, 0x02)  # DLPF 98Hz
+		self.bus.write_byte_data(self.address, _SMPLRT_DIV,
+								1000 // DMP_SAMPLE_RATE - 1)
+		self.bus.write_byte_data(self.address, _FIFO_EN, 0x00)
+		self.enabled = True
+		self.reset_fifo()
+		logging.info("Enabled the DMP ({!s}Hz, {!s} bytes per packet)"
+					.format(self.rate, self.packet_length))
+
+	def disable(self):
+		""" Stops the DMP (and the FIFO) """
+		self.bus.write_byte_data(self.address, _INT_ENABLE, 0x00)
+		self.bus.write_byte_data(self.address, _USER_CTRL, 0x00)
+		self.enabled = False
+
+	def reset_fifo(self):
+		""" Resets the FIFO (and the DMP) - the packets in it are lost """
+		self.bus.write_byte_data(self.address, _INT_ENABLE, 0x00)
+		self.bus.write_byte_data(self.address, _FIFO_EN, 0x00)
+		self.bus.write_byte_data(self.address, _USER_CTRL, 0x00)
+		self.bus.write_byte_data(self.address, _USER_CTRL,
+								BIT_FIFO_RST | BIT_DMP_RST)
+		autopylot.clock.sleep(0.05)
+		self.bus.write_byte_data(self.address, _USER_CTRL,
+								BIT_DMP_EN | BIT_FIFO_EN)
+		self.bus.write_byte_data(self.address, _INT_ENABLE, BIT_DMP_INT_EN)
+
+	def fifo_count(self):
+		""" Returns the number of bytes in the FIFO """
+		high, low = self.bus.read_i2c_block_data(self.address, _FIFO_COUNT_H,
+												2)
+		return (high << 8) | low
+
+	def read_packets(self, limit=None):
+		""" Reads the (complete) packets in the FIFO - at most limit. Returns
+		a list of DmpPackets. On an overflow or a corrupted packet the FIFO
+		is reset and the remaining packets are dropped. """
+		if not self.enabled or not self.packet_length:
+			raise Exception("DMP is not enabled")
+		count = self.fifo_count()
+		if count > MAX_FIFO // 2:
+			# half full - better check for an overflow
+			status = self.bus.read_byte_data(self.address, _INT_STATUS)
+			if status & BIT_FIFO_OVERFLOW:
+				self.overflows += 1
+				logging.warning("DMP FIFO overflow - resetting the FIFO")
+				self.reset_fifo()
+				return []
+		available = count // self.packet_length
+		if limit is not None:
+			available = min(available, limit)
+		packets = []
+		for _ in range(available):
+			data = bytes(self.bus.read_i2c_block_data(
+				self.address, _FIFO_R_W, self.packet_length))
+			packet = self.decode(data)
+			if packet is None:
+				self.corrupted += 1
+				logging.warning("Corrupted DMP packet - resetting the FIFO")
+				self.reset_fifo()
+				break
+			packets.append(packet)
+		return packets
+
+	def decode(self, data):
+		""" Returns the DmpPacket of the FIFO data - or None if the
+		quaternion is not normalized (misaligned FIFO) """
+		offset = 0
+		quaternion = None
+		accel = None
+		gyro = None
+		if self.quaternion:
+			raw = _QUATERNION_FORMAT.unpack_from(data, 0)
+			magnitude = sum((value >> 16) ** 2 for value in raw)
+			if abs(magnitude - _QUAT_MAG_SQ_NORMALIZED) > _QUAT_ERROR_THRESH:
+				return None
+			quaternion = tuple(value / QUATERNION_SCALE for value in raw)
+			offset += 16
+		if self.send_accel:
+			accel = tuple(value / self.accel_scale * GRAVITY for value in
+						_VECTOR_FORMAT.unpack_from(data, offset))
+			offset += 6
+		if self.send_gyro:
+			gyro = tuple(value / self.gyro_scale for value in
+						_VECTOR_FORMAT.unpack_from(data, offset))
+		return DmpPacket(quaternion, accel, gyro)
+
+	def start(self, rate):
+		""" Loads the firmware (if not done yet), enables all features,
+		sets the rate and enables the DMP """
+		if not self.loaded:
+			self.load_firmware()
+		self.configure()
+		self.set_rate(rate)
+		self.enable()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,119 @@
+""" Firmware image of the MPU-6050 DMP (InvenSense motion driver) - the
+same image the C++ port uploads, taken from
+cpp_rewrite/MotionSensor/inv_mpu_lib/inv_mpu_dmp_motion_driver.c """
+
+# DMP program start address
+START_ADDRESS = 0x0400
+
+FIRMWARE = bytes.fromhex(
+	# bank 0
+	'0000700000000024000000020003000000650054ffef0000fa80000b12820001'
+	'030c30c30e8c8ce914d5400213710f8e3883f8833000f883258ef8833000f883'
+	'ffffffff0ffea9d6240004001a8279a10000003cffff00000010000038836fa2'
+	'003e03304000000002cae3093e80000020000000000000004000000060000000'
+	'000c0000000c186e000006920a16c0dfffff0256fd8cd377ffe1c496e0c5beaa'
+	'00000000ffff0b2b00001657000003594000000000001dfa00026c1d00000000'
+	'3fffdfeb003eb3b6000d227800002f3c00000000001942b5000039a20000b365'
+	'd90e9fc91dcf4c3430000000500000003bb67ae80064000000c8000000000000'
+	# bank 1
+	'100000001000fa921000225e000d229f0001000000320000ff46000063d40000'
+	'1000000004d6000004cc000004cc000000001072000000400000000000000000'
+	'0006000200050007000000000064000000000000000000050005006400200000'
+	'0000000000000000000040000000030000000032f8980000ff650000830f0000'
+	'ff9bfc0000000000000000000000000000000000000000000000000000000000'
+	'0000000000000000000000000000100040000000000000060000b26a00020000'
+	'0001fb830068000000d9fc007cf1ff830000000000650000006403e800640028'
+	'000000250000000016a000000000100000001000002f0000000001f400001000'
+	# bank 2
+	'00280000ffff4581fffffa720000000000000000004400050005bac6004778a2'
+	'000000010000000000000600000000140000254d002f706d000005ae000c02d0'
+	'00000000000000000000000000000000001b0000000000000000000000000000'
+	'0064000000080000000000000000000000000000000000000000000000000000'
+	'0000000000000000000000000000000000000000000000000000000000000000'
+	'0000000000000000000000000000000000000000000000000000000000000000'
+	'001b00000000000000000000000e000e00000ac70004000000000032ffffff9c'
+	'00000b2b000000020000000100000064ffe50000000000000000000000000000'
+	# bank 3
+	'00000001000000000001000000000000000180000001800000018000002426d3'
+	'0000000000000000000600100096003c00000000000000000000000000000000'
+	'0c0a4e68cdcf770950166759c619ce8200000000000000000000000000000000'
+	'000000000000000017d78400030000000000000000000000c7938f9d1e1b1c19'
+	'0000000000000000000000000000000000000000000000000203188500004000'
+	'0000000300000003000000000000000040000000000000000000000000000000'
+	'0000000000000000000000000000000000000000000000000000000000000000'
+	'00000000677ddf7e72902e554cf6e68800000000000000000000000000000000'
+	# bank 4
+	'd8dcb4b8b0d8b9abf3f8fab3b7bb8e9eaef132f51bf1b4b8b08097f1a9dfdfdf'
+	'aadfdfdff2aac5cdc7a90cc92c97f1a989264666b28999a92d557db0b08aa896'
+	'365676f1baa3b4b280c0b8a89711b28398baa3f0240844106418b2b9b49883f1'
+	'a329557dbab5b1a38393f0002850f5b2b6aa839328547cf1b9a3829361baa2da'
+	'dedfdb819ab9aef5606870f1dabaa2dfd9baa2fab9a38292db31baa2d9baa2f8'
+	'df85a4d0c1bbad83c2c5c7b8a2dfdfdfbaa0dfdfdfd8d8f1b8aab38db4980d35'
+	'5db2b6baaf8c96198f9fa70e161eb49ab8aa872c547cbaa4b08ab691325676b2'
+	'8494a4c808cdd8b8b4b0f19982a82d557d98a80e161ea22c547c92a4f02c5078'
+	# bank 5
+	'f184a898c4cdfcd80ddba8fc2df3d9baa6f8dabaa6ded8bab2b68696a6d0f3c8'
+	'41daa6c8f8d8b0b4b882a892f52c548898f135d9f418d8f1a2d0f8f9a884d9c7'
+	'dff8f883c5dadf69df83c1d8f40114f1a8824ea884f311d182f5d992289788f1'
+	'09f41c1cd884a8f3c0f9d1d99782f129f40dd8f3f9f9d1d982f4c203d8dedf1a'
+	'd8f1a2faf9a88498d9c7dff8f8f883c7dadf69dff883c3d8f40114f198a8822e'
+	'a884f311d182f5d992509788f109f41cd884a8f3c0f8f9d1d99782f149f40dd8'
+	'f3f9f9d1d982f4c403d8dedfd8f1ad8898cca809f9d98292a8f57cf1883acf94'
+	'4a6e98db6931daadf2def9d88795a8f221d1daa5f9f417d9f1ae8ed0c0c3ae82'
+	# bank 6
+	'c684c3a88595c8a588f2c0f1f4010ef18e9ea8c63e56f554f18872f40115f198'
+	'45856ef58e9e0488f142985a8e9e068869f4011cf1981e1108d0f504f11e9702'
+	'02983625dbf9d985a5f3c1da85a5f3dfd88595a8f309daa5fad88292a8f578f1'
+	'881a849f26889821daf41df3d8879f39d1afd9dfdffbf9f40cf3d8fad0f8daf9'
+	'f9d0dfd9f9d8f40bd8f3879f39d1afd9dfdff41df3d8fafca869f9f9afd0dade'
+	'fad9f88f9fa8f1ccf398db45d9afdfd0f8d8f18f9fa8caf38809daaf8fcbf8d8'
+	'f2ad978d0cd9a5dff9baa6f3faf412f2d8950dd1d9baa6f3fadaa5f2c1baa6f3'
+	'dfd8f1bab2b68696a6d0caf349daa6cbf8d8b0b4b8d8ad84f2c0dff18fcbc3a8'
+	# bank 7
+	'b2b68696c8c1cbc3f3b0b48898a821db718d9d71859521d9adf2fad88597a828'
+	'd9f408d8f28d29daf405d9f285a4c2f2d8a88d9401d1d9f411f2d88721d8f40a'
+	'd8f28498a8c801d1d9f411d8f3a4c8bbafd0f2def8f8f8f8f8f8f8f8d8f1b8f6'
+	'b5b9b08a95a3de3ca3d9f8d85ca3d9f8d87ca3d9f8d8f8f9d1a5d9dfdafad8b1'
+	'8530f7d9ded8f830addaded8f2b48c99a32d557da083dfdfdfb591a0f629d9fb'
+	'd8a0fc29d9fad8a0d051d9f8d8fc51d9f9d879d9fbd8a0d0fc79d9fad8a1f9f9'
+	'f9f9f9a0dadfdfdfd8a1f8f8f8f8f8acdef8adde8393ac2c547cf1a8dfdfdff6'
+	'9d2cdaa0dfd9fadb2df8d8a850daa0d0ded9d0f8f8f8db55f8d8a878daa0d0df'
+	# bank 8
+	'd9d0faf8f8f8f8db7df8d89ca88cf530db38d9d0dedfa0d0dedfd8a848db58d9'
+	'dfd0dea0dfd0ded8a868db70d9dfdfa0dfdfd8f1a888902c547c98a8d05c38d1'
+	'daf2ae8cdff9d8b087a8c1c1b188a8c6f9f9da36d8a8f9da36d8a8f9da36d8a8'
+	'f9da36d8a8f9da36d8f78d9dadf818daf2aedfd8f7adfa30d9a4def9d8f2aede'
+	'faf983a7d9c3c5c7f1889ba77aadf7dedfa4f8849408a797f300aef29819a488'
+	'c6a39488f632dff28393db09d9f2aadfd8d8aef8f9d1daf3a4dea7f1889b7ad8'
+	'f38494ae19f9daaaf1dfd8a881c0c3c5c7a39283f628added9f8d8a350add9f8'
+	'd8a378add9f8d8f8f9d1a1dadec3c5c7d8a18194f818f2b089acc3c5c7f1d8b8'
+	# bank 9
+	'b4b09786a8319b069907ab9728889bf00c201440b0b4b8f0a88a9a285078b79b'
+	'a8295179247059446938644831f1bbab88002c547cf0b38bb8a804285078f1b0'
+	'88b49726a85998bbabb38b02264666b0b8f08a9ca82951798b2951798a247059'
+	'8b2058718a4469388b3940688a6448318b30496088f1ac002c547cf08ca80428'
+	'5078f1889726a85998ac8c02264666f0899ca8295179247059446938644831a9'
+	'8809205970ab11384069a8193148608ca83c415c207c00f187981986a86e767e'
+	'a999882d557dd8b1b5b9a3dfdfdfaed0dfaad0def2abf8f9d9b087c4aaf1dfdf'
+	'bbafdfdfb9d8b1f1a3978e60dfb084f2c8f8f9d9ded89385f14ab183a308b583'
+	# bank 10
+	'9a0810b79f10d8f1b0baaeb08ac2b2b68e9ef1fbd9f41dd8f9d90cf1d8f8f8ad'
+	'61d9aefbd8f40cf1d8f8f8ad19d9aefbdfd8f416f1d8f8ad8d61d9f4f4acf59c'
+	'9c8ddf2bbab6aefaf8f40bd8f1aed0f8ad51daaefaf8f1d8b9b1b6a3839c08b9'
+	'b1839ab5aac0fd3083b79f10b58b93f20202d1abdaded8f1b080baabc0c3b284'
+	'c1c3d8b1b9f38ba391b609b4d9abdeb0879cb9a3ddf1b38b8b8b8b8bb087a3a3'
+	'a3a3b28bb69bf2a3a3a3a3a3a3a3a3a3a3f1b087b59aa3f39ba3a3dcbaacdfb9'
+	'a3a3a3a3a3a3a3a3a3a3a3a3a3a3a3a3d8d8d8bbb3b7f1aaf9daffd9809aaa28'
+	'b48098a720b79787a86688f07951f1902c870ca781976293f071716085940129'
+	# bank 11
+	'517990a5f1284c6c870c95188578a38390284c6c886cd8f3a28200f210a89219'
+	'80a2f2d926d8f188a84dd948d896a83980d93cd89580a839a68698d92cda87a7'
+	'2cd8a8899519a980d938d8a88939a980da3cd8a82ea83990d90cd8a8953198d9'
+	'0cd8a809d9ffd801daffd89539a9da26ffd890a80d8999a810809821da2ed889'
+	'99a83180da2ed8a886963180da2ed8a8873180da2ed8a88292f34180f1d92ed8'
+	'a882f31980f1d92ed882acf3c0a28022f1a62ea72ea92298a829daacdeffd8a2'
+	'f22af1a92e8292a8f23180a696f1d900ac8c9c0c30acded0deffd88c9cacd010'
+	'acde8092a2f24c82a8f1caf235f19688a6d900d8f1ff'
+)
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
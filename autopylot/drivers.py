@@ -0,0 +1,403 @@
+""" Sensor drivers and the multi-rate sampler. Every driver declares its
+native rate (Hz) and read cost (bytes per read, the bus time follows from
+it) and knows how to set up the device and decode the registers it reads.
+The MultiRateSampler reads each sensor at its own rate through the
+BusScheduler (autopylot.i2cbus) - the reads are submitted without waiting,
+so a slow sensor never blocks the others - and publishes the timestamped
+readings to the subscribers (like the MotionEstimator).
+
+Fake device models for all drivers are in autopylot.fakes. """
+
+import math
+import heapq
+import struct
+import logging
+import threading
+import collections
+
+import numpy
+
+import autopylot.imu
+import autopylot.clock
+import autopylot.i2cbus
+
+# standard pressure at sea level in Pa
+SEA_LEVEL_PRESSURE = 101325.0
+
+# bus time of one byte at 400kHz (9 bits) - and the start, address and
+# register bytes of every read
+BYTE_TIME = 22.5e-6
+READ_OVERHEAD = 3
+
+# a reading of a sensor - values is a tuple (depends on the driver)
+Reading = collections.namedtuple('Reading', ['sensor', 'timestamp', 'values'])
+
+
+class SensorDriver():
+	""" Base class of the drivers. A driver reads length bytes starting at
+	register - decode() converts them into the values of a Reading. """
+	name = None
+	rate = None  # native rate (Hz)
+	register = None
+	length = None
+	priority = autopylot.i2cbus.PRIORITY_MAGNETOMETER
+
+	def __init__(self, address, rate=None):
+		self.address = address
+		if rate is not None:
+			self.rate = float(rate)
+
+	@property
+	def read_cost(self):
+		""" Estimated bus time (seconds) of one read """
+		return (READ_OVERHEAD + self.length) * BYTE_TIME
+
+	def setup(self, bus):
+		""" Configures the device (bus is smbus like) """
+		pass
+
+	def decode(self, data):
+		""" Converts the read bytes into a tuple of values """
+		raise NotImplementedError()
+
+	def read(self, bus):
+		""" Reads and decodes the registers (blocking) """
+		return self.decode(bytes(bus.read_i2c_block_data(
+			self.address, self.register, self.length)))
+
+
+class Mpu6050(SensorDriver):
+	""" MPU-6050 IMU - decoded by the ImuReader (autopylot.imu) with the
+	ranges, calibration and mounting of the config. setup only writes the
+	ranges: the sample rate and the DLPF belong to autopylot.sensor.
+	Values: (accel (x, y, z) in m/s², gyro (x, y, z) in °/s,
+	temperature in °C) """
+	name = 'imu'
+	rate = 1000.0
+	register = autopylot.imu.ACCEL_XOUT_H
+	length = autopylot.imu.BURST_LENGTH
+	priority = autopylot.i2cbus.PRIORITY_IMU
+
+	def __init__(self, address, rate=None, accel_full_scale=None,
+				gyro_full_scale=None):
+		super().__init__(address, rate)
+		self.accel_full_scale = accel_full_scale
+		self.gyro_full_scale = gyro_full_scale
+		self.reader = None
+		self._accel = numpy.zeros(3)
+		self._gyro = numpy.zeros(3)
+
+	def setup(self, bus):
+		self.reader = autopylot.imu.ImuReader(
+			bus, self.address, self.accel_full_scale, self.gyro_full_scale)
+		self.reader.configure()
+
+	def decode(self, data):
+		if self.reader is None:
+			raise Exception("MPU-6050 at {!s} is not set up"
+							.format(hex(self.address)))
+		self.reader.raw[:] = data
+		self.reader.decode_into(self._accel, self._gyro)
+		return (tuple(self._accel.tolist()), tuple(self._gyro.tolist()),
+				self.reader.temperature)
+
+
+class Hmc5883l(SensorDriver):
+	""" HMC5883L magnetometer - ±1.3Ga, continuous mode at 75Hz.
+	Values: field (x, y, z) in µT """
+	name = 'magnetometer'
+	rate = 75.0
+	register = 0x03  # DATA OUTPUT X MSB
+	length = 6
+	_format = struct.Struct('>3h')  # x, z, y
+	_scale = 100.0 / 1090  # LSB/Ga => µT
+
+	def setup(self, bus):
+		bus.write_byte_data(self.address, 0x00, 0x78)  # 8 samples avg, 75Hz
+		bus.write_byte_data(self.address, 0x01, 0x20)  # gain ±1.3Ga
+		bus.write_byte_data(self.address, 0x02, 0x00)  # continuous
+
+	def decode(self, data):
+		x, z, y = self._format.unpack(data)
+		return (x * self._scale, y * self._scale, z * self._scale)
+
+
+class Qmc5883l(SensorDriver):
+	""" QMC5883L magnetometer (the HMC5883L clone) - ±8G, continuous mode
+	at 200Hz. Values: field (x, y, z) in µT """
+	name = 'magnetometer'
+	rate = 200.0
+	register = 0x00
+	length = 6
+	_format = struct.Struct('<3h')  # x, y, z
+	_scale = 100.0 / 3000  # LSB/G => µT
+
+	def setup(self, bus):
+		bus.write_byte_data(self.address, 0x0b, 0x01)  # set/reset period
+		# OSR 512, ±8G, 200Hz, continuous
+		bus.write_byte_data(self.address, 0x09, 0x1d)
+
+	def decode(self, data):
+		return tuple(value * self._scale for value in self._format.unpack(data))
+
+
+class Bmp280(SensorDriver):
+	""" BMP280 barometer - normal mode, ultra high resolution (~26Hz).
+	Values: (pressure in Pa, temperature in °C, altitude in m) """
+	name = 'barometer'
+	rate = 25.0
+	register = 0xf7  # press_msb
+	length = 6
+	priority = autopylot.i2cbus.PRIORITY_TEMPERATURE
+	_calibration_format = struct.Struct('<HhhHhhhhhhhh')
+
+	def __init__(self, address, rate=None, sea_level_pressure=None):
+		super().__init__(address, rate)
+		self.sea_level_pressure = sea_level_pressure or SEA_LEVEL_PRESSURE
+		self.calibration = None
+
+	def setup(self, bus):
+		data = bytes(bus.read_i2c_block_data(self.address, 0x88, 24))
+		self.calibration = self._calibration_format.unpack(data)
+		bus.write_byte_data(self.address, 0xf5, 0x10)  # 0.5ms, filter x16
+		# temperature x2, pressure x16, normal mode
+		bus.write_byte_data(self.address, 0xf4, 0x57)
+
+	def decode(self, data):
+		if self.calibration is None:
+			raise Exception("BMP280 at {!s} is not set up"
+							.format(hex(self.address)))
+		adc_p = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
+		adc_t = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
+		pressure, temperature = compensate_bmp280(self.calibration, adc_t,
+												adc_p)
+		return (pressure, temperature,
+				pressure_altitude(pressure, self.sea_level_pressure))
+
+
+def compensate_bmp280(calibration, adc_t, adc_p):
+	""" Returns (pressure in Pa, temperature in °C) of the raw BMP280 values
+	(floating point compensation of the datasheet) """
+	t1, t2, t3, p1, p2, p3, p4, p5, p6, p7, p8, p9 = calibration
+	var1 = (adc_t / 16384.0 - t1 / 1024.0) * t2
+	var2 = (adc_t / 131072.0 - t1 / 8192.0) ** 2 * t3
+	t_fine = var1 + var2
+	temperature = t_fine / 5120.0
+
+	var1 = t_fine / 2.0 - 64000.0
+	var2 = var1 * var1 * p6 / 32768.0
+	var2 = var2 + var1 * p5 * 2.0
+	var2 = var2 / 4.0 + p4 * 65536.0
+	var1 = (p3 * var1 * var1 / 524288.0 + p2 * var1) / 524288.0
+	var1 = (1.0 + var1 / 32768.0) * p1
+	if var1 == 0:
+		return 0.0, temperature
+	pressure = 1048576.0 - adc_p
+	pressure = (pressure - var2 / 4096.0) * 6250.0 / var1
+	var1 = p9 * pressure * pressure / 2147483648.0
+	var2 = pressure * p8 / 32768.0
+	pressure = pressure + (var1 + var2 + p7) / 16.0
+	return pressure, temperature
+
+
+def pressure_altitude(pressure, sea_level_pressure=SEA_LEVEL_PRESSURE):
+	""" Returns the altitude (m) of the pressure (Pa) - international
+	barometric formula """
+	if pressure <= 0:
+		return float('nan')
+	return 44330.0 * (1.0 - math.pow(pressure / sea_level_pressure, 0.1903))
+
+
+DRIVERS = {'mpu6050': Mpu6050, 'hmc5883l': Hmc5883l, 'qmc5883l': Qmc5883l,
+		'bmp280': Bmp280}
+
+
+def create_driver(kind, address, rate=None):
+	""" Returns the driver for the kind (like in the config.ini) - or None
+	for 'none' """
+	kind = kind.lower()
+	if kind == 'none':
+		return None
+	if kind not in DRIVERS:
+		raise Exception("Unknown sensor type: {!s}".format(kind))
+	return DRIVERS[kind](address, rate)
+
+
+class _Schedule():
+	""" Sampling state and statistics of one driver """
+
+	def __init__(self, driver):
+		self.driver = driver
+		self.period = 1.0 / driver.rate
+		self.deadline = 0.0
+		self.pending = None
+		self.submitted = 0.0
+		self.samples = 0
+		self.overruns = 0
+		self.late = 0
+		self.errors = 0
+		self.total_latency = 0.0
+		self.first = None
+		self.last = None
+
+	def __lt__(self, other):
+		return self.deadline < other.deadline
+
+	def to_dict(self):
+		rate = 0.0
+		if self.samples > 1 and self.last > self.first:
+			rate = (self.samples - 1) / (self.last - self.first)
+		return {'rate': self.driver.rate, 'achieved_rate': rate,
+				'samples': self.samples, 'overruns': self.overruns,
+				'late': self.late, 'errors': self.errors,
+				'read_cost': self.driver.read_cost,
+				'mean_latency': (self.total_latency / self.samples
+								if self.samples else 0.0)}
+
+
+class MultiRateSampler():
+	""" Samples every driver at its own rate. The sampler thread sleeps
+	until the next deadline, submits the due reads to the scheduler and
+	goes on - the readings are published (in the bus thread) when the reads
+	are done. A read still pending at the next deadline is skipped
+	(overrun). Subscribers are called as callback(reading) and have to
+	return quickly. """
+
+	def __init__(self, scheduler, drivers):
+		self.scheduler = scheduler
+		self._schedules = [_Schedule(driver) for driver in drivers]
+		self._subscribers = collections.defaultdict(list)
+		self._latest = {}
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._thread = None
+
+	@property
+	def drivers(self):
+		return [schedule.driver for schedule in self._schedules]
+
+	def subscribe(self, name, callback):
+		""" Calls callback(reading) for every reading of the sensor name """
+		self._subscribers[name].append(callback)
+
+	def latest(self, name):
+		""" Returns the latest Reading of the sensor name (or None) """
+		with self._lock:
+			return self._latest.get(name)
+
+	def setup(self):
+		""" Sets up all devices (blocking) """
+		for schedule in self._schedules:
+			driver = schedule.driver
+			driver.setup(self.scheduler.client(driver.priority))
+			logging.info("Set up {!s} ({!s}) at {!s} - {!s}Hz".format(
+				driver.name, driver.__class__.__name__, hex(driver.address),
+				driver.rate))
+
+	def start(self):
+		""" Starts sampling (the devices have to be set up) """
+		self._stop.clear()
+		queue = self._reset_deadlines()
+		self._thread = threading.Thread(target=self._run, args=(queue,),
+										daemon=True, name='sensor-sampler')
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def _reset_deadlines(self):
+		""" All sensors are due now - returns the deadline queue """
+		now = autopylot.clock.now()
+		for schedule in self._schedules:
+			schedule.deadline = now
+		queue = list(self._schedules)
+		heapq.heapify(queue)
+		return queue
+
+	def _run(self, queue):
+		while not self._stop.is_set() and queue:
+			delay = self._step(queue)
+			if delay > 0:
+				autopylot.clock.wait(self._stop, delay)
+
+	def _step(self, queue):
+		""" Submits the read which is due next - returns the seconds until
+		the next deadline (0 if a read was submitted) """
+		delay = queue[0].deadline - autopylot.clock.now()
+		if delay > 0:
+			return delay
+		schedule = heapq.heappop(queue)
+		self._submit(schedule)
+		now = autopylot.clock.now()
+		schedule.deadline += schedule.period
+		if schedule.deadline < now:
+			# too far behind - skip the missed deadlines
+			missed = int((now - schedule.deadline) / schedule.period) + 1
+			schedule.late += missed
+			schedule.deadline += missed * schedule.period
+		heapq.heappush(queue, schedule)
+		return 0
+
+	def run_for(self, duration):
+		""" Samples for duration seconds in the calling thread instead of
+		the sampler thread - the scheduler has to be started without its
+		thread (start(thread=False)). Used to simulate on the VirtualClock
+		(autopylot.clock): every run gives the same readings. """
+		queue = self._reset_deadlines()
+		end = autopylot.clock.now() + duration
+		while queue:
+			delay = self._step(queue)
+			self.scheduler.run_pending()
+			if delay > 0:
+				remaining = end - autopylot.clock.now()
+				if remaining <= 0:
+					return
+				autopylot.clock.sleep(min(delay, remaining))
+
+	def _submit(self, schedule):
+		if schedule.pending is not None and not schedule.pending.done():
+			schedule.overruns += 1
+			return
+		driver = schedule.driver
+		schedule.submitted = autopylot.clock.now()
+		try:
+			future = self.scheduler.submit_read(driver.address, driver.register,
+												driver.length, driver.priority)
+		except Exception as e:
+			schedule.errors += 1
+			logging.error("Unable to read the {!s}: {!s}".format(driver.name, e))
+			return
+		schedule.pending = future
+		future.add_done_callback(
+			lambda future, schedule=schedule: self._publish(schedule, future))
+
+	def _publish(self, schedule, future):
+		""" Decodes the read and calls the subscribers (bus thread) """
+		timestamp = autopylot.clock.now()
+		try:
+			values = schedule.driver.decode(bytes(future.result()))
+		except Exception as e:
+			schedule.errors += 1
+			logging.error("Reading the {!s} failed: {!s}"
+						.format(schedule.driver.name, e))
+			return
+		schedule.samples += 1
+		schedule.total_latency += timestamp - schedule.submitted
+		if schedule.first is None:
+			schedule.first = timestamp
+		schedule.last = timestamp
+		reading = Reading(schedule.driver.name, timestamp, values)
+		with self._lock:
+			self._latest[reading.sensor] = reading
+		for callback in self._subscribers[reading.sensor]:
+			callback(reading)
+
+	def get_statistics(self):
+		""" Returns a dict (per sensor name) of the sampling statistics """
+		return {schedule.driver.name: schedule.to_dict()
+				for schedule in self._schedules}
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -1,14 +1,30 @@
+import threading
 import urwid
+import autopylot.config
 import autopylot.control
-
-
-quadcopter = autopylot.control.Quadcopter()
+import autopylot.tracing
+import autopylot.profiler
+import autopylot.telemetry
+
+
+tracer = None
+if autopylot.config.get_tracing_enabled():
+	tracer = autopylot.tracing.CommandTracer(
+		autopylot.config.get_tracing_capacity())
+telemetry = autopylot.telemetry.create_publisher(
+	len(autopylot.config.get_motor_names()))
+quadcopter = autopylot.control.Quadcopter(tracer=tracer, telemetry=telemetry)
 YAW_STEP = 5
 TILT_STEP = 5
 THROTTLE_STEP = 1
+# the UI has no control loop - so the heartbeat of the failsafe is sent
+# periodically (4 times per timeout)
+HEARTBEAT_INTERVAL = autopylot.config.get_failsafe_timeout() / 4000
 
 def handle_user_input(key):
 	""" handles the user input """
+	# the latency of a command is traced from the key press on
+	command = tracer.begin() if tracer is not None else None
 	user_input.set_text("Input: {!s}".format(repr(key)))
 
 	if key == 'I':  # only with SHIFT
@@ -16,23 +32,23 @@ def handle_user_input(key):
 	elif key == 'O':  # only with SHIFT
 		quadcopter.turn_off()
 	elif key == ' ':
-		quadcopter.hover()
+		quadcopter.hover(command)
 	elif key in ['up', 'w']:
-		quadcopter.change_tilt(quadcopter.TiltSide.front, TILT_STEP)
+		quadcopter.change_tilt(quadcopter.TiltSide.front, TILT_STEP, command)
 	elif key in ['down', 's']:
-		quadcopter.change_tilt(quadcopter.TiltSide.front, -TILT_STEP)
+		quadcopter.change_tilt(quadcopter.TiltSide.front, -TILT_STEP, command)
 	elif key in ['left', 'a']:
-		quadcopter.change_tilt(quadcopter.TiltSide.left, TILT_STEP)
+		quadcopter.change_tilt(quadcopter.TiltSide.left, TILT_STEP, command)
 	elif key in ['right', 'd']:
-		quadcopter.change_tilt(quadcopter.TiltSide.left, -TILT_STEP)
+		quadcopter.change_tilt(quadcopter.TiltSide.left, -TILT_STEP, command)
 	elif key == 'q':
-		quadcopter.change_yaw(-YAW_STEP)
+		quadcopter.change_yaw(-YAW_STEP, command)
 	elif key == 'e':
-		quadcopter.change_yaw(YAW_STEP)
+		quadcopter.change_yaw(YAW_STEP, command)
 	elif key == '+':
-		quadcopter.change_overall_throttle(quadcopter.request_total_throttle() / 4 + THROTTLE_STEP)
+		quadcopter.change_overall_throttle(quadcopter.request_total_throttle() / len(quadcopter.motors) + THROTTLE_STEP, command)
 	elif key =='-':
-		quadcopter.change_overall_throttle(quadcopter.request_total_throttle() / 4 - THROTTLE_STEP)
+		quadcopter.change_overall_throttle(quadcopter.request_total_throttle() / len(quadcopter.motors) - THROTTLE_STEP, command)
 
 	# update status fields
 	update_states()
@@ -42,17 +58,13 @@ def update_states():
 	""" updates the throttle display """
 	if not quadcopter.turned_on:
 		drone_state.set_text(('off', u"OFF"))
-		motor_fl_throttle.set_text(('throttle', u"NA"))
-		motor_fr_throttle.set_text(('throttle', u"NA"))
-		motor_rl_throttle.set_text(('throttle', u"NA"))
-		motor_rr_throttle.set_text(('throttle', u"NA"))
+		for motor_throttle in motor_throttles:
+			motor_throttle.set_text(('throttle', u"NA"))
 		total_throttle.set_text(('throttle', u"NA"))
 	else:
 		drone_state.set_text(('on', u"ON"))
-		motor_fl_throttle.set_text(('throttle', u"{!s}".format(quadcopter.request_throttle(quadcopter.MotorSide.front_left))))
-		motor_fr_throttle.set_text(('throttle', u"{!s}".format(quadcopter.request_throttle(quadcopter.MotorSide.front_right))))
-		motor_rl_throttle.set_text(('throttle', u"{!s}".format(quadcopter.request_throttle(quadcopter.MotorSide.rear_left))))
-		motor_rr_throttle.set_text(('throttle', u"{!s}".format(quadcopter.request_throttle(quadcopter.MotorSide.rear_right))))
+		for motor_throttle, motor in zip(motor_throttles, quadcopter.motors):
+			motor_throttle.set_text(('throttle', u"{!s}".format(motor.current_throttle)))
 		total_throttle.set_text(('throttle', u"{!s}".format(quadcopter.request_total_throttle())))
 		
 
@@ -66,16 +78,21 @@ palette = [
 		('off', '', '', '', 'white', '#d00'),
 ]
 
-motor_fl_throttle = urwid.Text(('throttle', u"FL"), align='center')
-motor_fr_throttle = urwid.Text(('throttle', u"FR"), align='center')
-motor_rl_throttle = urwid.Text(('throttle', u"RL"), align='center')
-motor_rr_throttle = urwid.Text(('throttle', u"RR"), align='center')
+# one throttle field per motor of the frame (in the order of the config.ini)
+motor_throttles = [urwid.Text(('throttle', name), align='center')
+				for name in quadcopter.frame.names]
 total_throttle = urwid.Text(('throttle', u"NA"), align='center')
 user_input = urwid.Text(('input', u""), align='center')
 drone_state = urwid.Text(('throttle', u"OFF"), align='center')
 name = urwid.Text(u"Easy Access", align='center')
 legend = urwid.Text(('legend', U"I: ignite | O: off | SPACE: hover | w: front | a: left | s: rear | d: right | q: ccw | e: cw | +: up | -: down"), align='center')
 
+def send_heartbeat(main_loop, user_data=None):
+	""" sends the failsafe heartbeat and schedules the next one """
+	quadcopter.heartbeat()
+	main_loop.set_alarm_in(HEARTBEAT_INTERVAL, send_heartbeat)
+
+
 placeholder = urwid.SolidFill()
 
 loop = urwid.MainLoop(placeholder, palette, unhandled_input=handle_user_input)
@@ -90,19 +107,38 @@ pile = loop.widget.base_widget
 
 motor_grid_top = urwid.GridFlow([], 10, 1, 1, 'center')
 motor_grid_bottom = urwid.GridFlow([], 10, 1, 1, 'center')
-for motor in [motor_fl_throttle, motor_fr_throttle]:
-	motor_grid_top.contents.append((motor, motor_grid_top.options()))
-for motor in [motor_rl_throttle, motor_rr_throttle]:
-	motor_grid_bottom.contents.append((motor, motor_grid_bottom.options()))
+# front motors on top, rear motors at the bottom - left to right
+for motor, position in sorted(zip(motor_throttles, quadcopter.frame.positions),
+							key=lambda item: (item[1] + 180) % 360):
+	grid = motor_grid_top if abs((position + 180) % 360 - 180) < 90 \
+		else motor_grid_bottom
+	grid.contents.append((motor, grid.options()))
 
 for item in [name, div, legend, div, user_input, drone_state, 
 			div, motor_grid_top, total_throttle, motor_grid_bottom]:
 	pile.contents.append((item, pile.options()))
 
+loop.set_alarm_in(HEARTBEAT_INTERVAL, send_heartbeat)
+
+# the sampling profiler is off until toggled (SIGUSR2 or control socket)
+threading.current_thread().name = 'ui'
+profiler = autopylot.profiler.SamplingProfiler(
+	autopylot.config.get_profiler_rate())
+autopylot.profiler.install_signal_handler(
+	profiler, autopylot.config.get_profiler_output_file())
+profiler_control = autopylot.profiler.ControlServer(
+	profiler, autopylot.config.get_profiler_socket(),
+	autopylot.config.get_profiler_output_file())
+profiler_control.start()
+
 try:
 	loop.run()
 finally:
 	quadcopter.turn_off()
+	profiler_control.stop()
+	profiler.stop()
+	if tracer is not None:
+		tracer.log_report()
 
 
 
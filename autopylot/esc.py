@@ -0,0 +1,261 @@
+""" ESC output protocols. The motors talk to an output object instead of
+calling pigpio directly - the pulsewidths are always given in the servo
+PWM range (0 = off, 1000 - 2000 µs), the output translates them to its
+protocol:
+
+	pwm         classic 50 Hz servo PWM (set_servo_pulsewidth)
+	oneshot125  125 - 250 µs pulses
+	multishot   5 - 25 µs pulses
+	dshot150    16 bit digital frames (11 bit throttle, telemetry bit, CRC)
+
+The analog (OneShot125, Multishot) and digital (DShot) protocols are sent
+as a pigpio waveform which the DMA repeats at the configured rate - all
+motors in one wave, so they are updated at the same time. A new throttle
+builds a new wave which takes over at the end of the current cycle
+(WAVE_MODE_REPEAT_SYNC), there is no gap in the signal.
+
+pigpio waveforms have a resolution of 1 µs: Multishot gets 20 steps only
+and DShot150 is sent with a 7 µs bit (0: 3 µs high, 1: 5 µs high) instead
+of 6.67 µs - faster DShot rates need a finer clock than pigpio offers. """
+
+import logging
+import contextlib
+import collections
+
+import autopylot.config
+
+# pigpio constants (same values as in the pigpio module - the pi object is
+# passed in, so pigpio itself is not needed here)
+OUTPUT = 1
+WAVE_MODE_ONE_SHOT = 0
+WAVE_MODE_REPEAT = 1
+WAVE_MODE_ONE_SHOT_SYNC = 2
+WAVE_MODE_REPEAT_SYNC = 3
+
+# servo PWM range the pulsewidths are given in
+PWM_LOW = 1000
+PWM_HIGH = 2000
+# minimal low time (µs) between two frames of a wave
+MIN_GAP = 2
+
+DSHOT_MIN_THROTTLE = 48
+DSHOT_MAX_THROTTLE = 2047
+
+# like pigpio.pulse - pigpio only reads these three attributes
+Pulse = collections.namedtuple('Pulse', ['gpio_on', 'gpio_off', 'delay'])
+
+
+def normalize(pulsewidth):
+	""" Returns the servo pulsewidth (1000 - 2000 µs) as 0 - 1 """
+	value = (pulsewidth - PWM_LOW) / (PWM_HIGH - PWM_LOW)
+	return min(max(value, 0.0), 1.0)
+
+
+def dshot_value(pulsewidth):
+	""" Returns the DShot throttle (48 - 2047) of the servo pulsewidth - 0
+	(the motor stop command) for a pulsewidth of 0 """
+	if pulsewidth <= 0:
+		return 0
+	return DSHOT_MIN_THROTTLE + int(round(
+		normalize(pulsewidth) * (DSHOT_MAX_THROTTLE - DSHOT_MIN_THROTTLE)))
+
+
+def dshot_frame(value, telemetry=False):
+	""" Returns the 16 bit DShot frame - value (11 bit), the telemetry
+	request bit and the 4 bit CRC """
+	if not 0 <= value <= DSHOT_MAX_THROTTLE:
+		raise Exception("DShot value out of range ({!s})".format(value))
+	packet = (value << 1) | int(bool(telemetry))
+	crc = (packet ^ (packet >> 4) ^ (packet >> 8)) & 0x0f
+	return (packet << 4) | crc
+
+
+class AnalogProtocol():
+	""" Pulse length protocol - the throttle is a pulse from min_pulse to
+	max_pulse µs (OneShot125, Multishot) """
+
+	def __init__(self, name, min_pulse, max_pulse):
+		self.name = name
+		self.min_pulse = min_pulse
+		self.max_pulse = max_pulse
+		self.frame_length = max_pulse
+
+	def pulse_length(self, pulsewidth):
+		""" Returns the pulse (µs) of the servo pulsewidth - 0 if off """
+		if pulsewidth <= 0:
+			return 0
+		return int(round(self.min_pulse + normalize(pulsewidth) *
+						(self.max_pulse - self.min_pulse)))
+
+	def build_pulses(self, pulsewidths, period):
+		""" Returns the pulses of one period (µs) - pulsewidths is a dict
+		of {pin: servo pulsewidth}. All pins rise together. """
+		lengths = {pin: self.pulse_length(pulsewidth)
+				for pin, pulsewidth in pulsewidths.items()}
+		on_mask = 0
+		falls = collections.defaultdict(int)
+		for pin, length in lengths.items():
+			if length > 0:
+				on_mask |= 1 << pin
+				falls[length] |= 1 << pin
+		pulses = []
+		time = 0
+		off_mask = 0
+		gpio_on = on_mask
+		for fall in sorted(falls):
+			pulses.append(Pulse(gpio_on, off_mask, fall - time))
+			gpio_on = 0
+			off_mask = falls[fall]
+			time = fall
+		pulses.append(Pulse(gpio_on, off_mask, period - time))
+		return pulses
+
+
+class DShotProtocol():
+	""" Digital protocol - 16 bits per frame, each bit starts high and
+	falls after zero_high (0) or one_high (1) of the bit µs """
+
+	def __init__(self, name, bit, zero_high, one_high):
+		self.name = name
+		self.bit = bit
+		self.zero_high = zero_high
+		self.one_high = one_high
+		self.frame_length = 16 * bit
+
+	def build_pulses(self, pulsewidths, period):
+		""" Returns the pulses of one period (µs) - pulsewidths is a dict
+		of {pin: servo pulsewidth}. The frames of all pins are sent in
+		parallel. """
+		frames = {pin: dshot_frame(dshot_value(pulsewidth))
+				for pin, pulsewidth in pulsewidths.items()}
+		all_mask = 0
+		for pin in frames:
+			all_mask |= 1 << pin
+		pulses = []
+		for bit in range(15, -1, -1):
+			ones = 0
+			for pin, frame in frames.items():
+				if frame >> bit & 1:
+					ones |= 1 << pin
+			zeros = all_mask & ~ones
+			pulses.append(Pulse(all_mask, 0, self.zero_high))
+			pulses.append(Pulse(0, zeros, self.one_high - self.zero_high))
+			pulses.append(Pulse(0, ones, self.bit - self.one_high))
+		pulses.append(Pulse(0, 0, period - self.frame_length))
+		return pulses
+
+
+PROTOCOLS = {'oneshot125': AnalogProtocol('oneshot125', 125, 250),
+			'multishot': AnalogProtocol('multishot', 5, 25),
+			'dshot150': DShotProtocol('dshot150', 7, 3, 5)}
+
+
+class PwmOutput():
+	""" Classic servo PWM (50 Hz) - straight to set_servo_pulsewidth """
+
+	# the edges are slow enough for the pigpio watchdog / callbacks
+	waves = False
+
+	def __init__(self, pi):
+		self.pi = pi
+
+	def set_pulsewidth(self, pin, pulsewidth):
+		return self.pi.set_servo_pulsewidth(pin, pulsewidth)
+
+	@contextlib.contextmanager
+	def batch(self):
+		yield
+
+	def stop(self):
+		pass
+
+
+class WaveOutput():
+	""" Sends the pulsewidths of all pins with a wave protocol at rate Hz.
+	Changes within batch() are sent as one new wave when it ends. """
+
+	waves = True
+
+	def __init__(self, pi, pins, protocol, rate):
+		self.pi = pi
+		self.protocol = protocol
+		self.period = int(round(1000000 / rate))
+		if protocol.frame_length + MIN_GAP > self.period:
+			raise Exception("{!s} needs {!s} µs per frame - the rate of {!s} "
+							"Hz is too high".format(protocol.name,
+												protocol.frame_length, rate))
+		self.pulsewidths = {int(pin): 0 for pin in pins}
+		self._wave = None
+		self._retired = []
+		self._batch = 0
+		for pin in self.pulsewidths:
+			self.pi.set_mode(pin, OUTPUT)
+		logging.info("ESC output: {!s} at {!s} Hz on pins {!s}".format(
+			protocol.name, rate, sorted(self.pulsewidths)))
+
+	def set_pulsewidth(self, pin, pulsewidth):
+		""" Sets the servo pulsewidth (0 = off, 1000 - 2000 µs) of the pin """
+		self.pulsewidths[pin] = int(pulsewidth)
+		if not self._batch:
+			self._send()
+		return 0
+
+	@contextlib.contextmanager
+	def batch(self):
+		self._batch += 1
+		try:
+			yield
+		finally:
+			self._batch -= 1
+			if not self._batch:
+				self._send()
+
+	def _send(self):
+		if not any(self.pulsewidths.values()):
+			self.stop()
+			return
+		self.pi.wave_add_generic(self.protocol.build_pulses(self.pulsewidths,
+															self.period))
+		wave = self.pi.wave_create()
+		if wave < 0:
+			raise Exception("Unable to create the ESC wave ({!s})"
+							.format(wave))
+		self.pi.wave_send_using_mode(wave, WAVE_MODE_REPEAT_SYNC)
+		if self._wave is not None:
+			self._retired.append(self._wave)
+		self._wave = wave
+		self._delete_retired()
+
+	def _delete_retired(self):
+		""" Deletes the old waves which are not sent anymore (the last one
+		is sent until the end of its cycle) """
+		current = self.pi.wave_tx_at()
+		for wave in list(self._retired):
+			if wave != current:
+				self.pi.wave_delete(wave)
+				self._retired.remove(wave)
+
+	def stop(self):
+		""" Stops the wave - the pins stay low """
+		self.pi.wave_tx_stop()
+		for wave in self._retired + ([self._wave] if self._wave is not None
+									else []):
+			self.pi.wave_delete(wave)
+		self._retired = []
+		self._wave = None
+
+
+def create_output(pi, pins, protocol=None, rate=None):
+	""" Returns the output of the protocol (default: config.ini) for the
+	pins """
+	if protocol is None:
+		protocol = autopylot.config.get_esc_protocol()
+	if rate is None:
+		rate = autopylot.config.get_esc_rate()
+	if protocol == 'pwm':
+		return PwmOutput(pi)
+	if protocol not in PROTOCOLS:
+		raise Exception("Unknown ESC protocol: {!s}".format(protocol))
+	return WaveOutput(pi, pins, PROTOCOLS[protocol], rate)
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,226 @@
+""" Hardware independent motion estimation - the math behind the
+MotionTracker. The estimator works on blocks of samples (numpy arrays) so
+recorded flights can be fed through it much faster than real time. A single
+sample is just a block of length one - so live and replayed data always
+take the same code path. """
+
+import math
+
+import numpy
+
+import autopylot.config
+import autopylot.filters
+import autopylot.orientation
+
+# Formula
+#--------------------------------
+# Distance:
+#    velocity = sum(acceleration)
+#    distance = sum(velocity)
+
+# Angular change:
+#    tilt = sum(rotation)
+
+# number of samples (at rest) used to set up the dead zone filter
+SAMPLE_COUNT = 100
+# the dead zone is widened by this factor (20%) on both ends
+DEAD_ZONE_BLUR = 0.2
+
+AXES = ('x', 'y', 'z')
+
+
+def to_dict(values):
+	""" Converts an array of three values into a {'x', 'y', 'z'} dict """
+	return dict(zip(AXES, values.tolist()))
+
+
+def to_array(values):
+	""" Converts a {'x', 'y', 'z'} dict into an array of three values """
+	return numpy.array([values['x'], values['y'], values['z']], dtype=float)
+
+
+def setup_dead_zone(samples, blur=DEAD_ZONE_BLUR):
+	""" Returns the dead zone (2x3 array - lower and upper bound per axis)
+	for the given (n, 3) samples. The bounds are the min / max values
+	widened by the blur factor. """
+	low = samples.min(axis=0)
+	high = samples.max(axis=0)
+	return numpy.vstack((low - numpy.abs(low) * blur,
+						high + numpy.abs(high) * blur))
+
+
+def _integrate(state, values):
+	""" Returns the running sum of values (n, 3) starting at state (3).
+	The state is summed in first so the result is exactly the same as
+	adding one sample after another. """
+	return numpy.cumsum(numpy.vstack((state, values)), axis=0)[1:]
+
+
+class MotionEstimator():
+	""" Integrates acceleration and rotation samples into distance and tilt.
+	The samples first pass the (optional) accel / rotation FilterPipelines
+	(autopylot.filters). The first sample_count filtered samples are used to
+	set up the dead zone filters (sensor noise at rest) and are not
+	integrated. After that every sample passes a dead band and a spike
+	rejection stage before it is integrated. """
+
+	def __init__(self, sample_count=SAMPLE_COUNT, dead_zone_blur=DEAD_ZONE_BLUR,
+				accel_filters=None, rotation_filters=None):
+		self.sample_count = int(sample_count)
+		self.dead_zone_blur = float(dead_zone_blur)
+		self.accel_filters = accel_filters or autopylot.filters.FilterPipeline()
+		self.rotation_filters = (rotation_filters or
+								autopylot.filters.FilterPipeline())
+		self.reset()
+
+	def reset(self):
+		""" Resets all integrated values and the dead zone filters """
+		self.tilt = numpy.zeros(3)
+		self.velocity = numpy.zeros(3)
+		self.distance = numpy.zeros(3)
+		# from the magnetometer / barometer readings (None until the first)
+		self.heading = None
+		self.altitude = None
+		self._reference_altitude = None
+		self.accel_filters.reset()
+		self.rotation_filters.reset()
+		self._set_dead_zones(None, None)
+		self._accel_samples = numpy.empty((self.sample_count, 3))
+		self._rotation_samples = numpy.empty((self.sample_count, 3))
+		self._sampled = 0
+
+	@property
+	def calibrated(self):
+		""" True as soon as the dead zone filters are set up """
+		return self.rotation_dead_zone is not None
+
+	def _set_dead_zones(self, accel_dead_zone, rotation_dead_zone):
+		""" Sets the dead zones and the filter stages applied after them """
+		self.accel_dead_zone = accel_dead_zone
+		self.rotation_dead_zone = rotation_dead_zone
+		if rotation_dead_zone is None:
+			self._accel_post_filters = None
+			self._rotation_post_filters = None
+			return
+		self._accel_post_filters = autopylot.filters.FilterPipeline([
+			autopylot.filters.DeadBand(*accel_dead_zone),
+			autopylot.filters.SpikeRejection()])
+		self._rotation_post_filters = autopylot.filters.FilterPipeline([
+			autopylot.filters.DeadBand(*rotation_dead_zone),
+			autopylot.filters.SpikeRejection()])
+
+	def use_calibration(self, calibration, mounting=None):
+		""" Sets up the dead zone filters from the noise bands of an
+		ImuCalibration (autopylot.calibration) - so no samples have to be
+		collected first. The bands are in the sensor frame - pass the
+		mounting (autopylot.orientation) if the samples are body frame. """
+		accel_band = numpy.array(calibration.accel_band)
+		gyro_band = numpy.array(calibration.gyro_band)
+		if mounting is not None:
+			accel_band = autopylot.orientation.rotate_band(mounting, accel_band)
+			gyro_band = autopylot.orientation.rotate_band(mounting, gyro_band)
+		self._set_dead_zones(setup_dead_zone(accel_band, self.dead_zone_blur),
+							setup_dead_zone(gyro_band, self.dead_zone_blur))
+
+	def get_tilt(self):
+		""" tilt (as dict - x,y,z) in unknown unit """
+		return to_dict(self.tilt)
+
+	def get_distance(self):
+		""" distance (as dict - x,y,z) in unknown unit """
+		return to_dict(self.distance)
+
+	def update_magnetometer(self, timestamp, field):
+		""" Updates the heading (degrees, 0 = magnetic north along +x,
+		clockwise) from a magnetometer reading - field (x, y, z) in µT """
+		self.heading = math.degrees(math.atan2(-field[1], field[0])) % 360
+
+	def update_barometer(self, timestamp, altitude):
+		""" Updates the altitude (m) relative to the first barometer reading
+		- altitude is the absolute pressure altitude """
+		if self._reference_altitude is None:
+			self._reference_altitude = altitude
+		self.altitude = altitude - self._reference_altitude
+
+	def update_orientation(self, quaternion):
+		""" Sets the tilt from an orientation quaternion (w, x, y, z) - like
+		the ones the DMP of the MPU-6050 delivers. The tilt is in degrees
+		then: x = roll, y = pitch, z = yaw. """
+		w, x, y, z = quaternion
+		self.tilt = numpy.degrees(numpy.array([
+			math.atan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y)),
+			math.asin(max(-1.0, min(1.0, 2 * (w * y - z * x)))),
+			math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))]))
+
+	def update(self, accel, rotation):
+		""" Processes a single sample (dicts as returned by the SensorData) """
+		self.process_block(to_array(accel)[numpy.newaxis],
+						to_array(rotation)[numpy.newaxis])
+
+	def _sample(self, accel, rotation):
+		""" Collects the samples for the dead zone filters and returns the
+		number of samples which were consumed """
+		count = min(len(accel), self.sample_count - self._sampled)
+		end = self._sampled + count
+		self._accel_samples[self._sampled:end] = accel[:count]
+		self._rotation_samples[self._sampled:end] = rotation[:count]
+		self._sampled = end
+
+		if self._sampled >= self.sample_count:
+			self._set_dead_zones(
+				setup_dead_zone(self._accel_samples, self.dead_zone_blur),
+				setup_dead_zone(self._rotation_samples, self.dead_zone_blur))
+		return count
+
+	def process_block(self, accel, rotation):
+		""" Processes a block of samples - accel and rotation are (n, 3)
+		arrays. Returns the tilt and distance after each sample as two
+		(n, 3) arrays. """
+		accel = self.accel_filters.process(accel)
+		rotation = self.rotation_filters.process(rotation)
+		count = len(accel)
+		tilt = numpy.empty((count, 3))
+		distance = numpy.empty((count, 3))
+
+		start = 0
+		if not self.calibrated:
+			start = self._sample(accel, rotation)
+			tilt[:start] = self.tilt
+			distance[:start] = self.distance
+		if start == count:
+			return tilt, distance
+
+		accel = self._accel_post_filters.process(accel[start:])
+		rotation = self._rotation_post_filters.process(rotation[start:])
+
+		velocity = _integrate(self.velocity, accel)
+		distance[start:] = _integrate(self.distance, velocity)
+		tilt[start:] = _integrate(self.tilt, rotation)
+
+		self.velocity = velocity[-1].copy()
+		self.distance = distance[-1].copy()
+		self.tilt = tilt[-1].copy()
+		return tilt, distance
+
+
+def create_estimator(sample_rate=None):
+	""" Returns a MotionEstimator set up from the config ([ESTIMATOR] and
+	the [FILTER] pipelines designed for sample_rate - the gyro sample rate
+	by default). The MotionTracker and the replay both use it. In DMP mode
+	the stages the (lower) DMP rate cannot carry are dropped. """
+	if sample_rate is None:
+		sample_rate = autopylot.config.get_gyrosensor_sample_rate()
+	accel_spec = autopylot.config.get_accel_filter_spec()
+	gyro_spec = autopylot.config.get_gyro_filter_spec()
+	if autopylot.config.get_gyrosensor_mode() == 'dmp':
+		accel_spec = autopylot.filters.fit_spec(accel_spec, sample_rate)
+		gyro_spec = autopylot.filters.fit_spec(gyro_spec, sample_rate)
+	return MotionEstimator(
+		sample_count=autopylot.config.get_estimator_sample_count(),
+		dead_zone_blur=autopylot.config.get_estimator_dead_zone_blur(),
+		accel_filters=autopylot.filters.build_pipeline(accel_spec,
+														sample_rate),
+		rotation_filters=autopylot.filters.build_pipeline(gyro_spec,
+														sample_rate))
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,179 @@
+""" Failsafe kill switch which runs inside the pigpio daemon. When the
+motors are armed a pigpio script is uploaded and started - it watches a
+heartbeat (script parameter p0) which the control loop bumps every tick.
+If the heartbeat does not change within the timeout (parameter p1, in µs
+by the daemon tick) the script sets all motor pins to their stop signal
+and halts. As the script runs in the daemon it also stops the motors if
+the Python process stalls (GC, I/O, a hung redraw) or dies.
+
+The worst-case cutoff latency is the timeout plus one check interval
+(1ms) plus the scheduling jitter of the daemon - measure_cutoff_latency
+measures it against a real daemon or the FakePi (autopylot.fakes). """
+
+import logging
+
+import autopylot.clock
+
+# pigpio script states (same values as in the pigpio module - the pi
+# object is passed in, so pigpio itself is not needed here)
+PI_SCRIPT_INITING = 0
+PI_SCRIPT_HALTED = 1
+PI_SCRIPT_RUNNING = 2
+PI_SCRIPT_WAITING = 3
+PI_SCRIPT_FAILED = 4
+
+# check interval of the script in ms
+CHECK_INTERVAL = 1
+
+
+def build_script(stop_signals, interval=CHECK_INTERVAL, stop_waves=False):
+	""" Returns the pigpio script text - stop_signals is a dict of
+	{pin: stop signal (pulsewidth)}. With stop_waves the ESC wave
+	(autopylot.esc) is halted first.
+	v0 = last heartbeat, v1 = tick (µs) when the heartbeat changed. The
+	elapsed time is taken from the tick - not by counting the check
+	intervals, which would add up the oversleeping of each interval. """
+	lines = ["ld v0 p0",
+			"tick",
+			"sta v1",
+			"tag 100",
+			"mils {!s}".format(interval),
+			"lda p0",
+			"cmp v0",
+			"jz 200",
+			# new heartbeat
+			"sta v0",
+			"tick",
+			"sta v1",
+			"jmp 100",
+			"tag 200",
+			# the 32 bit difference is right even if the tick wrapped
+			"tick",
+			"sub v1",
+			"cmp p1",
+			"jm 100"]
+	# timeout - stop all motors (all pins first, nothing in between)
+	if stop_waves:
+		lines.append("wvhlt")
+	for pin, stop_signal in sorted(stop_signals.items()):
+		lines.append("servo {!s} {!s}".format(pin, stop_signal))
+	lines.append("halt")
+	return "\n".join(lines)
+
+
+class Failsafe():
+	""" Heartbeat watchdog script in the pigpio daemon. arm() uploads and
+	starts it, heartbeat() has to be called more often than every timeout
+	ms, disarm() removes it. The pi can be a pigpio.pi or a FakePi. Set
+	stop_waves if the motors are driven by a wave (autopylot.esc). """
+
+	def __init__(self, pi, stop_signals, timeout, stop_waves=False):
+		self.pi = pi
+		self.stop_signals = dict(stop_signals)
+		self.timeout = int(timeout)  # ms
+		self.script = build_script(self.stop_signals, stop_waves=stop_waves)
+		self._script_id = None
+		self._beat = 0
+
+	@property
+	def armed(self):
+		return self._script_id is not None
+
+	@property
+	def triggered(self):
+		""" True if the script cut off the motors (it halted while armed) """
+		if self._script_id is None:
+			return False
+		status, _ = self.pi.script_status(self._script_id)
+		return status in (PI_SCRIPT_HALTED, PI_SCRIPT_FAILED)
+
+	def arm(self):
+		""" Uploads and starts the script - the heartbeat starts now """
+		if self.armed:
+			return
+		script_id = self.pi.store_script(self.script.encode())
+		if script_id < 0:
+			raise Exception("Unable to store the failsafe script ({!s})"
+							.format(script_id))
+		# the daemon checks the script in the background
+		deadline = autopylot.clock.now() + 1.0
+		while self.pi.script_status(script_id)[0] == PI_SCRIPT_INITING:
+			if autopylot.clock.now() > deadline:
+				self.pi.delete_script(script_id)
+				raise Exception("Failsafe script was not initialised in time")
+			autopylot.clock.sleep(0.001)
+		self._beat = 0
+		result = self.pi.run_script(script_id,
+									[self._beat, self.timeout * 1000])
+		if result is not None and result < 0:
+			self.pi.delete_script(script_id)
+			raise Exception("Unable to run the failsafe script ({!s})"
+							.format(result))
+		self._script_id = script_id
+		logging.info("Armed the failsafe (timeout: {!s}ms, pins: {!s})"
+					.format(self.timeout, sorted(self.stop_signals)))
+
+	def heartbeat(self):
+		""" Tells the script the control loop is alive """
+		if self._script_id is None:
+			return
+		self._beat = (self._beat + 1) & 0xffffffff
+		self.pi.update_script(self._script_id, [self._beat])
+
+	def disarm(self):
+		""" Stops and removes the script - the motors are not touched """
+		if self._script_id is None:
+			return
+		script_id = self._script_id
+		self._script_id = None
+		if self.pi.script_status(script_id)[0] in (PI_SCRIPT_HALTED,
+													PI_SCRIPT_FAILED):
+			logging.critical("The failsafe cut off the motors (no heartbeat "
+							"within {!s}ms)".format(self.timeout))
+		self.pi.stop_script(script_id)
+		self.pi.delete_script(script_id)
+		logging.info("Disarmed the failsafe")
+
+
+def _pulsewidth(pi, pin):
+	""" Returns the servo pulsewidth of the pin - pigpio raises an error
+	if the servo pulses are off (0) """
+	try:
+		return pi.get_servo_pulsewidth(pin)
+	except Exception:
+		return 0
+
+
+def measure_cutoff_latency(pi, stop_signals, timeout, trials=10,
+						throttle=1500, poll_interval=0.0002):
+	""" Measures the time from the last heartbeat until all pins are at
+	their stop signal. The pins are set to throttle (pulsewidth) before
+	each trial - do not run this with props on! Returns a dict with the
+	worst, mean and all latencies (seconds). """
+	latencies = []
+	for _ in range(trials):
+		failsafe = Failsafe(pi, stop_signals, timeout)
+		for pin in stop_signals:
+			pi.set_servo_pulsewidth(pin, throttle)
+		failsafe.arm()
+		failsafe.heartbeat()
+		last_beat = autopylot.clock.now()
+		deadline = last_beat + timeout / 1000 + 1.0
+		while any(_pulsewidth(pi, pin) != stop_signal
+				for pin, stop_signal in stop_signals.items()):
+			if autopylot.clock.now() > deadline:
+				failsafe.disarm()
+				raise Exception("Failsafe did not cut off the motors within "
+								"{!s}ms".format(timeout + 1000))
+			autopylot.clock.sleep(poll_interval)
+		latencies.append(autopylot.clock.now() - last_beat)
+		failsafe.disarm()
+	result = {'worst': max(latencies),
+			'mean': sum(latencies) / len(latencies),
+			'latencies': latencies}
+	logging.info("Failsafe cutoff latency (timeout {!s}ms): worst {:.2f}ms, "
+				"mean {:.2f}ms".format(timeout, result['worst'] * 1000,
+										result['mean'] * 1000))
+	return result
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,628 @@
+""" Fake hardware - stand-ins for the pigpio daemon, the I2C bus and the
+sensors so the timing critical parts can be tested (and benchmarked)
+without a Raspberry Pi. Only what the autopylot modules use is
+implemented. """
+
+import struct
+import threading
+import collections
+
+import autopylot.clock
+import autopylot.drivers
+import autopylot.dmpfirmware
+
+# pigpio constants (same values as in the pigpio module)
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+TIMEOUT = 2
+
+# pigpio script states
+PI_SCRIPT_HALTED = 1
+PI_SCRIPT_RUNNING = 2
+PI_SCRIPT_FAILED = 4
+
+
+class FakeCallback():
+	""" Returned by FakePi.callback - like the pigpio _callback object """
+
+	def __init__(self, pi, pin, edge, func):
+		self.pi = pi
+		self.pin = pin
+		self.edge = edge
+		self.func = func
+
+	def cancel(self):
+		self.pi._callbacks.remove(self)
+
+
+def _int32(value):
+	""" Wraps the value around like a signed 32 bit integer """
+	return ((value + 0x80000000) & 0xffffffff) - 0x80000000
+
+
+class FakeScript():
+	""" A pigpio script run by the FakePi - interprets the subset of the
+	pigpio script language the autopylot scripts use (ld, lda, sta, add,
+	sub, inr, dcr, cmp, tag, jmp, jz, jnz, jm, jp, mils, tick, servo, wvhlt,
+	halt)
+	in its own thread, like the daemon does - with 32 bit arithmetic """
+
+	def __init__(self, pi, text):
+		self.pi = pi
+		self.status = PI_SCRIPT_HALTED
+		self.params = [0] * 10
+		self.variables = [0] * 150
+		self.commands = []
+		self.tags = {}
+		for line in text.splitlines():
+			words = line.split()
+			if not words:
+				continue
+			if words[0] == 'tag':
+				self.tags[words[1]] = len(self.commands)
+			else:
+				self.commands.append(words)
+		self._running = False
+		self._thread = None
+
+	def _value(self, operand):
+		if operand[0] == 'p':
+			return self.params[int(operand[1:])]
+		if operand[0] == 'v':
+			return self.variables[int(operand[1:])]
+		return int(operand)
+
+	def run(self, params):
+		for index, value in enumerate(params or []):
+			self.params[index] = value
+		self.status = PI_SCRIPT_RUNNING
+		self._running = True
+		self._thread = threading.Thread(target=self._run, daemon=True,
+										name='fake-script')
+		self._thread.start()
+
+	def stop(self):
+		self._running = False
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		self.status = PI_SCRIPT_HALTED
+
+	def _run(self):
+		accumulator = 0
+		flags = 0
+		position = 0
+		while self._running and position < len(self.commands):
+			command, *operands = self.commands[position]
+			position += 1
+			if command == 'ld':
+				self.variables[int(operands[0][1:])] = self._value(operands[1])
+			elif command == 'lda':
+				accumulator = flags = self._value(operands[0])
+			elif command == 'sta':
+				self.variables[int(operands[0][1:])] = accumulator
+			elif command == 'add':
+				accumulator = flags = _int32(accumulator +
+											self._value(operands[0]))
+			elif command == 'sub':
+				accumulator = flags = _int32(accumulator -
+											self._value(operands[0]))
+			elif command == 'tick':
+				accumulator = flags = _int32(self.pi.get_current_tick())
+			elif command in ('inr', 'dcr'):
+				index = int(operands[0][1:])
+				self.variables[index] += 1 if command == 'inr' else -1
+				flags = self.variables[index]
+			elif command == 'cmp':
+				flags = _int32(accumulator - self._value(operands[0]))
+			elif command in ('jmp', 'jz', 'jnz', 'jm', 'jp'):
+				if (command == 'jmp' or (command == 'jz' and flags == 0) or
+						(command == 'jnz' and flags != 0) or
+						(command == 'jm' and flags < 0) or
+						(command == 'jp' and flags >= 0)):
+					position = self.tags[operands[0]]
+			elif command == 'mils':
+				autopylot.clock.sleep(self._value(operands[0]) / 1000)
+			elif command == 'servo':
+				self.pi.set_servo_pulsewidth(self._value(operands[0]),
+											self._value(operands[1]))
+			elif command == 'wvhlt':
+				self.pi.wave_tx_stop()
+			elif command == 'halt':
+				break
+			else:
+				self.status = PI_SCRIPT_FAILED
+				return
+		self.status = PI_SCRIPT_HALTED
+
+
+class FakePi():
+	""" Stand-in for pigpio.pi - keeps the state of the pins in dicts and
+	calls the registered callbacks for emitted edges. Waveforms are captured
+	(waves holds the pulses of each wave, sent_waves the ids in the order
+	they were sent) - see wave_timeline. """
+
+	def __init__(self):
+		self.connected = True
+		self.pulsewidths = {}
+		self.watchdogs = {}
+		self.modes = {}
+		self.scripts = {}
+		self.waves = {}
+		self.sent_waves = []
+		self.wave_modes = []
+		self.transmitting = None
+		self._pending_pulses = []
+		self._callbacks = []
+		self._lock = threading.Lock()
+		self._start = autopylot.clock.ticks()
+
+	def get_current_tick(self):
+		""" Microseconds since start (wraps at 2^32 like pigpio) """
+		return (autopylot.clock.ticks() - self._start) & 0xffffffff
+
+	def callback(self, pin, edge=RISING_EDGE, func=None):
+		callback = FakeCallback(self, pin, edge, func)
+		self._callbacks.append(callback)
+		return callback
+
+	def emit(self, pin, level=1, tick=None):
+		""" Emits an edge on the pin (level 1 = rising, 0 = falling,
+		TIMEOUT = watchdog) - calls the matching callbacks in the calling
+		thread like the pigpio callback thread would """
+		if tick is None:
+			tick = self.get_current_tick()
+		for callback in list(self._callbacks):
+			if callback.pin != pin:
+				continue
+			if (callback.edge == EITHER_EDGE or level == TIMEOUT or
+					(callback.edge == RISING_EDGE and level == 1) or
+					(callback.edge == FALLING_EDGE and level == 0)):
+				callback.func(pin, level, tick)
+
+	def set_servo_pulsewidth(self, pin, pulsewidth):
+		with self._lock:
+			self.pulsewidths[pin] = pulsewidth
+		return 0
+
+	def get_servo_pulsewidth(self, pin):
+		return self.pulsewidths.get(pin, 0)
+
+	def set_watchdog(self, pin, timeout):
+		self.watchdogs[pin] = timeout
+		return 0
+
+	def set_mode(self, pin, mode):
+		self.modes[pin] = mode
+		return 0
+
+	def wave_add_generic(self, pulses):
+		self._pending_pulses.extend((pulse.gpio_on, pulse.gpio_off,
+									pulse.delay) for pulse in pulses)
+		return len(self._pending_pulses)
+
+	def wave_create(self):
+		wave = 0
+		while wave in self.waves:
+			wave += 1
+		self.waves[wave] = self._pending_pulses
+		self._pending_pulses = []
+		return wave
+
+	def wave_send_using_mode(self, wave, mode):
+		if wave not in self.waves:
+			raise Exception("Unknown wave id {!s}".format(wave))
+		self.sent_waves.append(wave)
+		self.wave_modes.append(mode)
+		# the sync modes take over at the end of the current cycle - the
+		# fake switches at once
+		self.transmitting = wave
+		return sum(delay for _, _, delay in self.waves[wave])
+
+	def wave_tx_at(self):
+		# like pigpio: 9999 = no wave
+		return 9999 if self.transmitting is None else self.transmitting
+
+	def wave_tx_busy(self):
+		return int(self.transmitting is not None)
+
+	def wave_tx_stop(self):
+		self.transmitting = None
+		return 0
+
+	def wave_delete(self, wave):
+		if wave == self.transmitting:
+			raise Exception("Wave {!s} is still transmitted".format(wave))
+		del self.waves[wave]
+		return 0
+
+	def wave_clear(self):
+		self.waves = {}
+		self._pending_pulses = []
+		self.transmitting = None
+		return 0
+
+	def store_script(self, script):
+		if isinstance(script, bytes):
+			script = script.decode()
+		script_id = len(self.scripts)
+		while script_id in self.scripts:
+			script_id += 1
+		self.scripts[script_id] = FakeScript(self, script)
+		return script_id
+
+	def run_script(self, script_id, params=None):
+		self.scripts[script_id].run(params)
+		return 0
+
+	def update_script(self, script_id, params=None):
+		for index, value in enumerate(params or []):
+			self.scripts[script_id].params[index] = value
+		return 0
+
+	def script_status(self, script_id):
+		script = self.scripts[script_id]
+		return script.status, list(script.params)
+
+	def stop_script(self, script_id):
+		self.scripts[script_id].stop()
+		return 0
+
+	def delete_script(self, script_id):
+		self.scripts.pop(script_id).stop()
+		return 0
+
+	def stop(self):
+		for script in self.scripts.values():
+			script.stop()
+		self.connected = False
+
+
+class FakeInterruptSource():
+	""" Emits data ready interrupts on a FakePi pin at a fixed rate (in its
+	own thread, like the sensor would). Every drop_every-th interrupt is
+	left out (0 = never) to simulate missed interrupts. """
+
+	def __init__(self, pi, pin, sample_rate, drop_every=0):
+		self.pi = pi
+		self.pin = pin
+		self.period = 1.0 / sample_rate
+		self.drop_every = drop_every
+		self.emitted = 0
+		self._running = False
+		self._thread = None
+
+	def start(self):
+		self._running = True
+		self._thread = threading.Thread(target=self._run, daemon=True,
+										name='fake-interrupts')
+		self._thread.start()
+
+	def stop(self):
+		self._running = False
+		if self._thread is not None:
+			self._thread.join()
+
+	def _run(self):
+		count = 0
+		next_time = autopylot.clock.now()
+		while self._running:
+			next_time += self.period
+			delay = next_time - autopylot.clock.now()
+			if delay > 0:
+				autopylot.clock.sleep(delay)
+			count += 1
+			if self.drop_every and count % self.drop_every == 0:
+				continue
+			self.pi.emit(self.pin, 1,
+						int(count * self.period * 1e6) & 0xffffffff)
+			self.emitted += 1
+
+
+class FakeI2CBus():
+	""" Stand-in for smbus.SMBus - 256 byte registers per device address.
+	A transaction takes overhead + bytes * byte_time seconds (default:
+	roughly 400kHz with start, address and register byte). A call into the
+	bus takes call_overhead on top (the system call, transfer setup and
+	wake-up of a bus driver - roughly 100µs on a Raspberry Pi, 0 by
+	default). It counts transactions which overlap in time (two threads on
+	the bus at once). """
+
+	def __init__(self, overhead=60e-6, byte_time=22.5e-6, history=None,
+				call_overhead=0.0):
+		self.overhead = overhead
+		self.byte_time = byte_time
+		self.call_overhead = call_overhead
+		self.devices = {}
+		self.registers = {}
+		# the last history transactions only (long benchmarks) - all if None
+		self.transactions = ([] if history is None
+							else collections.deque(maxlen=history))
+		self.overlaps = 0
+		self._active = 0
+		self._lock = threading.Lock()
+
+	def add_device(self, address, registers=None):
+		""" Adds a device - registers is an optional {register: value} """
+		device = FakeDevice(address)
+		for register, value in (registers or {}).items():
+			device.registers[register] = value
+		self.attach(device)
+
+	def attach(self, device):
+		""" Adds a fake device model (like FakeHmc5883l) """
+		self.devices[device.address] = device
+		self.registers[device.address] = device.registers
+
+	def _transaction(self, kind, address, register, length):
+		self._transfer(((kind, address, register, length),),
+					self.overhead + length * self.byte_time)
+
+	def _transfer(self, transactions, duration):
+		for _, address, _, _ in transactions:
+			if address not in self.devices:
+				raise OSError(121, "Remote I/O error")
+		with self._lock:
+			self._active += 1
+			if self._active > 1:
+				self.overlaps += 1
+			self.transactions.extend(transactions)
+		autopylot.clock.spin(self.call_overhead + duration)
+		with self._lock:
+			self._active -= 1
+
+	def read_byte_data(self, address, register):
+		self._transaction('read', address, register, 1)
+		return self.devices[address].read(register, 1)[0]
+
+	def read_word_data(self, address, register):
+		self._transaction('read', address, register, 2)
+		low, high = self.devices[address].read(register, 2)
+		return low | (high << 8)
+
+	def read_i2c_block_data(self, address, register, length=32):
+		self._transaction('read', address, register, length)
+		return list(self.devices[address].read(register, length))
+
+	def read_into(self, address, register, buffer):
+		""" like autopylot.imu.DevI2C - fills the buffer """
+		self._transaction('read', address, register, len(buffer))
+		buffer[:] = self.devices[address].read(register, len(buffer))
+		return len(buffer)
+
+	def read_many_into(self, requests):
+		""" like autopylot.imu.DevI2C - one combined transfer of the
+		(address, register, buffer) requests: the bus time of every block,
+		the call_overhead once """
+		transactions = [('read', address, register, len(buffer))
+						for address, register, buffer in requests]
+		self._transfer(transactions, sum(
+			self.overhead + length * self.byte_time
+			for _, _, _, length in transactions))
+		for address, register, buffer in requests:
+			buffer[:] = self.devices[address].read(register, len(buffer))
+
+	def write_byte_data(self, address, register, value):
+		self._transaction('write', address, register, 1)
+		self.devices[address].write(register, [value & 0xff])
+
+	def write_i2c_block_data(self, address, register, data):
+		self._transaction('write', address, register, len(data))
+		self.devices[address].write(register, data)
+
+
+class FakeDevice():
+	""" Base of the fake device models - a plain register file. Models with
+	special registers (FIFOs, memory ports) override read / write. """
+
+	def __init__(self, address):
+		self.address = address
+		self.registers = bytearray(256)
+
+	def read(self, register, length):
+		return bytes(self.registers[register:register + length])
+
+	def write(self, register, data):
+		self.registers[register:register + len(data)] = bytes(data)
+
+	def _pack(self, register, format, *values):
+		data = struct.pack(format, *(int(round(value)) for value in values))
+		self.registers[register:register + len(data)] = data
+
+
+class FakeMpu6050(FakeDevice):
+	""" MPU-6050 at ±8g / ±2000°/s """
+
+	def __init__(self, address=0x68):
+		super().__init__(address)
+		self.registers[0x75] = 0x68  # WHO_AM_I
+		self.set_motion((0.0, 0.0, 9.80665), (0.0, 0.0, 0.0))
+
+	def set_motion(self, accel, gyro, temperature=25.0):
+		""" Sets the acceleration (m/s²), rotation (°/s) and temperature """
+		self._pack(0x3b, '>7h', *([value * 4096 / 9.80665 for value in accel] +
+								[(temperature - 36.53) * 340] +
+								[value * 16.4 for value in gyro]))
+
+
+class FakeHmc5883l(FakeDevice):
+	""" HMC5883L at ±1.3Ga """
+
+	def __init__(self, address=0x1e):
+		super().__init__(address)
+		self.registers[0x0a:0x0d] = b'H43'  # identification
+		self.set_field((20.0, 0.0, -40.0))
+
+	def set_field(self, field):
+		""" Sets the magnetic field (x, y, z) in µT """
+		x, y, z = (value * 1090 / 100 for value in field)
+		self._pack(0x03, '>3h', x, z, y)
+
+
+class FakeQmc5883l(FakeDevice):
+	""" QMC5883L at ±8G """
+
+	def __init__(self, address=0x0d):
+		super().__init__(address)
+		self.registers[0x0d] = 0xff  # chip id
+		self.set_field((20.0, 0.0, -40.0))
+
+	def set_field(self, field):
+		""" Sets the magnetic field (x, y, z) in µT """
+		self._pack(0x00, '<3h', *(value * 3000 / 100 for value in field))
+
+
+class FakeBmp280(FakeDevice):
+	""" BMP280 with the calibration of the datasheet example """
+	CALIBRATION = (27504, 26435, -1000, 36477, -10685, 3024, 2855, 140, -7,
+				15500, -14600, 6000)
+
+	def __init__(self, address=0x76):
+		super().__init__(address)
+		self.registers[0xd0] = 0x58  # chip id
+		self._pack(0x88, '<HhhHhhhhhhhh', *self.CALIBRATION)
+		self.set_raw(519888, 415148)  # 25.08°C, 100653.27Pa
+
+	def set_raw(self, adc_t, adc_p):
+		""" Sets the raw (20 bit) temperature and pressure values """
+		self.registers[0xf7:0xfd] = bytes([
+			(adc_p >> 12) & 0xff, (adc_p >> 4) & 0xff, (adc_p & 0x0f) << 4,
+			(adc_t >> 12) & 0xff, (adc_t >> 4) & 0xff, (adc_t & 0x0f) << 4])
+
+	def set_pressure(self, pressure, temperature=25.0):
+		""" Sets the raw values closest to the pressure (Pa) and
+		temperature (°C) - found by bisection """
+		def compensate(adc_t, adc_p):
+			return autopylot.drivers.compensate_bmp280(self.CALIBRATION,
+													adc_t, adc_p)
+		low, high = 0, (1 << 20) - 1
+		while low < high:
+			middle = (low + high) // 2
+			if compensate(middle, 0)[1] < temperature:
+				low = middle + 1
+			else:
+				high = middle
+		adc_t = low
+		# the pressure falls with the raw value
+		low, high = 0, (1 << 20) - 1
+		while low < high:
+			middle = (low + high) // 2
+			if compensate(adc_t, middle)[0] > pressure:
+				low = middle + 1
+			else:
+				high = middle
+		self.set_raw(adc_t, low)
+
+
+class FakeDmpDevice(FakeMpu6050):
+	""" MPU-6050 with the DMP memory port, the FIFO and the interrupt
+	status. It serves the given (recorded) DMP packets - but only after the
+	firmware was uploaded intact and the DMP was enabled, like the chip.
+	With a FakePi and pin every served packet emits a data ready interrupt. """
+
+	def __init__(self, address=0x68, packets=(), pi=None, pin=None):
+		super().__init__(address)
+		self.memory = bytearray(16 * 256)
+		self.packets = list(packets)
+		self.served = 0
+		self.pi = pi
+		self.pin = pin
+		# set when the program start address is written after an intact
+		# firmware upload
+		self.firmware_loaded = False
+		self._pointer = 0
+		self._fifo = bytearray()
+		self._overflow = False
+		self._lock = threading.Lock()
+
+
+	@property
+	def running(self):
+		""" True if the DMP and the FIFO are enabled """
+		return (self.firmware_loaded and
+				self.registers[0x6a] & 0xc0 == 0xc0)
+
+	def read(self, register, length):
+		with self._lock:
+			if register == 0x6f:  # MEM_R_W
+				data = bytes(self.memory[self._pointer:self._pointer + length])
+				self._pointer += length
+				return data
+			if register == 0x72:  # FIFO_COUNT_H (and L)
+				return len(self._fifo).to_bytes(2, 'big')[:length]
+			if register == 0x74:  # FIFO_R_W
+				data = bytes(self._fifo[:length])
+				del self._fifo[:length]
+				return data + bytes(length - len(data))
+			if register == 0x3a:  # INT_STATUS (cleared on read)
+				status = 0x10 if self._overflow else 0x00
+				self._overflow = False
+				return bytes([status])
+		return super().read(register, length)
+
+	def write(self, register, data):
+		with self._lock:
+			if register == 0x6d and len(data) >= 2:  # BANK_SEL + MEM_START
+				self._pointer = (data[0] << 8) | data[1]
+			elif register == 0x6f:  # MEM_R_W
+				self.memory[self._pointer:self._pointer + len(data)] = \
+					bytes(data)
+				self._pointer += len(data)
+				return
+			elif register == 0x70:  # PRGM_START_H (and L)
+				firmware = autopylot.dmpfirmware.FIRMWARE
+				start = autopylot.dmpfirmware.START_ADDRESS
+				self.firmware_loaded = (
+					self.memory[:len(firmware)] == firmware and
+					list(data[:2]) == [start >> 8, start & 0xff])
+			elif register == 0x6a and data[0] & 0x04:  # FIFO_RST
+				self._fifo.clear()
+				self._overflow = False
+				data = [data[0] & ~0x0c] + list(data[1:])
+		super().write(register, data)
+
+	def push(self, packet):
+		""" Writes a packet into the FIFO (1024 bytes - the oldest bytes are
+		lost on an overflow) """
+		if not self.running:
+			raise Exception("DMP is not running")
+		with self._lock:
+			self._fifo += packet
+			if len(self._fifo) > 1024:
+				del self._fifo[:len(self._fifo) - 1024]
+				self._overflow = True
+		if self.pi is not None:
+			self.pi.emit(self.pin, 1)
+
+	def serve(self, count=1):
+		""" Pushes the next count recorded packets - returns the number of
+		packets pushed """
+		packets = self.packets[self.served:self.served + count]
+		for packet in packets:
+			self.push(packet)
+		self.served += len(packets)
+		return len(packets)
+
+
+def wave_timeline(pulses, pin):
+	""" Returns the levels of the pin during a captured wave (pulses as
+	(gpio_on, gpio_off, delay) tuples) as a list of (level, µs) - adjacent
+	equal levels are merged. The pin starts low. """
+	timeline = []
+	level = 0
+	mask = 1 << pin
+	for gpio_on, gpio_off, delay in pulses:
+		if gpio_on & mask:
+			level = 1
+		if gpio_off & mask:
+			level = 0
+		if delay == 0:
+			continue
+		if timeline and timeline[-1][0] == level:
+			timeline[-1] = (level, timeline[-1][1] + delay)
+		else:
+			timeline.append((level, delay))
+	return timeline
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,262 @@
+""" Streaming digital filters for the IMU data. Each stage processes blocks
+of 3-axis samples ((n, 3) numpy arrays) in one call and keeps its state
+between the calls - so splitting the data into blocks (of any size) gives
+the same result as processing it at once.
+
+Pipelines are configured in the config.ini [FILTER] section as a space
+separated list of stages:
+
+	lowpass:<cutoff hz>[:<q>]   2nd order (biquad) low-pass
+	notch:<center hz>[:<q>]     2nd order (biquad) notch
+	dynnotch:<start hz>[:<q>]   notch retuned on the fly by the
+	                            VibrationAnalyzer (autopylot.vibration)
+	median:<window>             moving median over the last window samples
+	spike                       rejects isolated (single) non zero samples
+	none                        no filtering
+"""
+
+import math
+import time
+import logging
+
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+AXES = 3
+
+
+class Biquad():
+	""" 2nd order IIR filter (direct form II transposed) with separate
+	coefficients for each axis. Coefficients are normalized (a0 = 1). """
+
+	def __init__(self, b, a):
+		self.set_coefficients(b, a)
+		self.reset()
+
+	def set_coefficients(self, b, a):
+		""" Sets the coefficients - b (b0, b1, b2) and a (1, a1, a2) are
+		either the same for all axes or one triple per axis. The filter
+		state is kept, so the filter can be retuned while running. """
+		b = numpy.broadcast_to(numpy.asarray(b, dtype=float), (AXES, 3))
+		a = numpy.broadcast_to(numpy.asarray(a, dtype=float), (AXES, 3))
+		self._coefficients = [(b[axis, 0], b[axis, 1], b[axis, 2],
+							a[axis, 1], a[axis, 2]) for axis in range(AXES)]
+
+	def reset(self):
+		self._state = [(0.0, 0.0)] * AXES
+
+	def process(self, block):
+		""" Filters the (n, 3) block - the recursion has to run sample by
+		sample, so this is a tight scalar loop per axis """
+		out = numpy.empty((len(block), AXES))
+		for axis in range(AXES):
+			b0, b1, b2, a1, a2 = self._coefficients[axis]
+			z1, z2 = self._state[axis]
+			result = block[:, axis].tolist()
+			for index, x in enumerate(result):
+				y = b0 * x + z1
+				z1 = b1 * x - a1 * y + z2
+				z2 = b2 * x - a2 * y
+				result[index] = y
+			self._state[axis] = (z1, z2)
+			out[:, axis] = result
+		return out
+
+
+def lowpass_coefficients(cutoff, sample_rate, q=1 / math.sqrt(2)):
+	""" Returns (b, a) of a biquad low-pass (RBJ audio EQ cookbook) """
+	omega = 2 * math.pi * cutoff / sample_rate
+	alpha = math.sin(omega) / (2 * q)
+	cos = math.cos(omega)
+	a0 = 1 + alpha
+	b = [(1 - cos) / 2 / a0, (1 - cos) / a0, (1 - cos) / 2 / a0]
+	a = [1.0, -2 * cos / a0, (1 - alpha) / a0]
+	return b, a
+
+
+def notch_coefficients(frequency, sample_rate, q=2.0):
+	""" Returns (b, a) of a biquad notch (RBJ audio EQ cookbook) """
+	omega = 2 * math.pi * frequency / sample_rate
+	alpha = math.sin(omega) / (2 * q)
+	cos = math.cos(omega)
+	a0 = 1 + alpha
+	b = [1 / a0, -2 * cos / a0, 1 / a0]
+	a = [1.0, -2 * cos / a0, (1 - alpha) / a0]
+	return b, a
+
+
+def lowpass(cutoff, sample_rate, q=1 / math.sqrt(2)):
+	""" Returns a biquad low-pass stage """
+	if not 0 < cutoff < sample_rate / 2:
+		raise Exception("Low-pass cutoff ({!s}Hz) has to be between 0 and "
+						"half the sample rate ({!s}Hz)"
+						.format(cutoff, sample_rate))
+	return Biquad(*lowpass_coefficients(cutoff, sample_rate, q))
+
+
+def notch(frequency, sample_rate, q=2.0):
+	""" Returns a biquad notch stage """
+	if not 0 < frequency < sample_rate / 2:
+		raise Exception("Notch frequency ({!s}Hz) has to be between 0 and "
+						"half the sample rate ({!s}Hz)"
+						.format(frequency, sample_rate))
+	return Biquad(*notch_coefficients(frequency, sample_rate, q))
+
+
+class AdaptiveNotch(Biquad):
+	""" Notch whose center frequency can be changed (per axis) while
+	running - used by the VibrationAnalyzer to follow motor vibrations """
+
+	def __init__(self, frequency, sample_rate, q=2.0):
+		self.sample_rate = float(sample_rate)
+		self.q = float(q)
+		self.frequencies = [float(frequency)] * AXES
+		super().__init__(*notch_coefficients(frequency, sample_rate, q))
+
+	def set_frequencies(self, frequencies):
+		""" Retunes the notch - one center frequency per axis """
+		coefficients = [notch_coefficients(frequency, self.sample_rate,
+											self.q)
+						for frequency in frequencies]
+		self.set_coefficients([b for b, _ in coefficients],
+							[a for _, a in coefficients])
+		self.frequencies = [float(frequency) for frequency in frequencies]
+
+
+class MedianFilter():
+	""" Moving median over the last window samples (per axis) """
+
+	def __init__(self, window):
+		self.window = int(window)
+		if self.window < 1:
+			raise Exception("Median window has to be at least 1")
+		self.reset()
+
+	def reset(self):
+		self._history = None
+
+	def process(self, block):
+		if len(block) == 0:
+			return numpy.empty((0, AXES))
+		if self._history is None:
+			# start as if the first sample was there all the time
+			self._history = numpy.repeat(block[:1], self.window - 1, axis=0)
+		data = numpy.concatenate((self._history, block))
+		self._history = data[len(data) - (self.window - 1):]
+		windows = sliding_window_view(data, self.window, axis=0)
+		return numpy.median(windows, axis=-1)
+
+
+class DeadBand():
+	""" Sets all values within [low, high] (per axis) to 0 """
+
+	def __init__(self, low, high):
+		self.low = numpy.asarray(low, dtype=float)
+		self.high = numpy.asarray(high, dtype=float)
+
+	def reset(self):
+		pass
+
+	def process(self, block):
+		return numpy.where((block >= self.low) & (block <= self.high),
+						0.0, block)
+
+
+class SpikeRejection():
+	""" Rejects anomalies - a non zero value is only kept if the sample
+	before was not 0 as well. Meant to run after a DeadBand, where noise
+	is 0 and a single non zero sample is most likely a spike. """
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self._before = numpy.zeros(AXES)
+
+	def process(self, block):
+		if len(block) == 0:
+			return numpy.empty((0, AXES))
+		before = numpy.vstack((self._before, block[:-1]))
+		self._before = block[-1].copy()
+		return numpy.where(before != 0, block, 0.0)
+
+
+class FilterPipeline():
+	""" Chain of filter stages - the output of a stage is the input of the
+	next one """
+
+	def __init__(self, stages=()):
+		self.stages = list(stages)
+
+	def __len__(self):
+		return len(self.stages)
+
+	def reset(self):
+		for stage in self.stages:
+			stage.reset()
+
+	def process(self, block):
+		""" Filters a (n, 3) block and returns the filtered (n, 3) block """
+		block = numpy.asarray(block, dtype=float).reshape(-1, AXES)
+		for stage in self.stages:
+			block = stage.process(block)
+		return block
+
+	def benchmark(self, block_size=1000, blocks=20):
+		""" Measures the throughput of each stage with random data. Returns a
+		list of (stage name, samples per second). The stages are reset
+		afterwards. """
+		data = numpy.random.RandomState(0).normal(0, 1, (block_size, AXES))
+		results = []
+		for stage in self.stages:
+			stage.reset()
+			start_time = time.perf_counter()
+			for _ in range(blocks):
+				stage.process(data)
+			elapsed = time.perf_counter() - start_time
+			stage.reset()
+			results.append((stage.__class__.__name__,
+							block_size * blocks / elapsed))
+		return results
+
+
+def fit_spec(spec, sample_rate):
+	""" Returns the spec without the stages tuned to half the sample rate
+	or above (they could not be built) - a warning is logged for each """
+	tokens = []
+	for token in spec.split():
+		name, *args = token.lower().split(':')
+		if (name in ('lowpass', 'notch', 'dynnotch') and args and
+				float(args[0]) >= sample_rate / 2):
+			logging.warning("Dropping the filter stage {!s} - it is not below "
+							"half the sample rate ({!s}Hz)".format(
+								token, sample_rate))
+			continue
+		tokens.append(token)
+	return " ".join(tokens) if tokens else "none"
+
+
+def build_pipeline(spec, sample_rate):
+	""" Builds a FilterPipeline from a config string (see module doc) """
+	stages = []
+	for token in spec.lower().split():
+		name, *args = token.split(':')
+		args = [float(arg) for arg in args]
+		if name == 'none':
+			continue
+		elif name == 'lowpass':
+			stages.append(lowpass(args[0], sample_rate, *args[1:]))
+		elif name == 'notch':
+			stages.append(notch(args[0], sample_rate, *args[1:]))
+		elif name == 'dynnotch':
+			notch(args[0], sample_rate)  # validates the frequency
+			stages.append(AdaptiveNotch(args[0], sample_rate, *args[1:]))
+		elif name == 'median':
+			stages.append(MedianFilter(int(args[0])))
+		elif name == 'spike':
+			stages.append(SpikeRejection())
+		else:
+			raise Exception("Unknown filter stage: {!s}".format(token))
+	return FilterPipeline(stages)
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,299 @@
+""" Columnar, time indexed flight log. Each signal (timestamps, throttle per
+motor, gyro xyz, accel xyz) is stored as its own column in a raw binary
+file which is appended chunk by chunk. A sparse time index (first timestamp
+of each chunk) makes it possible to find any time range with two binary
+searches. The reader memory maps the columns and returns numpy views - so
+only the pages of the requested range are ever read from the disk.
+
+Layout of a log directory:
+
+	meta.json          column names / dtypes, chunk size
+	<column>.col       raw column data (little endian)
+	index.col          sparse time index (first timestamp of each chunk)
+	event_*.col        timestamp, level, offset and length of each event
+	events.txt         utf-8 text of all events
+
+Use convert_blackbox to convert an existing text log (autopylot.blackbox)
+into this format. """
+
+import os
+import re
+import json
+import logging
+import datetime
+
+import numpy
+
+LOG_VERSION = 1
+META_FILE = 'meta.json'
+EVENTS_FILE = 'events.txt'
+EVENT_COLUMNS = {'event_t': '<f8', 'event_level': '<i2',
+				'event_offset': '<i8', 'event_length': '<i4'}
+
+
+def signal_columns(motor_count):
+	""" Returns the (ordered) signal columns and their dtypes """
+	columns = [('t', '<f8')]
+	columns += [('throttle_{!s}'.format(motor), '<f4')
+				for motor in range(motor_count)]
+	columns += [('gyro_' + axis, '<f4') for axis in 'xyz']
+	columns += [('accel_' + axis, '<f4') for axis in 'xyz']
+	return columns
+
+
+def _column_file(directory, name):
+	return os.path.join(directory, name + '.col')
+
+
+class FlightLogWriter():
+	""" Appends rows to a columnar flight log. Signals which are not given
+	for a row keep their last value (throttle starts at 0, gyro and accel
+	as NaN). Rows are buffered in a preallocated chunk and written out
+	column by column when the chunk is full. """
+
+	def __init__(self, directory, motor_count=4, chunk_rows=4096):
+		self.directory = directory
+		self.motor_count = int(motor_count)
+		self.chunk_rows = int(chunk_rows)
+		self._columns = signal_columns(self.motor_count)
+		os.makedirs(directory, exist_ok=True)
+
+		self._chunk = numpy.empty((self.chunk_rows, len(self._columns)))
+		self._last = numpy.zeros(len(self._columns))
+		self._last[1 + self.motor_count:] = numpy.nan
+		self._last[0] = -numpy.inf
+		self._length = 0
+		self._rows = 0
+		self._event_offset = 0
+
+		meta = {'version': LOG_VERSION, 'chunk_rows': self.chunk_rows,
+				'motor_count': self.motor_count,
+				'columns': self._columns, 'events': list(EVENT_COLUMNS.items())}
+		with open(os.path.join(directory, META_FILE), 'w') as meta_file:
+			json.dump(meta, meta_file)
+
+		self._files = {name: open(_column_file(directory, name), 'wb')
+					for name, _ in self._columns}
+		self._index_file = open(_column_file(directory, 'index'), 'wb')
+		self._event_files = {name: open(_column_file(directory, name), 'wb')
+							for name in EVENT_COLUMNS}
+		self._events_file = open(os.path.join(directory, EVENTS_FILE), 'wb')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def append(self, t, throttle=None, gyro=None, accel=None):
+		""" Appends one row at time t (seconds). throttle is a sequence of
+		motor_count values (or a dict {motor_index: value}), gyro and accel
+		three values each. Timestamps must not decrease. """
+		if t < self._last[0]:
+			raise Exception("Flight log timestamps must not decrease "
+							"({!s} < {!s})".format(t, self._last[0]))
+		row = self._last
+		row[0] = t
+		if throttle is not None:
+			if isinstance(throttle, dict):
+				for motor, value in throttle.items():
+					row[1 + motor] = value
+			else:
+				row[1:1 + self.motor_count] = throttle
+		offset = 1 + self.motor_count
+		if gyro is not None:
+			row[offset:offset + 3] = gyro
+		if accel is not None:
+			row[offset + 3:offset + 6] = accel
+
+		self._chunk[self._length] = row
+		self._length += 1
+		if self._length == self.chunk_rows:
+			self._write_chunk()
+
+	def log_event(self, t, level, message):
+		""" Appends a (text) event - level is a logging level """
+		data = str(message).encode('utf-8')
+		values = {'event_t': t, 'event_level': level,
+				'event_offset': self._event_offset, 'event_length': len(data)}
+		for name, dtype in EVENT_COLUMNS.items():
+			self._event_files[name].write(
+				numpy.array(values[name], dtype=dtype).tobytes())
+		self._events_file.write(data)
+		self._event_offset += len(data)
+
+	def _write_chunk(self):
+		""" Writes the buffered rows (one chunk) to the column files.
+		Only the last chunk of a log may be shorter than chunk_rows. """
+		if self._length == 0:
+			return
+		chunk = self._chunk[:self._length]
+		for column, (name, dtype) in enumerate(self._columns):
+			self._files[name].write(
+				numpy.ascontiguousarray(chunk[:, column], dtype=dtype).tobytes())
+			self._files[name].flush()
+		# sparse index - first timestamp of the chunk
+		self._index_file.write(numpy.array(chunk[0, 0], dtype='<f8').tobytes())
+		self._index_file.flush()
+		for event_file in list(self._event_files.values()) + [self._events_file]:
+			event_file.flush()
+		self._rows += self._length
+		self._length = 0
+
+	def close(self):
+		""" Writes the last (partial) chunk and closes all files """
+		self._write_chunk()
+		files = list(self._files.values()) + list(self._event_files.values())
+		for column_file in files + [self._index_file, self._events_file]:
+			column_file.close()
+
+
+class FlightLogReader():
+	""" Memory maps a columnar flight log and returns numpy views for time
+	ranges without reading the whole file. """
+
+	def __init__(self, directory):
+		self.directory = directory
+		with open(os.path.join(directory, META_FILE)) as meta_file:
+			meta = json.load(meta_file)
+		if meta['version'] != LOG_VERSION:
+			raise Exception("Unsupported flight log version: {!s}"
+							.format(meta['version']))
+		self.chunk_rows = meta['chunk_rows']
+		self.motor_count = meta['motor_count']
+		self.columns = [name for name, _ in meta['columns']]
+		self._data = {name: self._map(name, dtype)
+					for name, dtype in meta['columns']}
+		self._index = self._map('index', '<f8')
+		self._events = {name: self._map(name, dtype)
+						for name, dtype in meta['events']}
+		self._events_text = self._map_file(
+			os.path.join(directory, EVENTS_FILE), 'u1')
+
+	def _map(self, name, dtype):
+		return self._map_file(_column_file(self.directory, name), dtype)
+
+	@staticmethod
+	def _map_file(filename, dtype):
+		""" numpy.memmap can not map empty files """
+		if os.path.getsize(filename) == 0:
+			return numpy.empty(0, dtype=dtype)
+		return numpy.memmap(filename, dtype=dtype, mode='r')
+
+	def __len__(self):
+		return len(self._data['t'])
+
+	def find_rows(self, start, stop):
+		""" Returns the (first, last + 1) row of the time range
+		[start, stop] - using the sparse index to only touch the chunks
+		at the borders of the range """
+		timestamps = self._data['t']
+		return (self._search(timestamps, start, 'left'),
+				self._search(timestamps, stop, 'right'))
+
+	def _search(self, timestamps, value, side):
+		# the chunk holding the searched row - for equal timestamps across
+		# a chunk border the left side has to start in the previous chunk
+		chunk = numpy.searchsorted(self._index, value, side=side) - 1
+		if chunk < 0:
+			return 0
+		begin = chunk * self.chunk_rows
+		end = min(begin + self.chunk_rows, len(timestamps))
+		return begin + int(numpy.searchsorted(timestamps[begin:end], value,
+											side=side))
+
+	def read(self, start, stop, columns=None):
+		""" Returns a dict of (read only) numpy views of the given columns
+		(default: all) for the time range [start, stop] """
+		first, last = self.find_rows(start, stop)
+		names = self.columns if columns is None else columns
+		return {name: self._data[name][first:last] for name in names}
+
+	def throttle(self, start, stop):
+		""" Returns the timestamps and the (n, motor_count) throttle values
+		for the time range [start, stop] """
+		names = ['throttle_{!s}'.format(motor)
+				for motor in range(self.motor_count)]
+		data = self.read(start, stop, ['t'] + names)
+		return data['t'], numpy.column_stack([data[name] for name in names])
+
+	def events(self, start=-numpy.inf, stop=numpy.inf):
+		""" Returns a list of (t, level, message) of all events within the
+		time range [start, stop] """
+		timestamps = self._events['event_t']
+		first = numpy.searchsorted(timestamps, start, side='left')
+		last = numpy.searchsorted(timestamps, stop, side='right')
+		events = []
+		for index in range(first, last):
+			offset = int(self._events['event_offset'][index])
+			length = int(self._events['event_length'][index])
+			message = bytes(self._events_text[offset:offset + length])
+			events.append((float(timestamps[index]),
+						int(self._events['event_level'][index]),
+						message.decode('utf-8')))
+		return events
+
+
+# format of the (text) log - see autopylot.config
+_BLACKBOX_LINE = re.compile(r"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\.(\d{3})\] "
+							r"(\w+) \[[^\]]*\] (.*)$")
+_THROTTLE_MESSAGE = re.compile(r"Successfully adjusted throttle from -?\d+% "
+							r"to (-?\d+)% on pin (\d+)")
+_STOP_MESSAGE = re.compile(r"Successfully sent (?:start|stop) signal "
+						r"\(\d+\) to the pin (\d+)")
+
+
+def convert_blackbox(text_file, directory, pins=None, chunk_rows=4096):
+	""" Converts a text log (as written by the logging module configured
+	in autopylot.config) into a columnar flight log. Throttle changes become
+	rows (one column per motor pin - in the order of the given pins or the
+	order they show up in the log), every other message becomes an event.
+	Timestamps are seconds since the first log line. Returns the number of
+	rows written. """
+	pins = list(pins) if pins is not None else []
+	entries = []
+	with open(text_file, encoding='utf-8', errors='replace') as log_file:
+		for line in log_file:
+			line = line.rstrip('\n')
+			match = _BLACKBOX_LINE.match(line)
+			if match is None:
+				# continuation of a multi line message (i.e. a traceback)
+				if entries:
+					entries[-1][2] += '\n' + line
+				continue
+			date, millis, level, message = match.groups()
+			timestamp = (datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+						+ datetime.timedelta(milliseconds=int(millis)))
+			entries.append([timestamp, logging.getLevelName(level), message])
+
+	for _, _, message in entries:
+		match = _THROTTLE_MESSAGE.search(message) or \
+			_STOP_MESSAGE.search(message)
+		if match is not None and int(match.groups()[-1]) not in pins:
+			pins.append(int(match.groups()[-1]))
+
+	rows = 0
+	with FlightLogWriter(directory, len(pins), chunk_rows) as writer:
+		if not entries:
+			return rows
+		first = entries[0][0]
+		for timestamp, level, message in entries:
+			t = (timestamp - first).total_seconds()
+			throttle_match = _THROTTLE_MESSAGE.search(message)
+			stop_match = _STOP_MESSAGE.search(message)
+			if throttle_match is not None:
+				throttle, pin = throttle_match.groups()
+				writer.append(t, throttle={pins.index(int(pin)): int(throttle)})
+				rows += 1
+			elif stop_match is not None:
+				writer.append(t, throttle={pins.index(int(stop_match.group(1))): 0})
+				rows += 1
+			else:
+				if not isinstance(level, int):
+					level = logging.NOTSET
+				writer.log_event(t, level, message)
+	logging.info("Converted {!s} into a flight log at {!s} ({!s} rows, "
+				"pins: {!s})".format(text_file, directory, rows, pins))
+	return rows
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
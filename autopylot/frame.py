@@ -0,0 +1,104 @@
+""" Frame definition of the multicopter - the motors (name, pin, spin
+direction and position) come from the config.ini. At load time the frame
+builds the arrays of the motor bank and the mixing table, so the control
+code only loops over arrays - a hexa- or octocopter costs no extra code.
+
+Positions are angles in degrees from the front, clockwise seen from above
+(quad X: front right = 45, rear right = 135, rear left = 225, front left =
+315 / -45). Tilt directions use the same angles. """
+
+import logging
+
+import numpy
+
+import autopylot.config
+
+# tilt directions (degrees from the front, clockwise seen from above)
+TILT_FRONT = 0.0
+TILT_FRONT_RIGHT = 45.0
+TILT_LEFT = -90.0
+TILT_FRONT_LEFT = -45.0
+
+# mixing table columns
+PITCH = 0
+ROLL = 1
+YAW = 2
+
+
+class Frame():
+	""" Motor bank of the frame - names, pins, spin (+1 cw, -1 ccw) and
+	positions (degrees) are arrays in the order of the config.ini.
+	mixing is a (motors, 3) table of the throttle change per unit of pitch
+	(nose down), roll (right side down) and yaw (clockwise). """
+
+	def __init__(self, names, pins, cw_rotations, positions):
+		if not len(names) == len(pins) == len(cw_rotations) == len(positions):
+			raise Exception("Every motor needs a pin, rotation and position")
+		if len(names) < 3:
+			raise Exception("A frame needs at least 3 motors ({!s} given)"
+							.format(len(names)))
+		self.names = list(names)
+		self.pins = numpy.array(pins, dtype=int)
+		self.spin = numpy.where(numpy.array(cw_rotations, dtype=bool), 1, -1)
+		self.positions = numpy.array(positions, dtype=float)
+		angles = numpy.radians(self.positions)
+		# a motor in the direction of the tilt slows down - the opposite
+		# one speeds up (rounded to drop the sin / cos noise around 0)
+		self.mixing = numpy.round(numpy.column_stack((-numpy.cos(angles),
+													-numpy.sin(angles),
+													self.spin)), 9)
+		self._tilt_mixes = {}
+
+	def __len__(self):
+		return len(self.names)
+
+	def index(self, name):
+		""" Returns the index of the motor name in the bank """
+		return self.names.index(name)
+
+	def tilt_mix(self, direction):
+		""" Returns the throttle coefficients (-1 to 1) per motor to tilt
+		towards direction (degrees) - the motor which is the most in that
+		direction gets -1 """
+		mix = self._tilt_mixes.get(direction)
+		if mix is None:
+			angle = numpy.radians(direction)
+			mix = numpy.round(self.mixing[:, PITCH] * numpy.cos(angle) +
+							self.mixing[:, ROLL] * numpy.sin(angle), 9)
+			mix = numpy.round(mix / numpy.abs(mix).max(), 9)
+			self._tilt_mixes[direction] = mix
+		return mix
+
+	@property
+	def yaw_mix(self):
+		""" Returns the throttle coefficients per motor to yaw clockwise """
+		return self.mixing[:, YAW]
+
+	def check_rotations(self):
+		""" Checks the frame can hold its heading - as many cw as ccw motors
+		and neighbours spin in opposite directions. Returns True if fine. """
+		if self.spin.sum() != 0:
+			logging.critical("The frame needs as many cw as ccw motors "
+							"(spin: {!s})".format(dict(zip(self.names,
+															self.spin))))
+			return False
+		order = numpy.argsort(self.positions % 360)
+		neighbours = self.spin[order] * numpy.roll(self.spin[order], 1)
+		if (neighbours > 0).any():
+			logging.critical("Neighbouring motors should not be rotating in "
+							"the same direction (cw or ccw): {!s}".format(
+								[self.names[index] for index in order]))
+			return False
+		return True
+
+
+def load_frame():
+	""" Returns the Frame of the config.ini """
+	names = autopylot.config.get_motor_names()
+	return Frame(names,
+				[autopylot.config.get_motor_pin(name) for name in names],
+				[autopylot.config.get_motor_rotation_is_cw(name)
+				for name in names],
+				[autopylot.config.get_motor_position(name) for name in names])
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
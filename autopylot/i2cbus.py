@@ -0,0 +1,521 @@
+""" I2C bus scheduler. Only one thread (the owner) talks to the bus - all
+other threads submit transactions to the BusScheduler, which queues them by
+priority (IMU reads first, then temperature and magnetometer) and runs them
+one after another. Queued reads of adjacent (or overlapping) registers of the
+same device are merged into one block transfer. The scheduler keeps track of
+the bus utilization and the latency (submit until done) per device.
+
+The bus is a smbus.SMBus like object - or a FakeI2CBus (autopylot.fakes).
+ScheduledBus is a smbus like proxy, so drivers (like the mpu6050 module) can
+use the scheduler without knowing about it.
+
+The IMU reads (read_into / read_many_into of the proxy) take a separate
+path: each proxy queues one preallocated request which the owner reads
+straight into the caller's buffers (read_into of a DevI2C, see
+autopylot.imu) - no Future, no result list per sample. These requests are
+not merged. """
+
+import heapq
+import logging
+import threading
+import concurrent.futures
+
+import autopylot.clock
+
+PRIORITY_IMU = 0
+PRIORITY_TEMPERATURE = 1
+PRIORITY_MAGNETOMETER = 2
+
+# max length of a SMBus block transfer
+MAX_BLOCK = 32
+
+_READ = 'read'
+_WRITE = 'write'
+_READ_INTO = 'readinto'
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class _Transaction():
+	""" A queued read or write - ordered by priority, then by submit order """
+
+	def __init__(self, kind, address, register, length, data, priority,
+				sequence):
+		self.kind = kind
+		self.address = address
+		self.register = register
+		self.length = length
+		self.data = data
+		self.priority = priority
+		self.sequence = sequence
+		self.submitted = autopylot.clock.now()
+		self.future = concurrent.futures.Future()
+
+	def __lt__(self, other):
+		return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class _Request():
+	""" A read into caller provided buffers - allocated once per proxy and
+	queued again for every read. Either address, register and buffer are
+	set or requests (a sequence of (address, register, buffer)). """
+
+	def __init__(self, priority):
+		self.kind = _READ_INTO
+		self.priority = priority
+		self.queued = False
+		self.submitted = 0.0
+		self.address = None
+		self.register = None
+		self.buffer = None
+		self.requests = None
+		self.error = None
+		# held until the owner is done with the request
+		self.done = threading.Lock()
+		self.done.acquire()
+
+
+class DeviceStatistics():
+	""" Transaction count and latency (seconds) of one device """
+
+	def __init__(self):
+		self.transactions = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+
+	def add(self, latency):
+		self.transactions += 1
+		self.total_latency += latency
+		self.max_latency = max(self.max_latency, latency)
+
+	@property
+	def mean_latency(self):
+		if not self.transactions:
+			return 0.0
+		return self.total_latency / self.transactions
+
+	def to_dict(self):
+		return {'transactions': self.transactions,
+				'mean_latency': self.mean_latency,
+				'max_latency': self.max_latency}
+
+
+class BusScheduler():
+	""" Owns the bus - runs the submitted transactions in its own thread.
+	Call start() before submitting and stop() when done. """
+
+	def __init__(self, bus, name='i2c-bus'):
+		self.bus = bus
+		self.name = name
+		# looked up once - a bound method per read would be an allocation
+		self._bus_read_into = getattr(bus, 'read_into', None)
+		self._bus_read_many_into = getattr(bus, 'read_many_into', None)
+		self._queue = []
+		# the _Requests of the proxies - ordered by priority
+		self._requests = []
+		self._sequence = 0
+		self._lock = threading.Lock()
+		# released to wake up the idle owner thread (a Condition would
+		# allocate a lock per wait)
+		self._wakeup = threading.Lock()
+		self._wakeup.acquire()
+		self._idle = False
+		self._running = False
+		self._thread = None
+		self._started = None
+		self.busy_time = 0.0
+		self.transfers = 0
+		self.merged = 0
+		self.devices = {}
+
+	def start(self, thread=True):
+		""" Starts the owner thread. Without a thread the caller runs the
+		queued transactions with run_pending() (simulations on the
+		VirtualClock of autopylot.clock). """
+		if self._running:
+			return
+		self._running = True
+		self._started = autopylot.clock.now()
+		if thread:
+			self._thread = threading.Thread(target=self._run, daemon=True,
+											name=self.name)
+			self._thread.start()
+		logging.info("Started I2C bus scheduler {!s}".format(self.name))
+
+	def stop(self):
+		""" Stops the owner thread after the queued transactions are done """
+		with self._lock:
+			self._running = False
+			self._wake()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def submit_read(self, address, register, length=1,
+					priority=PRIORITY_MAGNETOMETER):
+		""" Queues a read of length bytes starting at register. Returns a
+		Future of the list of bytes. """
+		if not 0 < length <= MAX_BLOCK:
+			raise Exception("I2C read length {!s} has to be between 1 and "
+							"{!s}".format(length, MAX_BLOCK))
+		return self._submit(_READ, address, register, length, None, priority)
+
+	def submit_write(self, address, register, data,
+					priority=PRIORITY_MAGNETOMETER):
+		""" Queues a write of the bytes (list) starting at register. Returns
+		a Future (of None). """
+		data = list(data)
+		if not 0 < len(data) <= MAX_BLOCK:
+			raise Exception("I2C write length {!s} has to be between 1 and "
+							"{!s}".format(len(data), MAX_BLOCK))
+		return self._submit(_WRITE, address, register, len(data), data,
+							priority)
+
+	def read(self, address, register, length=1,
+			priority=PRIORITY_MAGNETOMETER):
+		""" Reads length bytes - blocks until the transaction is done """
+		future = self.submit_read(address, register, length, priority)
+		self._run_inline()
+		return future.result()
+
+	def request(self, priority=PRIORITY_MAGNETOMETER):
+		""" Returns a new _Request for run_request - one per caller, it is
+		reused for every read """
+		request = _Request(priority)
+		with self._lock:
+			self._requests.append(request)
+			self._requests.sort(key=lambda request: request.priority)
+		return request
+
+	def run_request(self, request):
+		""" Queues the request (set up by the caller) - blocks until the
+		owner read the bytes into the buffer(s) """
+		# acquire / release instead of a with statement on this path - it
+		# would create the bound __enter__ and __exit__ methods every time
+		self._lock.acquire()
+		try:
+			if not self._running:
+				raise Exception("I2C bus scheduler {!s} is not running"
+								.format(self.name))
+			request.error = None
+			request.submitted = autopylot.clock.now()
+			request.queued = True
+			self._wake()
+		finally:
+			self._lock.release()
+		self._run_inline()
+		request.done.acquire()
+		if request.error is not None:
+			raise request.error
+
+	def write(self, address, register, data, priority=PRIORITY_MAGNETOMETER):
+		""" Writes the bytes - blocks until the transaction is done """
+		future = self.submit_write(address, register, data, priority)
+		self._run_inline()
+		future.result()
+
+	def _run_inline(self):
+		""" Without the owner thread the blocking calls run the queue """
+		if self._thread is None:
+			self.run_pending()
+
+	def client(self, priority=PRIORITY_MAGNETOMETER):
+		""" Returns a smbus like proxy which submits with the priority """
+		return ScheduledBus(self, priority)
+
+	def _submit(self, kind, address, register, length, data, priority):
+		with self._lock:
+			if not self._running:
+				raise Exception("I2C bus scheduler {!s} is not running"
+								.format(self.name))
+			transaction = _Transaction(kind, address, register, length, data,
+									priority, self._sequence)
+			self._sequence += 1
+			heapq.heappush(self._queue, transaction)
+			self._wake()
+		return transaction.future
+
+	def _wake(self):
+		""" Wakes up the idle owner thread (the lock has to be held) """
+		if self._idle:
+			self._idle = False
+			self._wakeup.release()
+
+	def _run(self):
+		while True:
+			self._lock.acquire()
+			try:
+				done = not self._running
+				idle = self._idle = not self._run_next()
+			finally:
+				self._lock.release()
+			if idle:
+				if done:
+					return
+				# released by the next submit (or stop)
+				self._wakeup.acquire()
+
+	def run_pending(self):
+		""" Runs the queued transactions in the calling thread - only if
+		started without the owner thread """
+		if self._thread is not None:
+			raise Exception("I2C bus scheduler {!s} runs its own thread"
+							.format(self.name))
+		self._lock.acquire()
+		try:
+			while self._run_next():
+				pass
+		finally:
+			self._lock.release()
+
+	def _run_next(self):
+		""" Runs the most important queued request or transaction - returns
+		False if nothing is queued (the lock has to be held, it is released
+		during the transfer) """
+		request = self._next_request()
+		if request is not None:
+			request.queued = False
+			self._lock.release()
+			try:
+				self._execute_request(request)
+			finally:
+				self._lock.acquire()
+			return True
+		if not self._queue:
+			return False
+		batch = self._next_batch()
+		self._lock.release()
+		try:
+			self._execute(batch)
+		finally:
+			self._lock.acquire()
+		return True
+
+	def _next_request(self):
+		""" Returns the queued _Request with the highest priority - if no
+		queued transaction is more important (the lock has to be held) """
+		for request in self._requests:
+			if request.queued:
+				if self._queue and self._queue[0].priority < request.priority:
+					return None
+				return request
+		return None
+
+	def _next_batch(self):
+		""" Pops the most important transaction - and the queued reads it
+		can be merged with (the lock has to be held) """
+		first = heapq.heappop(self._queue)
+		batch = [first]
+		if first.kind != _READ:
+			return batch
+		# reads must not overtake a write to the same device
+		barrier = min((transaction.sequence for transaction in self._queue
+					if transaction.kind == _WRITE and
+					transaction.address == first.address),
+					default=None)
+		start = first.register
+		end = first.register + first.length
+		found = True
+		while found:
+			found = False
+			for transaction in self._queue:
+				if (transaction.kind != _READ or
+						transaction.address != first.address or
+						(barrier is not None and
+						transaction.sequence > barrier)):
+					continue
+				new_start = min(start, transaction.register)
+				new_end = max(end, transaction.register + transaction.length)
+				# adjacent or overlapping and still fits in one block
+				if (transaction.register <= end and
+						transaction.register + transaction.length >= start and
+						new_end - new_start <= MAX_BLOCK):
+					start, end = new_start, new_end
+					batch.append(transaction)
+					self._queue.remove(transaction)
+					found = True
+					break
+		if len(batch) > 1:
+			heapq.heapify(self._queue)
+		return batch
+
+	def _execute(self, batch):
+		""" Runs the batch as one transfer and completes the futures """
+		first = batch[0]
+		start_time = autopylot.clock.now()
+		try:
+			if first.kind == _WRITE:
+				self._write(first.address, first.register, first.data)
+				results = [None]
+			else:
+				start = min(transaction.register for transaction in batch)
+				end = max(transaction.register + transaction.length
+						for transaction in batch)
+				data = self._read(first.address, start, end - start)
+				results = [data[transaction.register - start:
+								transaction.register - start +
+								transaction.length]
+						for transaction in batch]
+		except Exception as e:
+			for transaction in batch:
+				transaction.future.set_exception(e)
+			logging.error("I2C transaction with device {!s} failed: {!s}"
+						.format(hex(first.address), e))
+			return
+		finally:
+			done_time = autopylot.clock.now()
+			self.busy_time += done_time - start_time
+			self.transfers += 1
+			self.merged += len(batch) - 1
+		statistics = self.devices.setdefault(first.address,
+											DeviceStatistics())
+		for transaction, result in zip(batch, results):
+			statistics.add(done_time - transaction.submitted)
+			transaction.future.set_result(result)
+
+	def _execute_request(self, request):
+		""" Reads the request into its buffer(s) and releases the caller """
+		start_time = autopylot.clock.now()
+		try:
+			if request.requests is not None:
+				self._read_many_into(request.requests)
+			else:
+				self._read_into(request.address, request.register,
+								request.buffer)
+		except Exception as e:
+			request.error = e
+			logging.error("I2C read into a buffer failed: {!s}".format(e))
+		finally:
+			done_time = autopylot.clock.now()
+			self.busy_time += done_time - start_time
+			self.transfers += 1
+		if request.error is None:
+			if request.requests is not None:
+				for address, _, _ in request.requests:
+					self._device(address).add(done_time - request.submitted)
+			else:
+				self._device(request.address).add(done_time -
+												request.submitted)
+		request.done.release()
+
+	def _device(self, address):
+		statistics = self.devices.get(address)
+		if statistics is None:
+			statistics = self.devices[address] = DeviceStatistics()
+		return statistics
+
+	def _read_into(self, address, register, buffer):
+		if self._bus_read_into is not None:
+			self._bus_read_into(address, register, buffer)
+		else:
+			buffer[:] = self._read(address, register, len(buffer))
+
+	def _read_many_into(self, requests):
+		if self._bus_read_many_into is not None:
+			self._bus_read_many_into(requests)
+		else:
+			for address, register, buffer in requests:
+				self._read_into(address, register, buffer)
+
+	def _read(self, address, register, length):
+		if length == 1:
+			return [self.bus.read_byte_data(address, register)]
+		return list(self.bus.read_i2c_block_data(address, register, length))
+
+	def _write(self, address, register, data):
+		if len(data) == 1:
+			self.bus.write_byte_data(address, register, data[0])
+		else:
+			self.bus.write_i2c_block_data(address, register, data)
+
+	@property
+	def utilization(self):
+		""" Share of the time (0 - 1) the bus was busy since start() """
+		if self._started is None:
+			return 0.0
+		elapsed = autopylot.clock.now() - self._started
+		return min(self.busy_time / elapsed, 1.0) if elapsed > 0 else 0.0
+
+	def get_statistics(self):
+		""" Returns a dict of the bus statistics - the latencies per device
+		(address) are in seconds """
+		return {'utilization': self.utilization, 'transfers': self.transfers,
+				'merged': self.merged,
+				'devices': {address: statistics.to_dict()
+							for address, statistics in self.devices.items()}}
+
+
+class ScheduledBus():
+	""" smbus like proxy - every call is a (blocking) transaction of the
+	scheduler with the priority of this proxy """
+
+	def __init__(self, scheduler, priority=PRIORITY_MAGNETOMETER):
+		self.scheduler = scheduler
+		self.priority = priority
+		# set up by the first read_into / read_many_into
+		self._request = None
+		self._lock = threading.Lock()
+
+	def read_byte_data(self, address, register):
+		return self.scheduler.read(address, register, 1, self.priority)[0]
+
+	def read_word_data(self, address, register):
+		""" Reads two bytes - low byte first (like smbus) """
+		low, high = self.scheduler.read(address, register, 2, self.priority)
+		return (high << 8) | low
+
+	def read_i2c_block_data(self, address, register, length=MAX_BLOCK):
+		return self.scheduler.read(address, register, length, self.priority)
+
+	def read_into(self, address, register, buffer):
+		""" Fills the buffer with the bytes starting at register (like
+		DevI2C) - without creating objects per read """
+		self._lock.acquire()
+		try:
+			request = self._get_request()
+			request.address = address
+			request.register = register
+			request.buffer = buffer
+			request.requests = None
+			self.scheduler.run_request(request)
+		finally:
+			self._lock.release()
+		return len(buffer)
+
+	def read_many_into(self, requests):
+		""" Reads the blocks of the (address, register, buffer) requests
+		into the buffers - in one go (read_many_into of a DevI2C) """
+		self._lock.acquire()
+		try:
+			request = self._get_request()
+			request.requests = requests
+			self.scheduler.run_request(request)
+		finally:
+			self._lock.release()
+
+	def _get_request(self):
+		if self._request is None:
+			self._request = self.scheduler.request(self.priority)
+		return self._request
+
+	def write_byte_data(self, address, register, value):
+		self.scheduler.write(address, register, [value], self.priority)
+
+	def write_i2c_block_data(self, address, register, data):
+		self.scheduler.write(address, register, data, self.priority)
+
+
+def get_scheduler(bus_number=1):
+	""" Returns the (started) scheduler of the system I2C bus - created on
+	the first call. All sensors have to share it. """
+	global _scheduler
+	with _scheduler_lock:
+		if _scheduler is None:
+			import autopylot.imu
+			_scheduler = BusScheduler(autopylot.imu.DevI2C(bus_number),
+									name='i2c-{!s}'.format(bus_number))
+			_scheduler.start()
+		return _scheduler
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
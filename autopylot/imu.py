@@ -0,0 +1,399 @@
+""" Allocation free read path of the MPU-6050. The 14 bytes of the burst
+read (accel xyz, temperature, gyro xyz - big endian) go into a
+preallocated buffer and are decoded straight into caller provided float64
+NumPy arrays: the raw bytes are swapped into an int16 buffer, converted
+into a float buffer and transformed (range, calibration and mounting, see
+autopylot.orientation) into the outputs - every step writes into memory
+allocated once in the constructor.
+
+The byte read itself only avoids allocations on a bus with
+read_into(address, register, buffer) - DevI2C (/dev/i2c-N) and the
+ScheduledBus of autopylot.i2cbus, whose owner reads into the buffer with
+the DevI2C. smbus like buses return a list per read, the decoding stays
+allocation free there.
+
+benchmark() counts the allocations per sample (kept and transient ones) of
+this path and of the dict path of the mpu6050 package - both read through
+the BusScheduler. """
+
+import io
+import fcntl
+import ctypes
+import struct
+import argparse
+import tracemalloc
+import collections
+
+import numpy
+
+import autopylot.config
+import autopylot.i2cbus
+import autopylot.orientation
+
+GRAVITY = 9.80665
+
+# registers
+GYRO_CONFIG = 0x1B
+ACCEL_CONFIG = 0x1C
+ACCEL_XOUT_H = 0x3B
+BURST_LENGTH = 14
+
+# ioctls of the i2c-dev driver: select the slave address, combined transfer
+I2C_SLAVE = 0x0703
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+
+Range = collections.namedtuple('Range', ['register', 'sensitivity'])
+
+# full scale (g) => ACCEL_CONFIG value, LSB per g
+ACCEL_RANGES = {2: Range(0x00, 16384.0),
+				4: Range(0x08, 8192.0),
+				8: Range(0x10, 4096.0),
+				16: Range(0x18, 2048.0)}
+
+# full scale (°/s) => GYRO_CONFIG value, LSB per °/s
+GYRO_RANGES = {250: Range(0x00, 131.0),
+			500: Range(0x08, 65.5),
+			1000: Range(0x10, 32.8),
+			2000: Range(0x18, 16.4)}
+
+# the same decoding with struct - used by the dict path of the benchmark
+_BURST_FORMAT = struct.Struct('>7h')
+
+
+def accel_range(full_scale):
+	""" Returns the Range of the accel full scale (g) """
+	if full_scale not in ACCEL_RANGES:
+		raise Exception("Invalid accel range ±{!s}g - use one of {!s}"
+						.format(full_scale, sorted(ACCEL_RANGES)))
+	return ACCEL_RANGES[full_scale]
+
+
+def gyro_range(full_scale):
+	""" Returns the Range of the gyro full scale (°/s) """
+	if full_scale not in GYRO_RANGES:
+		raise Exception("Invalid gyro range ±{!s}°/s - use one of {!s}"
+						.format(full_scale, sorted(GYRO_RANGES)))
+	return GYRO_RANGES[full_scale]
+
+
+class _I2cMessage(ctypes.Structure):
+	""" struct i2c_msg of linux/i2c.h """
+	_fields_ = [('addr', ctypes.c_uint16), ('flags', ctypes.c_uint16),
+				('len', ctypes.c_uint16),
+				('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+
+class _I2cTransfer(ctypes.Structure):
+	""" struct i2c_rdwr_ioctl_data of linux/i2c-dev.h """
+	_fields_ = [('msgs', ctypes.POINTER(_I2cMessage)),
+				('nmsgs', ctypes.c_uint32)]
+
+
+class DevI2C():
+	""" Reads blocks of an I2C bus through /dev/i2c-N into a caller
+	provided buffer (write of the register byte, then a read) - the only
+	objects created per read are the ones cached here """
+
+	def __init__(self, bus_number=1):
+		self.path = '/dev/i2c-{!s}'.format(bus_number)
+		self._file = io.FileIO(self.path, 'r+')
+		self._address = None
+		self._registers = [bytes([register]) for register in range(256)]
+		self._register_buffers = [(ctypes.c_uint8 * 1)(register)
+								for register in range(256)]
+		self._requests = None
+		self._messages = None
+		self._transfer = None
+
+	def _select(self, address):
+		if address != self._address:
+			fcntl.ioctl(self._file, I2C_SLAVE, address)
+			self._address = address
+
+	def read_into(self, address, register, buffer):
+		""" Fills the buffer with the bytes starting at register """
+		self._select(address)
+		self._file.write(self._registers[register])
+		count = self._file.readinto(buffer)
+		if count != len(buffer):
+			raise OSError("Short read from {!s} at 0x{:02x} ({!s} of {!s} "
+						"bytes)".format(self.path, address, count,
+										len(buffer)))
+		return count
+
+	def read_many_into(self, requests):
+		""" Reads the blocks of several devices in one combined transfer
+		(I2C_RDWR: register write and read per request, repeated starts in
+		between) - one system call instead of two (three when switching the
+		address) per block. requests is a sequence of (address, register,
+		buffer) - pass the same object every time, it is compiled once. """
+		if requests is not self._requests:
+			self._compile(requests)
+		fcntl.ioctl(self._file, I2C_RDWR, self._transfer)
+
+	def _compile(self, requests):
+		messages = (_I2cMessage * (2 * len(requests)))()
+		for index, (address, register, buffer) in enumerate(requests):
+			write = messages[2 * index]
+			write.addr = address
+			write.len = 1
+			write.buf = ctypes.cast(self._register_buffers[register],
+									ctypes.POINTER(ctypes.c_uint8))
+			read = messages[2 * index + 1]
+			read.addr = address
+			read.flags = I2C_M_RD
+			read.len = len(buffer)
+			read.buf = (ctypes.c_uint8 * len(buffer)).from_buffer(buffer)
+		self._transfer = _I2cTransfer(messages, len(messages))
+		# the transfer only points to them
+		self._messages = messages
+		self._requests = requests
+
+	def write_byte_data(self, address, register, value):
+		self._select(address)
+		self._file.write(bytes([register, value & 0xff]))
+
+	# smbus like reads and writes - for the other devices on the bus (the
+	# BusScheduler of autopylot.i2cbus owns the DevI2C)
+
+	def read_byte_data(self, address, register):
+		return self.read_i2c_block_data(address, register, 1)[0]
+
+	def read_i2c_block_data(self, address, register, length=32):
+		buffer = bytearray(length)
+		self.read_into(address, register, buffer)
+		return list(buffer)
+
+	def write_i2c_block_data(self, address, register, data):
+		self._select(address)
+		self._file.write(bytes([register] + [value & 0xff for value in data]))
+
+	def close(self):
+		self._file.close()
+
+
+class ImuReader():
+	""" Reads the accel (m/s²) and gyro (°/s) data of the MPU-6050 at
+	address into preallocated buffers. The scales of the ranges, the
+	calibration and the mounting (sensor to body rotation, see
+	autopylot.orientation) are applied in place. """
+
+	def __init__(self, bus, address=0x68, accel_full_scale=None,
+				gyro_full_scale=None, mounting=None):
+		if accel_full_scale is None:
+			accel_full_scale = autopylot.config.get_gyrosensor_accel_range()
+		if gyro_full_scale is None:
+			gyro_full_scale = autopylot.config.get_gyrosensor_gyro_range()
+		self.bus = bus
+		self.address = address
+		self.accel_range = accel_range(accel_full_scale)
+		self.gyro_range = gyro_range(gyro_full_scale)
+		if mounting is None:
+			mounting = autopylot.config.get_gyrosensor_mounting()
+		self.mounting = mounting
+		self.calibration = None
+		self.duplicates = 0
+		self._read_into = getattr(bus, 'read_into', None)
+		self._raw = bytearray(BURST_LENGTH)
+		self._previous = bytearray(BURST_LENGTH)
+		# (address, register, buffer) of the burst read
+		self.request = (address, ACCEL_XOUT_H, self._raw)
+		self._big_endian = numpy.frombuffer(self._raw, dtype='>i2')
+		self._native = numpy.zeros(BURST_LENGTH // 2, dtype=numpy.int16)
+		self._values = numpy.zeros(BURST_LENGTH // 2)
+		self._raw_accel = self._values[0:3]
+		self._raw_gyro = self._values[4:7]
+		self.accel_transform = autopylot.orientation.AffineTransform()
+		self.gyro_transform = autopylot.orientation.AffineTransform()
+		self.use_calibration(None)
+
+	def configure(self):
+		""" Writes the ranges to the sensor """
+		self.bus.write_byte_data(self.address, ACCEL_CONFIG,
+								self.accel_range.register)
+		self.bus.write_byte_data(self.address, GYRO_CONFIG,
+								self.gyro_range.register)
+
+	def use_calibration(self, calibration):
+		""" Folds the range scales, the calibration (or None) and the
+		mounting into the transforms (autopylot.orientation) """
+		self.calibration = calibration
+		accel = autopylot.orientation.accel_transform(
+			self.mounting, calibration,
+			GRAVITY / self.accel_range.sensitivity)
+		gyro = autopylot.orientation.gyro_transform(
+			self.mounting, calibration, 1.0 / self.gyro_range.sensitivity)
+		self.accel_transform.set(accel.matrix, accel.offset)
+		self.gyro_transform.set(gyro.matrix, gyro.offset)
+
+	@property
+	def temperature(self):
+		""" Temperature (°C) of the last read """
+		return self._values[3] / 340.0 + 36.53
+
+	def read_raw(self):
+		""" Reads the 14 bytes into the raw buffer - returns False (and
+		counts it) if they equal the ones read before, i.e. the sensor did
+		not update its registers yet """
+		self.prepare_read()
+		self.fetch()
+		return self.finish_read()
+
+	def fetch(self):
+		""" Reads the 14 bytes into the raw buffer (the bus transfer of
+		read_raw only) """
+		if self._read_into is not None:
+			self._read_into(self.address, ACCEL_XOUT_H, self._raw)
+		else:
+			self._raw[:] = self.bus.read_i2c_block_data(
+				self.address, ACCEL_XOUT_H, BURST_LENGTH)
+
+	def prepare_read(self):
+		""" First half of read_raw for a read done by someone else (one
+		transfer for several sensors, see autopylot.redundancy) - keeps the
+		last bytes. The bytes go into the buffer of request. """
+		self._previous[:] = self._raw
+
+	def finish_read(self):
+		""" Second half of read_raw - returns False (and counts it) if the
+		bytes did not change """
+		if self._raw == self._previous:
+			self.duplicates += 1
+			return False
+		return True
+
+	@property
+	def raw(self):
+		""" The raw bytes of the last read """
+		return self._raw
+
+	def decode_into(self, accel, gyro):
+		""" Decodes the raw buffer into accel and gyro (float64 arrays of
+		three, NumPy - wrap an array.array with numpy.frombuffer once) """
+		numpy.copyto(self._native, self._big_endian)
+		numpy.copyto(self._values, self._native)
+		self.accel_transform.apply(self._raw_accel, accel)
+		self.gyro_transform.apply(self._raw_gyro, gyro)
+
+	def read_into(self, accel, gyro):
+		""" Reads a sample into accel and gyro - returns False if it was a
+		duplicate (the buffers are updated anyway) """
+		fresh = self.read_raw()
+		self.decode_into(accel, gyro)
+		return fresh
+
+
+def _count_allocations(function, sample_count):
+	""" Returns the memory blocks (and bytes) per call of function which are
+	still allocated when it returns - the results are kept to count them -
+	and the bytes allocated (and freed) within a call (peak, median of all
+	calls without the overhead of the measurement) """
+	results = [None] * sample_count
+	peaks = numpy.empty(sample_count)
+	function()
+	tracemalloc.start()
+	try:
+		baseline = min(_call_peak(_noop)[0] for _ in range(10))
+		before = tracemalloc.take_snapshot()
+		for index in range(sample_count):
+			peaks[index], results[index] = _call_peak(function)
+		after = tracemalloc.take_snapshot()
+	finally:
+		tracemalloc.stop()
+	statistics = after.compare_to(before, 'filename')
+	return {'blocks': sum(stat.count_diff for stat in statistics) / sample_count,
+			'bytes': sum(stat.size_diff for stat in statistics) / sample_count,
+			'peak': max(float(numpy.median(peaks)) - baseline, 0.0)}
+
+
+def _call_peak(function):
+	""" Calls function - returns the bytes allocated (and freed) within
+	the call and its result """
+	tracemalloc.reset_peak()
+	start, _ = tracemalloc.get_traced_memory()
+	result = function()
+	_, peak = tracemalloc.get_traced_memory()
+	return peak - start, result
+
+
+def _noop():
+	pass
+
+
+class _BenchmarkBus():
+	""" Bus of the benchmark - every read returns one of two bursts in
+	turn (so no read is a duplicate), the transfer takes no time """
+
+	def __init__(self, bursts):
+		self.bursts = [bytes(burst) for burst in bursts]
+		self._next = 0
+		# assigning to a slice of a bytearray allocates - of a memoryview not
+		self._buffer = None
+		self._view = None
+
+	def read_into(self, address, register, buffer):
+		if buffer is not self._buffer:
+			self._buffer = buffer
+			self._view = memoryview(buffer)
+		self._next ^= 1
+		self._view[:] = self.bursts[self._next]
+		return len(buffer)
+
+	def read_i2c_block_data(self, address, register, length=32):
+		self._next ^= 1
+		return list(self.bursts[self._next][:length])
+
+
+def benchmark(sample_count=10000):
+	""" Counts the allocations per sample of the buffer path and of the
+	dict path (unpacked values scaled into dicts like the mpu6050 package
+	returns them) - both read the burst through a BusScheduler (with its
+	owner thread) from a bus without delay. The buffer path only allocates
+	the counters of the scheduler (ints, freed at once). """
+	bus = _BenchmarkBus([
+		_BURST_FORMAT.pack(410, -205, 4017, -2000, 16, -33, 1640),
+		_BURST_FORMAT.pack(411, -205, 4017, -2000, 16, -33, 1641)])
+	scheduler = autopylot.i2cbus.BusScheduler(bus, name='imu-benchmark')
+	scheduler.start()
+	client = scheduler.client(autopylot.i2cbus.PRIORITY_IMU)
+	reader = ImuReader(client, accel_full_scale=8, gyro_full_scale=2000)
+	accel = numpy.zeros(3)
+	gyro = numpy.zeros(3)
+	accel_scale = GRAVITY / reader.accel_range.sensitivity
+	gyro_scale = 1.0 / reader.gyro_range.sensitivity
+
+	def buffer_path():
+		reader.read_into(accel, gyro)
+
+	def dict_path():
+		values = _BURST_FORMAT.unpack(bytes(client.read_i2c_block_data(
+			reader.address, ACCEL_XOUT_H, BURST_LENGTH)))
+		return ({'x': values[0] * accel_scale, 'y': values[1] * accel_scale,
+				'z': values[2] * accel_scale},
+				{'x': values[4] * gyro_scale, 'y': values[5] * gyro_scale,
+				'z': values[6] * gyro_scale})
+
+	try:
+		return {'buffer': _count_allocations(buffer_path, sample_count),
+				'dict': _count_allocations(dict_path, sample_count)}
+	finally:
+		scheduler.stop()
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description="Counts the allocations "
+									"per IMU sample")
+	parser.add_argument('--samples', type=int, default=10000,
+						help="number of decoded samples")
+	args = parser.parse_args(args)
+	for path, result in benchmark(args.samples).items():
+		print("{!s:>6}: {:.2f} blocks / {:.1f} bytes kept, {:.0f} bytes "
+			"allocated per sample".format(path, result['blocks'],
+										result['bytes'], result['peak']))
+
+
+if __name__ == '__main__':
+	main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
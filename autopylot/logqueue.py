@@ -0,0 +1,178 @@
+""" Non-blocking logging - the records of all threads go into a bounded
+queue and a writer thread hands them to the (file) handlers, so a slow SD
+card never stalls the thread which logs (the motor commands, the pigpio
+callbacks). If the queue is full the record is dropped and counted - the
+writer logs how many were lost once it caught up.
+
+Identical messages (same logger, line, level and text) arriving within
+window seconds of each other are collapsed: the first one is written, the
+rest is summed up as "last message repeated N times" when the burst ends -
+and at least once per window while it lasts.
+
+config.py sets this up for the root logger (see [LOG]). """
+
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+# put into the queue to stop the writer
+_STOP = object()
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+	""" Puts the records into the queue without blocking - counts the
+	records which did not fit. The message is formatted by the writer. """
+
+	def __init__(self, record_queue):
+		super().__init__(record_queue)
+		self.dropped = 0
+		self._formatter = logging.Formatter()
+		self._lock = threading.Lock()
+
+	def prepare(self, record):
+		# only the traceback is rendered here - the frames must not be kept
+		# alive in the queue
+		if record.exc_info:
+			record.exc_text = self._formatter.formatException(record.exc_info)
+			record.exc_info = None
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			with self._lock:
+				self.dropped += 1
+
+
+class LogWriter():
+	""" Writer thread - takes the records from the queue, collapses the
+	repeated ones and passes them on to the handlers """
+
+	def __init__(self, record_queue, handlers, window=1.0, queue_handler=None):
+		self.queue = record_queue
+		self.handlers = list(handlers)
+		self.window = window
+		self.queue_handler = queue_handler
+		self.statistics = {'written': 0, 'collapsed': 0, 'dropped': 0}
+		self._last_key = None
+		self._last_record = None
+		self._repeats = 0
+		# created time of the record the current summary counts from
+		self._window_start = None
+		self._thread = None
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name='log-writer',
+										daemon=True)
+		self._thread.start()
+
+	def stop(self, timeout=1.0):
+		""" Writes what is left in the queue and stops the thread """
+		if self._thread is None:
+			return
+		try:
+			self.queue.put(_STOP, timeout=timeout)
+		except queue.Full:
+			pass
+		self._thread.join(timeout)
+		self._thread = None
+		for handler in self.handlers:
+			handler.flush()
+
+	def _run(self):
+		while True:
+			try:
+				record = self.queue.get(timeout=self.window)
+			except queue.Empty:
+				self._flush_repeats()
+				self._report_dropped()
+				continue
+			if record is _STOP:
+				break
+			self.handle(record)
+			self._report_dropped()
+		self._flush_repeats()
+		self._report_dropped()
+
+	def handle(self, record):
+		""" Writes the record - or counts it if it repeats the last one """
+		key = (record.name, record.levelno, record.pathname, record.lineno,
+			record.getMessage())
+		if (key == self._last_key and
+				record.created - self._last_record.created <= self.window):
+			self._repeats += 1
+			self._last_record = record
+			self.statistics['collapsed'] += 1
+			if record.created - self._window_start >= self.window:
+				# the burst goes on - sum it up once per window
+				self._write_summary()
+				self._window_start = record.created
+			return
+		self._flush_repeats()
+		self._emit(record)
+		self._last_key = key
+		self._last_record = record
+		self._window_start = record.created
+
+	def _flush_repeats(self):
+		""" Writes the summary of the collapsed repeats (if any) - the burst
+		is over """
+		self._write_summary()
+		self._last_key = None
+
+	def _write_summary(self):
+		""" Writes the summary of the repeats collapsed since the last one
+		(if any) """
+		if self._repeats == 0:
+			return
+		summary = logging.makeLogRecord(self._last_record.__dict__)
+		summary.msg = "last message repeated {!s} times".format(self._repeats)
+		summary.args = None
+		summary.exc_text = None
+		self._emit(summary)
+		self._repeats = 0
+
+	def _report_dropped(self):
+		if self.queue_handler is None:
+			return
+		dropped = self.queue_handler.dropped
+		if dropped == self.statistics['dropped']:
+			return
+		record = logging.makeLogRecord({
+			'name': 'autopylot.logqueue', 'levelno': logging.WARNING,
+			'levelname': 'WARNING', 'funcName': '_report_dropped',
+			'msg': "{!s} log records dropped (the log queue was full)".format(
+				dropped - self.statistics['dropped'])})
+		self.statistics['dropped'] = dropped
+		self._emit(record)
+
+	def _emit(self, record):
+		for handler in self.handlers:
+			if record.levelno >= handler.level:
+				handler.handle(record)
+		self.statistics['written'] += 1
+
+
+def configure(filename, level, fmt, datefmt, queue_size=10000, window=1.0):
+	""" Sets up the root logger: records go through a bounded queue to a
+	writer thread which writes them to filename. Like logging.basicConfig
+	nothing is changed if the root logger has handlers already. Returns the
+	LogWriter (or None). """
+	root = logging.getLogger()
+	if root.handlers:
+		return None
+	file_handler = logging.FileHandler(filename)
+	file_handler.setFormatter(logging.Formatter(fmt, datefmt))
+	record_queue = queue.Queue(queue_size)
+	queue_handler = BoundedQueueHandler(record_queue)
+	root.addHandler(queue_handler)
+	root.setLevel(level)
+	writer = LogWriter(record_queue, [file_handler], window, queue_handler)
+	writer.start()
+	atexit.register(writer.stop)
+	return writer
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
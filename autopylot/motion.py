@@ -1,188 +1,243 @@
 """ module for motion tracking """
 
 import time
+import logging
 import threading
 
+import numpy
+import pigpio
+
 import autopylot.sensor
 import autopylot.config
-
-# Formula
-#--------------------------------
-# Distance:
-#    velocity = sum(acceleration)
-#    distance = sum(velocity)
-
-# Angular change:
-#    tilt = sum(rotation) 
-
-SAMPLE_COUNT = 100
+import autopylot.estimation
+import autopylot.orientation
+import autopylot.calibration
+import autopylot.filters
+import autopylot.vibration
+import autopylot.acquisition
+import autopylot.i2cbus
+import autopylot.drivers
+import autopylot.telemetry
 
 class MotionTracker():
-	""" 3D Motion Tracking """
-	def __init__(self):
-		address = autopylot.config.get_gyrosensor_address()
-		self._sensor = autopylot.sensor.SensorData(address)
-		self._tilt =		{'x': 0, 'y': 0, 'z': 0}
-		self._velocity =	{'x': 0, 'y': 0, 'z': 0}
-		self._distance =	{'x': 0, 'y': 0, 'z': 0}
-
-		self._accel_samples = []
-		self._rotation_samples = []
-		self._first_sampling = True
-
-		self._accel_before = None
-		self._rotation_before = None
-
-		self._accel_dead_zone = (0,0)
-		self._rotation_dead_zone = (0,0)
-
-		self._filtered_rotation_before = {'x': 0, 'y': 0, 'z': 0}
-		self._filtered_accel_before = {'x': 0, 'y': 0, 'z': 0}
-		
-		loop_thread = threading.Thread(target=self._loop)
+	""" 3D Motion Tracking. The math is done by the MotionEstimator - this
+	class only feeds it with the sensor data - whenever the data ready
+	interrupt of the sensor signals a new sample. Pass a FlightRecorder to
+	record the raw samples (and estimates) for a later replay. The
+	magnetometer and barometer are read at their own rates by a
+	MultiRateSampler (autopylot.drivers). Pass a TelemetryPublisher to send
+	the attitude, sensor rates and loop statistics from the loop thread. """
+	def __init__(self, recorder=None, pi=None, telemetry=None):
+		addresses = autopylot.config.get_gyrosensor_addresses()
+		scheduler = autopylot.i2cbus.get_scheduler()
+		magnetometer = autopylot.drivers.create_driver(
+			autopylot.config.get_magnetometer_type(),
+			autopylot.config.get_magnetometer_address(),
+			autopylot.config.get_magnetometer_rate())
+		barometer = autopylot.drivers.create_driver(
+			autopylot.config.get_barometer_type(),
+			autopylot.config.get_barometer_address(),
+			autopylot.config.get_barometer_rate())
+		self._sensor = autopylot.sensor.SensorData(addresses, scheduler,
+												magnetometer)
+		sample_rate = autopylot.config.get_gyrosensor_sample_rate()
+		self._dmp_mode = autopylot.config.get_gyrosensor_mode() == 'dmp'
+		if self._dmp_mode:
+			self._sensor.enable_dmp(sample_rate)
+		else:
+			self._sensor.enable_data_ready_interrupt(sample_rate)
+		self._pi = pi if pi is not None else pigpio.pi()
+		self._sampler = autopylot.acquisition.DataReadySampler(
+			self._pi, autopylot.config.get_gyrosensor_interrupt_pin(),
+			sample_rate)
+		self._estimator = autopylot.estimation.create_estimator(sample_rate)
+		self._recorder = recorder
+		self._telemetry = telemetry
+		self._loop_statistics = autopylot.telemetry.LoopStatistics()
+		if telemetry is not None:
+			telemetry.attach('attitude', self._fill_attitude)
+			telemetry.attach('sensors', self._fill_sampling_statistics)
+			telemetry.attach('loop', self._loop_statistics)
+		self._vibration = self._init_vibration_analyzer(sample_rate)
+		self._calibrate()
+		self._sensor_sampler = self._init_sensor_sampler(
+			scheduler, [magnetometer, barometer])
+
+		loop_thread = threading.Thread(target=self._loop, name='motion')
 		loop_thread.start()
 
+	def _init_vibration_analyzer(self, sample_rate):
+		""" Returns a VibrationAnalyzer which retunes the adaptive notch
+		filters (dynnotch) of the gyro filter pipeline """
+		analyzer = autopylot.vibration.VibrationAnalyzer(
+			sample_rate, window=autopylot.config.get_vibration_window(),
+			interval=autopylot.config.get_vibration_interval(),
+			min_frequency=autopylot.config.get_vibration_min_frequency(),
+			budget=autopylot.config.get_vibration_budget())
+		for stage in self._estimator.rotation_filters.stages:
+			if isinstance(stage, autopylot.filters.AdaptiveNotch):
+				analyzer.attach(stage)
+		return analyzer
+
+	def _init_sensor_sampler(self, scheduler, drivers):
+		""" Sets up the (available) slow sensors and starts sampling them -
+		the readings go to the estimator """
+		available = []
+		for driver in drivers:
+			if driver is None:
+				continue
+			try:
+				driver.setup(scheduler.client(driver.priority))
+			except Exception as e:
+				logging.warning("Unable to set up the {!s} at {!s} ({!s}) - "
+								"continuing without it".format(
+									driver.name, hex(driver.address), e))
+				continue
+			available.append(driver)
+		sampler = autopylot.drivers.MultiRateSampler(scheduler, available)
+		sampler.subscribe('magnetometer', lambda reading:
+						self._estimator.update_magnetometer(reading.timestamp,
+															reading.values))
+		sampler.subscribe('barometer', lambda reading:
+						self._estimator.update_barometer(reading.timestamp,
+														reading.values[2]))
+		sampler.start()
+		return sampler
+
+	def get_heading(self):
+		""" heading in degrees (magnetometer) - None without a magnetometer """
+		return self._estimator.heading
+
+	def get_altitude(self):
+		""" altitude in m relative to the start (barometer) - None without a
+		barometer """
+		return self._estimator.altitude
+
+	def get_sensor_statistics(self):
+		""" Returns the sampling statistics of the slow sensors """
+		return self._sensor_sampler.get_statistics()
+
+	def get_redundancy_statistics(self):
+		""" Returns the rejection and isolation counters of the redundant
+		IMUs - None with a single IMU """
+		return self._sensor.get_redundancy_statistics()
+
+	def get_vibration_spectrum(self):
+		""" Returns the (frequencies, magnitudes) of the last vibration
+		analysis of the raw gyro data (or None) """
+		return self._vibration.spectrum
+
+	def _calibrate(self):
+		""" Calibrates the sensor (cached by temperature) and sets up the
+		dead zone filters from it. If this fails the dead zone filters are
+		set up from the first samples instead. """
+		cache = autopylot.calibration.CalibrationCache(
+			autopylot.config.get_calibration_cache_file(),
+			autopylot.config.get_calibration_bin_width())
+		try:
+			calibration = self._sensor.calibrate_cached(cache)
+		except Exception as e:
+			logging.warning("Unable to calibrate the sensor ({!s}). Setting "
+							"up the dead zone filters from the first {!s} "
+							"samples".format(e, self._estimator.sample_count))
+			return
+		self._estimator.use_calibration(calibration, self._sensor.mounting)
+		if self._recorder is not None:
+			self._recorder.record_calibration(calibration,
+											self._sensor.mounting)
+
 	def get_distance(self):
-		""" distance (as tuple - x,y,z) in unknown unit """
-		return self._distance
+		""" distance (as dict - x,y,z) in unknown unit """
+		return self._estimator.get_distance()
 
 	def get_tilt(self):
-		""" tilt (as tuple - x,y,z) in unknown unit """
-		return self._tilt
-
-   #  def _avg(self, samples):
-   #      offset = {'x': 0, 'y': 0, 'z': 0}
-   #      for sample in samples:
-   #          offset['x'] += sample['x']
-   #          offset['y'] += sample['y']
-   #          offset['z'] += sample['z']
-
-   #      offset['x'] = offset['x'] / len(samples)
-   #      offset['y'] = offset['y'] / len(samples)
-   #      offset['z'] = offset['z'] / len(samples)
-   #      return offset
-
-	def _setup_dead_zone_filter(self, samples):
-		min_dict = {	'x': samples[0]['x'], 
-						'y': samples[0]['y'],
-						'z': samples[0]['z']
-					}
-		max_dict = {	'x': samples[0]['x'], 
-						'y': samples[0]['y'],
-						'z': samples[0]['z']
-					}
-
-
-		dead_zone = [min_dict, max_dict]
-		x_values = []
-		y_values = []
-		z_values = []
-		for sample in samples:
-			x_values.append(sample['x'])
-			y_values.append(sample['y'])
-			z_values.append(sample['z'])
-
-		def add_blur(value):
-			if value < 0:
-				return value - (value * 0.2)
-			else:
-				return value + (value * 0.2)
-
-		def sub_blur(value):
-			if value < 0:
-				return value + (value * 0.2)
-			else:
-				return value - (value * 0.2)
-			
-
-		min_dict['x'] = sub_blur(min(x_values))
-		min_dict['y'] = sub_blur(min(y_values))
-		min_dict['z'] = sub_blur(min(z_values))
-
-		max_dict['x'] = add_blur(max(x_values))
-		max_dict['y'] = add_blur(max(y_values))
-		max_dict['z'] = add_blur(max(z_values))
-
-		return dead_zone
-
-
-	def _sample(self, accel, rotation):
-		self._accel_samples.append(accel)
-		self._rotation_samples.append(rotation)
-
-		if len(self._accel_samples) >= SAMPLE_COUNT and len(self._rotation_samples) >= SAMPLE_COUNT:
-			self._accel_dead_zone = self._setup_dead_zone_filter(self._accel_samples)
-			self._rotation_dead_zone = self._setup_dead_zone_filter(self._rotation_samples)
-
-			self._first_sampling = False
-			self._accel_samples = []
-			self._rotation_samples = []
-
-	def _dead_zone_filter(self, value, dead_zone):
-		if value['x'] >= dead_zone[0]['x'] and value['x'] <= dead_zone[1]['x']:
-			value['x'] = 0
-		if value['y'] >= dead_zone[0]['y'] and value['y'] <= dead_zone[1]['y']:
-			value['y'] = 0
-		if value['z'] >= dead_zone[0]['z'] and value['z'] <= dead_zone[1]['z']:
-			value['z'] = 0
-
-	def _anomaly_filter(self, value, compare):
-		""" filter out anomalies - when there is a value that is
-		not 0 but not followed or preceded by another non 0 value """
-		filtered_value = {'x': 0, 'y': 0, 'z': 0}
-		if value['x'] != 0 and compare['x'] != 0:
-			filtered_value['x'] = value['x']
-		if value['y'] != 0 and compare['y'] != 0:
-			filtered_value['y'] = value['y']
-		if value['z'] != 0 and compare['z'] != 0:
-			filtered_value['z'] = value['z']
-
-		compare['x'] = value['x']
-		compare['y'] = value['y']
-		compare['z'] = value['z']
-
-	def _calc_distance(self, accel):
-		self._dead_zone_filter(accel, self._accel_dead_zone)
-		self._anomaly_filter(accel, self._filtered_accel_before)
-
-		self._accel_before = accel
-		self._velocity['x'] += accel['x']
-		self._velocity['y'] += accel['y']
-		self._velocity['z'] += accel['z']
-		self._distance['x'] += self._velocity['x']
-		self._distance['y'] += self._velocity['y']
-		self._distance['z'] += self._velocity['z']
-
-	def _calc_tilt(self, rotation):
-		self._dead_zone_filter(rotation, self._rotation_dead_zone)
-		self._anomaly_filter(rotation, self._filtered_rotation_before)
-
-		print("VALUE: ", rotation)
-		self._rotation_before = rotation
-		self._tilt['x'] += rotation['x']
-		self._tilt['y'] += rotation['y']
-		self._tilt['z'] += rotation['z']
+		""" tilt (as dict - x,y,z) in unknown unit """
+		return self._estimator.get_tilt()
+
+	def get_sampling_statistics(self):
+		""" Returns a dict of the sample counters (interrupts, missed,
+		duplicates, timeouts) """
+		return self._sampler.get_statistics()
+
+	def _fill_attitude(self, values):
+		""" telemetry source of the attitude channel """
+		tilt = self._estimator.get_tilt()
+		heading = self._estimator.heading
+		altitude = self._estimator.altitude
+		values[0], values[1], values[2] = tilt['x'], tilt['y'], tilt['z']
+		values[3] = numpy.nan if heading is None else heading
+		values[4] = numpy.nan if altitude is None else altitude
+
+	def _fill_sampling_statistics(self, values):
+		""" telemetry source of the sensors channel (counters) """
+		values[0] = self._sampler.interrupts
+		values[1] = self._sampler.missed
+		values[2] = self._sampler.duplicates
+		values[3] = self._sampler.timeouts
+
+	def _publish(self):
+		""" ends the loop iteration - sends the due telemetry """
+		self._loop_statistics.end()
+		if self._telemetry is not None:
+			self._telemetry.publish()
 
 	def _loop(self):
-		""" loop to sample the gyro sensor data continuously.
-		The MPU-6050 currently used can sample at 1kHz so we
-		will sample at 1ms """
+		""" loop to sample the gyro sensor data. It sleeps until the data
+		ready interrupt signals a new sample (or the timeout passed) """
+		if self._dmp_mode:
+			self._dmp_loop()
+			return
+		# the sample is read into these (1, 3) blocks - no new objects per
+		# sample until the estimator
+		accel = numpy.zeros((1, 3))
+		rotation = numpy.zeros((1, 3))
+		accel_sample = accel[0]
+		rotation_sample = rotation[0]
 		while True:
-			accel = self._sensor.get_acceleration_data()
-			print("REAL ACCEL: {!s}".format(accel))
-			rotation = self._sensor.get_gyroscope_data()
-			print("REAL ROTATION: {!s}".format(rotation))
-
-			if self._first_sampling:
-				self._sample(accel, rotation)
-			else:
-				self._calc_distance(accel)
-				self._calc_tilt(rotation)
-		# I THINK I KNOW HOW TO SOLVE MY PROBLEM
-		# WE NEED TO CLEAR THE BUFFER OF THE MPU6050
-		# AFTER EACH READ
-
-
+			self._sampler.wait()
+			self._loop_statistics.begin()
+			if not self._sensor.read_into(accel_sample, rotation_sample):
+				self._sampler.count_duplicate()
+				continue
+
+			self._vibration.push(rotation)
+			self._estimator.process_block(accel, rotation)
+			if self._recorder is not None:
+				self._recorder.record_sample(
+					autopylot.estimation.to_dict(accel_sample),
+					autopylot.estimation.to_dict(rotation_sample),
+					self._estimator.get_tilt(), self._estimator.get_distance(),
+					self._sampler.timestamp)
+			self._publish()
+
+	def _dmp_loop(self):
+		""" loop of the DMP mode - the orientation comes from the DMP
+		quaternions, only the distance is integrated here """
+		mounting = autopylot.orientation.AffineTransform(self._sensor.mounting)
+		while True:
+			self._sampler.wait()
+			self._loop_statistics.begin()
+			packets = self._sensor.get_dmp_packets()
+			if packets:
+				# the whole FIFO into the body frame at once
+				accels = mounting.apply(
+					numpy.array([packet.accel for packet in packets]))
+				rotations = mounting.apply(
+					numpy.array([packet.gyro for packet in packets]))
+				self._vibration.push(rotations)
+			for index, packet in enumerate(packets):
+				accel = autopylot.estimation.to_dict(accels[index])
+				rotation = autopylot.estimation.to_dict(rotations[index])
+				self._estimator.update(accel, rotation)
+				self._estimator.update_orientation(
+					autopylot.orientation.rotate_quaternion(
+						mounting.matrix, packet.quaternion))
+				if self._recorder is not None:
+					self._recorder.record_sample(accel, rotation,
+												self._estimator.get_tilt(),
+												self._estimator.get_distance(),
+												self._sampler.timestamp)
+			self._publish()
 
 
 # vim: tabstop=4 shiftwidth=4 noexpandtab
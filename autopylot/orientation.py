@@ -0,0 +1,124 @@
+""" Mounting orientation of the IMU. The config.ini names the sensor axis
+which measures the tilt to the left (roll) and the tilt to the front
+(pitch), like tiltleft = +x and tiltfront = +y. The body frame is:
+
+	x   the tilt left axis (roll)
+	y   the tilt front axis (pitch)
+	z   x × y (yaw)
+
+The mounting matrix turns sensor vectors into body vectors (body =
+matrix @ sensor). It is compiled once and checked to be a proper
+rotation - two settings along the same axis are rejected.
+
+The calibration (autopylot.calibration) is done in the sensor frame. An
+AffineTransform folds the scale, the offset and the rotation into one
+matrix and offset, so a whole block of samples turns into calibrated body
+frame data with one matrix multiply-add. """
+
+import numpy
+
+AXES = ('x', 'y', 'z')
+
+
+def parse_axis(spec):
+	""" Returns the unit vector of a signed axis like '+y' or '-x' """
+	spec = spec.strip().lower()
+	if len(spec) != 2 or spec[0] not in '+-' or spec[1] not in AXES:
+		raise Exception("Invalid axis {!r} - use +x, -x, +y, -y, +z or -z"
+						.format(spec))
+	vector = numpy.zeros(3)
+	vector[AXES.index(spec[1])] = 1.0 if spec[0] == '+' else -1.0
+	return vector
+
+
+def is_rotation(matrix, tolerance=1e-9):
+	""" Returns True if the 3x3 matrix is a proper rotation (orthonormal,
+	determinant +1 - no mirroring) """
+	matrix = numpy.asarray(matrix, dtype=numpy.float64)
+	return (matrix.shape == (3, 3) and
+			numpy.allclose(matrix @ matrix.T, numpy.eye(3), atol=tolerance) and
+			abs(numpy.linalg.det(matrix) - 1.0) < tolerance)
+
+
+def mounting_matrix(tilt_front, tilt_left):
+	""" Returns the sensor to body rotation (3x3) of the sensor axes which
+	measure the tilt to the front and to the left (like '+y', '+x') """
+	left = parse_axis(tilt_left)
+	front = parse_axis(tilt_front)
+	matrix = numpy.array([left, front, numpy.cross(left, front)])
+	if not is_rotation(matrix):
+		raise Exception("tiltfront ({!s}) and tiltleft ({!s}) have to be two "
+						"different sensor axes".format(tilt_front, tilt_left))
+	return matrix
+
+
+def rotate_band(matrix, band):
+	""" Returns the (min, max) band of the sensor axes as band of the body
+	axes - the mounting swaps the axes and flips their signs only """
+	low, high = numpy.asarray(band, dtype=numpy.float64)
+	first = matrix @ low
+	second = matrix @ high
+	return numpy.array([numpy.minimum(first, second),
+						numpy.maximum(first, second)])
+
+
+def rotate_quaternion(matrix, quaternion):
+	""" Returns the orientation quaternion (w, x, y, z) of the sensor as
+	orientation of the body - the axis of the rotation is rotated """
+	w, x, y, z = quaternion
+	vector = matrix @ numpy.array([x, y, z])
+	return (w, float(vector[0]), float(vector[1]), float(vector[2]))
+
+
+class AffineTransform():
+	""" out = matrix @ values + offset - for a vector (3) or a block
+	((n, 3), one sample per row). With out given nothing is allocated for a
+	vector. """
+
+	def __init__(self, matrix=None, offset=None):
+		self.matrix = numpy.eye(3)
+		self.offset = numpy.zeros(3)
+		self._transposed = numpy.eye(3)
+		self.set(numpy.eye(3) if matrix is None else matrix,
+				numpy.zeros(3) if offset is None else offset)
+
+	def set(self, matrix, offset):
+		""" Replaces the matrix and offset (in place - the arrays stay) """
+		self.matrix[:] = matrix
+		self.offset[:] = offset
+		self._transposed[:] = self.matrix.T
+
+	def apply(self, values, out=None):
+		""" Returns the transformed values (into out if given) """
+		if out is None:
+			out = numpy.empty(numpy.shape(values))
+		if numpy.ndim(values) == 1:
+			numpy.dot(self.matrix, values, out)
+		else:
+			numpy.dot(values, self._transposed, out)
+		numpy.add(out, self.offset, out)
+		return out
+
+
+def accel_transform(mounting, calibration=None, factor=1.0):
+	""" Returns the AffineTransform of raw accel values (times factor, the
+	scale of the range) into calibrated body frame values: accel =
+	mounting @ (raw * factor * accel_scale - accel_offset) """
+	scale = numpy.full(3, float(factor))
+	offset = numpy.zeros(3)
+	if calibration is not None:
+		scale *= calibration.accel_scale
+		offset[:] = calibration.accel_offset
+	return AffineTransform(mounting * scale, -(mounting @ offset))
+
+
+def gyro_transform(mounting, calibration=None, factor=1.0):
+	""" Returns the AffineTransform of raw gyro values (times factor) into
+	calibrated body frame values: gyro = mounting @ (raw * factor -
+	gyro_bias) """
+	bias = numpy.zeros(3)
+	if calibration is not None:
+		bias[:] = calibration.gyro_bias
+	return AffineTransform(mounting * float(factor), -(mounting @ bias))
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
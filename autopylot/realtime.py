@@ -0,0 +1,309 @@
+""" Real-time mode of the control loop. The cyclic garbage collector of
+Python runs whenever enough container objects were allocated - in the
+middle of a tick, a full collection of a big heap stalls the motor updates
+for milliseconds. In real-time mode:
+
+	- everything alive after the startup is frozen (gc.freeze) - the
+	  collections never scan these objects again
+	- the automatic collection is disabled while flying
+	- the loop calls idle() with the time left until its next tick, a due
+	  collection only runs if it fits into that slot. If the loop never
+	  has the time the youngest generation is collected anyway once
+	  force_limit objects piled up (bounded memory).
+
+audit() finds the code of a tick which allocates (tracemalloc): per stage
+the blocks a tick leaves allocated (these feed the collector) and the
+bytes allocated and freed within the tick. measure_latency() runs a tick
+at a fixed rate with and without the mode:
+
+	python -m autopylot.realtime --latency
+	python -m autopylot.realtime --audit """
+
+import gc
+import time
+import logging
+import argparse
+import tracemalloc
+import contextlib
+
+import numpy
+
+import autopylot.config
+
+PERCENTILES = (50, 99)
+
+
+class RealtimeMode():
+	""" Freezes the heap and runs the garbage collection in idle slots of
+	at least budget seconds only (see the module) """
+
+	def __init__(self, budget=0.001, force_limit=20000):
+		self.budget = budget
+		self.force_limit = force_limit
+		self.active = False
+		self.statistics = {'collections': [0, 0, 0], 'collected': 0,
+						'deferred': 0, 'forced': 0, 'frozen': 0,
+						'max_duration': 0.0}
+		# longest collection per generation - a generation only runs if
+		# its last worst case fits into the slot
+		self._durations = [0.0, 0.0, 0.0]
+		self._was_enabled = True
+
+	def enter(self):
+		""" Collects, freezes the survivors and disables the automatic
+		collection - call it after the startup (imports, objects of the
+		whole flight created) """
+		if self.active:
+			return
+		self._was_enabled = gc.isenabled()
+		gc.disable()
+		gc.collect()
+		gc.freeze()
+		self.active = True
+		self.statistics['frozen'] = gc.get_freeze_count()
+		logging.info("Real-time mode: froze {!s} objects, automatic garbage "
+					"collection disabled".format(self.statistics['frozen']))
+
+	def leave(self):
+		""" Restores the automatic collection """
+		if not self.active:
+			return
+		self.active = False
+		gc.unfreeze()
+		if self._was_enabled:
+			gc.enable()
+		logging.info("Real-time mode left: {!s}".format(self.statistics))
+
+	def __enter__(self):
+		self.enter()
+		return self
+
+	def __exit__(self, *args):
+		self.leave()
+
+	def due_generation(self):
+		""" Returns the generation the automatic collection would collect
+		now - or None """
+		counts = gc.get_count()
+		thresholds = gc.get_threshold()
+		for generation in (2, 1, 0):
+			threshold = thresholds[generation]
+			if threshold and counts[generation] > threshold:
+				return generation
+		return None
+
+	def idle(self, slack):
+		""" Called by the loop with the slack (seconds until the next tick)
+		- runs the due collection if it fits. Returns True if it ran. """
+		if not self.active:
+			return False
+		generation = self.due_generation()
+		if generation is None:
+			return False
+		if slack < max(self.budget, self._durations[generation]):
+			if gc.get_count()[0] < self.force_limit:
+				self.statistics['deferred'] += 1
+				return False
+			# bounded memory - the youngest generation is the cheapest
+			self.statistics['forced'] += 1
+			generation = 0
+		self.collect(generation)
+		return True
+
+	def collect(self, generation):
+		""" Runs (and times) a collection of the generation """
+		start = time.perf_counter()
+		self.statistics['collected'] += gc.collect(generation)
+		duration = time.perf_counter() - start
+		self.statistics['collections'][generation] += 1
+		self._durations[generation] = max(self._durations[generation],
+										duration)
+		self.statistics['max_duration'] = max(
+			self.statistics['max_duration'], duration)
+
+
+def create_mode():
+	""" Returns the RealtimeMode of the config.ini - or None if it is
+	disabled """
+	if not autopylot.config.get_realtime_enabled():
+		return None
+	return RealtimeMode(autopylot.config.get_realtime_idle_budget() / 1000,
+						autopylot.config.get_realtime_force_limit())
+
+
+def _tick_peak(function):
+	""" Returns the bytes allocated (and freed) within one call """
+	tracemalloc.reset_peak()
+	start, _ = tracemalloc.get_traced_memory()
+	function()
+	_, peak = tracemalloc.get_traced_memory()
+	return peak - start
+
+
+def audit(stages, ticks=1000, warmup=100, top=5):
+	""" Runs the stages (dict of {name: callable}) ticks times each under
+	tracemalloc. Returns per stage: blocks (and bytes) left allocated per
+	tick, the bytes allocated within a tick (peak, without the overhead of
+	the measurement), the top allocation sites ('file:line', blocks per
+	tick) and flagged (True if the stage allocates at all). """
+	report = {}
+	for name, function in stages.items():
+		for _ in range(warmup):
+			function()
+		tracemalloc.start(1)
+		try:
+			baseline = min(_tick_peak(_noop) for _ in range(10))
+			before = tracemalloc.take_snapshot()
+			peaks = numpy.empty(ticks)
+			for index in range(ticks):
+				peaks[index] = _tick_peak(function)
+			after = tracemalloc.take_snapshot()
+		finally:
+			tracemalloc.stop()
+		# without the blocks of the measurement itself
+		ignore = [tracemalloc.Filter(False, tracemalloc.__file__),
+				tracemalloc.Filter(False, __file__)]
+		statistics = sorted(
+			(stat for stat in after.filter_traces(ignore).compare_to(
+				before.filter_traces(ignore), 'lineno') if stat.count_diff > 0),
+			key=lambda stat: stat.count_diff, reverse=True)
+		blocks = sum(stat.count_diff for stat in statistics) / ticks
+		peak = max(float(numpy.median(peaks)) - baseline, 0.0)
+		report[name] = {
+			'blocks': blocks,
+			'bytes': sum(stat.size_diff for stat in statistics) / ticks,
+			'peak': peak,
+			'sites': [('{!s}:{!s}'.format(stat.traceback[0].filename,
+										stat.traceback[0].lineno),
+					stat.count_diff / ticks) for stat in statistics[:top]],
+			# a block every 100 ticks is a real allocation, less is noise
+			# of the snapshots
+			'flagged': blocks >= 0.01 or peak > 0}
+	return report
+
+
+def _noop():
+	pass
+
+
+def measure_latency(tick, rate=500, ticks=2000, realtime=None):
+	""" Runs the tick at rate Hz (like RemotePilot.run) and returns the
+	tick durations in ms: p50, p99 and max - with the RealtimeMode (its
+	statistics are included) or with the automatic collection """
+	interval = 1 / rate
+	durations = numpy.empty(ticks)
+	context = realtime if realtime is not None else contextlib.nullcontext()
+	with context:
+		deadline = time.perf_counter()
+		for index in range(ticks):
+			start = time.perf_counter()
+			tick()
+			end = time.perf_counter()
+			durations[index] = end - start
+			deadline += interval
+			if realtime is not None:
+				realtime.idle(deadline - end)
+			time.sleep(max(deadline - time.perf_counter(), 0))
+	durations *= 1000
+	result = {'p{!s}'.format(percentile):
+			float(numpy.percentile(durations, percentile))
+			for percentile in PERCENTILES}
+	result['max'] = float(durations.max())
+	if realtime is not None:
+		result['statistics'] = realtime.statistics
+	return result
+
+
+def fake_stages():
+	""" Returns the stages of a control tick on the fake hardware: sensor
+	read (ImuReader on the FakeI2CBus), estimator and motor output (the
+	ESC protocol of the config.ini on the FakePi). The fakes do allocate
+	a little themselves (the register copy of the bus). """
+	import autopylot.esc
+	import autopylot.imu
+	import autopylot.fakes
+	import autopylot.estimation
+	bus = autopylot.fakes.FakeI2CBus(overhead=0, byte_time=0, history=16)
+	mpu = autopylot.fakes.FakeMpu6050()
+	bus.attach(mpu)
+	reader = autopylot.imu.ImuReader(bus, mpu.address)
+	accel = numpy.zeros((1, 3))
+	rotation = numpy.zeros((1, 3))
+	accel_sample = accel[0]
+	rotation_sample = rotation[0]
+	estimator = autopylot.estimation.MotionEstimator(sample_count=10)
+	pi = autopylot.fakes.FakePi()
+	pins = [autopylot.config.get_motor_pin(name)
+			for name in autopylot.config.get_motor_names()]
+	output = autopylot.esc.create_output(pi, pins)
+	widths = [1200 + 10 * index for index in range(len(pins))]
+
+	def sensor_read():
+		reader.read_into(accel_sample, rotation_sample)
+
+	def estimator_update():
+		estimator.process_block(accel, rotation)
+
+	def motor_output():
+		with output.batch():
+			for pin, width in zip(pins, widths):
+				output.set_pulsewidth(pin, width)
+
+	return {'sensor read': sensor_read, 'estimator': estimator_update,
+			'motor output': motor_output}
+
+
+def _garbage(cycles):
+	""" Creates reference cycles like the rest of the process does (logging,
+	UI, telemetry) - they trigger the automatic collections """
+	for _ in range(cycles):
+		node = {}
+		node['self'] = node
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description="Real-time mode of the "
+									"control loop - latency and allocations")
+	parser.add_argument('--latency', action='store_true',
+						help="measure the tick latency with and without the "
+						"real-time mode")
+	parser.add_argument('--audit', action='store_true',
+						help="list the allocations of the tick stages")
+	parser.add_argument('--ticks', type=int, default=2000)
+	parser.add_argument('--rate', type=float, default=500)
+	parser.add_argument('--heap', type=int, default=200000,
+						help="long lived objects (a loaded process)")
+	parser.add_argument('--garbage', type=int, default=50,
+						help="reference cycles created per tick")
+	args = parser.parse_args(args)
+	stages = fake_stages()
+	if args.audit or not args.latency:
+		for name, result in audit(stages, args.ticks).items():
+			print("{!s:>14}: {!s:<8} {:.2f} blocks kept, {:.0f} bytes "
+				"allocated per tick".format(
+					name, "ALLOCATES" if result['flagged'] else "ok",
+					result['blocks'], result['peak']))
+			for site, blocks in result['sites']:
+				print("{!s:>16}{!s} ({:.2f} per tick)".format('', site, blocks))
+	if args.latency:
+		heap = [[index] for index in range(args.heap)]
+
+		def tick():
+			for stage in stages.values():
+				stage()
+			_garbage(args.garbage)
+		for label, realtime in (('automatic gc', None),
+								('real-time mode', create_mode() or
+								RealtimeMode())):
+			result = measure_latency(tick, args.rate, args.ticks, realtime)
+			print("{!s:>14}: p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms"
+				.format(label, result['p50'], result['p99'], result['max']))
+			if realtime is not None:
+				print("{!s:>16}{!s}".format('', result['statistics']))
+		del heap
+
+
+if __name__ == '__main__':
+	main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,389 @@
+""" Redundant IMUs. Two MPU-6050 fit on one bus (0x68 and 0x69 - AD0
+pin), more with a second bus. RedundantImu reads all of them per sample
+and fuses the good ones - so a broken sensor does not take out the whole
+estimation. Per sample and IMU:
+
+	- the read: one combined transfer for all IMUs if the bus can
+	  (read_many_into of DevI2C, FakeI2CBus and the ScheduledBus - see
+	  below), one read per IMU after an error to find the broken one
+	- the consistency checks: a failed read (error), all bits 0 or 1
+	  (invalid - the sensor was reset or the bus is stuck), unchanged
+	  registers (stale) and a deviation of more than the tolerance from
+	  the vote (disagree)
+	- the vote: the median per axis of the IMUs in use. Of two the last
+	  fused sample is the third voter, so the one which jumps away is
+	  rejected (the first sample of two is not checked). A single IMU in
+	  use is the reference for the isolated ones. If all samples in use
+	  disagree the closest one is kept (degraded).
+	- the fusion: the mean of the accepted samples weighted by the inverse
+	  of the noise of each IMU (a moving mean of its squared deviation
+	  from the vote)
+
+An IMU is isolated after stuck_limit stale or isolate_limit rejected
+samples in a row. It is still read and checked - and used again after
+recover_limit consistent samples in a row. If all IMUs are isolated the
+consistent ones are used anyway (degraded). The rejections are counted
+per IMU and reason (get_statistics).
+
+Reading n IMUs costs less than n single reads: the bytes on the bus stay
+the same, but the combined transfer (I2C_RDWR) is one call into the
+driver (one setup and wake-up) for all blocks. Through the BusScheduler
+all reads are queued at once and the caller only waits (and wakes up)
+once. The decoding per IMU does not allocate (see autopylot.imu):
+
+	python -m autopylot.redundancy --sensors 2 """
+
+import logging
+import argparse
+
+import numpy
+
+import autopylot.imu
+import autopylot.clock
+import autopylot.config
+
+REASONS = ('error', 'invalid', 'stale', 'disagree')
+
+# moving mean of the squared deviations (noise of an IMU)
+NOISE_ALPHA = 0.01
+
+
+class ImuHealth():
+	""" State and rejection counters of one IMU of the RedundantImu """
+
+	def __init__(self, address):
+		self.address = address
+		self.isolated = False
+		self.samples = 0
+		self.accepted = 0
+		self.rejected = dict.fromkeys(REASONS, 0)
+		self.isolations = 0
+		self.recoveries = 0
+		# in a row: unchanged, rejected and (while isolated) consistent
+		self.stale = 0
+		self.bad = 0
+		self.good = 0
+
+	def to_dict(self):
+		return {'isolated': self.isolated, 'samples': self.samples,
+				'accepted': self.accepted, 'rejected': dict(self.rejected),
+				'isolations': self.isolations, 'recoveries': self.recoveries}
+
+
+class RedundantImu():
+	""" Reads the ImuReaders (autopylot.imu) and fuses their samples into
+	one - see the module. The readers should use the same mounting and
+	ranges. """
+
+	def __init__(self, readers, gyro_tolerance=25.0, accel_tolerance=2.5,
+				stuck_limit=50, isolate_limit=10, recover_limit=1000):
+		if not readers:
+			raise Exception("RedundantImu needs at least one ImuReader")
+		self.readers = list(readers)
+		self.stuck_limit = stuck_limit
+		self.isolate_limit = isolate_limit
+		self.recover_limit = recover_limit
+		self.health = [ImuHealth(reader.address) for reader in self.readers]
+		self.samples = 0
+		self.degraded = 0
+		self.empty = 0
+		count = len(self.readers)
+		# accel xyz, gyro xyz per IMU - everything is allocated here
+		self.values = numpy.zeros((count, 6))
+		self._accels = [self.values[index, 0:3] for index in range(count)]
+		self._gyros = [self.values[index, 3:6] for index in range(count)]
+		self.tolerance = numpy.array([accel_tolerance] * 3 +
+									[gyro_tolerance] * 3, dtype=numpy.float64)
+		# a noise of a third of the tolerance until measured
+		self.noise = numpy.tile((self.tolerance / 3) ** 2, (count, 1))
+		self.fused = numpy.zeros(6)
+		self._fused_accel = self.fused[0:3]
+		self._fused_gyro = self.fused[3:6]
+		self._has_fused = False
+		self._voted = False
+		self._votes = numpy.zeros((count + 1, 6))
+		self._vote_rows = [self._votes[index] for index in range(count + 1)]
+		self._reference = numpy.zeros(6)
+		self._deviation = numpy.zeros(6)
+		self._exceeds_by = numpy.zeros(6)
+		self._weight = numpy.zeros(6)
+		self._weights = numpy.zeros(6)
+		self._weighted = numpy.zeros(6)
+		self._status = [None] * count
+		self._zeros = bytearray(autopylot.imu.BURST_LENGTH)
+		self._ones = bytearray(b'\xff' * autopylot.imu.BURST_LENGTH)
+		# one combined transfer if all IMUs are on the same bus which can
+		bus = self.readers[0].bus
+		self._requests = tuple(reader.request for reader in self.readers)
+		self._read_many = None
+		if all(reader.bus is bus for reader in self.readers):
+			self._read_many = getattr(bus, 'read_many_into', None)
+
+	def use_calibrations(self, calibrations):
+		""" Applies a calibration (or None) per reader """
+		for reader, calibration in zip(self.readers, calibrations):
+			if reader.calibration is not calibration:
+				reader.use_calibration(calibration)
+
+	def read_into(self, accel, gyro):
+		""" Reads all IMUs and writes the fused accel (m/s²) and gyro (°/s)
+		into the arrays of three. Returns False if no IMU delivered a
+		usable sample (the arrays are unchanged then). """
+		self._read()
+		self.samples += 1
+		count = 0
+		for index, health in enumerate(self.health):
+			if self._status[index] is None:
+				self.readers[index].decode_into(self._accels[index],
+												self._gyros[index])
+				if not health.isolated:
+					numpy.copyto(self._vote_rows[count], self.values[index])
+					count += 1
+		degraded = False
+		if not count:
+			# all in use are gone - vote with the isolated ones
+			for index in range(len(self.readers)):
+				if self._status[index] is None:
+					numpy.copyto(self._vote_rows[count], self.values[index])
+					count += 1
+			degraded = count > 0
+		kept = self._vote(count) and self._check(degraded)
+		if not self._fuse(degraded):
+			self.empty += 1
+			return False
+		self.degraded += degraded or kept
+		numpy.copyto(accel, self._fused_accel)
+		numpy.copyto(gyro, self._fused_gyro)
+		return True
+
+	def _read(self):
+		""" Reads the raw bytes of all IMUs - sets the status (None or the
+		reason of the rejection) per IMU """
+		readers = self.readers
+		for reader in readers:
+			reader.prepare_read()
+		combined = self._read_many is not None
+		if combined:
+			try:
+				self._read_many(self._requests)
+			except OSError:
+				combined = False
+		for index, reader in enumerate(readers):
+			status = None
+			if not combined:
+				try:
+					reader.fetch()
+				except OSError:
+					status = 'error'
+			if status is None:
+				raw = reader.raw
+				if raw == self._zeros or raw == self._ones:
+					status = 'invalid'
+				elif not reader.finish_read():
+					status = 'stale'
+			self._status[index] = status
+
+	def _vote(self, count):
+		""" Computes the reference (median per axis) of the count vote rows.
+		Two are completed by the last fused sample, a single one is the
+		reference itself. Returns False if there is nothing to check
+		against. """
+		self._voted = False
+		if count == 0:
+			return False
+		if count == 2:
+			if not self._has_fused:
+				return False
+			numpy.copyto(self._vote_rows[count], self.fused)
+			count += 1
+		votes = self._votes[:count]
+		votes.sort(axis=0)
+		numpy.add(self._vote_rows[(count - 1) // 2],
+				self._vote_rows[count // 2], self._reference)
+		numpy.multiply(self._reference, 0.5, self._reference)
+		# the noise is only learned from a real vote
+		self._voted = count >= 3
+		return True
+
+	def _deviate(self, index):
+		""" Returns the largest deviation of the IMU from the reference (in
+		tolerances) - the absolute deviations are left in _deviation """
+		numpy.subtract(self.values[index], self._reference, self._deviation)
+		numpy.abs(self._deviation, self._deviation)
+		numpy.divide(self._deviation, self.tolerance, self._exceeds_by)
+		return self._exceeds_by.max()
+
+	def _check(self, degraded):
+		""" Rejects the samples which deviate more than the tolerance from
+		the reference. If that were all usable ones, the closest one is kept
+		anyway - returns True then (degraded). """
+		closest = None
+		distance = 0.0
+		usable = 0
+		for index, health in enumerate(self.health):
+			if self._status[index] is not None:
+				continue
+			exceeds = self._deviate(index)
+			in_use = degraded or not health.isolated
+			if exceeds <= 1.0:
+				usable += in_use
+				continue
+			self._status[index] = 'disagree'
+			if in_use and (closest is None or exceeds < distance):
+				closest = index
+				distance = exceeds
+		if usable or closest is None:
+			return False
+		self._status[closest] = None
+		return True
+
+	def _fuse(self, degraded):
+		""" Updates the counters of every IMU and fuses the accepted samples
+		into fused (weighted by the inverse noise). Returns False if none
+		was accepted. """
+		self._weights.fill(0.0)
+		self._weighted.fill(0.0)
+		accepted = 0
+		for index, health in enumerate(self.health):
+			status = self._status[index]
+			self._update(health, status)
+			if status is not None or (health.isolated and not degraded):
+				continue
+			health.accepted += 1
+			accepted += 1
+			noise = self.noise[index]
+			if self._voted:
+				self._deviate(index)
+				numpy.multiply(self._deviation, self._deviation,
+							self._deviation)
+				numpy.multiply(noise, 1 - NOISE_ALPHA, noise)
+				numpy.multiply(self._deviation, NOISE_ALPHA, self._deviation)
+				numpy.add(noise, self._deviation, noise)
+			numpy.divide(1.0, noise, self._weight)
+			numpy.add(self._weights, self._weight, self._weights)
+			numpy.multiply(self._weight, self.values[index], self._weight)
+			numpy.add(self._weighted, self._weight, self._weighted)
+		if not accepted:
+			return False
+		numpy.divide(self._weighted, self._weights, self.fused)
+		self._has_fused = True
+		return True
+
+	def _update(self, health, status):
+		""" Counts the status of the sample - isolates or recovers the IMU """
+		health.samples += 1
+		if status is None:
+			health.stale = 0
+			health.bad = 0
+			if health.isolated:
+				health.good += 1
+				if health.good >= self.recover_limit:
+					health.isolated = False
+					health.recoveries += 1
+					logging.warning("IMU {!s} is consistent again - using "
+									"it".format(hex(health.address)))
+			return
+		health.rejected[status] += 1
+		health.good = 0
+		if status == 'stale':
+			health.stale += 1
+		else:
+			health.bad += 1
+		if not health.isolated and (health.stale >= self.stuck_limit or
+									health.bad >= self.isolate_limit):
+			health.isolated = True
+			health.isolations += 1
+			logging.error("IMU {!s} isolated ({!s} samples in a row: {!s}) - "
+						"rejected so far: {!s}".format(
+							hex(health.address),
+							max(health.stale, health.bad), status,
+							health.rejected))
+
+	@property
+	def active(self):
+		""" Number of IMUs in use (not isolated) """
+		return sum(not health.isolated for health in self.health)
+
+	def get_statistics(self):
+		""" Returns a dict of the counters - per IMU address (hex) the
+		rejections per reason and the isolations """
+		return {'samples': self.samples, 'degraded': self.degraded,
+				'empty': self.empty, 'active': self.active,
+				'imus': {hex(health.address): health.to_dict()
+						for health in self.health}}
+
+
+def create_redundant_imu(readers):
+	""" Returns the RedundantImu of the readers with the limits of the
+	config.ini """
+	return RedundantImu(
+		readers,
+		gyro_tolerance=autopylot.config.get_redundancy_gyro_tolerance(),
+		accel_tolerance=autopylot.config.get_redundancy_accel_tolerance(),
+		stuck_limit=autopylot.config.get_redundancy_stuck_limit(),
+		isolate_limit=autopylot.config.get_redundancy_isolate_limit(),
+		recover_limit=autopylot.config.get_redundancy_recover_limit())
+
+
+def fake_imus(count, bus=None):
+	""" Returns the bus (a FakeI2CBus with the call overhead of a Raspberry
+	Pi by default), the FakeMpu6050s (0x68, 0x69, ...) attached to it and an
+	ImuReader per sensor """
+	import autopylot.fakes
+	if bus is None:
+		bus = autopylot.fakes.FakeI2CBus(call_overhead=100e-6)
+	sensors = []
+	readers = []
+	for index in range(count):
+		sensor = autopylot.fakes.FakeMpu6050(0x68 + index)
+		bus.attach(sensor)
+		sensors.append(sensor)
+		readers.append(autopylot.imu.ImuReader(bus, sensor.address,
+											accel_full_scale=8,
+											gyro_full_scale=2000))
+	return bus, sensors, readers
+
+
+def measure_read(read, samples):
+	""" Returns the mean duration (s) of read() on the clock in use """
+	start = autopylot.clock.now()
+	for _ in range(samples):
+		read()
+	return (autopylot.clock.now() - start) / samples
+
+
+def benchmark(count=2, samples=2000):
+	""" Returns the mean read time (s) of one IMU, of count IMUs one after
+	another and of the RedundantImu (combined transfer, checks and fusion)
+	of count IMUs - on the FakeI2CBus (400kHz, 100µs per call) """
+	bus, _, readers = fake_imus(count)
+	imu = RedundantImu(readers)
+	accel = numpy.zeros(3)
+	gyro = numpy.zeros(3)
+
+	def sequential():
+		for reader in readers:
+			reader.read_into(accel, gyro)
+	return {'single': measure_read(
+				lambda: readers[0].read_into(accel, gyro), samples),
+			'sequential': measure_read(sequential, samples),
+			'redundant': measure_read(lambda: imu.read_into(accel, gyro),
+									samples)}
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description="Read time of redundant "
+									"IMUs on the fake I2C bus")
+	parser.add_argument('--sensors', type=int, default=2)
+	parser.add_argument('--samples', type=int, default=2000)
+	args = parser.parse_args(args)
+	result = benchmark(args.sensors, args.samples)
+	for name, duration in result.items():
+		print("{!s:>10}: {:.1f} µs per sample ({:.2f}x single)".format(
+			name, duration * 1e6, duration / result['single']))
+
+
+if __name__ == '__main__':
+	main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
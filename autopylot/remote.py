@@ -0,0 +1,425 @@
+""" Remote control link over UDP - the ground station (RemoteClient) sends
+absolute setpoints (throttle, roll, pitch, yaw and the arm state) as small
+binary datagrams, the aircraft (RemoteReceiver) only ever applies the newest
+one. Nothing is retransmitted or queued: a lost datagram is replaced by the
+next one anyway, and a late one is worse than none.
+
+Datagram (little endian, 24 bytes):
+	magic 'AP', version, flags (bit 0 armed), sequence (uint32, wraps),
+	timestamp (uint64, µs of the sender clock), throttle, roll, pitch, yaw
+	(int16, 1/100 %)
+
+Stale datagrams are detected without synchronized clocks: the smallest
+(receive time - send timestamp) seen is taken as the clock offset plus the
+minimal network delay, a datagram delayed by more than maxage on top of that
+is dropped. After a loss of link the receiver resyncs (the sequence and the
+offset start over), so a restarted client is accepted again.
+
+Run on the aircraft with `python3 -m autopylot.remote` - `--benchmark`
+measures the latency over loopback instead. """
+
+import socket
+import select
+import struct
+import logging
+import argparse
+import threading
+import collections
+
+import numpy
+
+import autopylot.config
+import autopylot.clock
+
+MAGIC = b'AP'
+VERSION = 1
+PACKET = struct.Struct('<2sBBIQhhhh')
+FLAG_ARMED = 0x01
+# setpoints are sent in 1/100 %
+SCALE = 100
+SEQUENCE_MASK = 0xffffffff
+# a few datagrams are enough - only the newest one is used anyway
+RECEIVE_BUFFER = 16 * PACKET.size
+# how often the receiver thread checks the link without datagrams (s)
+POLL_INTERVAL = 0.01
+
+LINK_LOSS_ACTIONS = ('hover', 'land', 'disarm')
+
+Setpoint = collections.namedtuple('Setpoint', ['sequence', 'timestamp',
+												'throttle', 'roll', 'pitch',
+												'yaw', 'armed'])
+
+
+def encode(setpoint):
+	""" Returns the datagram of the Setpoint (values in %) """
+	return PACKET.pack(MAGIC, VERSION, FLAG_ARMED if setpoint.armed else 0,
+					setpoint.sequence & SEQUENCE_MASK, setpoint.timestamp,
+					int(round(setpoint.throttle * SCALE)),
+					int(round(setpoint.roll * SCALE)),
+					int(round(setpoint.pitch * SCALE)),
+					int(round(setpoint.yaw * SCALE)))
+
+
+def decode(data):
+	""" Returns the Setpoint of the datagram - raises an Exception if it is
+	not a valid one """
+	if len(data) != PACKET.size:
+		raise Exception("Invalid datagram size ({!s} bytes)".format(len(data)))
+	(magic, version, flags, sequence, timestamp, throttle, roll, pitch,
+		yaw) = PACKET.unpack(data)
+	if magic != MAGIC or version != VERSION:
+		raise Exception("Invalid datagram (magic {!r}, version {!s})"
+						.format(magic, version))
+	if not 0 <= throttle <= 100 * SCALE:
+		raise Exception("Throttle out of range ({!s})".format(throttle / SCALE))
+	for value in (roll, pitch, yaw):
+		if not -100 * SCALE <= value <= 100 * SCALE:
+			raise Exception("Setpoint out of range ({!s})"
+							.format(value / SCALE))
+	return Setpoint(sequence, timestamp, throttle / SCALE, roll / SCALE,
+					pitch / SCALE, yaw / SCALE, bool(flags & FLAG_ARMED))
+
+
+def is_newer(sequence, last_sequence):
+	""" Returns True if sequence follows last_sequence (with wraparound -
+	up to half of the sequence range ahead) """
+	difference = (sequence - last_sequence) & SEQUENCE_MASK
+	return 0 < difference < (SEQUENCE_MASK + 1) // 2
+
+
+def _timestamp():
+	return int(autopylot.clock.now() * 1000000)
+
+
+class RemoteClient():
+	""" Sends setpoints to the aircraft - every send is a new sequence
+	number, so just send the current stick positions periodically """
+
+	def __init__(self, host, port, sequence=0):
+		self.address = (host, port)
+		self.sequence = sequence
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+	def send(self, throttle, roll=0, pitch=0, yaw=0, armed=True):
+		""" Sends the setpoint (throttle 0 to 100, roll, pitch and yaw -100
+		to 100) and returns it """
+		self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+		setpoint = Setpoint(self.sequence, _timestamp(), throttle, roll, pitch,
+							yaw, armed)
+		self.socket.sendto(encode(setpoint), self.address)
+		return setpoint
+
+	def close(self):
+		self.socket.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+class RemoteReceiver():
+	""" Receives the setpoints on a thread and keeps the newest valid one
+	(latest wins). Out of order, stale and malformed datagrams are dropped
+	and counted. on_link_lost is called (on the receiver thread) once no
+	valid datagram arrived for link_timeout seconds. Port 0 binds any free
+	port (see self.port). """
+
+	def __init__(self, port, address='0.0.0.0', link_timeout=0.25,
+				max_age=0.1, on_link_lost=None):
+		self.link_timeout = link_timeout
+		self.max_age = max_age
+		self.on_link_lost = on_link_lost
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+							RECEIVE_BUFFER)
+		self.socket.bind((address, port))
+		self.socket.setblocking(False)
+		self.port = self.socket.getsockname()[1]
+		self.statistics = {'received': 0, 'accepted': 0, 'superseded': 0,
+							'outoforder': 0, 'stale': 0, 'malformed': 0,
+							'linklosses': 0}
+		self._lock = threading.Lock()
+		self._latest = None
+		self._last_sequence = None
+		self._min_offset = None
+		self._last_valid = None
+		self._link_up = False
+		self._stop = threading.Event()
+		self._thread = None
+
+	def start(self):
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._run, name='remote',
+										daemon=True)
+		self._thread.start()
+		logging.info("Remote control receiver listening on port {!s}"
+					.format(self.port))
+
+	def stop(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		self.socket.close()
+
+	@property
+	def link_up(self):
+		""" True while valid setpoints arrive """
+		return self._link_up
+
+	def latest(self):
+		""" Returns the newest Setpoint - None if the link is down """
+		with self._lock:
+			return self._latest if self._link_up else None
+
+	def _run(self):
+		while not self._stop.is_set():
+			try:
+				select.select([self.socket], [], [], POLL_INTERVAL)
+			except (OSError, ValueError):
+				break
+			# drain whatever queued up - only the newest counts
+			datagrams = []
+			while True:
+				try:
+					datagrams.append(self.socket.recv(RECEIVE_BUFFER))
+				except BlockingIOError:
+					break
+			now = autopylot.clock.now()
+			self.process(datagrams, now)
+			self.check_link(now)
+
+	def process(self, datagrams, now):
+		""" Handles the datagrams received at now (s) - keeps the newest
+		valid one. Returns True if it became the latest setpoint. """
+		if not datagrams:
+			return False
+		self.statistics['received'] += len(datagrams)
+		newest = None
+		for data in datagrams:
+			try:
+				setpoint = decode(data)
+			except Exception as e:
+				self.statistics['malformed'] += 1
+				logging.debug("Dropped datagram: {!s}".format(e))
+				continue
+			if newest is None or is_newer(setpoint.sequence, newest.sequence):
+				if newest is not None:
+					self.statistics['superseded'] += 1
+				newest = setpoint
+			else:
+				self.statistics['superseded'] += 1
+		if newest is None:
+			return False
+		if not self._link_up:
+			# resync - the client may have restarted
+			self._last_sequence = None
+			self._min_offset = None
+		if (self._last_sequence is not None and
+				not is_newer(newest.sequence, self._last_sequence)):
+			self.statistics['outoforder'] += 1
+			return False
+		offset = now - newest.timestamp / 1000000
+		if self._min_offset is None or offset < self._min_offset:
+			self._min_offset = offset
+		if offset - self._min_offset > self.max_age:
+			self.statistics['stale'] += 1
+			return False
+		self.statistics['accepted'] += 1
+		self._last_sequence = newest.sequence
+		self._last_valid = now
+		with self._lock:
+			self._latest = newest
+			if not self._link_up:
+				logging.info("Remote control link established")
+			self._link_up = True
+		return True
+
+	def check_link(self, now):
+		""" Triggers the loss of link if the last valid setpoint is older
+		than the link timeout. Returns True while the link is up. """
+		if self._link_up and now - self._last_valid > self.link_timeout:
+			with self._lock:
+				self._link_up = False
+			self.statistics['linklosses'] += 1
+			logging.critical("Remote control link lost (no setpoint for {!s} "
+							"s)".format(round(now - self._last_valid, 3)))
+			if self.on_link_lost is not None:
+				self.on_link_lost()
+		return self._link_up
+
+
+class RemotePilot():
+	""" Applies the newest setpoint of the receiver to the quadcopter at a
+	fixed rate and keeps the failsafe fed. On a loss of link the action is
+	taken: hover (level out, keep the throttle), land (level out and lower
+	the throttle by land_rate %/s until the motors are off) or disarm (stop
+	the motors at once). After a failsafe cutoff the motors are only turned
+	on again once a disarmed setpoint was seen (the operator re-arms). With
+	a RealtimeMode (autopylot.realtime) the garbage collection runs in the
+	slack between the ticks. """
+
+	def __init__(self, quadcopter, receiver, action='land', rate=50,
+				land_rate=10, tracer=None, realtime=None):
+		if action not in LINK_LOSS_ACTIONS:
+			raise Exception("Unknown loss of link action: {!s}".format(action))
+		self.quadcopter = quadcopter
+		self.receiver = receiver
+		self.action = action
+		self.interval = 1 / rate
+		self.land_step = land_rate / rate
+		self.tracer = tracer
+		self.realtime = realtime
+		self._applied = None
+		self._landing = None
+		# a disarmed setpoint arrived since the motors were last commanded
+		self._disarm_seen = True
+
+	def _apply(self, setpoint):
+		if not setpoint.armed:
+			self._disarm_seen = True
+			if self.quadcopter.turned_on:
+				self.quadcopter.turn_off()
+			return
+		if not self.quadcopter.turned_on:
+			if self.quadcopter.failsafe_tripped and not self._disarm_seen:
+				logging.error("Ignoring the armed setpoint - the failsafe cut "
+							"off the motors, disarm and arm again first")
+				return
+			self.quadcopter.turn_on()
+		self._disarm_seen = False
+		command = self.tracer.begin() if self.tracer is not None else None
+		self.quadcopter.change_setpoint(setpoint.throttle, setpoint.roll,
+										setpoint.pitch, setpoint.yaw, command)
+
+	def _link_lost(self):
+		if self._landing is None:
+			# first tick without link
+			logging.critical("Loss of link action: {!s}".format(self.action))
+			self._applied = None
+			if self.action == 'disarm' or not self.quadcopter.turned_on:
+				self.quadcopter.turn_off()
+				self._landing = 0
+				return
+			self.quadcopter.hover()
+			self._landing = (self.quadcopter.request_total_throttle() /
+							len(self.quadcopter.motors))
+		elif self.action == 'land' and self.quadcopter.turned_on:
+			self._landing = max(self._landing - self.land_step, 0)
+			if self._landing > 0:
+				self.quadcopter.change_overall_throttle(self._landing)
+			else:
+				self.quadcopter.turn_off()
+
+	def step(self):
+		""" One tick - applies a new setpoint or continues the loss of link
+		action """
+		setpoint = self.receiver.latest()
+		if setpoint is None:
+			if self._applied is not None or self._landing is not None:
+				self._link_lost()
+		else:
+			self._landing = None
+			if self._applied is None or setpoint.sequence != self._applied:
+				self._apply(setpoint)
+				self._applied = setpoint.sequence
+		if self.quadcopter.turned_on:
+			self.quadcopter.heartbeat()
+
+	def run(self, stop):
+		""" Runs the ticks until the stop event is set """
+		deadline = autopylot.clock.now()
+		while not stop.is_set():
+			self.step()
+			deadline += self.interval
+			if self.realtime is not None:
+				self.realtime.idle(deadline - autopylot.clock.now())
+			autopylot.clock.sleep(max(deadline - autopylot.clock.now(), 0))
+
+
+def benchmark(count=1000, interval=0.001):
+	""" Sends count setpoints over loopback and returns the latencies (ms)
+	until the receiver holds them as the latest: p50, p99, max and the
+	share that was received (not superseded or lost) """
+	receiver = RemoteReceiver(0, '127.0.0.1', link_timeout=1, max_age=1)
+	receiver.start()
+	latencies = []
+	try:
+		with RemoteClient('127.0.0.1', receiver.port) as client:
+			for _ in range(count):
+				start = autopylot.clock.now()
+				setpoint = client.send(50, 10, -10, 5)
+				while True:
+					latest = receiver.latest()
+					if latest is not None and latest.sequence == setpoint.sequence:
+						break
+					if autopylot.clock.now() - start > 0.1:
+						latest = None
+						break
+					autopylot.clock.sleep(0)
+				if latest is not None:
+					latencies.append((autopylot.clock.now() - start) * 1000)
+				autopylot.clock.sleep(interval)
+	finally:
+		receiver.stop()
+	latencies = numpy.array(latencies if latencies else [numpy.nan])
+	return {'p50': float(numpy.percentile(latencies, 50)),
+			'p99': float(numpy.percentile(latencies, 99)),
+			'max': float(latencies.max()),
+			'received': len(latencies) / count,
+			'statistics': receiver.statistics}
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description="Remote control link - "
+									"applies the setpoints of a RemoteClient")
+	parser.add_argument('--benchmark', type=int, metavar='COUNT',
+						help="measure the loopback latency of COUNT setpoints")
+	args = parser.parse_args(args)
+	if args.benchmark:
+		result = benchmark(args.benchmark)
+		print("latency p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms, received "
+			"{:.1%}".format(result['p50'], result['p99'], result['max'],
+							result['received']))
+		return
+
+	# the hardware is only needed on the aircraft
+	import autopylot.control
+	import autopylot.realtime
+	import autopylot.telemetry
+	telemetry = autopylot.telemetry.create_publisher(
+		len(autopylot.config.get_motor_names()))
+	quadcopter = autopylot.control.Quadcopter(telemetry=telemetry)
+	receiver = RemoteReceiver(autopylot.config.get_remote_port(),
+							autopylot.config.get_remote_address(),
+							autopylot.config.get_remote_link_timeout() / 1000,
+							autopylot.config.get_remote_max_age() / 1000)
+	pilot = RemotePilot(quadcopter, receiver,
+						autopylot.config.get_remote_link_loss_action(),
+						autopylot.config.get_remote_rate(),
+						autopylot.config.get_remote_land_rate(),
+						realtime=autopylot.realtime.create_mode())
+	stop = threading.Event()
+	receiver.start()
+	# everything of the flight exists now - freeze it
+	if pilot.realtime is not None:
+		pilot.realtime.enter()
+	try:
+		pilot.run(stop)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if pilot.realtime is not None:
+			pilot.realtime.leave()
+		receiver.stop()
+		quadcopter.turn_off()
+		logging.info("Remote control statistics: {!s}"
+					.format(receiver.statistics))
+
+
+if __name__ == '__main__':
+	main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,304 @@
+""" Flight recording and replay. The FlightRecorder captures the raw sensor
+samples, the estimator output and the motor commands (with timestamps)
+during a flight - and the noise bands of the calibration the dead zones
+were set up from. The ReplayEngine feeds such a recording back through the
+estimation (and optionally control) code in blocks - as fast as the CPU
+allows - and reports how the outputs differ from the recorded ones. """
+
+import time
+import logging
+import threading
+
+import numpy
+
+import autopylot.clock
+import autopylot.estimation
+import autopylot.calibration
+import autopylot.orientation
+
+# column layout of the sample table
+SAMPLE_COLUMNS = 13
+_TIME = 0
+_ACCEL = slice(1, 4)
+_ROTATION = slice(4, 7)
+_TILT = slice(7, 10)
+_DISTANCE = slice(10, 13)
+
+# column layout of the motor command table (time, pin, throttle)
+MOTOR_COLUMNS = 3
+
+
+class _Table():
+	""" Preallocated (growing) 2d float table. Appending a row does not
+	allocate anything until the current capacity is exhausted - then the
+	capacity is doubled. """
+
+	def __init__(self, columns, capacity):
+		self._data = numpy.empty((int(capacity), columns))
+		self._length = 0
+		self._lock = threading.Lock()
+
+	def append(self, values):
+		""" Writes values (one per column) into the next free row - under
+		the lock, a concurrent append may replace the storage """
+		with self._lock:
+			if self._length == len(self._data):
+				grown = numpy.empty((len(self._data) * 2,
+									self._data.shape[1]))
+				grown[:self._length] = self._data
+				self._data = grown
+			self._data[self._length] = values
+			self._length += 1
+
+	def data(self):
+		""" Returns a view on all rows appended so far """
+		return self._data[:self._length]
+
+
+class FlightRecorder():
+	""" Records sensor samples and motor commands of a flight. Attach it
+	to the MotionTracker (samples) and the Quadcopter (motor commands). """
+
+	def __init__(self, capacity=4096):
+		self._samples = _Table(SAMPLE_COLUMNS, capacity)
+		self._motors = _Table(MOTOR_COLUMNS, capacity)
+		self._accel_band = None
+		self._gyro_band = None
+
+	def record_calibration(self, calibration, mounting=None):
+		""" Records the noise bands of the ImuCalibration the estimator uses
+		(see MotionEstimator.use_calibration) - in the body frame if the
+		mounting is given, like the samples """
+		accel_band = numpy.array(calibration.accel_band, dtype=float)
+		gyro_band = numpy.array(calibration.gyro_band, dtype=float)
+		if mounting is not None:
+			accel_band = autopylot.orientation.rotate_band(mounting, accel_band)
+			gyro_band = autopylot.orientation.rotate_band(mounting, gyro_band)
+		self._accel_band = accel_band
+		self._gyro_band = gyro_band
+
+	def record_sample(self, accel, rotation, tilt, distance, timestamp=None):
+		""" Records one raw sensor sample (dicts as returned by the
+		SensorData) together with the estimated tilt and distance. The
+		timestamp (seconds) defaults to now. """
+		if timestamp is None:
+			timestamp = autopylot.clock.now()
+		self._samples.append((timestamp,
+							accel['x'], accel['y'], accel['z'],
+							rotation['x'], rotation['y'], rotation['z'],
+							tilt['x'], tilt['y'], tilt['z'],
+							distance['x'], distance['y'], distance['z']))
+
+	def record_motor_command(self, pin, throttle):
+		""" Records a throttle (in percent %) sent to the motor on pin """
+		self._motors.append((autopylot.clock.now(), pin, throttle))
+
+	def get_recording(self):
+		""" Returns a FlightRecording of everything recorded so far """
+		return FlightRecording(self._samples.data().copy(),
+							self._motors.data().copy(),
+							self._accel_band, self._gyro_band)
+
+	def save(self, filename):
+		""" Writes the recording to the given file (numpy .npz format) """
+		self.get_recording().save(filename)
+
+
+class FlightRecording():
+	""" A recorded flight - a sample table, a motor command table and the
+	(body frame) noise bands of the calibration - None if the dead zones
+	were set up from the first samples """
+
+	def __init__(self, samples, motors, accel_band=None, gyro_band=None):
+		self.samples = numpy.asarray(samples, dtype=float).reshape(
+			-1, SAMPLE_COLUMNS)
+		self.motors = numpy.asarray(motors, dtype=float).reshape(
+			-1, MOTOR_COLUMNS)
+		self.accel_band = accel_band
+		self.gyro_band = gyro_band
+
+	@classmethod
+	def load(cls, filename):
+		""" Loads a recording written by FlightRecording.save """
+		with numpy.load(filename) as data:
+			bands = [data[name] if name in data.files else None
+					for name in ('accel_band', 'gyro_band')]
+			return cls(data['samples'], data['motors'], *bands)
+
+	def save(self, filename):
+		""" Writes the recording to the given file (numpy .npz format) """
+		arrays = {'samples': self.samples, 'motors': self.motors}
+		if self.accel_band is not None:
+			arrays['accel_band'] = self.accel_band
+			arrays['gyro_band'] = self.gyro_band
+		numpy.savez(filename, **arrays)
+		logging.info("Saved flight recording ({!s} samples, {!s} motor "
+					"commands) to {!s}".format(len(self.samples),
+											len(self.motors), filename))
+
+	def __len__(self):
+		return len(self.samples)
+
+	@property
+	def timestamps(self):
+		return self.samples[:, _TIME]
+
+	@property
+	def accel(self):
+		return self.samples[:, _ACCEL]
+
+	@property
+	def rotation(self):
+		return self.samples[:, _ROTATION]
+
+	@property
+	def tilt(self):
+		return self.samples[:, _TILT]
+
+	@property
+	def distance(self):
+		return self.samples[:, _DISTANCE]
+
+	@property
+	def calibration(self):
+		""" ImuCalibration with the recorded noise bands (body frame) - None
+		if no calibration was recorded """
+		if self.accel_band is None:
+			return None
+		return autopylot.calibration.ImuCalibration(
+			gyro_band=self.gyro_band, accel_band=self.accel_band)
+
+	@property
+	def duration(self):
+		""" Duration of the recording in seconds """
+		if len(self.samples) < 2:
+			return 0.0
+		return float(self.timestamps[-1] - self.timestamps[0])
+
+	@property
+	def pins(self):
+		""" Sorted list of all motor pins which received commands """
+		return [int(pin) for pin in numpy.unique(self.motors[:, 1])]
+
+	def motor_throttle_at(self, timestamps):
+		""" Returns the throttle of each motor (columns ordered like pins)
+		at the given timestamps. The last command sent before a timestamp
+		is held - motors without a command yet are at 0. """
+		timestamps = numpy.asarray(timestamps, dtype=float)
+		throttle = numpy.zeros((len(timestamps), len(self.pins)))
+		for column, pin in enumerate(self.pins):
+			commands = self.motors[self.motors[:, 1] == pin]
+			index = numpy.searchsorted(commands[:, 0], timestamps,
+									side='right') - 1
+			sent = index >= 0
+			throttle[sent, column] = commands[index[sent], 2]
+		return throttle
+
+
+class ReplayReport():
+	""" Result of a replay - differences between the replayed and the
+	recorded outputs and the achieved throughput """
+
+	def __init__(self, samples, elapsed, duration, tilt_error, distance_error,
+				motor_error=None):
+		self.samples = samples
+		self.elapsed = elapsed
+		self.duration = duration
+		# max absolute difference per axis (or per motor)
+		self.tilt_error = tilt_error
+		self.distance_error = distance_error
+		self.motor_error = motor_error
+
+	@property
+	def samples_per_second(self):
+		return self.samples / self.elapsed if self.elapsed > 0 else float('inf')
+
+	@property
+	def realtime_factor(self):
+		""" How many times faster than the real flight the replay was """
+		return self.duration / self.elapsed if self.elapsed > 0 else float('inf')
+
+	@property
+	def matches(self):
+		""" True if the replay reproduced the recorded outputs exactly """
+		errors = [self.tilt_error, self.distance_error]
+		if self.motor_error is not None:
+			errors.append(self.motor_error)
+		return all(not numpy.any(error) for error in errors)
+
+	def __str__(self):
+		text = ("Replayed {!s} samples in {:.3f}s ({:.0f} samples/s, {:.1f}x "
+				"real time). Max. tilt error: {!s} - max. distance error: {!s}"
+				.format(self.samples, self.elapsed, self.samples_per_second,
+						self.realtime_factor, self.tilt_error.tolist(),
+						self.distance_error.tolist()))
+		if self.motor_error is not None:
+			text += " - max. motor error: {!s}".format(self.motor_error.tolist())
+		return text
+
+
+class ReplayEngine():
+	""" Feeds a FlightRecording through a fresh estimator (and optionally a
+	controller) block by block.
+	The estimator_factory returns an object with a process_block(accel,
+	rotation) method (like the MotionEstimator) - by default the estimator
+	of the MotionTracker, set up from the config. If the recording has a
+	calibration it is passed to use_calibration(calibration) of the
+	estimator. The controller is called as controller(timestamps, tilt,
+	distance) and returns the throttle of each motor - one column per pin
+	of the recording. """
+
+	def __init__(self, estimator_factory=autopylot.estimation.create_estimator,
+				controller=None, block_size=4096):
+		self.estimator_factory = estimator_factory
+		self.controller = controller
+		self.block_size = int(block_size)
+
+	def run(self, recording):
+		""" Replays the recording and returns a ReplayReport """
+		estimator = self.estimator_factory()
+		calibration = recording.calibration
+		if calibration is not None:
+			estimator.use_calibration(calibration)
+		count = len(recording)
+		tilt = numpy.empty((count, 3))
+		distance = numpy.empty((count, 3))
+		motors = None
+		if self.controller is not None:
+			motors = numpy.empty((count, len(recording.pins)))
+
+		timestamps = recording.timestamps
+		accel = recording.accel
+		rotation = recording.rotation
+
+		start_time = time.perf_counter()
+		for start in range(0, count, self.block_size):
+			end = min(start + self.block_size, count)
+			tilt[start:end], distance[start:end] = estimator.process_block(
+				accel[start:end], rotation[start:end])
+			if motors is not None:
+				motors[start:end] = self.controller(timestamps[start:end],
+													tilt[start:end],
+													distance[start:end])
+		elapsed = time.perf_counter() - start_time
+
+		motor_error = None
+		if motors is not None:
+			recorded = recording.motor_throttle_at(timestamps)
+			motor_error = _max_abs_difference(motors, recorded)
+
+		report = ReplayReport(count, elapsed, recording.duration,
+							_max_abs_difference(tilt, recording.tilt),
+							_max_abs_difference(distance, recording.distance),
+							motor_error)
+		logging.info(str(report))
+		return report
+
+
+def _max_abs_difference(replayed, recorded):
+	""" Returns the max absolute difference per column """
+	if len(replayed) == 0:
+		return numpy.zeros(replayed.shape[1])
+	return numpy.abs(replayed - recorded).max(axis=0)
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
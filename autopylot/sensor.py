@@ -3,32 +3,91 @@
 # utilize the sensors once for the whole system
 
 import logging
-import time
+import struct
 
-import mpu6050.mpu6050 as mpu6050
+from mpu6050 import mpu6050
+
+import autopylot.calibration
+import autopylot.i2cbus
+import autopylot.dmp
+import autopylot.imu
+import autopylot.redundancy
+
+# accel xyz, temperature, gyro xyz (big endian)
+_BURST_FORMAT = struct.Struct('>7h')
+_TEMPERATURE_FORMAT = struct.Struct('>h')
+
+# registers used to configure the data ready interrupt
+_SMPLRT_DIV = 0x19
+_CONFIG = 0x1A
+_INT_PIN_CFG = 0x37
+_INT_ENABLE = 0x38
 
 
 class SensorData():
 	""" Wrapper class for all the used sensors - like the mpu6050 gyrosensor.
 	Makes it easier to switch the module which communicates with the
 	mpu6050 sensor easier later. Or we could even switch to a whole
-	new sensor and also add new sensors """
-	def __init__(self, address):
-		self.sensor = mpu6050(address)
-		# configure the gyro sensor
-		# let it here be hardcoded because maybe we'll change the sensor
-		# in the future and then we won't be able to use the same configs
-		# self.sensor.set_gyro_range(mpu6050.GYRO_RANGE_250DEG)
-		self.sensor.set_gyro_range(mpu6050.GYRO_RANGE_2000DEG)
-		# self.sensor.set_accel_range(mpu6050.ACCEL_RANGE_2G)
-		self.sensor.set_accel_range(mpu6050.ACCEL_RANGE_8G)
-		# TODO: sensor data is shitty... the check always fails
-		# assert self._perform_selfcheck(), "Sensor self check failed"
+	new sensor and also add new sensors.
+	Pass a BusScheduler (autopylot.i2cbus) to share the bus with other
+	sensors - the IMU reads get the highest priority then. The magnetometer
+	is a driver of autopylot.drivers (needs the scheduler).
+	address is a list for redundant IMUs - read_into reads all of them and
+	fuses the consistent samples (autopylot.redundancy). The first one is
+	the primary: the dict reads, the temperature and the DMP use it only. """
+	def __init__(self, address, scheduler=None, magnetometer=None):
+		if isinstance(address, (list, tuple)):
+			self.addresses = list(address)
+		else:
+			self.addresses = [address]
+		self.sensors = [mpu6050(address) for address in self.addresses]
+		self.sensor = self.sensors[0]
+		self.scheduler = scheduler
+		self.magnetometer = magnetometer
+		self.dmp = None
+		if scheduler is not None:
+			# one client for all IMUs - so they are read in one go
+			bus = scheduler.client(autopylot.i2cbus.PRIORITY_IMU)
+			for sensor in self.sensors:
+				sensor.bus = bus
+		# ranges of the config.ini - the register values are the ones of
+		# the mpu6050 package (GYRO_RANGE_2000DEG, ACCEL_RANGE_8G ...)
+		self.readers = [autopylot.imu.ImuReader(sensor.bus, sensor.address)
+						for sensor in self.sensors]
+		self.reader = self.readers[0]
+		# sensor to body rotation - read_into delivers body frame data,
+		# the other reads (and the calibration) stay in the sensor frame
+		self.mounting = self.reader.mounting
+		for sensor in self.sensors:
+			sensor.set_gyro_range(self.reader.gyro_range.register)
+			sensor.set_accel_range(self.reader.accel_range.register)
+		self.redundant = None
+		if len(self.readers) > 1:
+			self.redundant = autopylot.redundancy.create_redundant_imu(
+				self.readers)
+			logging.info("Using {!s} redundant IMUs at {!s}".format(
+				len(self.readers),
+				", ".join(hex(address) for address in self.addresses)))
+		# scale factors of the configured ranges (raw value => m/s² / °/s)
+		self._accel_scale = (autopylot.imu.GRAVITY /
+							self.reader.accel_range.sensitivity)
+		self._gyro_scale = 1.0 / self.reader.gyro_range.sensitivity
+		# set by calibrate() and applied to every read - calibration is
+		# the one of the primary IMU (or the first one calibrated)
+		self.calibration = None
+		self.calibrations = [None] * len(self.addresses)
 
 	def get_sensor_temperature(self):
 		""" Returns the temperature of the gyrosensor in °C
 		(rounded to one decimal) """
-		rounded_temp = round(self.sensor.get_temp(), 1)
+		if self.scheduler is not None:
+			raw = self.scheduler.read(self.sensor.address, mpu6050.TEMP_OUT0, 2,
+									autopylot.i2cbus.PRIORITY_TEMPERATURE)
+			temperature = (_TEMPERATURE_FORMAT.unpack(bytes(raw))[0] / 340.0 +
+						36.53)
+		else:
+			temperature = self.sensor.get_temp()
+		rounded_temp = round(temperature, 1)
 		logging.debug("Current gyrosensor temperature: {!s}°C"
 					.format(rounded_temp))
 		return rounded_temp
@@ -37,18 +96,140 @@ class SensorData():
 		""" Returns the acceleration data measured by the gyrosensor.
 		['x', 'y', 'z']"""
 		accel_data = self.sensor.get_accel_data()
+		if self.calibration is not None:
+			accel_data = self.calibration.apply_accel(accel_data)
 		return accel_data
 
 	def get_gyroscope_data(self):
 		""" Returns the gyroscope data from the gyrosensor.
 		['x','y','z']"""
 		gyro_data = self.sensor.get_gyro_data()
+		if self.calibration is not None:
+			gyro_data = self.calibration.apply_gyro(gyro_data)
 		return gyro_data
 
 	def get_magneto_data(self):
-		""" Returns the x,y,z axis magnet field data """
-		# TODO: implement when i have a sensor for it
-		return None
+		""" Returns the x,y,z axis magnet field data (in µT) - or None
+		without a magnetometer """
+		if self.magnetometer is None or self.scheduler is None:
+			return None
+		field = self.magnetometer.read(
+			self.scheduler.client(self.magnetometer.priority))
+		return dict(zip(('x', 'y', 'z'), field))
+
+	def read_burst(self, address=None):
+		""" Reads the acceleration, temperature and gyroscope registers in
+		one block read (14 bytes) - returns the uncalibrated values as
+		(accel, gyro, temperature) with accel (x, y, z) in m/s²,
+		gyro (x, y, z) in °/s and the temperature in °C. address selects
+		one of the IMUs (default: the primary one). """
+		if address is None:
+			address = self.sensor.address
+		raw = self.sensor.bus.read_i2c_block_data(address,
+												mpu6050.ACCEL_XOUT0, 14)
+		values = _BURST_FORMAT.unpack(bytes(raw))
+		accel = (values[0] * self._accel_scale, values[1] * self._accel_scale,
+				values[2] * self._accel_scale)
+		gyro = (values[4] * self._gyro_scale, values[5] * self._gyro_scale,
+				values[6] * self._gyro_scale)
+		temperature = values[3] / 340.0 + 36.53
+		return accel, gyro, temperature
+
+	def read_into(self, accel, gyro):
+		""" Reads the calibrated accel (m/s²) and gyro (°/s) data in the
+		body frame into the float64 arrays of three (see autopylot.imu)
+		without creating new objects per sample. Returns False if the
+		sample is a duplicate - or if no redundant IMU delivered a usable
+		sample. """
+		if self.redundant is not None:
+			self.redundant.use_calibrations(self.calibrations)
+			return self.redundant.read_into(accel, gyro)
+		reader = self.reader
+		if reader.calibration is not self.calibration:
+			reader.use_calibration(self.calibration)
+		return reader.read_into(accel, gyro)
+
+	def get_redundancy_statistics(self):
+		""" Returns the rejection and isolation counters per IMU (see
+		autopylot.redundancy) - or None with a single IMU """
+		if self.redundant is None:
+			return None
+		return self.redundant.get_statistics()
+
+	def enable_data_ready_interrupt(self, sample_rate):
+		""" Configures the sensor to sample at sample_rate (Hz) and to
+		pulse the INT pin (active high, 50us) whenever new data is ready.
+		The digital low pass filter is enabled, so the internal rate is
+		1kHz and sample_rate has to be 1000 / n. Redundant IMUs sample at
+		the same rate - only the INT pin of the primary one is enabled. """
+		if sample_rate <= 0 or 1000 % sample_rate != 0:
+			raise Exception("Invalid gyrosensor sample rate {!s}Hz - it has "
+							"to be 1000Hz / n".format(sample_rate))
+		bus = self.sensor.bus
+		for address in self.addresses:
+			bus.write_byte_data(address, _CONFIG, 0x01)  # DLPF 188Hz => 1kHz
+			bus.write_byte_data(address, _SMPLRT_DIV, 1000 // sample_rate - 1)
+		address = self.sensor.address
+		bus.write_byte_data(address, _INT_PIN_CFG, 0x00)
+		bus.write_byte_data(address, _INT_ENABLE, 0x01)  # DATA_RDY_EN
+		logging.info("Enabled data ready interrupt of the gyrosensor at "
+					"{!s}Hz".format(sample_rate))
+
+	def enable_dmp(self, rate):
+		""" Switches to the DMP mode - uploads the DMP firmware and lets the
+		DMP write quaternion packets at rate (Hz, 200 / n) into the FIFO.
+		The INT pin then signals every packet. """
+		self.dmp = autopylot.dmp.Dmp(self.sensor.bus, self.sensor.address,
+									self.reader.accel_range.sensitivity,
+									self.reader.gyro_range.sensitivity)
+		self.dmp.start(rate)
+		return self.dmp
+
+	def get_dmp_packets(self):
+		""" Returns the DmpPackets in the FIFO (DMP mode only) - the gyro
+		data is calibrated by the DMP """
+		if self.dmp is None:
+			raise Exception("DMP mode is not enabled")
+		return self.dmp.read_packets()
+
+	def calibrate(self, sample_count=200):
+		""" Calibrates the sensor (gyro bias, accel scale and offset) - the
+		device must not be moved meanwhile. The returned calibration is
+		applied to all following reads. Each redundant IMU gets its own. """
+		return self._calibrate_all(
+			lambda address: autopylot.calibration.calibrate(
+				lambda: self.read_burst(address), sample_count))
+
+	def calibrate_cached(self, cache):
+		""" Uses the calibration from the CalibrationCache for the current
+		temperature (after a short verification) - or calibrates the sensor
+		and stores the result in the cache. The device must not be moved
+		meanwhile. """
+		temperature = self.get_sensor_temperature()
+		return self._calibrate_all(
+			lambda address: autopylot.calibration.load_or_calibrate(
+				lambda: self.read_burst(address), address, temperature, cache))
+
+	def _calibrate_all(self, calibrate):
+		""" Calibrates every IMU with calibrate(address). A redundant IMU
+		which fails is left uncalibrated (the fusion isolates it if its
+		data is off) - as long as one of them succeeds. """
+		calibrations = []
+		for address in self.addresses:
+			try:
+				calibrations.append(calibrate(address))
+			except Exception as e:
+				if len(self.addresses) == 1:
+					raise
+				logging.error("Unable to calibrate the IMU {!s} ({!s})"
+							.format(hex(address), e))
+				calibrations.append(None)
+		if all(calibration is None for calibration in calibrations):
+			raise Exception("Unable to calibrate any of the IMUs")
+		self.calibrations = calibrations
+		self.calibration = next(calibration for calibration in calibrations
+								if calibration is not None)
+		return self.calibration
 
 	def _perform_selfcheck(self):
 		""" Checks if the gyrosensor is active and responding with
@@ -66,61 +247,25 @@ class SensorData():
 							"Could be too cold or too hot...")
 			return False
 
-		# TODO: add sampling of some more data for the test...
-
-		gyro = self._sample_avg_data_gyro()
-		logging.debug("Gyrosensor gyroscope data: {!s}".format(gyro))
-		# if all([round(val, 0) == 0 for _, val in gyro.items()]):
-		print(gyro)
-		if round(gyro['x'], 0) == 0 and round(gyro['y'], 0) == 0 and round(gyro['z'], 0) in [10, -10]:
-			logging.info("Gyrosensor gyroscope data check PASSED")
-		else:
-			logging.critical("Gyrosensor gyroscope data check FAILED. "
-							"Do not shake the device while checking...")
+		# the calibration checks the variance of the samples - it fails
+		# if the device is moved (or the data is just noise)
+		try:
+			calibration = self.calibrate()
+		except Exception as e:
+			logging.critical("Gyrosensor calibration FAILED: {!s}".format(e))
 			return False
+		logging.info("Gyrosensor gyroscope and acceleration data check PASSED")
 
-		accel = self._sample_avg_data_accel()
-		logging.debug("Gyrosensor acceleration data: {!s}".format(accel))
-		# if all([round(val, 0) == 0 for _, val in accel.items()]):
-		print(accel)
-		if round(accel['x'], 0) == 0 and round(accel['y'], 0) == 0 and round(accel['z'], 0) in [10, -10]:
-			logging.info("Gyrosensor acceleration data check PASSED")
+		# the raw acceleration at rest should be 1g (accel scale 1.0)
+		if abs(calibration.accel_scale[0] - 1.0) < 0.1:
+			logging.info("Gyrosensor gravity check PASSED")
 		else:
-			logging.critical("Gyrosensor acceleration data check FAILED. "
-							"Do not move the device while checking...")
+			logging.critical("Gyrosensor gravity check FAILED. Measured "
+							"gravity is off by the factor {!s}"
+							.format(calibration.accel_scale[0]))
 			return False
 
 		# if you reach this point you have passed the test...
 		return True
 
-	def _dead_simple_avg_sampling(self, function, count):
-		""" Samples data from the given function (count times) and returns the
-		avg value """
-		sample_set = list()
-		for _ in range(0, count):
-			sample_set.append(function())
-			time.sleep(0.01)
-
-		avg_x = 0
-		avg_y = 0
-		avg_z = 0
-		for data in sample_set:
-			avg_x += round(data['x'], 2)
-			avg_y += round(data['y'], 2)
-			avg_z += round(data['z'], 2)
-
-		avg_x = avg_x / len(sample_set)
-		avg_y = avg_y / len(sample_set)
-		avg_z = avg_z / len(sample_set)
-		avg = {'x': avg_x, 'y': avg_y, 'z': avg_z}
-		return avg
-
-	def _sample_avg_data_gyro(self):
-		""" Samples some gyroscope data and returns the avg values """
-		return self._dead_simple_avg_sampling(self.get_gyroscope_data, 50)
-
-	def _sample_avg_data_accel(self):
-		""" Samples some acceleration data and returns the avg values """
-		return self._dead_simple_avg_sampling(self.get_acceleration_data, 50)
-
 # vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,393 @@
+""" Synthetic IMU flights with ground truth. A flight is a smooth attitude
+(roll, pitch, yaw) and position trajectory - the body rates and the
+specific force (what the accelerometer measures, +g on z at rest) follow
+from it. An ImuModel turns them into MPU-6050 like readings: scale error,
+bias, temperature drift of the bias, noise, motor vibration, quantization
+to the LSB of the configured range and clipping at full scale.
+
+Flights (each starts at rest - the estimators set up their dead zones):
+
+	hover       small attitude and position wobble
+	steps       attitude and position steps (smoothed) every second
+	aggressive  fast rolls / pitches, a yaw spin and a figure eight
+	vibration   hover with strong motor vibration
+
+The harness runs estimators over the datasets and reports the attitude
+(degrees) and position (m) errors next to the samples per second:
+
+	python -m autopylot.synthetic --duration 60
+	python -m autopylot.synthetic --save datasets/ """
+
+import os
+import math
+import time
+import argparse
+import collections
+
+import numpy
+
+import autopylot.imu
+import autopylot.config
+import autopylot.estimation
+
+GRAVITY = autopylot.imu.GRAVITY
+FLIGHTS = ('hover', 'steps', 'aggressive', 'vibration')
+
+# seconds at rest before the manoeuvres start and of the blend in
+REST = 1.0
+RAMP = 2.0
+
+
+class ImuModel():
+	""" Error model of the sensor - biases in °/s and m/s², noise as
+	standard deviation, scale errors as fraction (0.01 = 1%), drift per °C
+	of temperature change. The temperature rises from temperature by
+	warmup °C with the time constant warmup_time (s). """
+
+	def __init__(self, gyro_bias=(0.3, -0.2, 0.1),
+				accel_bias=(0.05, -0.03, 0.08), gyro_noise=0.05,
+				accel_noise=0.02, gyro_scale=(0.01, -0.005, 0.0),
+				accel_scale=(0.005, 0.0, -0.01), gyro_drift=(0.02, 0.01, -0.01),
+				accel_drift=(0.002, -0.002, 0.004), temperature=25.0,
+				warmup=10.0, warmup_time=60.0, vibration=0.5,
+				vibration_frequency=150.0, accel_full_scale=None,
+				gyro_full_scale=None):
+		self.gyro_bias = numpy.array(gyro_bias, dtype=float)
+		self.accel_bias = numpy.array(accel_bias, dtype=float)
+		self.gyro_noise = float(gyro_noise)
+		self.accel_noise = float(accel_noise)
+		self.gyro_scale = numpy.array(gyro_scale, dtype=float)
+		self.accel_scale = numpy.array(accel_scale, dtype=float)
+		self.gyro_drift = numpy.array(gyro_drift, dtype=float)
+		self.accel_drift = numpy.array(accel_drift, dtype=float)
+		self.temperature = float(temperature)
+		self.warmup = float(warmup)
+		self.warmup_time = float(warmup_time)
+		# gyro amplitude (°/s) - the accelerometer sees 2.5 times it (m/s²)
+		self.vibration = float(vibration)
+		self.vibration_frequency = float(vibration_frequency)
+		if accel_full_scale is None:
+			accel_full_scale = autopylot.config.get_gyrosensor_accel_range()
+		if gyro_full_scale is None:
+			gyro_full_scale = autopylot.config.get_gyrosensor_gyro_range()
+		self.accel_range = autopylot.imu.accel_range(accel_full_scale)
+		self.gyro_range = autopylot.imu.gyro_range(gyro_full_scale)
+
+	@classmethod
+	def ideal(cls):
+		""" A sensor without any error (but quantization) """
+		return cls(gyro_bias=(0, 0, 0), accel_bias=(0, 0, 0), gyro_noise=0,
+				accel_noise=0, gyro_scale=(0, 0, 0), accel_scale=(0, 0, 0),
+				gyro_drift=(0, 0, 0), accel_drift=(0, 0, 0), warmup=0,
+				vibration=0)
+
+	def temperatures(self, times):
+		""" Returns the sensor temperature (°C) at the times """
+		if self.warmup_time <= 0:
+			return numpy.full(len(times), self.temperature)
+		return self.temperature + self.warmup * (
+			1 - numpy.exp(-times / self.warmup_time))
+
+	def measure(self, times, rates, force, generator):
+		""" Returns the gyro (°/s), accel (m/s²) readings and temperatures
+		of the true body rates (°/s) and specific force (m/s²) """
+		temperature = self.temperatures(times)
+		heating = (temperature - self.temperature)[:, numpy.newaxis]
+		phase = 2 * math.pi * self.vibration_frequency * times
+		# the frame shakes on all axes - a bit out of phase per axis
+		shake = numpy.sin(phase[:, numpy.newaxis] +
+						numpy.array([0.0, 2.1, 4.2]))
+		shake += 0.3 * numpy.sin(2 * phase[:, numpy.newaxis])
+		gyro = (rates * (1 + self.gyro_scale) + self.gyro_bias +
+				self.gyro_drift * heating + self.vibration * shake +
+				generator.normal(0.0, self.gyro_noise, rates.shape))
+		accel = (force * (1 + self.accel_scale) + self.accel_bias +
+				self.accel_drift * heating + 2.5 * self.vibration * shake +
+				generator.normal(0.0, self.accel_noise, force.shape))
+		gyro = _quantize(gyro, 1.0 / self.gyro_range.sensitivity)
+		accel = _quantize(accel, GRAVITY / self.accel_range.sensitivity)
+		return gyro, accel, _quantize(temperature, 1 / 340.0)
+
+
+def _quantize(values, lsb):
+	""" Rounds to the LSB and clips to the int16 range like the sensor """
+	return numpy.clip(numpy.round(values / lsb), -32768, 32767) * lsb
+
+
+class Dataset():
+	""" A synthetic flight - readings (gyro °/s, accel m/s², temperature
+	°C) and the ground truth: attitude (roll, pitch, yaw in degrees),
+	position (m, z up), velocity (m/s), body rates (°/s) and specific force
+	(m/s²), one row per sample """
+
+	FIELDS = ('gyro', 'accel', 'temperature', 'attitude', 'position',
+			'velocity', 'rates', 'force')
+
+	def __init__(self, name, sample_rate, **arrays):
+		self.name = name
+		self.sample_rate = float(sample_rate)
+		for field in self.FIELDS:
+			setattr(self, field, numpy.asarray(arrays[field], dtype=float))
+
+	def __len__(self):
+		return len(self.gyro)
+
+	@property
+	def times(self):
+		return numpy.arange(len(self)) / self.sample_rate
+
+	@property
+	def duration(self):
+		return len(self) / self.sample_rate
+
+	def save(self, filename):
+		""" Writes the dataset (numpy .npz format) """
+		numpy.savez(filename, name=self.name, sample_rate=self.sample_rate,
+					**{field: getattr(self, field) for field in self.FIELDS})
+
+	@classmethod
+	def load(cls, filename):
+		with numpy.load(filename) as data:
+			return cls(str(data['name']), float(data['sample_rate']),
+					**{field: data[field] for field in cls.FIELDS})
+
+	def to_scenario(self):
+		""" Returns the dataset as tuning Scenario (autopylot.tuning) - the
+		reference tilt in the units of the MotionEstimator """
+		import autopylot.tuning
+		return autopylot.tuning.Scenario(self.name, self.accel, self.gyro,
+										self.attitude * self.sample_rate,
+										self.sample_rate)
+
+
+def _smootherstep(values):
+	""" 0 - 1 with zero first and second derivative at both ends """
+	values = numpy.clip(values, 0.0, 1.0)
+	return values * values * values * (values * (values * 6 - 15) + 10)
+
+
+def _steps(times, targets, interval, transition):
+	""" Goes to a new target (row of targets) every interval seconds -
+	smoothly within transition seconds """
+	values = numpy.zeros((len(times), targets.shape[1]))
+	previous = numpy.zeros(targets.shape[1])
+	for index, target in enumerate(targets):
+		start = index * interval
+		blend = _smootherstep((times - start) / transition)[:, numpy.newaxis]
+		later = times >= start
+		values[later] = (previous + (target - previous) * blend[later])
+		previous = target
+	return values
+
+
+def _waves(times, generator, amplitude, low, high, count=3):
+	""" Sum of count sines per axis (3) with random frequencies (low -
+	high Hz) and phases - amplitude per axis """
+	values = numpy.zeros((len(times), 3))
+	for _ in range(count):
+		frequency = generator.uniform(low, high, 3)
+		phase = generator.uniform(0, 2 * math.pi, 3)
+		values += numpy.sin(2 * math.pi * frequency *
+							times[:, numpy.newaxis] + phase)
+	return values * (numpy.asarray(amplitude) / count)
+
+
+def _manoeuvre(flight, times, generator):
+	""" Returns the attitude (degrees) and position (m) of the flight
+	(times since the start of the manoeuvres) """
+	count = len(times)
+	if flight in ('hover', 'vibration'):
+		attitude = _waves(times, generator, (2.0, 2.0, 5.0), 0.05, 0.5)
+		position = _waves(times, generator, (0.2, 0.2, 0.1), 0.05, 0.3)
+	elif flight == 'steps':
+		steps = int(times[-1]) + 2 if count else 1
+		attitude = _steps(times, generator.uniform(-20, 20, (steps, 3)) *
+						[1, 1, 2], 1.0, 0.2)
+		position = _steps(times, generator.uniform(-1, 1, (steps, 3)), 1.0,
+						0.6)
+	elif flight == 'aggressive':
+		attitude = _waves(times, generator, (60.0, 60.0, 30.0), 1.0, 2.0, 2)
+		# yaw spin with 180°/s
+		attitude[:, 2] += 180.0 * times
+		omega = 2 * math.pi * 0.5
+		position = numpy.column_stack((
+			3.0 * numpy.sin(omega * times), 0.75 * numpy.sin(2 * omega * times),
+			0.5 * numpy.sin(omega * times)))
+	else:
+		raise Exception("Unknown synthetic flight: {!s} (use one of {!s})"
+						.format(flight, FLIGHTS))
+	return attitude, position
+
+
+def body_to_world(attitude):
+	""" Returns the rotation matrices (n, 3, 3) body => world of the
+	attitudes (roll, pitch, yaw in degrees - Z-Y-X order) """
+	roll, pitch, yaw = numpy.radians(attitude).T
+	cr, sr = numpy.cos(roll), numpy.sin(roll)
+	cp, sp = numpy.cos(pitch), numpy.sin(pitch)
+	cy, sy = numpy.cos(yaw), numpy.sin(yaw)
+	return numpy.stack([
+		numpy.stack([cy * cp, cy * sp * sr - sy * cr, cy * sp * cr + sy * sr],
+					axis=-1),
+		numpy.stack([sy * cp, sy * sp * sr + cy * cr, sy * sp * cr - cy * sr],
+					axis=-1),
+		numpy.stack([-sp, cp * sr, cp * cr], axis=-1)], axis=-2)
+
+
+def body_rates(attitude, sample_rate):
+	""" Returns the body rates (°/s) of the attitudes (degrees, Z-Y-X) """
+	angles = numpy.radians(attitude)
+	roll, pitch, _ = angles.T
+	change = numpy.gradient(angles, 1 / sample_rate, axis=0)
+	droll, dpitch, dyaw = change.T
+	return numpy.degrees(numpy.column_stack((
+		droll - dyaw * numpy.sin(pitch),
+		dpitch * numpy.cos(roll) + dyaw * numpy.sin(roll) * numpy.cos(pitch),
+		-dpitch * numpy.sin(roll) + dyaw * numpy.cos(roll) * numpy.cos(pitch))))
+
+
+def generate(flight, duration=30.0, sample_rate=None, model=None, seed=0,
+			rest=REST):
+	""" Returns the Dataset of a synthetic flight (see FLIGHTS) - duration
+	in seconds including rest seconds at rest at the start """
+	if sample_rate is None:
+		sample_rate = autopylot.config.get_gyrosensor_sample_rate()
+	if model is None:
+		model = ImuModel(vibration=5.0) if flight == 'vibration' else ImuModel()
+	generator = numpy.random.RandomState(seed)
+	times = numpy.arange(int(duration * sample_rate)) / sample_rate
+	since = numpy.maximum(times - rest, 0.0)
+	attitude, position = _manoeuvre(flight, since, generator)
+	# blend in from rest - smooth up to the second derivative
+	envelope = _smootherstep((times - rest) / RAMP)[:, numpy.newaxis]
+	attitude *= envelope
+	position *= envelope
+	position[:, 2] += 1.0
+	step = 1 / sample_rate
+	velocity = numpy.gradient(position, step, axis=0)
+	acceleration = numpy.gradient(velocity, step, axis=0)
+	rotation = body_to_world(attitude)
+	# specific force: acceleration minus gravity, seen in the body frame
+	force = numpy.einsum('nji,nj->ni', rotation,
+						acceleration + [0.0, 0.0, GRAVITY])
+	rates = body_rates(attitude, sample_rate)
+	gyro, accel, temperature = model.measure(times, rates, force, generator)
+	return Dataset('{!s}-{!s}'.format(flight, seed), sample_rate, gyro=gyro,
+				accel=accel, temperature=temperature, attitude=attitude,
+				position=position, velocity=velocity, rates=rates, force=force)
+
+
+def generate_all(duration=30.0, sample_rate=None, seed=0, flights=FLIGHTS):
+	""" Returns a Dataset of every flight """
+	return [generate(flight, duration, sample_rate, seed=seed)
+			for flight in flights]
+
+
+class MotionEstimatorAdapter():
+	""" Runs a MotionEstimator and converts its output (sums of the
+	samples) to degrees and meters. Its distance is relative to the start
+	position. """
+
+	def __init__(self, sample_rate, **kwargs):
+		self.sample_rate = sample_rate
+		self.estimator = autopylot.estimation.MotionEstimator(**kwargs)
+
+	def process_block(self, accel, gyro):
+		tilt, distance = self.estimator.process_block(accel, gyro)
+		return tilt / self.sample_rate, distance / self.sample_rate ** 2
+
+
+# name => factory(dataset) of an object with process_block(accel, gyro)
+# returning the attitude (degrees) and position (m, relative to the start)
+ESTIMATORS = collections.OrderedDict([
+	('motion', lambda dataset: MotionEstimatorAdapter(dataset.sample_rate))])
+
+Result = collections.namedtuple('Result', [
+	'estimator', 'dataset', 'samples', 'elapsed', 'attitude_rms',
+	'attitude_max', 'position_rms', 'position_final'])
+
+
+def _angle_difference(first, second):
+	""" Difference of angles (degrees) wrapped to -180 - 180 """
+	return (first - second + 180.0) % 360.0 - 180.0
+
+
+def evaluate(factory, dataset, name='', block_size=4096):
+	""" Runs the estimator of the factory over the dataset block by block
+	- returns a Result: attitude errors (degrees) and position errors (m)
+	per axis, samples and the time it took (the estimator only) """
+	estimator = factory(dataset)
+	count = len(dataset)
+	attitude = numpy.empty((count, 3))
+	position = numpy.empty((count, 3))
+	elapsed = 0.0
+	for start in range(0, count, block_size):
+		end = min(start + block_size, count)
+		accel = dataset.accel[start:end]
+		gyro = dataset.gyro[start:end]
+		begin = time.perf_counter()
+		attitude[start:end], position[start:end] = estimator.process_block(
+			accel, gyro)
+		elapsed += time.perf_counter() - begin
+	attitude_error = _angle_difference(attitude, dataset.attitude)
+	position_error = position - (dataset.position - dataset.position[0])
+	return Result(name, dataset.name, count, elapsed,
+				numpy.sqrt(numpy.mean(attitude_error ** 2, axis=0)),
+				numpy.abs(attitude_error).max(axis=0),
+				numpy.sqrt(numpy.mean(position_error ** 2, axis=0)),
+				float(numpy.linalg.norm(position_error[-1])))
+
+
+def run_harness(datasets, estimators=None, block_size=4096):
+	""" Evaluates every estimator (dict name => factory, default:
+	ESTIMATORS) on every dataset - returns the list of Results """
+	if estimators is None:
+		estimators = ESTIMATORS
+	return [evaluate(factory, dataset, name, block_size)
+			for name, factory in estimators.items() for dataset in datasets]
+
+
+def format_results(results):
+	""" Returns the results as table (text) """
+	lines = ["{:<10} {:<14} {:>23} {:>8} {:>20} {:>8} {:>12}".format(
+		'estimator', 'dataset', 'attitude rms (°)', 'max',
+		'position rms (m)', 'final', 'samples/s')]
+	for result in results:
+		rate = (result.samples / result.elapsed if result.elapsed > 0
+				else float('inf'))
+		lines.append("{:<10} {:<14} {:>23} {:>8.1f} {:>20} {:>8.2f} {:>12.0f}"
+					.format(result.estimator, result.dataset,
+							' '.join('{:7.2f}'.format(value)
+									for value in result.attitude_rms),
+							result.attitude_max.max(),
+							' '.join('{:6.2f}'.format(value)
+									for value in result.position_rms),
+							result.position_final, rate))
+	return '\n'.join(lines)
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description="Synthetic IMU flights - "
+									"estimator accuracy and speed")
+	parser.add_argument('--flight', action='append', choices=FLIGHTS,
+						help="flights to generate (default: all)")
+	parser.add_argument('--duration', type=float, default=30.0)
+	parser.add_argument('--rate', type=float, default=None,
+						help="sample rate (default: config.ini)")
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--save', metavar='DIRECTORY',
+						help="write the datasets (.npz) into the directory")
+	args = parser.parse_args(args)
+	datasets = generate_all(args.duration, args.rate, args.seed,
+							args.flight or FLIGHTS)
+	if args.save:
+		os.makedirs(args.save, exist_ok=True)
+		for dataset in datasets:
+			dataset.save(os.path.join(args.save, dataset.name + '.npz'))
+	print(format_results(run_harness(datasets)))
+
+
+if __name__ == '__main__':
+	main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,426 @@
+""" Telemetry downlink - the attitude, motor outputs, sensor rates and loop
+statistics are sent as small fixed layout binary frames over UDP
+('host:port') or a Unix datagram socket (a path). Every channel has its own
+rate, the values are quantized to int16 (value * scale) and - with the
+delta encoding - sent as int8 differences to the previous frame, with a
+full (key) frame every keyframe_interval frames or whenever a difference
+does not fit.
+
+Frame (little endian):
+	magic 0xa7, version, channel id, flags (bit 0 delta), sequence (uint32,
+	per channel), timestamp (uint64, µs) - then one int16 (key frame) or
+	int8 (delta frame) per field. Missing values (NaN) are sent as -32768.
+
+Serializing goes into buffers which are allocated once per channel, so
+publishing on the flight thread does not allocate (the sources filling in
+the values are the caller's business). A source is only called when its
+channel is due.
+
+The TelemetryReceiver decodes the frames into numpy arrays (a ring of the
+last frames per channel) for live plotting - `python3 -m
+autopylot.telemetry` prints them. """
+
+import os
+import socket
+import struct
+import logging
+import argparse
+import threading
+
+import numpy
+
+import autopylot.config
+import autopylot.clock
+
+MAGIC = 0xa7
+VERSION = 1
+HEADER = struct.Struct('<BBBBIQ')
+FLAG_DELTA = 0x01
+MISSING = -32768
+INT16_MAX = 32767
+DELTA_MAX = 127
+SEQUENCE_MASK = 0xffffffff
+ENCODINGS = ('delta', 'quantized')
+
+# channel ids
+ATTITUDE = 1
+MOTORS = 2
+SENSORS = 3
+LOOP = 4
+
+
+class Channel():
+	""" Fixed layout of one telemetry channel - fields are the names of the
+	values, scale the quantization (value * scale is sent as int16), rate
+	in Hz (0 = off). With counters the values are monotonic counters and
+	their rate of change (per second) is sent instead. """
+
+	def __init__(self, name, channel_id, fields, scale=100, rate=10,
+				encoding='delta', keyframe_interval=50, counters=False):
+		if encoding not in ENCODINGS:
+			raise Exception("Unknown telemetry encoding: {!s}".format(encoding))
+		self.name = name
+		self.channel_id = int(channel_id)
+		self.fields = list(fields)
+		self.scale = float(scale)
+		self.rate = float(rate)
+		self.interval = 1 / self.rate if self.rate > 0 else numpy.inf
+		self.delta = encoding == 'delta'
+		self.keyframe_interval = int(keyframe_interval)
+		self.counters = counters
+		self.source = None
+		self.next_due = -numpy.inf
+		self.sequence = 0
+		count = len(self.fields)
+		# latest values (filled in by update or the source)
+		self.values = numpy.zeros(count)
+		self._scaled = numpy.zeros(count)
+		self._quantized = numpy.zeros(count, dtype=numpy.int32)
+		self._sent = numpy.zeros(count, dtype=numpy.int32)
+		self._difference = numpy.zeros(count, dtype=numpy.int32)
+		self._missing = numpy.zeros(count, dtype=bool)
+		self._last_counters = numpy.zeros(count)
+		self._last_time = None
+		# the first frame is a key frame
+		self._since_keyframe = self.keyframe_interval
+		self._frame = bytearray(HEADER.size + 2 * count)
+		self._keyframe_payload = numpy.frombuffer(
+			self._frame, dtype='<i2', count=count, offset=HEADER.size)
+		self._delta_payload = numpy.frombuffer(
+			self._frame, dtype='i1', count=count, offset=HEADER.size)
+		self._keyframe_view = memoryview(self._frame)
+		self._delta_view = self._keyframe_view[:HEADER.size + count]
+
+	@property
+	def keyframe_size(self):
+		return len(self._keyframe_view)
+
+	def _quantize(self, now):
+		""" Scales the values into self._quantized (int16 range, NaN as
+		MISSING) """
+		scaled = self._scaled
+		if self.counters:
+			numpy.subtract(self.values, self._last_counters, out=scaled)
+			if self._last_time is None or now <= self._last_time:
+				scaled.fill(numpy.nan)
+			else:
+				numpy.divide(scaled, now - self._last_time, out=scaled)
+			numpy.copyto(self._last_counters, self.values)
+			self._last_time = now
+			numpy.multiply(scaled, self.scale, out=scaled)
+		else:
+			numpy.multiply(self.values, self.scale, out=scaled)
+		numpy.rint(scaled, out=scaled)
+		numpy.clip(scaled, -INT16_MAX, INT16_MAX, out=scaled)
+		numpy.isnan(scaled, out=self._missing)
+		numpy.copyto(scaled, MISSING, where=self._missing)
+		numpy.copyto(self._quantized, scaled, casting='unsafe')
+
+	def serialize(self, now):
+		""" Returns the frame (a memoryview of the channel buffer - only
+		valid until the next call) of the current values at now (s) """
+		self._quantize(now)
+		keyframe = (not self.delta or
+					self._since_keyframe >= self.keyframe_interval)
+		if not keyframe:
+			numpy.subtract(self._quantized, self._sent, out=self._difference)
+			numpy.abs(self._difference, out=self._difference)
+			if self._difference.max() > DELTA_MAX:
+				keyframe = True
+			else:
+				numpy.subtract(self._quantized, self._sent,
+							out=self._difference)
+				numpy.copyto(self._delta_payload, self._difference,
+							casting='unsafe')
+		if keyframe:
+			numpy.copyto(self._keyframe_payload, self._quantized,
+						casting='unsafe')
+			self._since_keyframe = 0
+		self._since_keyframe += 1
+		numpy.copyto(self._sent, self._quantized)
+		self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+		HEADER.pack_into(self._frame, 0, MAGIC, VERSION, self.channel_id,
+						0 if keyframe else FLAG_DELTA, self.sequence,
+						int(now * 1000000))
+		return self._keyframe_view if keyframe else self._delta_view
+
+
+def load_channels(motor_count):
+	""" Returns the channels with the rates and encoding of the config.ini """
+	encoding = autopylot.config.get_telemetry_encoding()
+	keyframe_interval = autopylot.config.get_telemetry_keyframe_interval()
+
+	def channel(name, channel_id, fields, scale, counters=False):
+		return Channel(name, channel_id, fields, scale,
+					autopylot.config.get_telemetry_rate(name), encoding,
+					keyframe_interval, counters)
+
+	return [channel('attitude', ATTITUDE, ['tilt_x', 'tilt_y', 'tilt_z',
+											'heading', 'altitude'], 100),
+			channel('motors', MOTORS, ['throttle_{!s}'.format(motor)
+										for motor in range(motor_count)], 10),
+			channel('sensors', SENSORS, ['interrupts', 'missed', 'duplicates',
+										'timeouts'], 10, counters=True),
+			channel('loop', LOOP, ['rate', 'mean_us', 'max_us'], 1)]
+
+
+def parse_address(address):
+	""" Returns (family, address) of 'host:port' (UDP) or a path (Unix
+	datagram socket) """
+	if address.startswith('/'):
+		return socket.AF_UNIX, address
+	host, port = address.rsplit(':', 1)
+	return socket.AF_INET, (host, int(port))
+
+
+class TelemetryPublisher():
+	""" Sends the due channels whenever publish is called (from the flight
+	loop). Frames which can not be sent right away (no receiver, full
+	socket buffer) are dropped - telemetry never blocks the flight. """
+
+	def __init__(self, address, channels):
+		family, self.address = parse_address(address)
+		self.socket = socket.socket(family, socket.SOCK_DGRAM)
+		self.socket.setblocking(False)
+		self.channels = {channel.name: channel for channel in channels}
+		self._due = list(self.channels.values())
+		self._lock = threading.Lock()
+		self.statistics = {'frames': 0, 'bytes': 0, 'dropped': 0}
+
+	def attach(self, name, source):
+		""" Sets the source of the channel - a callable which fills in the
+		values array (passed to it) when the channel is due """
+		self.channels[name].source = source
+
+	def update(self, name, values):
+		""" Sets the values of the channel (sent when it is due) """
+		self.channels[name].values[:] = values
+
+	def publish(self, now=None):
+		""" Sends every channel which is due - returns the number of frames
+		sent """
+		now = autopylot.clock.now() if now is None else now
+		sent = 0
+		with self._lock:
+			for channel in self._due:
+				if now < channel.next_due:
+					continue
+				channel.next_due += channel.interval
+				if channel.next_due <= now:
+					channel.next_due = now + channel.interval
+				if channel.source is not None:
+					channel.source(channel.values)
+				frame = channel.serialize(now)
+				try:
+					self.socket.sendto(frame, self.address)
+				except OSError:
+					self.statistics['dropped'] += 1
+					continue
+				self.statistics['frames'] += 1
+				self.statistics['bytes'] += len(frame)
+				sent += 1
+		return sent
+
+	def close(self):
+		self.socket.close()
+
+
+class TelemetryReceiver():
+	""" Receives the frames and keeps the last history frames of each
+	channel (numpy ring arrays). A delta frame after a lost frame can not
+	be decoded - the channel waits for the next key frame. """
+
+	def __init__(self, address, channels, history=1024):
+		family, self.address = parse_address(address)
+		if family == socket.AF_UNIX and os.path.exists(self.address):
+			os.remove(self.address)
+		self.socket = socket.socket(family, socket.SOCK_DGRAM)
+		self.socket.bind(self.address)
+		if family == socket.AF_INET:
+			self.address = self.socket.getsockname()
+		self.history = int(history)
+		self.channels = {channel.channel_id: channel for channel in channels}
+		self._times = {}
+		self._values = {}
+		self._state = {}
+		self._sequence = {}
+		self._count = {}
+		for channel_id, channel in self.channels.items():
+			self._times[channel_id] = numpy.full(self.history, numpy.nan)
+			self._values[channel_id] = numpy.full(
+				(self.history, len(channel.fields)), numpy.nan)
+			self._state[channel_id] = numpy.zeros(len(channel.fields),
+												dtype=numpy.int32)
+			self._sequence[channel_id] = None
+			self._count[channel_id] = 0
+		self.statistics = {'frames': 0, 'lost': 0, 'skipped': 0,
+							'malformed': 0}
+
+	def poll(self, timeout=0):
+		""" Decodes the frames which arrived (waits up to timeout seconds
+		for the first one) - returns the number of decoded frames """
+		# a timeout of 0 makes the socket non-blocking
+		self.socket.settimeout(max(timeout, 0))
+		decoded = 0
+		while True:
+			try:
+				data = self.socket.recv(65536)
+			except (BlockingIOError, socket.timeout):
+				break
+			self.socket.settimeout(0)
+			if self.decode(data):
+				decoded += 1
+		return decoded
+
+	def decode(self, data):
+		""" Decodes one frame into the history - returns True on success """
+		if len(data) < HEADER.size:
+			self.statistics['malformed'] += 1
+			return False
+		(magic, version, channel_id, flags, sequence,
+			timestamp) = HEADER.unpack_from(data)
+		channel = self.channels.get(channel_id)
+		delta = flags & FLAG_DELTA
+		if (magic != MAGIC or version != VERSION or channel is None or
+				len(data) != HEADER.size + (1 if delta else 2) *
+				len(channel.fields)):
+			self.statistics['malformed'] += 1
+			return False
+		state = self._state[channel_id]
+		last = self._sequence[channel_id]
+		if last is not None and sequence != (last + 1) & SEQUENCE_MASK:
+			self.statistics['lost'] += (sequence - last - 1) & SEQUENCE_MASK
+			last = None
+		if delta:
+			if last is None:
+				# the reference frame is missing
+				self._sequence[channel_id] = None
+				self.statistics['skipped'] += 1
+				return False
+			state += numpy.frombuffer(data, dtype='i1', offset=HEADER.size)
+		else:
+			state[:] = numpy.frombuffer(data, dtype='<i2', offset=HEADER.size)
+		self._sequence[channel_id] = sequence
+		row = self._count[channel_id] % self.history
+		self._times[channel_id][row] = timestamp / 1000000
+		values = self._values[channel_id][row]
+		numpy.divide(state, channel.scale, out=values)
+		values[state == MISSING] = numpy.nan
+		self._count[channel_id] += 1
+		self.statistics['frames'] += 1
+		return True
+
+	def _channel_id(self, name):
+		for channel_id, channel in self.channels.items():
+			if channel.name == name:
+				return channel_id
+		raise Exception("Unknown telemetry channel: {!s}".format(name))
+
+	def get(self, name):
+		""" Returns (times, values) of the received frames of the channel -
+		oldest first, values is a (frames, fields) array """
+		channel_id = self._channel_id(name)
+		count = self._count[channel_id]
+		if count <= self.history:
+			return (self._times[channel_id][:count].copy(),
+					self._values[channel_id][:count].copy())
+		order = numpy.roll(numpy.arange(self.history),
+						-(count % self.history))
+		return self._times[channel_id][order], self._values[channel_id][order]
+
+	def latest(self, name):
+		""" Returns a dict of the last values of the channel (or None) """
+		channel_id = self._channel_id(name)
+		count = self._count[channel_id]
+		if count == 0:
+			return None
+		values = self._values[channel_id][(count - 1) % self.history]
+		return dict(zip(self.channels[channel_id].fields, values.tolist()))
+
+	def close(self):
+		self.socket.close()
+		if isinstance(self.address, str) and os.path.exists(self.address):
+			os.remove(self.address)
+
+
+class LoopStatistics():
+	""" Collects the duration of the loop iterations - the source of the
+	loop channel (rate in Hz, mean and max duration in µs since the last
+	frame) """
+
+	def __init__(self):
+		self._count = 0
+		self._total = 0.0
+		self._max = 0.0
+		self._start = None
+		self._window_start = autopylot.clock.now()
+
+	def begin(self):
+		self._start = autopylot.clock.now()
+
+	def end(self):
+		if self._start is None:
+			return
+		duration = autopylot.clock.now() - self._start
+		self._count += 1
+		self._total += duration
+		if duration > self._max:
+			self._max = duration
+		self._start = None
+
+	def __call__(self, values):
+		now = autopylot.clock.now()
+		window = now - self._window_start
+		values[0] = self._count / window if window > 0 else 0
+		values[1] = self._total / self._count * 1000000 if self._count else 0
+		values[2] = self._max * 1000000
+		self._count = 0
+		self._total = 0.0
+		self._max = 0.0
+		self._window_start = now
+
+
+def create_publisher(motor_count):
+	""" Returns the TelemetryPublisher of the config.ini - None if the
+	telemetry is disabled """
+	if not autopylot.config.get_telemetry_enabled():
+		return None
+	address = autopylot.config.get_telemetry_address()
+	logging.info("Sending the telemetry to {!s}".format(address))
+	return TelemetryPublisher(address, load_channels(motor_count))
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description="Receives the telemetry "
+									"and prints the latest values")
+	parser.add_argument('--address', default=None,
+						help="host:port or path (default: config.ini)")
+	parser.add_argument('--interval', type=float, default=1.0,
+						help="print interval in seconds")
+	args = parser.parse_args(args)
+	address = args.address or autopylot.config.get_telemetry_address()
+	receiver = TelemetryReceiver(address, load_channels(
+		len(autopylot.config.get_motor_names())))
+	try:
+		while True:
+			deadline = autopylot.clock.now() + args.interval
+			while autopylot.clock.now() < deadline:
+				receiver.poll(max(deadline - autopylot.clock.now(), 0.001))
+			for channel in receiver.channels.values():
+				latest = receiver.latest(channel.name)
+				if latest is not None:
+					print("{!s}: {!s}".format(channel.name, ", ".join(
+						"{!s}={:.2f}".format(field, value)
+						for field, value in latest.items())))
+			print("frames {frames!s}, lost {lost!s}, skipped {skipped!s}, "
+				"malformed {malformed!s}".format(**receiver.statistics))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		receiver.close()
+
+
+if __name__ == '__main__':
+	main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
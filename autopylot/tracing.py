@@ -0,0 +1,111 @@
+""" Command latency tracing (opt-in). Every command (a key press, a
+controller output) gets an ID and is timestamped when it is created, after
+the mixing (throttle per motor computed), when it is submitted to pigpio and
+when pigpio acknowledged it (set_servo_pulsewidth returned). A command for
+several motors is one batch (autopylot.esc) - it counts as submitted before
+pigpio gets the first pulsewidth (the wave with all of them) and as
+acknowledged after the last one. The ESC sees the new pulsewidth with the next servo frame
+(up to 20ms at 50Hz) - that part is not visible from here.
+
+The timestamps are kept in a preallocated ring buffer (the oldest commands
+are overwritten), so tracing does not allocate anything while flying. """
+
+import math
+import time
+import logging
+import threading
+
+import numpy
+
+STAGES = ('created', 'mixed', 'submitted', 'acknowledged')
+CREATED = 0
+MIXED = 1
+SUBMITTED = 2
+ACKNOWLEDGED = 3
+
+PERCENTILES = (50, 90, 99)
+
+
+class CommandTracer():
+	""" Records the stage timestamps (seconds) of up to capacity commands """
+
+	def __init__(self, capacity=8192, clock=time.perf_counter):
+		self.capacity = int(capacity)
+		self.clock = clock
+		self._times = numpy.full((self.capacity, len(STAGES)), numpy.nan)
+		self._next_id = 0
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return min(self._next_id, self.capacity)
+
+	def begin(self):
+		""" Creates a new command - returns its ID """
+		now = self.clock()
+		with self._lock:
+			command = self._next_id
+			self._next_id += 1
+		row = self._times[command % self.capacity]
+		row[:] = numpy.nan
+		row[CREATED] = now
+		return command
+
+	def mark(self, command, stage):
+		""" Timestamps the stage (index) of the command. submitted keeps the
+		first timestamp, the other stages the last one. """
+		if command is None:
+			return
+		now = self.clock()
+		row = self._times[command % self.capacity]
+		if stage == SUBMITTED and not math.isnan(row[SUBMITTED]):
+			return
+		row[stage] = now
+
+	def get_spans(self):
+		""" Returns a (n, 4) array of the stage timestamps of the recorded
+		commands (oldest first) - nan for stages not reached """
+		count = len(self)
+		start = self._next_id - count
+		index = numpy.arange(start, start + count) % self.capacity
+		return self._times[index]
+
+	def report(self):
+		""" Returns the latency percentiles (ms) per stage and end to end -
+		a dict {'created->mixed': {'count', 'p50', 'p90', 'p99', 'max'}, ...,
+		'total': {...}} """
+		spans = self.get_spans()
+		steps = [(STAGES[stage] + '->' + STAGES[stage + 1], stage, stage + 1)
+				for stage in range(len(STAGES) - 1)]
+		steps.append(('total', CREATED, ACKNOWLEDGED))
+		result = {}
+		for name, first, second in steps:
+			latencies = (spans[:, second] - spans[:, first]) * 1000
+			latencies = latencies[~numpy.isnan(latencies)]
+			entry = {'count': len(latencies)}
+			if len(latencies):
+				for percentile, value in zip(PERCENTILES, numpy.percentile(
+						latencies, PERCENTILES)):
+					entry['p{!s}'.format(percentile)] = float(value)
+				entry['max'] = float(latencies.max())
+			result[name] = entry
+		return result
+
+	def format_report(self):
+		""" Returns the report as a (multi line) table """
+		lines = ["{:<26} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+			'stage (ms)', 'count', 'p50', 'p90', 'p99', 'max')]
+		for name, entry in self.report().items():
+			if not entry['count']:
+				lines.append("{:<26} {:>7}".format(name, 0))
+				continue
+			lines.append("{:<26} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}"
+						.format(name, entry['count'], entry['p50'],
+								entry['p90'], entry['p99'], entry['max']))
+		return "\n".join(lines)
+
+	def log_report(self):
+		""" Logs the report (info) """
+		logging.info("Command latency ({!s} commands):\n{!s}"
+					.format(len(self), self.format_report()))
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,348 @@
+""" Parameter tuning of the motion estimation. Candidates (sets of
+parameters) come from a grid, random or Bayesian (Gaussian process) search
+and are evaluated in a ProcessPoolExecutor - one candidate per task, so it
+scales with the number of cores (the scenarios are sent to every worker
+once, not per candidate). Every candidate runs a fresh MotionEstimator over
+all scenarios - recorded flights (autopylot.replay) or a simulated vehicle -
+and is scored on the tracking error (RMS of estimated - reference tilt) and
+the overshoot (how far the estimate leaves the reference range).
+
+The best candidate is written as a config.ini fragment ([ESTIMATOR] and
+[FILTER] sections):
+
+	python -m autopylot.tuning --method bayes --count 64 --output best.ini
+	python -m autopylot.tuning --recording flight.npz --method grid """
+
+import os
+import math
+import random
+import logging
+import argparse
+import itertools
+import configparser
+import concurrent.futures
+
+import numpy
+
+import autopylot.config
+import autopylot.estimation
+import autopylot.filters
+import autopylot.replay
+
+# searchable parameters: (low, high) bounds - ints stay ints
+SEARCH_SPACE = {'samplecount': (20, 800),
+				'deadzoneblur': (0.0, 1.0),
+				'gyrolowpass': (20.0, 400.0),
+				'accellowpass': (5.0, 100.0)}
+
+# a few values per parameter for the grid search
+GRID = {'samplecount': [50, 100, 200, 400],
+		'deadzoneblur': [0.0, 0.1, 0.2, 0.4],
+		'gyrolowpass': [50.0, 100.0, 200.0],
+		'accellowpass': [15.0, 30.0]}
+
+OVERSHOOT_WEIGHT = 0.5
+
+
+class Scenario():
+	""" Sensor samples (n, 3 arrays) and the reference tilt the estimator
+	should track. The tilt is the sum of the rotation samples - like the
+	MotionEstimator integrates it. """
+
+	def __init__(self, name, accel, rotation, reference, sample_rate):
+		self.name = name
+		self.accel = numpy.asarray(accel, dtype=float)
+		self.rotation = numpy.asarray(rotation, dtype=float)
+		self.reference = numpy.asarray(reference, dtype=float)
+		self.sample_rate = float(sample_rate)
+
+	@classmethod
+	def from_recording(cls, recording, sample_rate, reference=None):
+		""" Scenario of a FlightRecording - the reference defaults to the
+		recorded tilt (tunes towards the flown estimator, use a better
+		reference - i.e. from the DMP - if there is one) """
+		return cls('recording', recording.accel, recording.rotation,
+				recording.tilt if reference is None else reference,
+				sample_rate)
+
+
+def simulate_flight(duration=10.0, sample_rate=1000, rest=1.0, seed=0):
+	""" Scenario of a simulated vehicle - at rest for rest seconds, then a
+	new rotation rate (°/s) step every 0.5 seconds. The gyro sees the rate
+	plus bias, noise and motor vibration (150Hz). """
+	generator = numpy.random.RandomState(seed)
+	count = int(duration * sample_rate)
+	rest_count = int(rest * sample_rate)
+	step = int(0.5 * sample_rate)
+	rate = numpy.zeros((count, 3))
+	for start in range(rest_count, count, step):
+		rate[start:start + step] = generator.uniform(-50, 50, 3)
+	time = numpy.arange(count) / sample_rate
+	vibration = 2.0 * numpy.sin(2 * math.pi * 150 * time)[:, numpy.newaxis]
+	rotation = (rate + generator.normal(0.0, 0.2, (count, 3)) + vibration +
+				numpy.array([0.3, -0.2, 0.1]))
+	accel = (numpy.array([0.0, 0.0, 9.81]) + vibration * 0.5 +
+			generator.normal(0.0, 0.05, (count, 3)))
+	return Scenario('simulated-{!s}'.format(seed), accel, rotation,
+					numpy.cumsum(rate, axis=0), sample_rate)
+
+
+def _with_lowpass(spec, cutoff):
+	""" Returns the filter spec with the cutoff of its low-pass stage
+	replaced (or a low-pass stage appended) """
+	stages = [stage for stage in spec.split()
+			if stage.lower() != 'none']
+	token = 'lowpass:{:g}'.format(cutoff)
+	for index, stage in enumerate(stages):
+		if stage.lower().startswith('lowpass'):
+			stages[index] = token
+			return " ".join(stages)
+	return " ".join(stages + [token])
+
+
+def candidate_specs(params, gyro_spec, accel_spec):
+	""" Returns the (gyro, accel) filter specs of the candidate """
+	if 'gyrolowpass' in params:
+		gyro_spec = _with_lowpass(gyro_spec, params['gyrolowpass'])
+	if 'accellowpass' in params:
+		accel_spec = _with_lowpass(accel_spec, params['accellowpass'])
+	return gyro_spec, accel_spec
+
+
+class TuningResult():
+	""" Score of one candidate (lower is better) """
+
+	def __init__(self, params, score, error, overshoot):
+		self.params = params
+		self.score = score
+		self.error = error
+		self.overshoot = overshoot
+
+	def __repr__(self):
+		return ("TuningResult(score={:.4f}, error={:.4f}, overshoot={:.4f}, "
+				"params={!s})".format(self.score, self.error, self.overshoot,
+									self.params))
+
+
+# set once per worker process (see _init_worker)
+_worker_state = None
+
+
+def _init_worker(scenarios, gyro_spec, accel_spec, overshoot_weight):
+	global _worker_state
+	_worker_state = (scenarios, gyro_spec, accel_spec, overshoot_weight)
+
+
+def evaluate(params, scenarios, gyro_spec, accel_spec,
+			overshoot_weight=OVERSHOOT_WEIGHT):
+	""" Runs the candidate over all scenarios - returns a TuningResult
+	(error and overshoot are the means over the scenarios) """
+	errors = []
+	overshoots = []
+	gyro, accel = candidate_specs(params, gyro_spec, accel_spec)
+	for scenario in scenarios:
+		estimator = autopylot.estimation.MotionEstimator(
+			sample_count=params.get('samplecount',
+									autopylot.estimation.SAMPLE_COUNT),
+			dead_zone_blur=params.get('deadzoneblur',
+									autopylot.estimation.DEAD_ZONE_BLUR),
+			accel_filters=autopylot.filters.build_pipeline(
+				accel, scenario.sample_rate),
+			rotation_filters=autopylot.filters.build_pipeline(
+				gyro, scenario.sample_rate))
+		tilt, _ = estimator.process_block(scenario.accel, scenario.rotation)
+		difference = tilt - scenario.reference
+		errors.append(float(numpy.sqrt(numpy.mean(difference ** 2))))
+		above = tilt - scenario.reference.max(axis=0)
+		below = scenario.reference.min(axis=0) - tilt
+		overshoots.append(float(max(above.max(), below.max(), 0.0)))
+	error = sum(errors) / len(errors)
+	overshoot = sum(overshoots) / len(overshoots)
+	return TuningResult(params, error + overshoot_weight * overshoot, error,
+						overshoot)
+
+
+def _evaluate_in_worker(params):
+	return evaluate(params, *_worker_state)
+
+
+def grid_candidates(grid=GRID):
+	""" Returns all combinations of the grid values """
+	names = sorted(grid)
+	return [dict(zip(names, values))
+			for values in itertools.product(*(grid[name] for name in names))]
+
+
+def random_candidates(count, space=SEARCH_SPACE, seed=0):
+	""" Returns count candidates drawn uniformly from the space """
+	generator = random.Random(seed)
+	return [_from_unit(space, [generator.random() for _ in space])
+			for _ in range(count)]
+
+
+def _to_unit(space, params):
+	return [(params[name] - low) / (high - low)
+			for name, (low, high) in sorted(space.items())]
+
+
+def _from_unit(space, point):
+	params = {}
+	for value, (name, (low, high)) in zip(point, sorted(space.items())):
+		value = low + min(max(value, 0.0), 1.0) * (high - low)
+		params[name] = int(round(value)) if isinstance(low, int) else value
+	return params
+
+
+def _expected_improvement(known, scores, pool, length_scale=0.2,
+						noise=1e-6):
+	""" Expected improvement (minimizing) of the pool points from a
+	Gaussian process (RBF kernel) fitted to the known points """
+	def kernel(first, second):
+		distance = ((first[:, numpy.newaxis, :] -
+					second[numpy.newaxis, :, :]) ** 2).sum(axis=2)
+		return numpy.exp(-distance / (2 * length_scale ** 2))
+
+	mean = scores.mean()
+	spread = scores.std() or 1.0
+	normalized = (scores - mean) / spread
+	covariance = kernel(known, known) + noise * numpy.eye(len(known))
+	cross = kernel(pool, known)
+	solved = numpy.linalg.solve(covariance, normalized)
+	prediction = cross @ solved
+	variance = 1.0 - (cross * numpy.linalg.solve(covariance, cross.T).T).sum(
+		axis=1)
+	sigma = numpy.sqrt(numpy.maximum(variance, 1e-12))
+	improvement = normalized.min() - prediction
+	z = improvement / sigma
+	cdf = 0.5 * (1 + numpy.vectorize(math.erf)(z / math.sqrt(2)))
+	pdf = numpy.exp(-z ** 2 / 2) / math.sqrt(2 * math.pi)
+	return improvement * cdf + sigma * pdf
+
+
+class Tuner():
+	""" Evaluates candidates on the scenarios in a process pool (workers
+	None = all cores). The filter specs of the candidates start from the
+	ones given (default: the config.ini). """
+
+	def __init__(self, scenarios, workers=None, gyro_spec=None,
+				accel_spec=None, overshoot_weight=OVERSHOOT_WEIGHT):
+		self.scenarios = list(scenarios)
+		self.workers = workers or os.cpu_count() or 1
+		self.gyro_spec = (gyro_spec if gyro_spec is not None
+						else autopylot.config.get_gyro_filter_spec())
+		self.accel_spec = (accel_spec if accel_spec is not None
+						else autopylot.config.get_accel_filter_spec())
+		self.overshoot_weight = overshoot_weight
+		self._executor = None
+
+	def __enter__(self):
+		self._executor = concurrent.futures.ProcessPoolExecutor(
+			self.workers, initializer=_init_worker,
+			initargs=(self.scenarios, self.gyro_spec, self.accel_spec,
+					self.overshoot_weight))
+		return self
+
+	def __exit__(self, *args):
+		self._executor.shutdown()
+		self._executor = None
+
+	def evaluate(self, candidates):
+		""" Returns the TuningResults of the candidates (same order) """
+		if self._executor is None:
+			with self:
+				return self.evaluate(candidates)
+		return list(self._executor.map(_evaluate_in_worker, candidates))
+
+	def grid_search(self, grid=GRID):
+		return rank(self.evaluate(grid_candidates(grid)))
+
+	def random_search(self, count, space=SEARCH_SPACE, seed=0):
+		return rank(self.evaluate(random_candidates(count, space, seed)))
+
+	def bayesian_search(self, count, space=SEARCH_SPACE, seed=0,
+						initial=None, pool_size=1000):
+		""" Starts with initial random candidates, then picks batches (one
+		candidate per worker) with the highest expected improvement """
+		generator = random.Random(seed)
+		initial = initial or min(count, max(self.workers, 8))
+		results = []
+		with self:
+			results += self.evaluate(random_candidates(initial, space, seed))
+			while len(results) < count:
+				known = numpy.array([_to_unit(space, result.params)
+									for result in results])
+				scores = numpy.array([result.score for result in results])
+				pool = numpy.array([[generator.random() for _ in space]
+									for _ in range(pool_size)])
+				improvement = _expected_improvement(known, scores, pool)
+				batch = min(self.workers, count - len(results))
+				best = numpy.argsort(-improvement)[:batch]
+				results += self.evaluate([_from_unit(space, pool[index])
+										for index in best])
+		return rank(results)
+
+
+def rank(results):
+	""" Returns the results sorted by score (best first) """
+	return sorted(results, key=lambda result: result.score)
+
+
+def write_config_fragment(result, filename, gyro_spec=None, accel_spec=None):
+	""" Writes the parameters of the result as config.ini sections """
+	gyro, accel = candidate_specs(
+		result.params,
+		gyro_spec if gyro_spec is not None
+		else autopylot.config.get_gyro_filter_spec(),
+		accel_spec if accel_spec is not None
+		else autopylot.config.get_accel_filter_spec())
+	fragment = configparser.ConfigParser()
+	fragment['ESTIMATOR'] = {
+		'samplecount': str(int(result.params.get(
+			'samplecount', autopylot.config.get_estimator_sample_count()))),
+		'deadzoneblur': '{:.3f}'.format(result.params.get(
+			'deadzoneblur', autopylot.config.get_estimator_dead_zone_blur()))}
+	fragment['FILTER'] = {'gyro': gyro, 'accel': accel}
+	with open(filename, 'w') as output:
+		output.write("; tuned: score {:.4f} (error {:.4f}, overshoot {:.4f})\n"
+					.format(result.score, result.error, result.overshoot))
+		fragment.write(output)
+	logging.info("Wrote the tuned parameters to {!s}: {!s}"
+				.format(filename, result))
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Tunes the estimation "
+									"parameters")
+	parser.add_argument('--method', choices=['grid', 'random', 'bayes'],
+						default='random')
+	parser.add_argument('--count', type=int, default=64,
+						help="candidates (random / bayes)")
+	parser.add_argument('--recording', action='append', default=[],
+						help="FlightRecording (.npz) - default: simulated")
+	parser.add_argument('--workers', type=int, default=None)
+	parser.add_argument('--output', default='tuning.ini')
+	args = parser.parse_args()
+
+	sample_rate = autopylot.config.get_gyrosensor_sample_rate()
+	scenarios = [Scenario.from_recording(
+		autopylot.replay.FlightRecording.load(filename), sample_rate)
+		for filename in args.recording]
+	if not scenarios:
+		scenarios = [simulate_flight(sample_rate=sample_rate, seed=seed)
+					for seed in range(3)]
+	tuner = Tuner(scenarios, args.workers)
+	if args.method == 'grid':
+		results = tuner.grid_search()
+	elif args.method == 'random':
+		results = tuner.random_search(args.count)
+	else:
+		results = tuner.bayesian_search(args.count)
+	for result in results[:10]:
+		print(result)
+	write_config_fragment(results[0], args.output)
+
+
+if __name__ == '__main__':
+	main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,157 @@
+""" Vibration analysis of the gyro stream. Motor and prop vibrations end up
+in the gyro readings - the VibrationAnalyzer collects the raw gyro samples
+in a ring buffer, runs a FFT over the latest window every few samples (low
+duty cycle) and tracks the dominant peaks per axis. Attached AdaptiveNotch
+stages (autopylot.filters) are retuned to the strongest peak on the fly. """
+
+import time
+import logging
+
+import numpy
+
+AXES = 3
+MIN_WINDOW = 32
+
+
+class RingBuffer():
+	""" Preallocated ring buffer of (n, 3) samples """
+
+	def __init__(self, size):
+		self._data = numpy.zeros((int(size), AXES))
+		self._position = 0
+		self.count = 0
+
+	def __len__(self):
+		return len(self._data)
+
+	def extend(self, block):
+		""" Appends a (n, 3) block - older samples are overwritten """
+		block = numpy.asarray(block, dtype=float).reshape(-1, AXES)
+		size = len(self._data)
+		if len(block) >= size:
+			block = block[-size:]
+		first = min(len(block), size - self._position)
+		self._data[self._position:self._position + first] = block[:first]
+		self._data[:len(block) - first] = block[first:]
+		self._position = (self._position + len(block)) % size
+		self.count += len(block)
+
+	def latest(self, count):
+		""" Returns (a copy of) the latest count samples - oldest first """
+		index = numpy.arange(self._position - count, self._position) % len(self)
+		return self._data[index]
+
+
+class VibrationAnalyzer():
+	""" Finds the dominant vibration frequencies of the gyro data.
+	Every interval samples the latest window samples are analyzed. If a
+	pass takes longer than the budget (seconds) the window is halved (the
+	frequency resolution gets worse, but the flight loop stays on time). """
+
+	def __init__(self, sample_rate, window=256, interval=1024,
+				min_frequency=40.0, max_frequency=None, peaks=2,
+				prominence=4.0, budget=0.002):
+		self.sample_rate = float(sample_rate)
+		self.window = int(window)
+		self.interval = int(interval)
+		self.min_frequency = float(min_frequency)
+		self.max_frequency = float(max_frequency or sample_rate * 0.45)
+		self.peak_count = int(peaks)
+		# a peak has to be that many times stronger than the median of
+		# the spectrum (band) to retune the notch filters
+		self.prominence = float(prominence)
+		self.budget = float(budget)
+		self._buffer = RingBuffer(self.window)
+		self._notches = []
+		self._since = 0
+		self.frequencies = None
+		self.magnitudes = None
+		self.peaks = numpy.zeros((AXES, self.peak_count))
+		self.passes = 0
+		self.analysis_time = 0.0
+		self.max_analysis_time = 0.0
+
+	def attach(self, notch):
+		""" Attaches an AdaptiveNotch which follows the strongest peak """
+		self._notches.append(notch)
+
+	@property
+	def spectrum(self):
+		""" (frequencies, magnitudes) of the last pass - magnitudes is a
+		(bins, 3) array. None if there was no pass yet. """
+		if self.frequencies is None:
+			return None
+		return self.frequencies, self.magnitudes
+
+	def push(self, block):
+		""" Adds raw gyro samples ((n, 3) block) - runs an analysis pass
+		when one is due. Returns True if a pass was made. """
+		self._buffer.extend(block)
+		self._since += len(block)
+		if self._since < self.interval or self._buffer.count < self.window:
+			return False
+		self._since = 0
+		self.analyze()
+		return True
+
+	def analyze(self):
+		""" Runs one analysis pass over the latest window samples """
+		start_time = time.perf_counter()
+		window = min(self.window, self._buffer.count)
+		data = self._buffer.latest(window)
+		data -= data.mean(axis=0)
+		data *= numpy.hanning(window)[:, numpy.newaxis]
+		magnitudes = numpy.abs(numpy.fft.rfft(data, axis=0)) / window
+		frequencies = numpy.fft.rfftfreq(window, 1 / self.sample_rate)
+
+		band = ((frequencies >= self.min_frequency) &
+				(frequencies <= self.max_frequency))
+		band_magnitudes = magnitudes[band]
+		band_frequencies = frequencies[band]
+		strongest = None
+		if len(band_frequencies) > 0:
+			self.peaks = self._find_peaks(band_frequencies, band_magnitudes)
+			strongest = band_magnitudes.max(axis=0)
+			floor = numpy.median(band_magnitudes, axis=0)
+			prominent = strongest > floor * self.prominence
+			if numpy.any(prominent):
+				self._retune(numpy.where(prominent, self.peaks[:, 0], numpy.nan))
+
+		self.frequencies = frequencies
+		self.magnitudes = magnitudes
+		self.passes += 1
+
+		elapsed = time.perf_counter() - start_time
+		self.analysis_time += elapsed
+		self.max_analysis_time = max(self.max_analysis_time, elapsed)
+		if elapsed > self.budget and self.window > MIN_WINDOW:
+			self.window //= 2
+			logging.warning("Vibration analysis took {:.2f}ms (budget: "
+							"{:.2f}ms) - reduced the window to {!s} samples"
+							.format(elapsed * 1000, self.budget * 1000,
+									self.window))
+
+	def _find_peaks(self, frequencies, magnitudes):
+		""" Returns the frequencies of the strongest local maxima per axis -
+		(3, peaks) array, strongest first (nan if there are fewer) """
+		peaks = numpy.full((AXES, self.peak_count), numpy.nan)
+		padded = numpy.pad(magnitudes, ((1, 1), (0, 0)))
+		local_max = ((magnitudes > padded[:-2]) & (magnitudes >= padded[2:]))
+		for axis in range(AXES):
+			candidates = numpy.flatnonzero(local_max[:, axis])
+			order = numpy.argsort(magnitudes[candidates, axis])[::-1]
+			strongest = candidates[order[:self.peak_count]]
+			peaks[axis, :len(strongest)] = frequencies[strongest]
+		return peaks
+
+	def _retune(self, frequencies):
+		""" Retunes the attached notches - axes without a (nan) peak keep
+		their frequency """
+		for notch in self._notches:
+			notch.set_frequencies([current if numpy.isnan(new) else new
+								for current, new in zip(notch.frequencies,
+														frequencies)])
+		logging.debug("Retuned {!s} notch filter(s) to {!s}Hz"
+					.format(len(self._notches), frequencies.tolist()))
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
+import autopylot.config
 import autopylot.motion
-import time
+import autopylot.clock
+import autopylot.telemetry
 
 
 if __name__ == '__main__':
-    mt = autopylot.motion.MotionTracker()
+    telemetry = autopylot.telemetry.create_publisher(
+        len(autopylot.config.get_motor_names()))
+    mt = autopylot.motion.MotionTracker(telemetry=telemetry)
     while True:
         distance = mt.get_distance()
         tilt = mt.get_tilt()
@@ -19,4 +23,4 @@ if __name__ == '__main__':
             tilt['x'],
             tilt['y'],
             tilt['z']))
-        time.sleep(1)
+        autopylot.clock.sleep(1)
@@ -19,8 +19,10 @@ setup(
     url="https://github.com/ngrande/PiPyFly",
     packages=["autopylot", "tests"],
     long_description=load_file_content("README.md"),
-    install_requires=['pigpio', 'psutil', 'mpu6050-raspberrypi', 'smbus-cffi', 'urwid'],
-    tests_require=['pigpio', 'psutil', 'mpu6050-raspberrypi', 'smbus-cffi'],
+    install_requires=['pigpio', 'psutil', 'mpu6050-raspberrypi', 'smbus-cffi', 'urwid',
+                      'numpy'],
+    tests_require=['pigpio', 'psutil', 'mpu6050-raspberrypi', 'smbus-cffi',
+                   'numpy'],
     test_suite='tests',
     # classifiers = [""]
 )
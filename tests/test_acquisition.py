@@ -0,0 +1,93 @@
+import unittest
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.acquisition as acquisition
+import autopylot.fakes as fakes
+
+PIN = 23
+SAMPLE_RATE = 1000
+
+
+class TestAcquisition(unittest.TestCase):
+	""" Class to test the interrupt driven acquisition """
+
+	def setUp(self):
+		self.pi = fakes.FakePi()
+
+	def test_tick_diff(self):
+		""" Tests the tick difference wraps around at 2^32 """
+		self.assertEqual(acquisition.tick_diff(100, 350), 250)
+		self.assertEqual(acquisition.tick_diff(0xffffff00, 0x10), 0x110)
+
+	def test_wakes_on_interrupt(self):
+		""" Tests wait() returns as soon as an interrupt arrives """
+		sampler = acquisition.DataReadySampler(self.pi, PIN, SAMPLE_RATE,
+											timeout=1.0)
+		timer = threading.Timer(0.01, self.pi.emit, (PIN, 1, 5000))
+		timer.start()
+		start_time = time.perf_counter()
+		self.assertEqual(sampler.wait(), 5000)
+		self.assertLess(time.perf_counter() - start_time, 0.5)
+		timer.join()
+		self.assertEqual(sampler.get_statistics(),
+						{'interrupts': 1, 'missed': 0, 'duplicates': 0,
+						'timeouts': 0})
+
+	def test_timestamps_from_ticks(self):
+		""" Tests the timestamp follows the interrupt ticks """
+		sampler = acquisition.DataReadySampler(self.pi, PIN, SAMPLE_RATE)
+		self.pi.emit(PIN, 1, 1000)
+		sampler.wait()
+		self.pi.emit(PIN, 1, 2000)
+		sampler.wait()
+		self.pi.emit(PIN, 1, 3000)
+		sampler.wait()
+		self.assertAlmostEqual(sampler.timestamp, 0.002)
+
+	def test_missed_interrupts(self):
+		""" Tests lost interrupts (gaps in the ticks) and overruns (the loop
+		did not wait in time) are counted """
+		sampler = acquisition.DataReadySampler(self.pi, PIN, SAMPLE_RATE)
+		self.pi.emit(PIN, 1, 1000)
+		self.pi.emit(PIN, 1, 4000)  # two interrupts lost in between
+		self.assertEqual(sampler.missed, 2)
+		# both interrupts were pending - the first sample is gone
+		self.assertEqual(sampler.wait(), 4000)
+		self.assertEqual(sampler.missed, 3)
+
+	def test_missed_with_source(self):
+		""" Tests the missed interrupts of a real time interrupt source """
+		sampler = acquisition.DataReadySampler(self.pi, PIN, SAMPLE_RATE)
+		source = fakes.FakeInterruptSource(self.pi, PIN, SAMPLE_RATE,
+										drop_every=10)
+		source.start()
+		time.sleep(0.2)
+		source.stop()
+		self.assertEqual(sampler.interrupts, source.emitted)
+		self.assertGreaterEqual(sampler.missed, source.emitted // 9 - 1)
+
+	def test_timeout(self):
+		""" Tests the fallback if there is no interrupt """
+		sampler = acquisition.DataReadySampler(self.pi, PIN, SAMPLE_RATE,
+											timeout=0.01)
+		self.assertIsNone(sampler.wait())
+		self.assertEqual(sampler.timeouts, 1)
+
+	def test_cancel(self):
+		""" Tests the callback is removed """
+		sampler = acquisition.DataReadySampler(self.pi, PIN, SAMPLE_RATE)
+		sampler.cancel()
+		self.pi.emit(PIN, 1)
+		self.assertEqual(sampler.interrupts, 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,145 @@
+import unittest
+import os
+import sys
+import random
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.calibration as calibration
+
+
+class FakeImu():
+	""" Returns noisy samples of a device at rest (z axis up) """
+
+	def __init__(self, gyro_bias, accel_offset, accel_gain, noise=0.05):
+		self.gyro_bias = gyro_bias
+		self.accel_offset = accel_offset
+		self.accel_gain = accel_gain
+		self.noise = noise
+		self.random = random.Random(42)
+		self.reads = 0
+
+	def read_burst(self):
+		self.reads += 1
+		gyro = [bias + self.random.gauss(0, self.noise)
+				for bias in self.gyro_bias]
+		accel = [(value + offset) * self.accel_gain + self.random.gauss(0, self.noise)
+				for value, offset in zip((0, 0, calibration.GRAVITY),
+										self.accel_offset)]
+		return accel, gyro, 25.0
+
+
+class TestCalibration(unittest.TestCase):
+	""" Class to test the IMU calibration """
+
+	def test_running_stats(self):
+		""" Welford results should match the two pass results """
+		generator = random.Random(1)
+		samples = [[generator.uniform(-5, 5) for _ in range(3)]
+				for _ in range(500)]
+		stats = calibration.RunningStats()
+		for sample in samples:
+			stats.add(sample)
+		for axis in range(3):
+			values = [sample[axis] for sample in samples]
+			self.assertAlmostEqual(stats.mean[axis], statistics.mean(values))
+			self.assertAlmostEqual(stats.variance[axis],
+								statistics.variance(values))
+			self.assertEqual(stats.min[axis], min(values))
+			self.assertEqual(stats.max[axis], max(values))
+
+	def test_calibrate(self):
+		""" Tests the estimated bias, scale and offset """
+		imu = FakeImu(gyro_bias=(1.5, -0.5, 0.25), accel_offset=(0.3, -0.2, 0),
+					accel_gain=1.05)
+		result = calibration.calibrate(imu.read_burst, sample_count=2000)
+		self.assertEqual(imu.reads, 2000)
+		self.assertEqual(result.temperature, 25.0)
+		for axis, bias in enumerate((1.5, -0.5, 0.25)):
+			self.assertAlmostEqual(result.gyro_bias[axis], bias, places=1)
+		self.assertAlmostEqual(result.accel_scale[2], 1 / 1.05, places=2)
+
+		# corrected values at rest should be (0, 0, 1g) / (0, 0, 0)
+		accel, gyro, _ = imu.read_burst()
+		corrected = result.correct_accel(accel)
+		for axis, expected in enumerate((0, 0, calibration.GRAVITY)):
+			self.assertAlmostEqual(corrected[axis], expected, delta=0.25)
+		for value in result.correct_gyro(gyro):
+			self.assertAlmostEqual(value, 0, delta=0.25)
+		applied = result.apply_gyro({'x': 1.5, 'y': -0.5, 'z': 0.25})
+		for axis in 'xyz':
+			self.assertAlmostEqual(applied[axis], 0, places=2)
+
+		# the noise band should contain 0
+		for low, high in zip(*result.gyro_band):
+			self.assertLess(low, 0)
+			self.assertGreater(high, 0)
+
+	def test_calibrate_moving(self):
+		""" Calibration has to fail if the device is moved """
+		imu = FakeImu(gyro_bias=(0, 0, 0), accel_offset=(0, 0, 0),
+					accel_gain=1.0, noise=5.0)
+		with self.assertRaises(Exception):
+			calibration.calibrate(imu.read_burst)
+
+
+class TestCalibrationCache(unittest.TestCase):
+	""" Class to test the temperature indexed calibration cache """
+
+	def setUp(self):
+		self._directory = tempfile.TemporaryDirectory()
+		self.filename = os.path.join(self._directory.name, 'calibration.json')
+
+	def tearDown(self):
+		self._directory.cleanup()
+
+	def test_lookup_interpolates(self):
+		""" Tests storing, reloading and interpolating between bins """
+		cache = calibration.CalibrationCache(self.filename, bin_width=5)
+		self.assertIsNone(cache.lookup(0x68, 25))
+		cache.store(0x68, calibration.ImuCalibration(
+			gyro_bias=(1, 0, 0), temperature=20.0))
+		cache.store(0x68, calibration.ImuCalibration(
+			gyro_bias=(2, 0, 0), temperature=30.0))
+		# same bin as 30°C - replaces it
+		cache.store(0x68, calibration.ImuCalibration(
+			gyro_bias=(3, 0, 0), temperature=31.0))
+
+		cache = calibration.CalibrationCache(self.filename, bin_width=5)
+		self.assertEqual(len(cache.entries(0x68)), 2)
+		self.assertEqual(cache.entries(0x69), [])
+		self.assertAlmostEqual(cache.lookup(0x68, 25.5).gyro_bias[0], 2.0)
+		self.assertEqual(cache.lookup(0x68, 10).gyro_bias[0], 1)
+		self.assertEqual(cache.lookup(0x68, 40).gyro_bias[0], 3)
+
+	def test_load_or_calibrate(self):
+		""" A valid cached calibration should only be verified """
+		cache = calibration.CalibrationCache(self.filename)
+		imu = FakeImu(gyro_bias=(1.5, -0.5, 0.25), accel_offset=(0.3, -0.2, 0),
+					accel_gain=1.05)
+		first = calibration.load_or_calibrate(imu.read_burst, 0x68, 25.0,
+											cache, sample_count=200,
+											verify_count=50)
+		self.assertEqual(imu.reads, 200)
+		second = calibration.load_or_calibrate(imu.read_burst, 0x68, 25.0,
+											cache, sample_count=200,
+											verify_count=50)
+		self.assertEqual(imu.reads, 250)
+		self.assertEqual(first.gyro_bias, second.gyro_bias)
+
+		# the bias changed (i.e. other temperature) => recalibrate
+		imu.gyro_bias = (3.0, -0.5, 0.25)
+		third = calibration.load_or_calibrate(imu.read_burst, 0x68, 25.0,
+											cache, sample_count=200,
+											verify_count=50)
+		self.assertEqual(imu.reads, 500)
+		self.assertAlmostEqual(third.gyro_bias[0], 3.0, places=1)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
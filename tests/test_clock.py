@@ -0,0 +1,115 @@
+import unittest
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.acquisition as acquisition
+import autopylot.clock as clock
+import autopylot.drivers as drivers
+import autopylot.fakes as fakes
+import autopylot.i2cbus as i2cbus
+
+
+class TestVirtualClock(unittest.TestCase):
+	""" Class to test the virtual time source """
+
+	def setUp(self):
+		self.clock = clock.VirtualClock(start=10.0)
+		self.previous = clock.set_clock(self.clock)
+
+	def tearDown(self):
+		clock.set_clock(self.previous)
+
+	def test_waiting_advances(self):
+		""" Tests sleep, spin and wait move the time at once """
+		self.assertIs(clock.get_clock(), self.clock)
+		clock.sleep(2.5)
+		clock.spin(0.5)
+		self.assertEqual(clock.now(), 13.0)
+		self.assertEqual(clock.ticks(), 13000000)
+		event = threading.Event()
+		self.assertFalse(clock.wait(event, 1.0))
+		event.set()
+		self.assertTrue(clock.wait(event, 1.0))
+		self.assertEqual(clock.now(), 14.0)
+		with self.assertRaises(Exception):
+			self.clock.advance(-1)
+
+	def test_fake_pi_tick(self):
+		""" Tests the fake daemon tick follows the clock (and wraps) """
+		pi = fakes.FakePi()
+		self.clock.advance(4295.0)
+		self.assertEqual(pi.get_current_tick(), 4295000000 & 0xffffffff)
+
+	def test_sampler_timeout(self):
+		""" Tests the data ready fallback times out on the clock - without
+		waiting in real time """
+		pi = fakes.FakePi()
+		sampler = acquisition.DataReadySampler(pi, 23, 100, timeout=5.0)
+		start_time = time.perf_counter()
+		self.assertIsNone(sampler.wait())
+		self.assertIsNone(sampler.wait())
+		self.assertLess(time.perf_counter() - start_time, 1.0)
+		self.assertEqual(clock.now(), 20.0)
+		self.assertAlmostEqual(sampler.timestamp, 5.0)
+		self.assertEqual(sampler.timeouts, 2)
+		# an interrupt wakes it up at once
+		pi.emit(23, 1, pi.get_current_tick())
+		self.assertIsNotNone(sampler.wait())
+		self.assertEqual(clock.now(), 20.0)
+		sampler.cancel()
+
+	def _simulate(self, duration):
+		""" Samples all sensors for duration (virtual) seconds - returns the
+		IMU timestamps and the statistics """
+		clock.set_clock(clock.VirtualClock(start=10.0))
+		bus = fakes.FakeI2CBus()
+		for device in (fakes.FakeMpu6050(), fakes.FakeHmc5883l(),
+					fakes.FakeBmp280()):
+			bus.attach(device)
+		scheduler = i2cbus.BusScheduler(bus)
+		scheduler.start(thread=False)
+		sampler = drivers.MultiRateSampler(scheduler, [
+			drivers.Mpu6050(0x68, rate=200), drivers.Hmc5883l(0x1e),
+			drivers.Bmp280(0x76)])
+		setup = scheduler.client()
+		for driver in sampler.drivers:
+			driver.setup(setup)
+		timestamps = []
+		sampler.subscribe('imu', lambda reading:
+						timestamps.append(reading.timestamp))
+		sampler.run_for(duration)
+		scheduler.stop()
+		return timestamps, sampler.get_statistics(), scheduler.utilization
+
+	def test_simulation(self):
+		""" Tests two minutes of sampling run fast and give the same result
+		every run """
+		start_time = time.perf_counter()
+		timestamps, statistics, utilization = self._simulate(120)
+		elapsed = time.perf_counter() - start_time
+		self.assertLess(elapsed, 5)
+		self.assertEqual(len(timestamps), statistics['imu']['samples'])
+		self.assertAlmostEqual(statistics['imu']['achieved_rate'], 200,
+							places=0)
+		self.assertAlmostEqual(statistics['magnetometer']['achieved_rate'],
+							75, places=0)
+		self.assertAlmostEqual(statistics['barometer']['achieved_rate'],
+							25, places=0)
+		self.assertEqual(statistics['imu']['overruns'], 0)
+		self.assertGreater(utilization, 0)
+		self.assertLess(utilization, 1)
+
+		again = self._simulate(120)
+		self.assertEqual(again[0], timestamps)
+		self.assertEqual(again[1], statistics)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
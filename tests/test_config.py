@@ -95,6 +95,77 @@ class TestControlMotor(unittest.TestCase):
 			self.assertFalse(config.verify_config_ini(invalid_config))
 
 
+	def test_verify_gyro(self):
+		""" Checks tiltfront and tiltleft have to be different axes """
+		gyro_config = configparser.ConfigParser()
+		gyro_config.read_string("""
+			[GYRO]
+			address = 0x68
+			tiltfront = -x
+			tiltleft = +z
+		""")
+		self.assertTrue(config.verify_config_ini(gyro_config))
+		gyro_config['GYRO']['tiltleft'] = '+x'
+		with self.assertRaises(Exception):
+			config.verify_config_ini(gyro_config)
+
+	def test_gyro_addresses(self):
+		""" Checks redundant IMUs - a list of different addresses """
+		gyro_config = configparser.ConfigParser()
+		gyro_config.read_string("""
+			[GYRO]
+			address = 0x68, 0x69
+		""")
+		self.assertTrue(config.verify_config_ini(gyro_config))
+		gyro_config['GYRO']['address'] = '0x68,0x68'
+		with self.assertRaises(Exception):
+			config.verify_config_ini(gyro_config)
+		gyro_config['GYRO']['address'] = '0x68,'
+		with self.assertRaises(Exception):
+			config.verify_config_ini(gyro_config)
+		self.assertEqual(config.get_gyrosensor_addresses(), [0x68])
+		self.assertEqual(config.get_gyrosensor_address(), 0x68)
+
+	def test_verify_motors(self):
+		""" Checks the motor sections take any motor name - but the same
+		motors in all of them """
+		hexa_config_str = """
+			[MOTORS.PIN]
+			m1 = 4
+			m2 = 17
+			m3 = 22
+			m4 = 27
+			m5 = 5
+			m6 = 6
+
+			[MOTORS.ROTATION]
+			m1 = CW
+			m2 = CCW
+			m3 = CW
+			m4 = CCW
+			m5 = CW
+			m6 = CCW
+
+			[MOTORS.POSITION]
+			m1 = 30
+			m2 = 90
+			m3 = 150
+			m4 = 210
+			m5 = 270
+			m6 = -30
+		"""
+		hexa_config = configparser.ConfigParser()
+		hexa_config.read_string(hexa_config_str)
+		self.assertTrue(config.verify_config_ini(hexa_config))
+		del hexa_config['MOTORS.ROTATION']['m6']
+		with self.assertRaises(Exception):
+			config.verify_config_ini(hexa_config)
+		hexa_config['MOTORS.ROTATION']['m6'] = 'CCW'
+		hexa_config['MOTORS.PIN']['m6'] = '4'
+		with self.assertRaises(Exception):
+			config.verify_config_ini(hexa_config)
+
+
 if __name__ == '__main__':
 		unittest.main()
 
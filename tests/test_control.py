@@ -1,6 +1,8 @@
 import unittest
 import os
 import sys
+import time
+import contextlib
 # import logging
 
 import pigpio
@@ -10,6 +12,50 @@ sys.path.insert(0, os.path.abspath('..'))
 
 import autopylot
 import autopylot.control as control
+import autopylot.tracing as tracing
+
+
+class CountingClock():
+	""" Clock of the tracer - every reading is one tick later """
+
+	def __init__(self):
+		self.ticks = 0
+
+	def __call__(self):
+		self.ticks += 1
+		return self.ticks
+
+
+class RecordingWaveOutput():
+	""" Wave protocol output which only sends the pulsewidths when the
+	outermost batch exits - records the clock when it does """
+
+	waves = True
+
+	def __init__(self, clock):
+		self.clock = clock
+		self.pending = {}
+		self.sent = []
+		self._depth = 0
+
+	def set_pulsewidth(self, pin, pulsewidth):
+		self.pending[pin] = pulsewidth
+		if self._depth == 0:
+			self._send()
+
+	def _send(self):
+		self.sent.append((self.clock(), dict(self.pending)))
+		self.pending.clear()
+
+	@contextlib.contextmanager
+	def batch(self):
+		self._depth += 1
+		try:
+			yield
+		finally:
+			self._depth -= 1
+		if self._depth == 0 and self.pending:
+			self._send()
 
 
 class TestControlMotor(unittest.TestCase):
@@ -93,6 +139,16 @@ class TestControlMotor(unittest.TestCase):
 		# logging.WARNING):
 		#     self.motor.send_throttle(1860)
 
+	def test_decorator_keywords(self):
+		""" Tests the decorated methods keep their name and take keyword
+		arguments """
+		self.assertEqual(self.motor.send_throttle.__name__, 'send_throttle')
+		with self.assertRaises(Exception):
+			self.motor.send_throttle(throttle=20)
+		self.assertTrue(self.motor.send_start_signal())
+		self.assertTrue(self.motor.send_throttle(throttle=20))
+		self.assertIs(self.motor.current_throttle, 20)
+
 	def test_create_perc_to_value_dict(self):
 		""" Tests the creation of the percent to value map dictionary.
 		Min throttle should always be mapped to 1% and max throttle to 100% """
@@ -208,10 +264,10 @@ class TestControlQuadcopter(unittest.TestCase):
 		self.assertTrue(self.quadcopter.change_overall_throttle(50))
 		self.assertTrue(self.quadcopter.change_tilt(
 			side=self.quadcopter.TiltSide.front, adjustment=20))
-		self.assertIs(self.quadcopter._motor_front_left.current_throttle, 40)
-		self.assertIs(self.quadcopter._motor_front_right.current_throttle, 40)
-		self.assertIs(self.quadcopter._motor_rear_right.current_throttle, 60)
-		self.assertIs(self.quadcopter._motor_rear_left.current_throttle, 60)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 40)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 40)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 60)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 60)
 	
 	def test_change_tilt_rear(self):
 		""" tests changing the tilt to the rear """
@@ -219,10 +275,10 @@ class TestControlQuadcopter(unittest.TestCase):
 		self.assertTrue(self.quadcopter.change_overall_throttle(50))
 		self.assertTrue(self.quadcopter.change_tilt(
 			side=self.quadcopter.TiltSide.front, adjustment=-20))
-		self.assertIs(self.quadcopter._motor_front_left.current_throttle, 60)
-		self.assertIs(self.quadcopter._motor_front_right.current_throttle, 60)
-		self.assertIs(self.quadcopter._motor_rear_right.current_throttle, 40)
-		self.assertIs(self.quadcopter._motor_rear_left.current_throttle, 40)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 60)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 60)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 40)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 40)
 		
 	def test_change_tilt_front_left(self):
 		""" Tests changing the tilt to the front left """
@@ -232,10 +288,10 @@ class TestControlQuadcopter(unittest.TestCase):
 		self.assertTrue(self.quadcopter.change_tilt(
 			side=self.quadcopter.TiltSide.front_left,
 			adjustment=20))
-		self.assertIs(self.quadcopter._motor_front_left.current_throttle, 40)
-		self.assertIs(self.quadcopter._motor_front_right.current_throttle, 50)
-		self.assertIs(self.quadcopter._motor_rear_right.current_throttle, 60)
-		self.assertIs(self.quadcopter._motor_rear_left.current_throttle, 50)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 40)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 60)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 50)
 
 	def test_change_tilt_front_right(self):
 		""" Tests changing the tilt to the front right """
@@ -245,10 +301,10 @@ class TestControlQuadcopter(unittest.TestCase):
 		self.assertTrue(self.quadcopter.change_tilt(
 			side=self.quadcopter.TiltSide.front_right,
 			adjustment=20))
-		self.assertIs(self.quadcopter._motor_front_left.current_throttle, 50)
-		self.assertIs(self.quadcopter._motor_front_right.current_throttle, 40)
-		self.assertIs(self.quadcopter._motor_rear_right.current_throttle, 50)
-		self.assertIs(self.quadcopter._motor_rear_left.current_throttle, 60)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 40)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 60)
 
 	def test_change_tilt_rear_left(self):
 		""" Tests changing the tilt to the rear left """
@@ -258,10 +314,10 @@ class TestControlQuadcopter(unittest.TestCase):
 		self.assertTrue(self.quadcopter.change_tilt(
 			side=self.quadcopter.TiltSide.front_right,
 			adjustment=-20))
-		self.assertIs(self.quadcopter._motor_front_left.current_throttle, 50)
-		self.assertIs(self.quadcopter._motor_front_right.current_throttle, 60)
-		self.assertIs(self.quadcopter._motor_rear_right.current_throttle, 50)
-		self.assertIs(self.quadcopter._motor_rear_left.current_throttle, 40)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 60)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 40)
 
 	def test_change_tilt_fail(self):
 		""" Tests changing the tilt to an invalid value - expected to fail """
@@ -280,10 +336,10 @@ class TestControlQuadcopter(unittest.TestCase):
 		self.assertTrue(self.quadcopter.change_tilt(
 			side=self.quadcopter.TiltSide.left,
 			adjustment=20))
-		self.assertIs(self.quadcopter._motor_front_left.current_throttle, 40)
-		self.assertIs(self.quadcopter._motor_front_right.current_throttle, 60)
-		self.assertIs(self.quadcopter._motor_rear_right.current_throttle, 60)
-		self.assertIs(self.quadcopter._motor_rear_left.current_throttle, 40)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 40)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 60)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 60)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 40)
 
 	def test_change_tilt_right(self):
 		""" tests changing the tilt to right """
@@ -293,10 +349,10 @@ class TestControlQuadcopter(unittest.TestCase):
 		self.assertTrue(self.quadcopter.change_tilt(
 			side=self.quadcopter.TiltSide.left,
 			adjustment=-20))
-		self.assertIs(self.quadcopter._motor_front_left.current_throttle, 60)
-		self.assertIs(self.quadcopter._motor_front_right.current_throttle, 40)
-		self.assertIs(self.quadcopter._motor_rear_right.current_throttle, 40)
-		self.assertIs(self.quadcopter._motor_rear_left.current_throttle, 60)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 60)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 40)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 40)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 60)
 
 	def test_hover(self):
 		""" Tests hover """
@@ -307,10 +363,70 @@ class TestControlQuadcopter(unittest.TestCase):
 			self.quadcopter.TiltSide.left, -30))
 		self.assertTrue(self.quadcopter.hover())
 
-		self.assertIs(self.quadcopter._motor_front_left.current_throttle, 50)
-		self.assertIs(self.quadcopter._motor_front_right.current_throttle, 50)
-		self.assertIs(self.quadcopter._motor_rear_right.current_throttle, 50)
-		self.assertIs(self.quadcopter._motor_rear_left.current_throttle, 50)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 50)
+
+	def test_change_setpoint(self):
+		""" Tests the absolute setpoint mixes pitch and roll at once and
+		clips at full throttle """
+		self.assertTrue(self.quadcopter.turn_on())
+		self.assertTrue(self.quadcopter.change_setpoint(50, roll=10, pitch=20,
+														yaw=0))
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 45)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 35)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 65)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 55)
+		self.assertTrue(self.quadcopter.change_setpoint(95, 0, 20, 0))
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 100)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 76)
+		self.assertFalse(self.quadcopter.change_setpoint(101, 0, 0, 0))
+
+	def test_failsafe_cutoff(self):
+		""" Tests no command drives the motors after the failsafe cut them
+		off - until they are turned on again """
+		quadcopter = self.quadcopter
+		self.assertTrue(quadcopter.turn_on())
+		self.assertTrue(quadcopter.change_overall_throttle(20))
+		self.assertTrue(quadcopter.heartbeat())
+		deadline = time.monotonic() + 2.0
+		while not quadcopter.failsafe.triggered:
+			self.assertLess(time.monotonic(), deadline)
+			time.sleep(0.005)
+		pins = [motor.pin for motor in quadcopter.motors]
+		self.assertEqual([quadcopter.pi.get_servo_pulsewidth(pin)
+						for pin in pins], [0] * len(pins))
+		self.assertFalse(quadcopter.change_overall_throttle(60))
+		self.assertFalse(quadcopter.turned_on)
+		self.assertFalse(quadcopter.change_setpoint(50, 0, 0, 0))
+		self.assertFalse(quadcopter.heartbeat())
+		self.assertEqual([quadcopter.pi.get_servo_pulsewidth(pin)
+						for pin in pins], [0] * len(pins))
+		self.assertTrue(quadcopter.turn_on())
+		self.assertTrue(quadcopter.failsafe.armed)
+		self.assertTrue(quadcopter.change_overall_throttle(60))
+		self.assertTrue(quadcopter.turn_off())
+
+	def test_trace_wave_batch(self):
+		""" A wave protocol sends the motor batch when it exits - the command
+		has to be submitted before and acknowledged after that """
+		clock = CountingClock()
+		quadcopter = self.quadcopter
+		quadcopter.tracer = tracing.CommandTracer(capacity=4, clock=clock)
+		quadcopter.output = RecordingWaveOutput(clock)
+		for motor in quadcopter.motors:
+			motor.output = quadcopter.output
+		self.assertTrue(quadcopter.turn_on())
+		self.assertTrue(quadcopter.change_overall_throttle(20))
+		sent, pulsewidths = quadcopter.output.sent[-1]
+		self.assertEqual(len(pulsewidths), len(quadcopter.motors))
+		created, mixed, submitted, acknowledged = \
+			quadcopter.tracer.get_spans()[0]
+		self.assertLess(mixed, submitted)
+		self.assertLess(submitted, sent)
+		self.assertLess(sent, acknowledged)
+		self.assertTrue(quadcopter.turn_off())
 
 	def test_request_total_throttle(self):
 		""" Test requesting total throttle """
@@ -322,16 +438,16 @@ class TestControlQuadcopter(unittest.TestCase):
 		""" Test requesting throttle of each individual motor """
 		self.assertTrue(self.quadcopter.turn_on())
 		self.assertTrue(self.quadcopter.change_overall_throttle(50))
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.front_left), 50)
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.rear_left), 50)
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.front_right), 50)
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.rear_right), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 50)
 
 		self.assertTrue(self.quadcopter.change_tilt(self.quadcopter.TiltSide.front, 50))
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.front_left), 25)
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.rear_left), 75)
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.front_right), 25)
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.rear_right), 75)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 25)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 75)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 25)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 75)
 
 
 	def test_tilt_edge_case(self):
@@ -339,10 +455,10 @@ class TestControlQuadcopter(unittest.TestCase):
 		self.assertTrue(self.quadcopter.turn_on())
 		self.assertTrue(self.quadcopter.change_overall_throttle(100))
 		self.assertFalse(self.quadcopter.change_tilt(self.quadcopter.TiltSide.front, 50))
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.front_left), 50)
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.rear_left), 100)
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.front_right), 50)
-		self.assertIs(self.quadcopter.request_throttle(self.quadcopter.MotorSide.rear_right), 100)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontleft'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorrearleft'), 100)
+		self.assertIs(self.quadcopter.request_throttle('motorfrontright'), 50)
+		self.assertIs(self.quadcopter.request_throttle('motorrearright'), 100)
 
 	def test_yaw_edge_case(self):
 		""" test yaw edge case - when already at 100 throttle """
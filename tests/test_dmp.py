@@ -0,0 +1,134 @@
+import unittest
+import os
+import sys
+import math
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.acquisition as acquisition
+import autopylot.dmp as dmp
+import autopylot.dmpfirmware as dmpfirmware
+import autopylot.estimation as estimation
+import autopylot.fakes as fakes
+
+
+def _rotation(yaw=0.0, pitch=0.0, roll=0.0):
+	""" Returns the quaternion (w, x, y, z) of the euler angles (degrees) """
+	yaw, pitch, roll = (math.radians(angle) / 2 for angle in (yaw, pitch, roll))
+	return (math.cos(roll) * math.cos(pitch) * math.cos(yaw) +
+			math.sin(roll) * math.sin(pitch) * math.sin(yaw),
+			math.sin(roll) * math.cos(pitch) * math.cos(yaw) -
+			math.cos(roll) * math.sin(pitch) * math.sin(yaw),
+			math.cos(roll) * math.sin(pitch) * math.cos(yaw) +
+			math.sin(roll) * math.cos(pitch) * math.sin(yaw),
+			math.cos(roll) * math.cos(pitch) * math.sin(yaw) -
+			math.sin(roll) * math.sin(pitch) * math.cos(yaw))
+
+
+class TestDmp(unittest.TestCase):
+	""" Class to test the DMP mode against a fake device """
+
+	def setUp(self):
+		self.packets = [dmp.pack_packet(_rotation(roll=index), (0, 0, 9.81),
+										(index, 0, 0)) for index in range(10)]
+		self.pi = fakes.FakePi()
+		self.device = fakes.FakeDmpDevice(packets=self.packets, pi=self.pi,
+										pin=23)
+		self.bus = fakes.FakeI2CBus(overhead=0, byte_time=0)
+		self.bus.attach(self.device)
+		self.dmp = dmp.Dmp(self.bus)
+
+	def test_firmware_upload(self):
+		""" Tests the firmware is uploaded (and verified) in chunks within
+		the banks """
+		self.dmp.load_firmware()
+		self.assertTrue(self.device.firmware_loaded)
+		self.assertFalse(self.device.running)
+		with self.assertRaises(Exception):
+			self.dmp.load_firmware()
+		# a device which does not store the firmware fails the verification
+		self.device.memory = bytearray(16 * 256)
+		broken = dmp.Dmp(self.bus)
+		self.device.write = lambda register, data: None
+		with self.assertRaises(Exception):
+			broken.load_firmware()
+
+	def test_memory_bank_boundary(self):
+		""" Tests memory accesses must not cross a bank boundary """
+		with self.assertRaises(Exception):
+			self.dmp.write_memory(250, bytes(8))
+		with self.assertRaises(Exception):
+			self.dmp.read_memory(0x1f8, 16)
+
+	def test_read_packets(self):
+		""" Tests the recorded packets are read and decoded """
+		self.dmp.start(100)
+		self.assertTrue(self.device.running)
+		self.assertEqual(self.dmp.rate, 100)
+		self.assertEqual(self.dmp.packet_length, 28)
+		self.assertEqual(self.device.memory[dmp.D_0_22:dmp.D_0_22 + 2],
+						bytes([0, 1]))
+		with self.assertRaises(Exception):
+			self.dmp.set_rate(400)
+
+		self.device.serve(3)
+		packets = self.dmp.read_packets()
+		self.assertEqual(len(packets), 3)
+		for index, packet in enumerate(packets):
+			yaw, pitch, roll = dmp.quaternion_to_euler(packet.quaternion)
+			self.assertAlmostEqual(roll, index, places=3)
+			self.assertAlmostEqual(pitch, 0, places=3)
+			self.assertAlmostEqual(packet.accel[2], 9.81, places=2)
+			self.assertAlmostEqual(packet.gyro[0], index, places=1)
+		self.assertEqual(self.dmp.read_packets(), [])
+
+		self.device.serve(5)
+		self.assertEqual(len(self.dmp.read_packets(limit=2)), 2)
+		self.assertEqual(len(self.dmp.read_packets()), 3)
+
+	def test_corrupted_packet(self):
+		""" Tests a misaligned FIFO is detected and reset """
+		self.dmp.start(200)
+		self.device.serve(1)
+		self.device.push(self.packets[1][4:] + self.packets[1][:4])
+		self.device.serve(1)
+		packets = self.dmp.read_packets()
+		self.assertEqual(len(packets), 1)
+		self.assertEqual(self.dmp.corrupted, 1)
+		self.assertEqual(self.dmp.fifo_count(), 0)
+
+	def test_overflow(self):
+		""" Tests a FIFO overflow is detected """
+		self.dmp.start(200)
+		for _ in range(40):
+			self.device.push(self.packets[0])
+		self.assertEqual(self.dmp.read_packets(), [])
+		self.assertEqual(self.dmp.overflows, 1)
+
+	def test_interrupt(self):
+		""" Tests every packet signals the data ready interrupt """
+		sampler = acquisition.DataReadySampler(self.pi, 23, 200, timeout=0.1)
+		self.dmp.start(200)
+		self.device.serve(1)
+		self.assertIsNotNone(sampler.wait())
+		self.assertEqual(len(self.dmp.read_packets()), 1)
+
+	def test_estimator_orientation(self):
+		""" Tests the estimator takes over the DMP orientation """
+		estimator = estimation.MotionEstimator()
+		estimator.update_orientation(_rotation(yaw=30, pitch=10, roll=-20))
+		tilt = estimator.get_tilt()
+		self.assertAlmostEqual(tilt['x'], -20)
+		self.assertAlmostEqual(tilt['y'], 10)
+		self.assertAlmostEqual(tilt['z'], 30)
+
+	def test_firmware_image(self):
+		""" Tests the firmware image has the size of the C driver """
+		self.assertEqual(len(dmpfirmware.FIRMWARE), 3062)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
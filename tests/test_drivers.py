@@ -0,0 +1,127 @@
+import unittest
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.drivers as drivers
+import autopylot.estimation as estimation
+import autopylot.fakes as fakes
+import autopylot.i2cbus as i2cbus
+
+
+class TestDrivers(unittest.TestCase):
+	""" Class to test the sensor drivers and the multi-rate sampler """
+
+	def setUp(self):
+		self.bus = fakes.FakeI2CBus()
+		self.imu = fakes.FakeMpu6050()
+		self.hmc = fakes.FakeHmc5883l()
+		self.qmc = fakes.FakeQmc5883l()
+		self.bmp = fakes.FakeBmp280()
+		for device in (self.imu, self.hmc, self.qmc, self.bmp):
+			self.bus.attach(device)
+
+	def test_mpu6050(self):
+		""" Tests the IMU decodes with the configured ranges and leaves the
+		sample rate alone """
+		driver = drivers.Mpu6050(0x68, rate=500, accel_full_scale=8,
+								gyro_full_scale=2000)
+		with self.assertRaises(Exception):
+			driver.read(self.bus)
+		driver.setup(self.bus)
+		self.assertEqual(self.bus.registers[0x68][0x1c], 0x10)
+		self.assertEqual(self.bus.registers[0x68][0x1b], 0x18)
+		# SMPLRT_DIV and CONFIG (DLPF) are not touched
+		self.assertEqual(self.bus.registers[0x68][0x19], 0)
+		self.assertEqual(self.bus.registers[0x68][0x1a], 0)
+		self.imu.set_motion((1.0, -2.0, 9.81), (100.0, 0.0, -50.0), 30.0)
+		accel, gyro, temperature = driver.read(self.bus)
+		mounting = driver.reader.mounting
+		numpy.testing.assert_allclose(accel, mounting @ [1.0, -2.0, 9.81],
+									atol=0.01)
+		numpy.testing.assert_allclose(gyro, mounting @ [100.0, 0.0, -50.0],
+									atol=0.1)
+		self.assertAlmostEqual(temperature, 30.0, places=1)
+
+	def test_magnetometers(self):
+		""" Tests both magnetometer drivers """
+		for driver, device in ((drivers.Hmc5883l(0x1e), self.hmc),
+							(drivers.Qmc5883l(0x0d), self.qmc)):
+			driver.setup(self.bus)
+			device.set_field((25.0, -10.0, -42.0))
+			for value, expected in zip(driver.read(self.bus),
+									(25.0, -10.0, -42.0)):
+				self.assertAlmostEqual(value, expected, places=0)
+		self.assertEqual(self.bus.registers[0x1e][0x02], 0x00)
+		self.assertEqual(self.bus.registers[0x0d][0x09], 0x1d)
+
+	def test_bmp280(self):
+		""" Tests the barometer against the datasheet example """
+		driver = drivers.Bmp280(0x76)
+		with self.assertRaises(Exception):
+			driver.read(self.bus)
+		driver.setup(self.bus)
+		pressure, temperature, altitude = driver.read(self.bus)
+		self.assertAlmostEqual(pressure, 100653.27, places=1)
+		self.assertAlmostEqual(temperature, 25.08, places=2)
+		self.assertAlmostEqual(altitude, drivers.pressure_altitude(pressure))
+		# ~12Pa per meter near sea level
+		self.bmp.set_pressure(pressure - 120)
+		self.assertAlmostEqual(driver.read(self.bus)[2] - altitude, 10, places=0)
+
+	def test_create_driver(self):
+		""" Tests the drivers are created from the config values """
+		self.assertIsNone(drivers.create_driver('none', 0x1e))
+		driver = drivers.create_driver('QMC5883L', 0x0d, 50)
+		self.assertIsInstance(driver, drivers.Qmc5883l)
+		self.assertEqual(driver.rate, 50)
+		self.assertGreater(driver.read_cost, 0)
+		with self.assertRaises(Exception):
+			drivers.create_driver('ak8963', 0x0c)
+
+	def test_multi_rate(self):
+		""" Tests every sensor is sampled at its own rate - the slow
+		barometer (slow bus transactions) does not hold back the IMU """
+		scheduler = i2cbus.BusScheduler(self.bus)
+		scheduler.start()
+		sampler = drivers.MultiRateSampler(scheduler, [
+			drivers.Mpu6050(0x68, rate=400), drivers.Hmc5883l(0x1e),
+			drivers.Bmp280(0x76)])
+		sampler.setup()
+		estimator = estimation.MotionEstimator()
+		timestamps = []
+		sampler.subscribe('imu', lambda reading:
+						timestamps.append(reading.timestamp))
+		sampler.subscribe('magnetometer', lambda reading:
+						estimator.update_magnetometer(reading.timestamp,
+													reading.values))
+		sampler.subscribe('barometer', lambda reading:
+						estimator.update_barometer(reading.timestamp,
+													reading.values[2]))
+		self.hmc.set_field((0.0, -20.0, -40.0))
+		sampler.start()
+		time.sleep(0.5)
+		sampler.stop()
+		scheduler.stop()
+
+		statistics = sampler.get_statistics()
+		self.assertGreater(statistics['imu']['samples'], 100)
+		self.assertGreater(statistics['magnetometer']['samples'], 20)
+		self.assertGreater(statistics['barometer']['samples'], 5)
+		self.assertLess(statistics['barometer']['samples'],
+						statistics['magnetometer']['samples'])
+		self.assertEqual(timestamps, sorted(timestamps))
+		self.assertEqual(sampler.latest('imu').timestamp, timestamps[-1])
+		self.assertAlmostEqual(estimator.heading, 90.0, places=0)
+		self.assertEqual(estimator.altitude, 0.0)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,125 @@
+import unittest
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.esc as esc
+import autopylot.fakes as fakes
+import autopylot.failsafe as failsafe
+
+PINS = [4, 17, 22, 27]
+
+
+class TestEsc(unittest.TestCase):
+	""" Class to test the ESC protocols against the captured waves """
+
+	def setUp(self):
+		self.pi = fakes.FakePi()
+
+	def _timeline(self, pin):
+		return fakes.wave_timeline(self.pi.waves[self.pi.transmitting], pin)
+
+	def _decode_dshot(self, pin, protocol):
+		""" Returns the frame of the pin from the captured wave """
+		timeline = self._timeline(pin)
+		frame = 0
+		for index in range(16):
+			(high, high_time), (low, low_time) = timeline[2 * index:2 * index + 2]
+			self.assertEqual((high, low), (1, 0))
+			if index < 15:
+				self.assertEqual(high_time + low_time, protocol.bit)
+			self.assertIn(high_time, (protocol.zero_high, protocol.one_high))
+			frame = frame << 1 | (high_time == protocol.one_high)
+		return frame
+
+	def test_dshot_frame(self):
+		""" Tests the frame layout and the CRC """
+		self.assertEqual(esc.dshot_frame(1046), 0x82c6)
+		self.assertEqual(esc.dshot_frame(1046, telemetry=True) >> 4, 2093)
+		self.assertEqual(esc.dshot_value(0), 0)
+		self.assertEqual(esc.dshot_value(1000), 48)
+		self.assertEqual(esc.dshot_value(2000), 2047)
+		with self.assertRaises(Exception):
+			esc.dshot_frame(2048)
+
+	def test_dshot_wave(self):
+		""" Tests the bit timings of the DShot150 wave of every pin """
+		protocol = esc.PROTOCOLS['dshot150']
+		output = esc.WaveOutput(self.pi, PINS, protocol, 2000)
+		widths = {4: 1000, 17: 1500, 22: 2000, 27: 0}
+		with output.batch():
+			for pin, width in widths.items():
+				output.set_pulsewidth(pin, width)
+		self.assertEqual(len(self.pi.sent_waves), 1)
+		self.assertEqual(self.pi.wave_modes, [esc.WAVE_MODE_REPEAT_SYNC])
+		for pin, width in widths.items():
+			self.assertEqual(self._decode_dshot(pin, protocol),
+							esc.dshot_frame(esc.dshot_value(width)))
+			self.assertEqual(sum(duration for _, duration
+								in self._timeline(pin)), 500)
+		self.assertEqual(self.pi.modes, dict.fromkeys(PINS, esc.OUTPUT))
+
+	def test_oneshot_wave(self):
+		""" Tests all pins rise together and fall after their pulse """
+		output = esc.WaveOutput(self.pi, PINS, esc.PROTOCOLS['oneshot125'],
+								2000)
+		with output.batch():
+			output.set_pulsewidth(4, 1000)
+			output.set_pulsewidth(17, 1500)
+			output.set_pulsewidth(22, 2000)
+		self.assertEqual(self._timeline(4), [(1, 125), (0, 375)])
+		self.assertEqual(self._timeline(17), [(1, 188), (0, 312)])
+		self.assertEqual(self._timeline(22), [(1, 250), (0, 250)])
+		self.assertEqual(self._timeline(27), [(0, 500)])
+
+	def test_multishot_wave(self):
+		""" Tests the Multishot pulse range at 10 kHz """
+		output = esc.WaveOutput(self.pi, PINS, esc.PROTOCOLS['multishot'],
+								10000)
+		output.set_pulsewidth(27, 1750)
+		self.assertEqual(self._timeline(27), [(1, 20), (0, 80)])
+		with self.assertRaises(Exception):
+			esc.WaveOutput(self.pi, PINS, esc.PROTOCOLS['oneshot125'], 8000)
+
+	def test_wave_switch(self):
+		""" Tests old waves are deleted and the wave stops at 0 """
+		output = esc.WaveOutput(self.pi, PINS, esc.PROTOCOLS['dshot150'], 1000)
+		for width in (1100, 1200, 1300):
+			output.set_pulsewidth(4, width)
+		self.assertEqual(len(self.pi.sent_waves), 3)
+		self.assertEqual(list(self.pi.waves), [self.pi.transmitting])
+		output.set_pulsewidth(4, 0)
+		self.assertIsNone(self.pi.transmitting)
+		self.assertEqual(self.pi.waves, {})
+
+	def test_pwm_output(self):
+		""" Tests the default protocol of the config.ini is servo PWM """
+		output = esc.create_output(self.pi, PINS)
+		self.assertFalse(output.waves)
+		output.set_pulsewidth(4, 1500)
+		self.assertEqual(self.pi.get_servo_pulsewidth(4), 1500)
+		with self.assertRaises(Exception):
+			esc.create_output(self.pi, PINS, 'dshot1200', 1000)
+
+	def test_failsafe_stops_wave(self):
+		""" Tests the failsafe script halts the wave """
+		output = esc.WaveOutput(self.pi, PINS, esc.PROTOCOLS['dshot150'], 1000)
+		output.set_pulsewidth(4, 1500)
+		kill_switch = failsafe.Failsafe(self.pi, dict.fromkeys(PINS, 0), 20,
+										stop_waves=True)
+		self.assertIn("wvhlt", kill_switch.script)
+		kill_switch.arm()
+		deadline = time.monotonic() + 1
+		while self.pi.transmitting is not None and time.monotonic() < deadline:
+			time.sleep(0.005)
+		kill_switch.disarm()
+		self.assertIsNone(self.pi.transmitting)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,81 @@
+import unittest
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.failsafe as failsafe
+import autopylot.fakes as fakes
+
+STOP_SIGNALS = {4: 0, 17: 0, 22: 0, 27: 0}
+TIMEOUT = 20
+
+
+class TestFailsafe(unittest.TestCase):
+	""" Class to test the failsafe script against the fake daemon """
+
+	def setUp(self):
+		self.pi = fakes.FakePi()
+		for pin in STOP_SIGNALS:
+			self.pi.set_servo_pulsewidth(pin, 1500)
+		self.failsafe = failsafe.Failsafe(self.pi, STOP_SIGNALS, TIMEOUT)
+
+	def tearDown(self):
+		self.failsafe.disarm()
+		self.pi.stop()
+
+	def _motors_stopped(self):
+		return all(self.pi.get_servo_pulsewidth(pin) == 0
+				for pin in STOP_SIGNALS)
+
+	def test_script(self):
+		""" Tests all pins are stopped in one go at the end of the script """
+		lines = failsafe.build_script(STOP_SIGNALS).splitlines()
+		self.assertEqual(lines[-5:], ["servo 4 0", "servo 17 0",
+									"servo 22 0", "servo 27 0", "halt"])
+
+	def test_heartbeat_keeps_motors_running(self):
+		""" Tests the motors keep running while the heartbeat goes on """
+		self.failsafe.arm()
+		self.assertTrue(self.failsafe.armed)
+		for _ in range(20):
+			self.failsafe.heartbeat()
+			time.sleep(TIMEOUT / 4000)
+		self.assertFalse(self._motors_stopped())
+		self.assertFalse(self.failsafe.triggered)
+
+	def test_cutoff(self):
+		""" Tests the motors are stopped if the heartbeat stops """
+		self.failsafe.arm()
+		self.failsafe.heartbeat()
+		time.sleep(TIMEOUT / 1000 * 3)
+		self.assertTrue(self._motors_stopped())
+		self.assertTrue(self.failsafe.triggered)
+
+	def test_disarm(self):
+		""" Tests a disarmed failsafe does not touch the motors """
+		self.failsafe.arm()
+		self.failsafe.disarm()
+		self.assertFalse(self.failsafe.armed)
+		self.assertEqual(self.pi.scripts, {})
+		time.sleep(TIMEOUT / 1000 * 2)
+		self.assertFalse(self._motors_stopped())
+		# heartbeats without a script are ignored
+		self.failsafe.heartbeat()
+
+	def test_cutoff_latency(self):
+		""" Measures the worst case cutoff latency - it has to stay close
+		to the timeout """
+		result = failsafe.measure_cutoff_latency(self.pi, STOP_SIGNALS,
+												TIMEOUT, trials=5)
+		self.assertEqual(len(result['latencies']), 5)
+		self.assertGreaterEqual(min(result['latencies']), TIMEOUT / 1000)
+		self.assertLess(result['worst'], TIMEOUT / 1000 + 0.03)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,120 @@
+import unittest
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.filters as filters
+
+SAMPLE_RATE = 1000
+
+
+def _sine(frequency, count=2000, amplitude=1.0):
+	""" Returns a (count, 3) sine with the same signal on all axes """
+	t = numpy.arange(count) / SAMPLE_RATE
+	return numpy.repeat((amplitude * numpy.sin(2 * numpy.pi * frequency * t))
+						[:, numpy.newaxis], 3, axis=1)
+
+
+class TestFilters(unittest.TestCase):
+	""" Class to test the filter stages and pipelines """
+
+	def _assert_block_invariant(self, make_stage, data):
+		""" Processing in blocks must equal processing at once """
+		whole = make_stage().process(data)
+		stage = make_stage()
+		parts = [stage.process(data[start:start + 77])
+				for start in range(0, len(data), 77)]
+		numpy.testing.assert_allclose(numpy.vstack(parts), whole)
+
+	def test_block_invariance(self):
+		""" Tests all stages keep their state between blocks """
+		data = numpy.random.RandomState(3).normal(0, 1, (1000, 3))
+		data[data < 0.5] = 0
+		self._assert_block_invariant(
+			lambda: filters.lowpass(50, SAMPLE_RATE), data)
+		self._assert_block_invariant(
+			lambda: filters.notch(120, SAMPLE_RATE), data)
+		self._assert_block_invariant(lambda: filters.MedianFilter(5), data)
+		self._assert_block_invariant(filters.SpikeRejection, data)
+
+	def test_lowpass(self):
+		""" The low-pass should keep low and damp high frequencies """
+		lowpass = filters.lowpass(50, SAMPLE_RATE)
+		self.assertGreater(numpy.abs(lowpass.process(_sine(5))[1000:]).max(),
+						0.95)
+		lowpass.reset()
+		self.assertLess(numpy.abs(lowpass.process(_sine(300))[1000:]).max(),
+						0.05)
+
+	def test_notch(self):
+		""" The notch should remove its center frequency only """
+		notch = filters.notch(120, SAMPLE_RATE, q=2)
+		self.assertLess(numpy.abs(notch.process(_sine(120))[1000:]).max(), 0.01)
+		notch.reset()
+		self.assertGreater(numpy.abs(notch.process(_sine(20))[1000:]).max(),
+						0.9)
+
+	def test_notch_per_axis(self):
+		""" Each axis can have its own notch frequency """
+		b_x, a_x = filters.notch_coefficients(120, SAMPLE_RATE)
+		b_y, a_y = filters.notch_coefficients(200, SAMPLE_RATE)
+		notch = filters.Biquad([b_x, b_y, b_y], [a_x, a_y, a_y])
+		out = notch.process(_sine(120))[1000:]
+		self.assertLess(numpy.abs(out[:, 0]).max(), 0.01)
+		self.assertGreater(numpy.abs(out[:, 1]).max(), 0.5)
+
+	def test_median(self):
+		""" The median should remove single spikes """
+		data = numpy.zeros((20, 3))
+		data[10] = 100
+		self.assertFalse(numpy.any(filters.MedianFilter(3).process(data)))
+
+	def test_dead_band_and_spike_rejection(self):
+		""" Tests the dead band and the rejection of isolated samples """
+		pipeline = filters.FilterPipeline([
+			filters.DeadBand([-1, -1, -1], [1, 1, 1]),
+			filters.SpikeRejection()])
+		data = numpy.array([[0.5, 5, 5], [3, 5, 0], [0, 5, 0], [0, 5, 4]])
+		numpy.testing.assert_array_equal(
+			pipeline.process(data),
+			[[0, 0, 0], [0, 5, 0], [0, 5, 0], [0, 5, 0]])
+
+	def test_build_pipeline(self):
+		""" Tests building pipelines from the config strings """
+		pipeline = filters.build_pipeline("lowpass:100 notch:120:3 median:5 "
+										"spike", SAMPLE_RATE)
+		self.assertEqual([stage.__class__.__name__
+						for stage in pipeline.stages],
+						['Biquad', 'Biquad', 'MedianFilter', 'SpikeRejection'])
+		self.assertEqual(len(filters.build_pipeline("none", SAMPLE_RATE)), 0)
+		with self.assertRaises(Exception):
+			filters.build_pipeline("lowpass:600", SAMPLE_RATE)
+		with self.assertRaises(Exception):
+			filters.build_pipeline("highpass:10", SAMPLE_RATE)
+
+	def test_fit_spec(self):
+		""" Stages at or above half the sample rate should be dropped """
+		with self.assertLogs(level='WARNING'):
+			spec = filters.fit_spec("dynnotch:150 lowpass:100 median:5", 200)
+		self.assertEqual(spec, "median:5")
+		with self.assertLogs(level='WARNING'):
+			self.assertEqual(filters.fit_spec("lowpass:100", 200), "none")
+		self.assertEqual(filters.fit_spec("lowpass:30", 200), "lowpass:30")
+
+	def test_benchmark(self):
+		""" Tests the benchmark reports each stage """
+		pipeline = filters.build_pipeline("lowpass:100 median:5", SAMPLE_RATE)
+		results = pipeline.benchmark(block_size=100, blocks=2)
+		self.assertEqual([name for name, _ in results],
+						['Biquad', 'MedianFilter'])
+		self.assertTrue(all(rate > 0 for _, rate in results))
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,118 @@
+import unittest
+import os
+import sys
+import logging
+import tempfile
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.flightlog as flightlog
+
+
+BLACKBOX = """\
+[2017-01-21 15:10:39.000] INFO [root.send_start_signal:199] Successfully sent start signal (1000) to the pin 4
+[2017-01-21 15:10:39.000] INFO [root.send_start_signal:199] Successfully sent start signal (1000) to the pin 17
+[2017-01-21 15:10:40.500] INFO [root.send_throttle:262] Successfully adjusted throttle from 0% to 20% on pin 4
+[2017-01-21 15:10:40.500] INFO [root.send_throttle:262] Successfully adjusted throttle from 0% to 20% on pin 17
+[2017-01-21 15:10:41.250] WARNING [root.callback_func:120] Timeout event triggered from watchdog on pin: 4 (tick: 1234).
+[2017-01-21 15:10:42.000] ERROR [root.send_throttle:266] Error while adjusting throttle to 30% on pin 17
+Traceback (most recent call last):
+Exception: broken
+[2017-01-21 15:10:43.000] INFO [root.send_throttle:262] Successfully adjusted throttle from 20% to 40% on pin 17
+[2017-01-21 15:10:44.000] INFO [root.send_stop_signal:220] Successfully sent stop signal (0) to the pin 4
+"""
+
+
+class TestFlightLog(unittest.TestCase):
+	""" Class to test the columnar flight log """
+
+	def setUp(self):
+		self._directory = tempfile.TemporaryDirectory()
+		self.directory = self._directory.name
+
+	def tearDown(self):
+		self._directory.cleanup()
+
+	def _write(self, rows, chunk_rows):
+		log_directory = os.path.join(self.directory, 'log')
+		with flightlog.FlightLogWriter(log_directory, 4, chunk_rows) as writer:
+			for row in range(rows):
+				writer.append(row * 0.001, throttle=[row % 100] * 4,
+							gyro=(row, -row, 0))
+				if row % 1000 == 0:
+					writer.log_event(row * 0.001, logging.INFO,
+									"event {!s}".format(row))
+		return flightlog.FlightLogReader(log_directory)
+
+	def test_read_time_range(self):
+		""" Tests reading a time range across chunk borders """
+		reader = self._write(10000, chunk_rows=256)
+		self.assertEqual(len(reader), 10000)
+		data = reader.read(2.0, 2.5)
+		numpy.testing.assert_allclose(data['t'], numpy.arange(2000, 2501) * 0.001)
+		numpy.testing.assert_array_equal(data['gyro_x'], numpy.arange(2000, 2501))
+		self.assertTrue(numpy.all(numpy.isnan(data['accel_z'])))
+		# views on the memory mapped file - not copies
+		self.assertIsInstance(data['t'].base, numpy.memmap)
+
+	def test_read_out_of_range(self):
+		""" Tests reading time ranges before and after the log """
+		reader = self._write(1000, chunk_rows=100)
+		self.assertEqual(len(reader.read(-5, -1)['t']), 0)
+		self.assertEqual(len(reader.read(5, 10)['t']), 0)
+		self.assertEqual(len(reader.read(-1, 100)['t']), 1000)
+
+	def test_equal_timestamps_across_chunks(self):
+		""" Rows with the same timestamp in two chunks should all be found """
+		log_directory = os.path.join(self.directory, 'log')
+		with flightlog.FlightLogWriter(log_directory, 1, 4) as writer:
+			for t in [0, 1, 2, 3, 3, 3, 3, 3, 4]:
+				writer.append(t)
+		reader = flightlog.FlightLogReader(log_directory)
+		self.assertEqual(reader.find_rows(3, 3), (3, 8))
+
+	def test_decreasing_timestamps(self):
+		""" Timestamps must not decrease """
+		log_directory = os.path.join(self.directory, 'log')
+		with flightlog.FlightLogWriter(log_directory) as writer:
+			writer.append(1.0)
+			with self.assertRaises(Exception):
+				writer.append(0.5)
+
+	def test_events(self):
+		""" Tests reading the events of a time range """
+		reader = self._write(5000, chunk_rows=256)
+		events = reader.events(0.5, 3.5)
+		self.assertEqual([message for _, _, message in events],
+						['event 1000', 'event 2000', 'event 3000'])
+
+	def test_convert_blackbox(self):
+		""" Tests converting a text log """
+		text_file = os.path.join(self.directory, 'autopylot.blackbox')
+		with open(text_file, 'w') as log_file:
+			log_file.write(BLACKBOX)
+		log_directory = os.path.join(self.directory, 'log')
+		rows = flightlog.convert_blackbox(text_file, log_directory)
+		self.assertEqual(rows, 6)
+
+		reader = flightlog.FlightLogReader(log_directory)
+		self.assertEqual(reader.motor_count, 2)
+		timestamps, throttle = reader.throttle(1.0, 3.5)
+		numpy.testing.assert_array_equal(timestamps, [1.5, 1.5])
+		numpy.testing.assert_array_equal(throttle, [[20, 0], [20, 20]])
+		timestamps, throttle = reader.throttle(4.0, 5.0)
+		numpy.testing.assert_array_equal(throttle, [[20, 40], [0, 40]])
+
+		events = reader.events()
+		self.assertEqual(len(events), 2)
+		self.assertEqual(events[0][:2], (2.25, logging.WARNING))
+		self.assertTrue(events[1][2].endswith("Exception: broken"))
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,111 @@
+import unittest
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.config as config
+import autopylot.frame as frame
+
+QUAD_X = frame.Frame(['motorfrontleft', 'motorfrontright', 'motorrearleft',
+					'motorrearright'], [4, 17, 22, 27],
+					[True, False, False, True], [-45, 45, 225, 135])
+
+HEXA_X = frame.Frame(['m{!s}'.format(index) for index in range(6)],
+					[4, 17, 22, 27, 5, 6],
+					[True, False, True, False, True, False],
+					[30, 90, 150, 210, 270, 330])
+
+
+class TestFrame(unittest.TestCase):
+	""" Class to test the frame definition and the mixing table """
+
+	def _mix(self, mixing, direction):
+		return dict(zip(mixing.names, mixing.tilt_mix(direction)))
+
+	def test_quad_tilt(self):
+		""" Tests the mixing gives the same throttles as the former
+		hardcoded quad X code """
+		self.assertEqual(self._mix(QUAD_X, frame.TILT_FRONT),
+						{'motorfrontleft': -1, 'motorfrontright': -1,
+						'motorrearleft': 1, 'motorrearright': 1})
+		self.assertEqual(self._mix(QUAD_X, frame.TILT_LEFT),
+						{'motorfrontleft': -1, 'motorfrontright': 1,
+						'motorrearleft': -1, 'motorrearright': 1})
+		self.assertEqual(self._mix(QUAD_X, frame.TILT_FRONT_LEFT),
+						{'motorfrontleft': -1, 'motorfrontright': 0,
+						'motorrearleft': 0, 'motorrearright': 1})
+		self.assertEqual(self._mix(QUAD_X, frame.TILT_FRONT_RIGHT),
+						{'motorfrontleft': 0, 'motorfrontright': -1,
+						'motorrearleft': 1, 'motorrearright': 0})
+
+	def test_quad_yaw(self):
+		""" Tests cw motors speed up to yaw clockwise """
+		self.assertEqual(list(QUAD_X.yaw_mix), [1, -1, -1, 1])
+
+	def test_hexa(self):
+		""" Tests a hexa X frame keeps the total throttle """
+		for direction in (frame.TILT_FRONT, frame.TILT_LEFT, 30, 100):
+			mix = HEXA_X.tilt_mix(direction)
+			self.assertAlmostEqual(numpy.abs(mix).max(), 1)
+			throttles = 50 + numpy.rint(mix * 20).astype(int)
+			self.assertEqual(throttles.sum(), 300)
+		self.assertEqual(list(HEXA_X.tilt_mix(frame.TILT_FRONT)),
+						[-1, 0, 1, 1, 0, -1])
+		self.assertEqual(HEXA_X.yaw_mix.sum(), 0)
+		self.assertEqual(HEXA_X.index('m4'), 4)
+
+	def test_check_rotations(self):
+		""" Tests the spin directions have to alternate """
+		self.assertTrue(QUAD_X.check_rotations())
+		self.assertTrue(HEXA_X.check_rotations())
+		same_side = frame.Frame('abcd', [1, 2, 3, 4],
+								[True, True, False, False], [-45, 45, 135, 225])
+		self.assertFalse(same_side.check_rotations())
+		unbalanced = frame.Frame('abc', [1, 2, 3], [True, False, True],
+								[0, 120, 240])
+		self.assertFalse(unbalanced.check_rotations())
+
+	def test_invalid(self):
+		""" Tests incomplete frames are rejected """
+		with self.assertRaises(Exception):
+			frame.Frame('ab', [1, 2], [True, False], [0, 180])
+		with self.assertRaises(Exception):
+			frame.Frame('abc', [1, 2], [True, False, True], [0, 120, 240])
+
+	def test_load_frame(self):
+		""" Tests the frame of the config.ini is the quad X """
+		loaded = frame.load_frame()
+		self.assertEqual(len(loaded), 4)
+		self.assertTrue(loaded.check_rotations())
+		self.assertEqual(self._mix(loaded, frame.TILT_FRONT),
+						self._mix(QUAD_X, frame.TILT_FRONT))
+
+	def test_default_positions(self):
+		""" Tests the frame without MOTORS.POSITION - the quad X keeps its
+		layout, other frames are spread evenly """
+		positions = dict(config.config['MOTORS.POSITION'])
+		config.config.remove_section('MOTORS.POSITION')
+		try:
+			self.assertTrue(config.verify_config_ini(config.config))
+			loaded = frame.load_frame()
+			self.assertEqual(self._mix(loaded, frame.TILT_FRONT),
+							self._mix(QUAD_X, frame.TILT_FRONT))
+			config.config['MOTORS.PIN']['m5'] = '5'
+			config.config['MOTORS.PIN']['m6'] = '6'
+			self.assertEqual([config.get_motor_position(name)
+							for name in config.get_motor_names()],
+							[30, 90, 150, 210, 270, 330])
+		finally:
+			config.config.remove_option('MOTORS.PIN', 'm5')
+			config.config.remove_option('MOTORS.PIN', 'm6')
+			config.config['MOTORS.POSITION'] = positions
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
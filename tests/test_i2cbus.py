@@ -0,0 +1,182 @@
+import unittest
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.i2cbus as i2cbus
+import autopylot.fakes as fakes
+
+IMU = 0x68
+MAGNETOMETER = 0x1e
+
+
+class TestI2CBus(unittest.TestCase):
+	""" Class to test the I2C bus scheduler """
+
+	def setUp(self):
+		self.bus = fakes.FakeI2CBus()
+		self.bus.add_device(IMU, {register: register
+								for register in range(0x3b, 0x49)})
+		self.bus.add_device(MAGNETOMETER, {0x03: 0x12, 0x04: 0x34})
+		self.scheduler = i2cbus.BusScheduler(self.bus)
+
+	def tearDown(self):
+		self.scheduler.stop()
+
+	def _queue_blocked(self):
+		""" Blocks the owner thread with a slow write, so the following
+		submits queue up. Returns the future of the write. """
+		self.bus.add_device(0x70)
+		self.bus.byte_time = 0.02
+		future = self.scheduler.submit_write(0x70, 0x00, [1])
+		while not self.bus.transactions:
+			pass
+		self.bus.byte_time = 22.5e-6
+		return future
+
+	def test_read_write(self):
+		""" Tests simple reads and writes through the proxy """
+		self.scheduler.start()
+		client = self.scheduler.client(i2cbus.PRIORITY_IMU)
+		self.assertEqual(client.read_byte_data(IMU, 0x3b), 0x3b)
+		self.assertEqual(client.read_i2c_block_data(IMU, 0x3b, 3),
+						[0x3b, 0x3c, 0x3d])
+		self.assertEqual(client.read_word_data(MAGNETOMETER, 0x03), 0x3412)
+		client.write_byte_data(IMU, 0x6b, 0x01)
+		self.assertEqual(self.bus.registers[IMU][0x6b], 0x01)
+
+	def test_priority(self):
+		""" Tests queued IMU reads run before the magnetometer reads """
+		self.scheduler.start()
+		blocker = self._queue_blocked()
+		magneto = self.scheduler.submit_read(MAGNETOMETER, 0x03, 2,
+											i2cbus.PRIORITY_MAGNETOMETER)
+		temperature = self.scheduler.submit_read(IMU, 0x41, 2,
+												i2cbus.PRIORITY_TEMPERATURE)
+		imu = self.scheduler.submit_read(IMU, 0x43, 6, i2cbus.PRIORITY_IMU)
+		for future in (blocker, magneto, temperature, imu):
+			future.result()
+		# the IMU reads were merged into one transfer
+		self.assertEqual(self.bus.transactions[1:],
+						[('read', IMU, 0x41, 8), ('read', MAGNETOMETER, 0x03, 2)])
+		self.assertEqual(temperature.result(), [0x41, 0x42])
+		self.assertEqual(imu.result(), [0x43, 0x44, 0x45, 0x46, 0x47, 0x48])
+		self.assertEqual(magneto.result(), [0x12, 0x34])
+
+	def test_merge(self):
+		""" Tests adjacent and overlapping reads are merged - but not over
+		a gap or a queued write """
+		self.scheduler.start()
+		blocker = self._queue_blocked()
+		futures = [self.scheduler.submit_read(IMU, 0x3b, 6),
+				self.scheduler.submit_read(IMU, 0x3f, 4),
+				self.scheduler.submit_read(IMU, 0x43, 2),
+				self.scheduler.submit_read(IMU, 0x47, 2)]
+		self.scheduler.submit_write(IMU, 0x45, [0xff])
+		futures.append(self.scheduler.submit_read(IMU, 0x45, 2))
+		blocker.result()
+		results = [future.result() for future in futures]
+		self.assertEqual(results[0], [0x3b, 0x3c, 0x3d, 0x3e, 0x3f, 0x40])
+		self.assertEqual(results[1], [0x3f, 0x40, 0x41, 0x42])
+		self.assertEqual(results[2], [0x43, 0x44])
+		self.assertEqual(results[4], [0xff, 0x46])
+		self.assertEqual(self.bus.transactions[1:],
+						[('read', IMU, 0x3b, 10), ('read', IMU, 0x47, 2),
+						('write', IMU, 0x45, 1), ('read', IMU, 0x45, 2)])
+		self.assertEqual(self.scheduler.merged, 2)
+
+	def test_single_owner(self):
+		""" Tests concurrent consumers never overlap on the bus """
+		self.scheduler.start()
+
+		def consume(address, register, priority):
+			client = self.scheduler.client(priority)
+			for _ in range(50):
+				client.read_i2c_block_data(address, register, 6)
+
+		threads = [threading.Thread(target=consume, args=arguments)
+				for arguments in ((IMU, 0x3b, i2cbus.PRIORITY_IMU),
+									(IMU, 0x41, i2cbus.PRIORITY_TEMPERATURE),
+									(MAGNETOMETER, 0x03,
+									i2cbus.PRIORITY_MAGNETOMETER))]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(self.bus.overlaps, 0)
+
+		# the fake bus alone overlaps
+		self.bus.overlaps = 0
+		threads = [threading.Thread(target=self.bus.read_i2c_block_data,
+									args=(IMU, 0x3b, 32)) for _ in range(4)]
+		self.bus.byte_time = 0.001
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertGreater(self.bus.overlaps, 0)
+
+	def test_statistics(self):
+		""" Tests the utilization and latency statistics """
+		self.bus.overhead = 0.002
+		self.scheduler.start()
+		for _ in range(5):
+			self.scheduler.read(IMU, 0x3b, 14, i2cbus.PRIORITY_IMU)
+		statistics = self.scheduler.get_statistics()
+		self.assertEqual(statistics['transfers'], 5)
+		self.assertGreater(statistics['utilization'], 0.3)
+		self.assertLessEqual(statistics['utilization'], 1.0)
+		device = statistics['devices'][IMU]
+		self.assertEqual(device['transactions'], 5)
+		self.assertGreaterEqual(device['mean_latency'], 0.002)
+		self.assertGreaterEqual(device['max_latency'], device['mean_latency'])
+
+	def test_read_into(self):
+		""" Tests the reads into buffers - before the queued transactions
+		of lower priority and without merging """
+		self.scheduler.start()
+		client = self.scheduler.client(i2cbus.PRIORITY_IMU)
+		buffer = bytearray(6)
+		self.assertEqual(client.read_into(IMU, 0x43, buffer), 6)
+		self.assertEqual(list(buffer), [0x43, 0x44, 0x45, 0x46, 0x47, 0x48])
+
+		self.bus.transactions.clear()
+		blocker = self._queue_blocked()
+		magneto = self.scheduler.submit_read(MAGNETOMETER, 0x03, 2)
+		first = bytearray(2)
+		second = bytearray(2)
+		client.read_many_into(((IMU, 0x3b, first), (IMU, 0x3d, second)))
+		blocker.result()
+		magneto.result()
+		self.assertEqual(list(first) + list(second), [0x3b, 0x3c, 0x3d, 0x3e])
+		self.assertEqual(self.bus.transactions[1:],
+						[('read', IMU, 0x3b, 2), ('read', IMU, 0x3d, 2),
+						('read', MAGNETOMETER, 0x03, 2)])
+		self.assertEqual(self.scheduler.get_statistics()['devices'][IMU]
+						['transactions'], 3)
+
+		with self.assertRaises(OSError):
+			client.read_into(0x42, 0x00, buffer)
+		self.scheduler.stop()
+		with self.assertRaises(Exception):
+			client.read_into(IMU, 0x3b, buffer)
+
+	def test_errors(self):
+		""" Tests failed transactions raise in the submitting thread """
+		self.scheduler.start()
+		with self.assertRaises(OSError):
+			self.scheduler.read(0x42, 0x00)
+		with self.assertRaises(Exception):
+			self.scheduler.read(IMU, 0x00, 33)
+		self.scheduler.stop()
+		with self.assertRaises(Exception):
+			self.scheduler.read(IMU, 0x00)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
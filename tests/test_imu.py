@@ -0,0 +1,122 @@
+import unittest
+import os
+import sys
+import struct
+import array
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.imu as imu
+import autopylot.fakes as fakes
+import autopylot.orientation as orientation
+import autopylot.i2cbus as i2cbus
+import autopylot.calibration as calibration
+
+
+class TestImu(unittest.TestCase):
+	""" Class to test the buffer read path of the MPU-6050 """
+
+	def setUp(self):
+		self.bus = fakes.FakeI2CBus(overhead=0, byte_time=0)
+		self.mpu = fakes.FakeMpu6050()
+		self.bus.attach(self.mpu)
+		self.accel = numpy.zeros(3)
+		self.gyro = numpy.zeros(3)
+
+	def test_config_ranges(self):
+		""" Tests the ranges of the config.ini match the fake (±8g,
+		±2000°/s) """
+		reader = imu.ImuReader(self.bus)
+		self.mpu.set_motion((1.0, -2.0, 9.80665), (100.0, -250.0, 0.5),
+							temperature=30.0)
+		self.assertTrue(reader.read_into(self.accel, self.gyro))
+		numpy.testing.assert_allclose(self.accel, [1.0, -2.0, 9.80665],
+									atol=0.003)
+		numpy.testing.assert_allclose(self.gyro, [100.0, -250.0, 0.5],
+									atol=0.04)
+		self.assertAlmostEqual(reader.temperature, 30.0, places=2)
+		self.assertEqual(self.bus.transactions, [('read', 0x68, 0x3b, 14)])
+
+	def test_ranges(self):
+		""" Tests the scales of the other ranges and the range registers """
+		reader = imu.ImuReader(self.bus, accel_full_scale=2,
+							gyro_full_scale=250)
+		reader.configure()
+		self.assertEqual(self.mpu.registers[imu.ACCEL_CONFIG], 0x00)
+		self.assertEqual(self.mpu.registers[imu.GYRO_CONFIG], 0x00)
+		self.mpu.registers[0x3b:0x49] = struct.pack('>7h', 16384, -8192, 0,
+													0, 131, -262, 13100)
+		reader.read_into(self.accel, self.gyro)
+		numpy.testing.assert_allclose(self.accel, [9.80665, -4.903325, 0])
+		numpy.testing.assert_allclose(self.gyro, [1, -2, 100])
+		with self.assertRaises(Exception):
+			imu.ImuReader(self.bus, accel_full_scale=3)
+
+	def test_calibration(self):
+		""" Tests the calibration is applied like Calibration.correct_* """
+		cal = calibration.ImuCalibration(gyro_bias=(1, -2, 0.5),
+										accel_offset=(0.1, 0, -0.2),
+										accel_scale=(1.01, 0.99, 1))
+		reader = imu.ImuReader(self.bus)
+		reader.use_calibration(cal)
+		self.mpu.set_motion((1.0, -2.0, 9.0), (10.0, 20.0, -30.0))
+		reader.read_into(self.accel, self.gyro)
+		reader.use_calibration(None)
+		raw_accel = numpy.zeros(3)
+		raw_gyro = numpy.zeros(3)
+		reader.decode_into(raw_accel, raw_gyro)
+		numpy.testing.assert_allclose(self.accel, cal.correct_accel(raw_accel))
+		numpy.testing.assert_allclose(self.gyro, cal.correct_gyro(raw_gyro))
+
+	def test_mounting(self):
+		""" Tests the sample is read in the body frame """
+		reader = imu.ImuReader(self.bus,
+							mounting=orientation.mounting_matrix('+x', '-y'))
+		self.mpu.set_motion((1.0, -2.0, 9.80665), (100.0, -250.0, 0.5))
+		reader.read_into(self.accel, self.gyro)
+		numpy.testing.assert_allclose(self.accel, [2.0, 1.0, 9.80665],
+									atol=0.003)
+		numpy.testing.assert_allclose(self.gyro, [250.0, 100.0, 0.5],
+									atol=0.04)
+
+	def test_duplicate(self):
+		""" Tests unchanged registers are reported as duplicate """
+		reader = imu.ImuReader(self.bus)
+		self.assertTrue(reader.read_into(self.accel, self.gyro))
+		self.assertFalse(reader.read_into(self.accel, self.gyro))
+		self.mpu.set_motion((0, 0, 9), (1, 0, 0))
+		self.assertTrue(reader.read_into(self.accel, self.gyro))
+		self.assertEqual(reader.duplicates, 1)
+
+	def test_scheduled_bus(self):
+		""" Tests reading through the scheduler proxy (its read_into) and an
+		array.array as output """
+		scheduler = i2cbus.BusScheduler(self.bus)
+		scheduler.start(thread=False)
+		reader = imu.ImuReader(scheduler.client(i2cbus.PRIORITY_IMU))
+		values = array.array('d', [0.0] * 6)
+		accel = numpy.frombuffer(values, dtype=numpy.float64)[0:3]
+		gyro = numpy.frombuffer(values, dtype=numpy.float64)[3:6]
+		self.mpu.set_motion((0, 0, 9.80665), (0, 0, 90))
+		reader.read_into(accel, gyro)
+		self.assertAlmostEqual(values[2], 9.80665, places=2)
+		self.assertAlmostEqual(values[5], 90, places=1)
+
+	def test_benchmark(self):
+		""" Tests the buffer path (bus read included) keeps nothing per
+		sample - the transient memory is the counters of the scheduler
+		(ints, not tracked by the garbage collector) """
+		result = imu.benchmark(2000)
+		self.assertLess(result['buffer']['blocks'], 0.05)
+		self.assertLessEqual(result['buffer']['peak'], 64)
+		self.assertGreater(result['dict']['blocks'], 5)
+		self.assertGreater(result['dict']['peak'], 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
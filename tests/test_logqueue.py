@@ -0,0 +1,129 @@
+import unittest
+import os
+import sys
+import time
+import queue
+import logging
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.logqueue as logqueue
+
+
+class ListHandler(logging.Handler):
+	""" Keeps the formatted messages - optionally slow like an SD card """
+
+	def __init__(self, delay=0):
+		super().__init__()
+		self.delay = delay
+		self.messages = []
+
+	def emit(self, record):
+		time.sleep(self.delay)
+		self.messages.append(self.format(record))
+
+
+class TestLogQueue(unittest.TestCase):
+	""" Class to test the queued log writer """
+
+	def setUp(self):
+		self.queue = queue.Queue(100)
+		self.queue_handler = logqueue.BoundedQueueHandler(self.queue)
+		self.logger = logging.getLogger('test_logqueue')
+		self.logger.propagate = False
+		self.logger.setLevel(logging.DEBUG)
+		self.logger.addHandler(self.queue_handler)
+		self.handler = ListHandler()
+
+	def tearDown(self):
+		self.logger.removeHandler(self.queue_handler)
+
+	def _writer(self, window=1.0):
+		return logqueue.LogWriter(self.queue, [self.handler], window,
+								self.queue_handler)
+
+	def test_collapse(self):
+		""" Tests a burst of identical messages is summed up """
+		writer = self._writer()
+		writer.start()
+		for _ in range(50):
+			self.logger.warning("timeout on pin %s", 4)
+		self.logger.warning("timeout on pin %s", 17)
+		writer.stop()
+		self.assertEqual(self.handler.messages,
+						["timeout on pin 4", "last message repeated 49 times",
+						"timeout on pin 17"])
+		self.assertEqual(writer.statistics['collapsed'], 49)
+
+	def test_window(self):
+		""" Tests the summary is written once the burst is over - even
+		without a new message """
+		writer = self._writer(window=0.05)
+		writer.start()
+		for _ in range(3):
+			self.logger.info("same")
+		time.sleep(0.3)
+		messages = list(self.handler.messages)
+		self.logger.info("same")
+		writer.stop()
+		self.assertEqual(messages, ["same", "last message repeated 2 times"])
+		self.assertEqual(self.handler.messages[-1], "same")
+
+	def test_continuous_burst(self):
+		""" Tests a burst longer than the window is summed up once per
+		window while it lasts """
+		writer = self._writer(window=0.25)
+		for index in range(101):
+			record = self.logger.makeRecord('test_logqueue', logging.WARNING,
+											__file__, 1, "burst", None, None)
+			record.created = index / 100
+			writer.handle(record)
+		self.assertEqual(self.handler.messages,
+						["burst"] + ["last message repeated 25 times"] * 4)
+		# nothing left over when the burst ends
+		writer._flush_repeats()
+		self.assertEqual(len(self.handler.messages), 5)
+
+	def test_overflow(self):
+		""" Tests a full queue drops (and counts) instead of blocking """
+		start = time.monotonic()
+		for index in range(150):
+			self.logger.debug("record %s", index)
+		self.assertLess(time.monotonic() - start, 0.5)
+		self.assertEqual(self.queue_handler.dropped, 50)
+		writer = self._writer()
+		writer.start()
+		writer.stop()
+		self.assertEqual(len(self.handler.messages), 101)
+		self.assertIn("50 log records dropped (the log queue was full)",
+					self.handler.messages)
+
+	def test_slow_handler(self):
+		""" Tests logging does not wait for a slow handler """
+		self.handler.delay = 0.01
+		writer = self._writer()
+		writer.start()
+		start = time.monotonic()
+		for index in range(20):
+			self.logger.info("record %s", index)
+		elapsed = time.monotonic() - start
+		writer.stop(timeout=2)
+		self.assertLess(elapsed, 0.1)
+		self.assertEqual(len(self.handler.messages), 20)
+
+	def test_exception(self):
+		""" Tests the traceback is rendered before the record is queued """
+		try:
+			raise ValueError("broken")
+		except ValueError:
+			self.logger.exception("failed")
+		record = self.queue.get_nowait()
+		self.assertIsNone(record.exc_info)
+		self.assertIn("ValueError: broken", record.exc_text)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,78 @@
+import unittest
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.orientation as orientation
+import autopylot.calibration as calibration
+
+
+class TestOrientation(unittest.TestCase):
+	""" Class to test the mounting matrix and the fused transforms """
+
+	def test_default_mounting(self):
+		""" Tests the config.ini mounting (+y / +x) is the identity """
+		numpy.testing.assert_array_equal(
+			orientation.mounting_matrix('+y', '+x'), numpy.eye(3))
+		numpy.testing.assert_array_equal(
+			autopylot.config.get_gyrosensor_mounting(), numpy.eye(3))
+
+	def test_rotated_mounting(self):
+		""" Tests a sensor turned by 90° (x to the front) and one mounted
+		upside down """
+		matrix = orientation.mounting_matrix('+x', '-y')
+		self.assertTrue(orientation.is_rotation(matrix))
+		# the sensor measures a tilt front on x, a tilt left on -y
+		numpy.testing.assert_array_equal(matrix @ [0, -1, 0], [1, 0, 0])
+		numpy.testing.assert_array_equal(matrix @ [1, 0, 0], [0, 1, 0])
+		numpy.testing.assert_array_equal(matrix @ [0, 0, 1], [0, 0, 1])
+		upside_down = orientation.mounting_matrix('-y', '+x')
+		numpy.testing.assert_array_equal(upside_down @ [0, 0, 9.81],
+										[0, 0, -9.81])
+
+	def test_invalid_mounting(self):
+		""" Tests two settings along the same axis are rejected """
+		for front, left in (('+x', '+x'), ('+y', '-y'), ('+z', '+q')):
+			with self.assertRaises(Exception):
+				orientation.mounting_matrix(front, left)
+		self.assertFalse(orientation.is_rotation(numpy.diag([1, 1, -1])))
+
+	def test_fused_transform(self):
+		""" Tests the fused transform equals calibration then rotation -
+		for a block and for a single vector """
+		cal = calibration.ImuCalibration(gyro_bias=(1, -2, 0.5),
+										accel_offset=(0.1, 0, -0.2),
+										accel_scale=(1.01, 0.99, 1.02))
+		matrix = orientation.mounting_matrix('-x', '+z')
+		raw = numpy.random.default_rng(1).normal(size=(50, 3)) * 100
+		expected_accel = numpy.array([matrix @ cal.correct_accel(row * 0.5)
+									for row in raw])
+		expected_gyro = numpy.array([matrix @ cal.correct_gyro(row)
+									for row in raw])
+		accel = orientation.accel_transform(matrix, cal, factor=0.5)
+		gyro = orientation.gyro_transform(matrix, cal)
+		numpy.testing.assert_allclose(accel.apply(raw), expected_accel)
+		numpy.testing.assert_allclose(gyro.apply(raw), expected_gyro)
+		out = numpy.empty(3)
+		self.assertIs(gyro.apply(raw[7], out), out)
+		numpy.testing.assert_allclose(out, expected_gyro[7])
+
+	def test_band_and_quaternion(self):
+		""" Tests the noise bands keep min <= max and the quaternion axis
+		is rotated """
+		matrix = orientation.mounting_matrix('+x', '-y')
+		band = orientation.rotate_band(matrix, [[-1, -2, -3], [4, 5, 6]])
+		numpy.testing.assert_array_equal(band, [[-5, -1, -3], [2, 4, 6]])
+		# a pure roll of the sensor (about its -y) is a roll of the body
+		w, x, y, z = orientation.rotate_quaternion(matrix, (0.9, 0, -0.1, 0))
+		self.assertEqual((w, x, y, z), (0.9, 0.1, 0.0, 0.0))
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
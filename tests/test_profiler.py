@@ -0,0 +1,107 @@
+import unittest
+import os
+import sys
+import time
+import socket
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.profiler as profiler
+
+
+def busy_leaf(stop):
+	while not stop.is_set():
+		sum(range(100))
+
+
+def busy_root(stop):
+	busy_leaf(stop)
+
+
+class TestSamplingProfiler(unittest.TestCase):
+	""" Class to test the sampling profiler and its control socket """
+
+	def setUp(self):
+		self.stop = threading.Event()
+		self.worker = threading.Thread(target=busy_root, args=(self.stop,),
+									name='control', daemon=True)
+		self.worker.start()
+		self.directory = tempfile.TemporaryDirectory()
+		self.profiler = profiler.SamplingProfiler(rate=200)
+
+	def tearDown(self):
+		self.profiler.stop()
+		self.stop.set()
+		self.worker.join()
+		self.directory.cleanup()
+
+	def test_collapsed_stacks(self):
+		""" Tests the stacks are counted root first per thread """
+		for _ in range(5):
+			self.profiler.sample()
+		lines = self.profiler.collapsed().splitlines()
+		worker = [line.rsplit(' ', 1) for line in lines
+				if line.startswith('control;')]
+		# the worker may be caught in Event.is_set (one more frame)
+		self.assertEqual(sum(int(count) for _, count in worker), 5)
+		for stack, _ in worker:
+			self.assertIn('test_profiler.busy_root;test_profiler.busy_leaf',
+						stack)
+
+	def test_thread_filter(self):
+		""" Tests only the named threads are sampled """
+		self.profiler = profiler.SamplingProfiler(threads=['control'])
+		self.profiler.sample()
+		lines = self.profiler.collapsed().splitlines()
+		self.assertEqual(len(lines), 1)
+		self.assertTrue(lines[0].startswith('control;'))
+
+	def test_toggle(self):
+		""" Tests start / stop at runtime and the measured overhead """
+		self.assertTrue(self.profiler.toggle())
+		time.sleep(0.2)
+		self.assertFalse(self.profiler.toggle())
+		statistics = self.profiler.get_statistics()
+		self.assertGreater(statistics['samples'], 5)
+		self.assertLess(statistics['overhead'], 0.25)
+		samples = statistics['samples']
+		time.sleep(0.05)
+		self.assertEqual(self.profiler.get_statistics()['samples'], samples)
+		self.profiler.reset()
+		self.assertEqual(self.profiler.collapsed(), "")
+
+	def test_control_socket(self):
+		""" Tests the commands of the control socket """
+		path = os.path.join(self.directory.name, 'control')
+		output = os.path.join(self.directory.name, 'profile.folded')
+		server = profiler.ControlServer(self.profiler, path, output)
+		server.start()
+
+		def send(command):
+			client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			client.connect(path)
+			client.sendall((command + "\n").encode())
+			reply = client.makefile().readline().strip()
+			client.close()
+			return reply
+
+		try:
+			self.assertTrue(send('start').startswith('ok running=True'))
+			time.sleep(0.1)
+			self.assertTrue(send('stop').startswith('ok running=False'))
+			self.assertEqual(send('dump'), 'ok ' + output)
+			with open(output) as profile:
+				self.assertIn('busy_leaf', profile.read())
+			self.assertTrue(send('foo').startswith('error'))
+		finally:
+			server.stop()
+		self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,125 @@
+import unittest
+import os
+import sys
+import gc
+import weakref
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.realtime as realtime
+
+
+class Node():
+	""" Part of a reference cycle """
+
+	def __init__(self):
+		self.other = self
+
+
+def make_cycles(count):
+	""" Creates count unreachable cycles - returns a weak reference to the
+	last one """
+	for _ in range(count):
+		node = Node()
+	return weakref.ref(node)
+
+
+class TestRealtimeMode(unittest.TestCase):
+	""" Class to test the frozen heap and the idle collections """
+
+	def setUp(self):
+		self.mode = realtime.RealtimeMode(budget=0.001, force_limit=100000)
+
+	def tearDown(self):
+		self.mode.leave()
+
+	def test_enter_leave(self):
+		""" Tests the automatic collection is off while in the mode """
+		self.assertTrue(gc.isenabled())
+		with self.mode:
+			self.assertFalse(gc.isenabled())
+			self.assertGreater(gc.get_freeze_count(), 0)
+			self.assertGreater(self.mode.statistics['frozen'], 0)
+		self.assertTrue(gc.isenabled())
+		self.assertEqual(gc.get_freeze_count(), 0)
+
+	def test_idle_slot(self):
+		""" Tests a due collection waits for a slot which is long enough """
+		self.mode.enter()
+		self.assertIsNone(self.mode.due_generation())
+		cycle = make_cycles(gc.get_threshold()[0] + 10)
+		self.assertIsNotNone(cycle())
+		self.assertIsNotNone(self.mode.due_generation())
+		self.assertFalse(self.mode.idle(0.0001))
+		self.assertEqual(self.mode.statistics['deferred'], 1)
+		self.assertIsNotNone(cycle())
+		self.assertTrue(self.mode.idle(0.01))
+		self.assertIsNone(cycle())
+		self.assertEqual(sum(self.mode.statistics['collections']), 1)
+
+	def test_forced(self):
+		""" Tests the youngest generation is collected without a slot once
+		the limit is reached """
+		self.mode.force_limit = 500
+		self.mode.enter()
+		cycle = make_cycles(1000)
+		self.assertTrue(self.mode.idle(0))
+		self.assertIsNone(cycle())
+		self.assertEqual(self.mode.statistics['forced'], 1)
+		self.assertEqual(self.mode.statistics['collections'][0], 1)
+
+	def test_inactive(self):
+		""" Tests idle does nothing outside the mode """
+		make_cycles(1000)
+		self.assertFalse(self.mode.idle(1.0))
+
+
+class TestAudit(unittest.TestCase):
+	""" Class to test the allocation audit and the latency measurement """
+
+	def test_audit(self):
+		""" Tests a growing list is flagged, in place math is not """
+		kept = []
+		values = numpy.zeros(3)
+		factors = numpy.ones(3)
+
+		def leaking():
+			kept.append([len(kept)])
+
+		def in_place():
+			numpy.multiply(values, factors, values)
+		report = realtime.audit({'leaking': leaking, 'in place': in_place},
+								ticks=500, warmup=10)
+		self.assertTrue(report['leaking']['flagged'])
+		self.assertGreaterEqual(report['leaking']['blocks'], 1)
+		self.assertIn(__file__, report['leaking']['sites'][0][0])
+		self.assertFalse(report['in place']['flagged'])
+		self.assertEqual(report['in place']['blocks'], 0)
+
+	def test_fake_stages(self):
+		""" Tests the stages of the fake control tick run """
+		report = realtime.audit(realtime.fake_stages(), ticks=100, warmup=20)
+		self.assertEqual(set(report), {'sensor read', 'estimator',
+										'motor output'})
+		self.assertLess(report['sensor read']['blocks'], 0.05)
+
+	def test_measure_latency(self):
+		""" Tests the tick latency with and without the mode """
+		def tick():
+			make_cycles(50)
+		mode = realtime.RealtimeMode(budget=0.0001)
+		result = realtime.measure_latency(tick, 1000, 100, mode)
+		self.assertLessEqual(result['p50'], result['max'])
+		self.assertGreater(sum(result['statistics']['collections']), 0)
+		self.assertTrue(gc.isenabled())
+		self.assertNotIn('statistics',
+						realtime.measure_latency(tick, 1000, 10))
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
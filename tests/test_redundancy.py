@@ -0,0 +1,190 @@
+import unittest
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.clock as clock
+import autopylot.fakes as fakes
+import autopylot.i2cbus as i2cbus
+import autopylot.realtime as realtime
+import autopylot.redundancy as redundancy
+
+GRAVITY = 9.80665
+
+
+class TestRedundantImu(unittest.TestCase):
+	""" Class to test the fusion and isolation of redundant IMUs """
+
+	def setUp(self):
+		self.bus = fakes.FakeI2CBus(overhead=0, byte_time=0)
+		self.accel = numpy.zeros(3)
+		self.gyro = numpy.zeros(3)
+
+	def _imu(self, count, **limits):
+		_, self.sensors, readers = redundancy.fake_imus(count, self.bus)
+		return redundancy.RedundantImu(readers, **limits)
+
+	def _run(self, imu, samples, offsets=None, frozen=()):
+		""" Moves the sensors (a new sample each, offsets (°/s) added to the
+		gyro per sensor) and reads - returns the results of read_into """
+		results = []
+		for step in range(samples):
+			rate = 10.0 + step % 7
+			for index, sensor in enumerate(self.sensors):
+				if index in frozen:
+					continue
+				offset = 0.0 if offsets is None else offsets[index]
+				sensor.set_motion((0.1, -0.2, GRAVITY),
+								(rate + offset, -rate, 2.0), 25 + step * 0.01)
+			results.append(imu.read_into(self.accel, self.gyro))
+		self.expected = [rate, -rate, 2.0]
+		return results
+
+	def test_fusion(self):
+		""" Tests consistent IMUs are fused into the same sample """
+		imu = self._imu(3)
+		self.assertTrue(all(self._run(imu, 20)))
+		numpy.testing.assert_allclose(self.accel, [0.1, -0.2, GRAVITY],
+									atol=0.003)
+		numpy.testing.assert_allclose(self.gyro, self.expected, atol=0.07)
+		statistics = imu.get_statistics()
+		self.assertEqual(statistics['active'], 3)
+		self.assertEqual(statistics['imus']['0x69']['accepted'], 20)
+		self.assertEqual(sum(statistics['imus']['0x6a']['rejected'].values()),
+						0)
+		# one combined transfer per sample
+		self.assertEqual(len(self.bus.transactions), 3 * 20)
+
+	def test_disagree(self):
+		""" Tests an IMU off the vote is rejected, then isolated - and used
+		again once it agrees for recover_limit samples """
+		imu = self._imu(3, isolate_limit=5, recover_limit=30)
+		self._run(imu, 20, offsets=[0, 100.0, 0])
+		numpy.testing.assert_allclose(self.gyro, self.expected, atol=0.07)
+		health = imu.get_statistics()['imus']['0x69']
+		self.assertTrue(health['isolated'])
+		self.assertEqual(health['isolations'], 1)
+		self.assertEqual(health['rejected']['disagree'], 20)
+		self.assertEqual(health['accepted'], 0)
+		self.assertEqual(imu.active, 2)
+		self._run(imu, 29)
+		self.assertTrue(imu.health[1].isolated)
+		self._run(imu, 1)
+		self.assertFalse(imu.health[1].isolated)
+		self.assertEqual(imu.health[1].recoveries, 1)
+
+	def test_two_imus(self):
+		""" Tests the last fused sample breaks the tie of two IMUs - the one
+		which jumps away is rejected """
+		imu = self._imu(2, isolate_limit=3)
+		self._run(imu, 5)
+		self._run(imu, 10, offsets=[0, -80.0])
+		numpy.testing.assert_allclose(self.gyro, self.expected, atol=0.07)
+		self.assertTrue(imu.health[1].isolated)
+		self.assertFalse(imu.health[0].isolated)
+		self.assertEqual(imu.health[0].rejected['disagree'], 0)
+
+	def test_stuck(self):
+		""" Tests an IMU which does not update its registers is isolated
+		after stuck_limit samples """
+		imu = self._imu(2, stuck_limit=10)
+		self._run(imu, 5)
+		self.assertTrue(all(self._run(imu, 15, frozen=(0,))))
+		health = imu.health[0]
+		self.assertTrue(health.isolated)
+		self.assertEqual(health.rejected['stale'], 15)
+		self.assertEqual(imu.get_statistics()['imus']['0x69']['accepted'], 20)
+
+	def test_errors(self):
+		""" Tests a failing and a reset IMU are rejected - the others are
+		still read """
+		imu = self._imu(3, isolate_limit=100)
+		self._run(imu, 3)
+		sensor = self.bus.devices.pop(0x68)
+		self.sensors[2].registers[0x3b:0x49] = b'\xff' * 14
+		self.assertTrue(all(self._run(imu, 4, frozen=(2,))))
+		numpy.testing.assert_allclose(self.gyro, self.expected, atol=0.07)
+		self.assertEqual(imu.health[0].rejected['error'], 4)
+		self.assertEqual(imu.health[2].rejected['invalid'], 4)
+		self.assertEqual(imu.health[1].accepted, 7)
+		self.bus.attach(sensor)
+		self._run(imu, 2)
+		self.assertEqual(imu.health[0].accepted, 5)
+		# all gone
+		self.bus.devices.clear()
+		self.assertFalse(imu.read_into(self.accel, self.gyro))
+		self.assertEqual(imu.empty, 1)
+
+	def test_degraded(self):
+		""" Tests the consistent isolated IMUs are used if no IMU is left in
+		use - and the closest one is kept if all disagree """
+		imu = self._imu(2, isolate_limit=2)
+		self._run(imu, 3)
+		# both move away from the last sample in different directions
+		results = self._run(imu, 4, offsets=[60.0, -90.0])
+		self.assertTrue(all(results))
+		numpy.testing.assert_allclose(
+			self.gyro, [self.expected[0] + 60.0, -13.0, 2.0], atol=0.07)
+		self.assertEqual(imu.active, 1)
+		self.assertGreater(imu.degraded, 0)
+
+	def test_read_cost(self):
+		""" Tests reading two IMUs in one transfer costs less than two single
+		reads (the call overhead once) """
+		previous = clock.set_clock(clock.VirtualClock())
+		try:
+			self.bus = fakes.FakeI2CBus(call_overhead=100e-6)
+			imu = self._imu(2)
+			reader = imu.readers[0]
+			single = redundancy.measure_read(
+				lambda: reader.read_into(self.accel, self.gyro), 10)
+			both = redundancy.measure_read(
+				lambda: imu.read_into(self.accel, self.gyro), 10)
+		finally:
+			clock.set_clock(previous)
+		self.assertAlmostEqual(single, 100e-6 + 60e-6 + 14 * 22.5e-6)
+		self.assertAlmostEqual(both, 100e-6 + 2 * (60e-6 + 14 * 22.5e-6))
+		self.assertLess(both, 2 * single)
+
+	def test_scheduler(self):
+		""" Tests the IMUs are read through the bus scheduler - all of them
+		in one request (one transfer per sample) """
+		scheduler = i2cbus.BusScheduler(self.bus)
+		scheduler.start(thread=False)
+		_, self.sensors, readers = redundancy.fake_imus(2, self.bus)
+		client = scheduler.client(i2cbus.PRIORITY_IMU)
+		for reader in readers:
+			reader.bus = client
+		imu = redundancy.RedundantImu(readers)
+		self.assertTrue(all(self._run(imu, 5)))
+		numpy.testing.assert_allclose(self.gyro, self.expected, atol=0.07)
+		self.assertEqual(scheduler.transfers, 5)
+		self.assertEqual(len(self.bus.transactions), 10)
+		scheduler.stop()
+
+	def test_allocations(self):
+		""" Tests the checks and the fusion keep no objects per sample (the
+		counters above 256 are new ints - a few blocks in total) """
+		self.bus = fakes.FakeI2CBus(overhead=0, byte_time=0, history=16)
+		imu = self._imu(3)
+		rates = [10.0, 11.0]
+
+		def read():
+			rates.reverse()
+			for sensor in self.sensors:
+				sensor.set_motion((0, 0, GRAVITY), (rates[0], 0, 0))
+			imu.read_into(self.accel, self.gyro)
+		report = realtime.audit({'read': read}, ticks=1000, warmup=10)
+		self.assertLess(report['read']['blocks'], 0.02)
+		self.assertEqual(imu.get_statistics()['imus']['0x6a']['accepted'],
+						1010)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,266 @@
+import unittest
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.remote as remote
+
+
+class RecordingQuadcopter():
+	""" Records the calls of the RemotePilot (the quadcopter interface
+	without motors) """
+
+	def __init__(self):
+		self.motors = [None] * 4
+		self.turned_on = False
+		self.failsafe_tripped = False
+		self.throttle = 0
+		self.calls = []
+
+	def turn_on(self):
+		self.calls.append('turn_on')
+		self.turned_on = True
+		self.failsafe_tripped = False
+
+	def turn_off(self):
+		self.calls.append('turn_off')
+		self.turned_on = False
+		self.throttle = 0
+
+	def heartbeat(self):
+		pass
+
+	def hover(self):
+		self.calls.append('hover')
+
+	def request_total_throttle(self):
+		return self.throttle * len(self.motors)
+
+	def change_overall_throttle(self, throttle):
+		self.throttle = throttle
+
+	def change_setpoint(self, throttle, roll, pitch, yaw, command=None):
+		self.calls.append(('setpoint', throttle, roll, pitch, yaw))
+		self.throttle = throttle
+
+
+def setpoint(sequence, timestamp=0, throttle=50, armed=True):
+	return remote.Setpoint(sequence, timestamp, throttle, 0, 0, 0, armed)
+
+
+class RecordingRealtime():
+	""" Records the idle slots the RemotePilot offers """
+
+	def __init__(self):
+		self.slots = []
+
+	def idle(self, slack):
+		self.slots.append(slack)
+		return False
+
+
+class TestRemoteProtocol(unittest.TestCase):
+	""" Class to test the datagrams and the latest wins rules """
+
+	def setUp(self):
+		self.receiver = remote.RemoteReceiver(0, '127.0.0.1', link_timeout=0.25,
+											max_age=0.1)
+
+	def tearDown(self):
+		self.receiver.stop()
+
+	def test_encode_decode(self):
+		""" Tests a setpoint survives the round trip (1/100 % resolution) """
+		sent = remote.Setpoint(7, 123456789, 55.5, -12.25, 3, -100, True)
+		data = remote.encode(sent)
+		self.assertEqual(len(data), 24)
+		self.assertEqual(remote.decode(data), sent)
+		with self.assertRaises(Exception):
+			remote.decode(data[:-1])
+		with self.assertRaises(Exception):
+			remote.decode(b'XX' + data[2:])
+		with self.assertRaises(Exception):
+			remote.decode(remote.encode(setpoint(1, throttle=120)))
+
+	def test_sequence_wraparound(self):
+		""" Tests the sequence number comparison across the wrap """
+		self.assertTrue(remote.is_newer(1, 0))
+		self.assertTrue(remote.is_newer(2, 0xffffffff))
+		self.assertFalse(remote.is_newer(0xffffffff, 2))
+		self.assertFalse(remote.is_newer(5, 5))
+
+	def test_latest_wins(self):
+		""" Tests only the newest datagram of a batch is applied and older
+		ones are dropped """
+		datagrams = [remote.encode(setpoint(sequence, 1000000))
+					for sequence in (3, 5, 4)]
+		self.assertTrue(self.receiver.process(datagrams + [b'junk'], 1.0))
+		self.assertEqual(self.receiver.latest().sequence, 5)
+		self.assertFalse(self.receiver.process(
+			[remote.encode(setpoint(4, 1000000))], 1.0))
+		self.assertEqual(self.receiver.latest().sequence, 5)
+		statistics = self.receiver.statistics
+		self.assertEqual(statistics['superseded'], 2)
+		self.assertEqual(statistics['malformed'], 1)
+		self.assertEqual(statistics['outoforder'], 1)
+
+	def test_stale(self):
+		""" Tests a datagram delayed beyond max age is dropped """
+		self.receiver.process([remote.encode(setpoint(1, 0))], 5.0)
+		self.assertTrue(self.receiver.process(
+			[remote.encode(setpoint(2, 100000))], 5.15))
+		self.assertFalse(self.receiver.process(
+			[remote.encode(setpoint(3, 200000))], 5.35))
+		self.assertEqual(self.receiver.statistics['stale'], 1)
+		self.assertEqual(self.receiver.latest().sequence, 2)
+
+	def test_link_loss_and_resync(self):
+		""" Tests the link loss callback and a restarted client """
+		lost = []
+		self.receiver.on_link_lost = lambda: lost.append(True)
+		self.receiver.process([remote.encode(setpoint(100, 0))], 1.0)
+		self.assertTrue(self.receiver.check_link(1.2))
+		self.assertFalse(self.receiver.check_link(1.3))
+		self.assertFalse(self.receiver.check_link(1.4))
+		self.assertEqual(lost, [True])
+		self.assertIsNone(self.receiver.latest())
+		# the client restarted - its sequence and clock start over
+		self.assertTrue(self.receiver.process(
+			[remote.encode(setpoint(1, 0))], 2.0))
+		self.assertEqual(self.receiver.latest().sequence, 1)
+
+	def test_loopback(self):
+		""" Tests the receiver thread and the client over loopback """
+		self.receiver.start()
+		with remote.RemoteClient('127.0.0.1', self.receiver.port) as client:
+			sent = client.send(40, roll=5, pitch=-5, yaw=1)
+			deadline = time.monotonic() + 1
+			while (self.receiver.latest() is None and
+					time.monotonic() < deadline):
+				time.sleep(0.001)
+		self.assertEqual(self.receiver.latest(), sent)
+		time.sleep(0.4)
+		self.assertFalse(self.receiver.link_up)
+		self.assertEqual(self.receiver.statistics['linklosses'], 1)
+
+	def test_benchmark(self):
+		""" Tests the loopback benchmark """
+		result = remote.benchmark(50, interval=0)
+		self.assertGreater(result['received'], 0.9)
+		self.assertLess(result['p50'], 50)
+
+
+class TestRemotePilot(unittest.TestCase):
+	""" Class to test the setpoints are applied and the loss of link
+	actions """
+
+	def setUp(self):
+		self.quadcopter = RecordingQuadcopter()
+		self.receiver = remote.RemoteReceiver(0, '127.0.0.1', link_timeout=0.25,
+											max_age=0.1)
+
+	def tearDown(self):
+		self.receiver.stop()
+
+	def _connect(self, sequence=1, throttle=50, armed=True):
+		self.receiver.process([remote.encode(setpoint(sequence, 0, throttle,
+														armed))], 1.0)
+
+	def test_apply(self):
+		""" Tests arming and that every setpoint is applied once """
+		pilot = remote.RemotePilot(self.quadcopter, self.receiver)
+		self._connect()
+		pilot.step()
+		pilot.step()
+		self.assertEqual(self.quadcopter.calls,
+						['turn_on', ('setpoint', 50, 0, 0, 0)])
+		self._connect(2, armed=False)
+		pilot.step()
+		self.assertFalse(self.quadcopter.turned_on)
+
+	def test_failsafe_rearm(self):
+		""" After a failsafe cutoff armed setpoints must not turn the motors
+		on again - only after a disarmed one """
+		pilot = remote.RemotePilot(self.quadcopter, self.receiver)
+		self._connect(1)
+		pilot.step()
+		# cut off by the failsafe (see Quadcopter._check_failsafe)
+		self.quadcopter.turned_on = False
+		self.quadcopter.failsafe_tripped = True
+		self._connect(2)
+		pilot.step()
+		self.assertFalse(self.quadcopter.turned_on)
+		self.assertEqual(self.quadcopter.calls.count('turn_on'), 1)
+		self._connect(3, armed=False)
+		pilot.step()
+		self._connect(4)
+		pilot.step()
+		self.assertTrue(self.quadcopter.turned_on)
+		self.assertEqual(self.quadcopter.calls[-2:],
+						['turn_on', ('setpoint', 50, 0, 0, 0)])
+
+	def test_land(self):
+		""" Tests landing lowers the throttle until the motors are off """
+		pilot = remote.RemotePilot(self.quadcopter, self.receiver, 'land',
+								rate=10, land_rate=100)
+		self._connect(throttle=30)
+		pilot.step()
+		self.receiver.check_link(2.0)
+		pilot.step()
+		self.assertEqual(self.quadcopter.calls[-1], 'hover')
+		pilot.step()
+		self.assertAlmostEqual(self.quadcopter.throttle, 20)
+		pilot.step()
+		pilot.step()
+		self.assertEqual(self.quadcopter.calls[-1], 'turn_off')
+		self.assertFalse(self.quadcopter.turned_on)
+
+	def test_hover_and_disarm(self):
+		""" Tests the hover and the disarm action """
+		pilot = remote.RemotePilot(self.quadcopter, self.receiver, 'hover')
+		self._connect()
+		pilot.step()
+		self.receiver.check_link(2.0)
+		for _ in range(3):
+			pilot.step()
+		self.assertEqual(self.quadcopter.calls.count('hover'), 1)
+		self.assertTrue(self.quadcopter.turned_on)
+		pilot.action = 'disarm'
+		self._connect(2)
+		pilot.step()
+		self.receiver.check_link(3.0)
+		pilot.step()
+		self.assertFalse(self.quadcopter.turned_on)
+		with self.assertRaises(Exception):
+			remote.RemotePilot(self.quadcopter, self.receiver, 'loop')
+
+	def test_run(self):
+		""" Tests the pilot loop over loopback """
+		realtime = RecordingRealtime()
+		pilot = remote.RemotePilot(self.quadcopter, self.receiver, rate=200,
+								realtime=realtime)
+		stop = threading.Event()
+		thread = threading.Thread(target=pilot.run, args=(stop,))
+		self.receiver.start()
+		thread.start()
+		try:
+			with remote.RemoteClient('127.0.0.1', self.receiver.port) as client:
+				client.send(60, pitch=10)
+				time.sleep(0.1)
+		finally:
+			stop.set()
+			thread.join()
+		self.assertIn(('setpoint', 60, 0, 10, 0), self.quadcopter.calls)
+		# the slack until the next tick is offered to the collector
+		self.assertGreater(len(realtime.slots), 5)
+		self.assertLessEqual(max(realtime.slots), 0.005)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
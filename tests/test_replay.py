@@ -0,0 +1,180 @@
+import unittest
+import os
+import sys
+import tempfile
+import threading
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.config as config
+import autopylot.estimation as estimation
+import autopylot.calibration as calibration
+import autopylot.replay as replay
+
+
+def _random_samples(count, seed=0):
+	""" Returns random (accel, rotation) dict lists - the first 100 samples
+	are small (sensor at rest) """
+	generator = numpy.random.RandomState(seed)
+	values = generator.normal(0, 1, (count, 6))
+	values[:estimation.SAMPLE_COUNT] *= 0.1
+	return [(dict(zip('xyz', row[:3])), dict(zip('xyz', row[3:])))
+			for row in values.tolist()]
+
+
+class TestEstimation(unittest.TestCase):
+	""" Class to test the motion estimator """
+
+	def test_setup_dead_zone(self):
+		""" The dead zone should be the min / max values widened by 20% """
+		samples = numpy.array([[-1.0, 1.0, -2.0], [1.0, 2.0, -1.0]])
+		dead_zone = estimation.setup_dead_zone(samples)
+		numpy.testing.assert_allclose(dead_zone, [[-1.2, 0.8, -2.4],
+												[1.2, 2.4, -0.8]])
+
+	def test_create_estimator_dmp(self):
+		""" The default filters should be fitted to the DMP rate (200Hz) """
+		gyro = dict(config.config['GYRO'])
+		spec = config.config['FILTER']['gyro']
+		config.config['GYRO']['mode'] = 'dmp'
+		config.config['GYRO']['samplerate'] = '200'
+		config.config['FILTER']['gyro'] = 'dynnotch:150 lowpass:100'
+		try:
+			with self.assertLogs(level='WARNING'):
+				estimator = estimation.create_estimator()
+		finally:
+			config.config['GYRO'].update(gyro)
+			config.config['FILTER']['gyro'] = spec
+		self.assertEqual(len(estimator.rotation_filters), 0)
+		self.assertEqual(len(estimator.accel_filters), 1)
+		estimator.process_block(numpy.zeros((200, 3)), numpy.zeros((200, 3)))
+
+	def test_calibration_samples_are_not_integrated(self):
+		""" The first SAMPLE_COUNT samples only set up the dead zone """
+		estimator = estimation.MotionEstimator()
+		for accel, rotation in _random_samples(estimation.SAMPLE_COUNT):
+			estimator.update(accel, rotation)
+		self.assertTrue(estimator.calibrated)
+		self.assertEqual(estimator.get_tilt(), {'x': 0, 'y': 0, 'z': 0})
+
+	def test_block_equals_single_samples(self):
+		""" Processing blocks must give exactly the same result as processing
+		one sample after another """
+		samples = _random_samples(1000)
+		single = estimation.MotionEstimator()
+		for accel, rotation in samples:
+			single.update(accel, rotation)
+
+		accel = numpy.array([[a['x'], a['y'], a['z']] for a, _ in samples])
+		rotation = numpy.array([[r['x'], r['y'], r['z']] for _, r in samples])
+		block = estimation.MotionEstimator()
+		for start in range(0, 1000, 333):
+			block.process_block(accel[start:start + 333],
+								rotation[start:start + 333])
+
+		self.assertEqual(single.get_tilt(), block.get_tilt())
+		self.assertEqual(single.get_distance(), block.get_distance())
+
+
+class TestReplay(unittest.TestCase):
+	""" Class to test the flight recorder and the replay engine """
+
+	def setUp(self):
+		self.recorder = replay.FlightRecorder(capacity=16)
+		imu_calibration = calibration.ImuCalibration(
+			accel_band=[[-0.1, -0.1, -0.1], [0.1, 0.1, 0.1]],
+			gyro_band=[[-0.2, -0.1, -0.3], [0.2, 0.1, 0.3]])
+		estimator = estimation.create_estimator()
+		estimator.use_calibration(imu_calibration)
+		self.recorder.record_calibration(imu_calibration)
+		for index, (accel, rotation) in enumerate(_random_samples(500)):
+			estimator.update(accel, rotation)
+			self.recorder.record_sample(accel, rotation, estimator.get_tilt(),
+										estimator.get_distance())
+			if index % 100 == 0:
+				self.recorder.record_motor_command(4, index / 10)
+				self.recorder.record_motor_command(17, index / 20)
+
+	def test_record(self):
+		""" Tests the recorder grows and keeps all rows """
+		recording = self.recorder.get_recording()
+		self.assertEqual(len(recording), 500)
+		self.assertEqual(recording.pins, [4, 17])
+		self.assertTrue(numpy.all(numpy.diff(recording.timestamps) >= 0))
+
+	def test_concurrent_record(self):
+		""" Rows appended by several threads while the table grows must all
+		be kept """
+		recorder = replay.FlightRecorder(capacity=1)
+
+		def record(pin):
+			for index in range(2000):
+				recorder.record_motor_command(pin, index)
+
+		threads = [threading.Thread(target=record, args=(pin,))
+				for pin in (4, 17, 27, 22)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		recording = recorder.get_recording()
+		self.assertEqual(len(recording.motors), 8000)
+		for pin in (4, 17, 27, 22):
+			throttle = recording.motors[recording.motors[:, 1] == pin, 2]
+			numpy.testing.assert_array_equal(throttle, numpy.arange(2000))
+
+	def test_save_load(self):
+		""" Tests writing and reading back a recording """
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, 'flight.npz')
+			self.recorder.save(filename)
+			loaded = replay.FlightRecording.load(filename)
+		recording = self.recorder.get_recording()
+		numpy.testing.assert_array_equal(loaded.samples, recording.samples)
+		numpy.testing.assert_array_equal(loaded.motors, recording.motors)
+		numpy.testing.assert_array_equal(loaded.accel_band,
+										recording.accel_band)
+		numpy.testing.assert_array_equal(loaded.gyro_band, recording.gyro_band)
+
+	def test_replay_matches_recording(self):
+		""" Replaying with the same estimator should reproduce the flight """
+		recording = self.recorder.get_recording()
+		engine = replay.ReplayEngine(block_size=64)
+		report = engine.run(recording)
+		self.assertEqual(report.samples, 500)
+		self.assertTrue(report.matches)
+		self.assertGreater(report.samples_per_second, 0)
+
+	def test_replay_needs_calibration(self):
+		""" Without the recorded calibration the replayed estimator sets up
+		its dead zones from the first samples - and differs """
+		recording = self.recorder.get_recording()
+		uncalibrated = replay.FlightRecording(recording.samples,
+											recording.motors)
+		self.assertIsNone(uncalibrated.calibration)
+		report = replay.ReplayEngine().run(uncalibrated)
+		self.assertFalse(report.matches)
+
+	def test_replay_detects_changes(self):
+		""" A changed estimator and controller should be reported """
+		recording = self.recorder.get_recording()
+
+		def controller(timestamps, tilt, distance):
+			return recording.motor_throttle_at(timestamps) + 1
+
+		engine = replay.ReplayEngine(
+			estimator_factory=lambda: estimation.MotionEstimator(
+				dead_zone_blur=0.0),
+			controller=controller)
+		report = engine.run(recording)
+		self.assertFalse(report.matches)
+		numpy.testing.assert_array_equal(report.motor_error, [1, 1])
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
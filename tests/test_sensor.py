@@ -2,35 +2,154 @@ import unittest
 import os
 import sys
 
+import numpy
+
 sys.path.insert(0, os.path.abspath('..'))
 
-import autopylot.config as config
 import autopylot
+import autopylot.fakes as fakes
 import autopylot.sensor as sensor
 
 
-class TestSensorGyrosensor(unittest.TestCase):
-	""" Class to test the gyrosensor class """
+class FakeSmbus():
+	""" Stands in for the smbus module of the mpu6050 package - every
+	SMBus opened is the FakeI2CBus """
+
+	def __init__(self, bus):
+		self.bus = bus
+
+	def SMBus(self, bus_number):
+		return self.bus
+
+
+class MovingMpu6050(fakes.FakeMpu6050):
+	""" FakeMpu6050 which is shaken - the gyro jumps by 50°/s on every
+	read """
+
+	def __init__(self, address=0x68):
+		super().__init__(address)
+		self.reads = 0
+
+	def read(self, register, length):
+		self.reads += 1
+		self.set_motion((0.0, 0.0, 9.80665),
+						(50.0 * (self.reads % 2), 0.0, 0.0))
+		return super().read(register, length)
+
+
+class TestSensorData(unittest.TestCase):
+	""" Class to test the SensorData on fake MPU-6050s """
+
 	def setUp(self):
-		self.gyrosensor = sensor.Gyrosensor(config.get_gyrosensor_address())
+		self.bus = fakes.FakeI2CBus(overhead=0, byte_time=0)
+		# the mpu6050 package opens the bus itself
+		self.package = sys.modules[sensor.mpu6050.__module__]
+		self.smbus = self.package.smbus
+		self.package.smbus = FakeSmbus(self.bus)
+		self.accel = numpy.zeros(3)
+		self.gyro = numpy.zeros(3)
 
 	def tearDown(self):
-		self.gyrosensor = None
+		self.package.smbus = self.smbus
+
+	def _sensor_data(self, *devices):
+		for device in devices:
+			self.bus.attach(device)
+		addresses = [device.address for device in devices]
+		return sensor.SensorData(addresses if len(addresses) > 1
+								else addresses[0])
 
 	def test_get_sensor_temperature(self):
-		""" Tests if the gyrosensor returns valid temperature values in °C """
-		temp = round(self.gyrosensor.get_sensor_temperature(), 0)
-		# this test should be run in a room so i expect values
-		# within "room temperature"
-		in_range = temp in range(0, 60)
-		self.assertTrue(in_range)
+		""" Tests if the gyrosensor returns the temperature in °C """
+		device = fakes.FakeMpu6050()
+		device.set_motion((0.0, 0.0, 9.80665), (0.0, 0.0, 0.0), 21.5)
+		sensor_data = self._sensor_data(device)
+		self.assertAlmostEqual(sensor_data.get_sensor_temperature(), 21.5,
+							delta=0.1)
+
+	def test_calibrate(self):
+		""" The gyro bias should be measured and applied to read_into """
+		device = fakes.FakeMpu6050()
+		device.set_motion((0.0, 0.0, 9.80665), (1.0, -2.0, 0.5))
+		sensor_data = self._sensor_data(device)
+		calibration = sensor_data.calibrate(sample_count=50)
+		numpy.testing.assert_allclose(calibration.gyro_bias, [1.0, -2.0, 0.5],
+									atol=0.1)
+		self.assertIs(sensor_data.calibration, calibration)
+		self.assertEqual(sensor_data.calibrations, [calibration])
+
+		device.set_motion((0.0, 0.0, 9.80665), (11.0, -2.0, 0.5))
+		self.assertTrue(sensor_data.read_into(self.accel, self.gyro))
+		numpy.testing.assert_allclose(
+			self.gyro, sensor_data.mounting @ [10.0, 0.0, 0.0], atol=0.1)
+		numpy.testing.assert_allclose(
+			self.accel, sensor_data.mounting @ [0.0, 0.0, 9.80665], atol=0.1)
+
+	def test_calibrate_moving(self):
+		""" Calibrating a single moving IMU should fail """
+		sensor_data = self._sensor_data(MovingMpu6050())
+		with self.assertRaises(Exception):
+			sensor_data.calibrate(sample_count=50)
+		self.assertIsNone(sensor_data.calibration)
+
+	def test_read_into_duplicates(self):
+		""" read_into should report a sample the sensor did not update """
+		device = fakes.FakeMpu6050()
+		sensor_data = self._sensor_data(device)
+		self.assertTrue(sensor_data.read_into(self.accel, self.gyro))
+		self.assertFalse(sensor_data.read_into(self.accel, self.gyro))
+		device.set_motion((0.0, 0.0, 9.80665), (5.0, 0.0, 0.0))
+		self.assertTrue(sensor_data.read_into(self.accel, self.gyro))
+		numpy.testing.assert_allclose(
+			self.gyro, sensor_data.mounting @ [5.0, 0.0, 0.0], atol=0.1)
+
+	def test_redundant(self):
+		""" Several addresses should be read and fused by read_into """
+		sensor_data = self._sensor_data(fakes.FakeMpu6050(0x68),
+										fakes.FakeMpu6050(0x69))
+		self.assertEqual(sensor_data.addresses, [0x68, 0x69])
+		self.assertIsNotNone(sensor_data.redundant)
+		self.assertIsNotNone(sensor_data.get_redundancy_statistics())
+		for device in self.bus.devices.values():
+			device.set_motion((0.0, 0.0, 9.80665), (0.0, 20.0, 0.0))
+		self.assertTrue(sensor_data.read_into(self.accel, self.gyro))
+		numpy.testing.assert_allclose(
+			self.gyro, sensor_data.mounting @ [0.0, 20.0, 0.0], atol=0.1)
+
+	def test_calibrate_all(self):
+		""" A redundant IMU which fails to calibrate is left uncalibrated -
+		as long as one of them succeeds """
+		sensor_data = self._sensor_data(MovingMpu6050(0x68),
+										fakes.FakeMpu6050(0x69))
+		calibration = sensor_data.calibrate(sample_count=50)
+		self.assertIsNone(sensor_data.calibrations[0])
+		self.assertIs(sensor_data.calibrations[1], calibration)
+		self.assertIs(sensor_data.calibration, calibration)
+
+		with self.assertRaises(Exception):
+			sensor_data._calibrate_all(lambda address: 1 / 0)
 
 	def test_perform_selfcheck(self):
 		""" Tests if the selfcheck is working as expected """
-		# self.assertTrue(self.gyrosensor._perform_selfcheck())
+		device = fakes.FakeMpu6050()
+		sensor_data = self._sensor_data(device)
+		self.assertTrue(sensor_data._perform_selfcheck())
+
+		# too hot
+		device.set_motion((0.0, 0.0, 9.80665), (0.0, 0.0, 0.0), 55.0)
+		self.assertFalse(sensor_data._perform_selfcheck())
+
+		# gravity off by half
+		device.set_motion((0.0, 0.0, 4.9), (0.0, 0.0, 0.0))
+		self.assertFalse(sensor_data._perform_selfcheck())
+
+	def test_selfcheck_moving(self):
+		""" The selfcheck should fail if the device is moved """
+		sensor_data = self._sensor_data(MovingMpu6050())
+		self.assertFalse(sensor_data._perform_selfcheck())
 
 
 if __name__ == '__main__':
-		unittest.main()
+	unittest.main()
 
 # vim: tabstop=4 shiftwidth=4 noexpandtab
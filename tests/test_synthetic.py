@@ -0,0 +1,128 @@
+import unittest
+import os
+import sys
+import tempfile
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.synthetic as synthetic
+import autopylot.tuning as tuning
+
+RATE = 500
+
+
+class OracleEstimator():
+	""" Integrates the ideal readings - the harness should find (almost)
+	no error """
+
+	def __init__(self, dataset):
+		self.rate = dataset.sample_rate
+		self.tilt = numpy.zeros(3)
+
+	def process_block(self, accel, gyro):
+		tilt = self.tilt + numpy.cumsum(gyro, axis=0) / self.rate
+		self.tilt = tilt[-1]
+		return tilt, numpy.zeros_like(tilt)
+
+
+class TestSynthetic(unittest.TestCase):
+	""" Class to test the synthetic flights and the estimator harness """
+
+	def test_rest(self):
+		""" Tests the readings at rest are gravity on z and no rotation """
+		dataset = synthetic.generate('hover', 2, RATE,
+									synthetic.ImuModel.ideal())
+		self.assertEqual(len(dataset), 2 * RATE)
+		rest = slice(0, int(synthetic.REST * RATE))
+		numpy.testing.assert_allclose(dataset.accel[rest],
+									[[0, 0, synthetic.GRAVITY]] * (RATE // 1),
+									atol=0.003)
+		numpy.testing.assert_array_equal(dataset.gyro[rest], 0)
+		numpy.testing.assert_array_equal(dataset.attitude[rest], 0)
+
+	def test_tilted_gravity(self):
+		""" Tests the specific force follows the attitude (gravity seen in
+		the body frame) """
+		rotation = synthetic.body_to_world(numpy.array([[0, 90, 0],
+														[90, 0, 0]]))
+		numpy.testing.assert_allclose(rotation[0].T @ [0, 0, 1], [-1, 0, 0],
+									atol=1e-12)
+		numpy.testing.assert_allclose(rotation[1].T @ [0, 0, 1], [0, 1, 0],
+									atol=1e-12)
+		dataset = synthetic.generate('steps', 4, RATE,
+									synthetic.ImuModel.ideal())
+		magnitude = numpy.linalg.norm(dataset.force, axis=1)
+		acceleration = numpy.gradient(dataset.velocity, 1 / RATE, axis=0)
+		expected = numpy.linalg.norm(acceleration + [0, 0, synthetic.GRAVITY],
+									axis=1)
+		numpy.testing.assert_allclose(magnitude, expected, rtol=1e-9)
+
+	def test_sensor_errors(self):
+		""" Tests bias, drift, noise and the quantization of the readings """
+		model = synthetic.ImuModel(gyro_noise=0.1, warmup=10, warmup_time=1)
+		dataset = synthetic.generate('hover', 3, RATE, model, seed=3)
+		lsb = 1 / model.gyro_range.sensitivity
+		counts = dataset.gyro / lsb
+		numpy.testing.assert_allclose(counts, numpy.round(counts), atol=1e-6)
+		error = dataset.gyro - dataset.rates
+		heating = dataset.temperature[:, numpy.newaxis] - model.temperature
+		self.assertGreater(dataset.temperature[-1], model.temperature + 9)
+		residual = error - model.gyro_bias - model.gyro_drift * heating
+		rest = slice(0, int(synthetic.REST * RATE))
+		self.assertLess(abs(residual[rest].mean(axis=0)).max(), 0.05)
+		self.assertGreater(residual[rest].std(), 0.1)
+
+	def test_saturation(self):
+		""" Tests the readings clip at the full scale """
+		model = synthetic.ImuModel.ideal()
+		model.gyro_range = synthetic.autopylot.imu.gyro_range(250)
+		dataset = synthetic.generate('aggressive', 5, RATE, model)
+		self.assertGreater(abs(dataset.rates).max(), 300)
+		self.assertLessEqual(abs(dataset.gyro).max(), 32768 / 131.0)
+
+	def test_reproducible(self):
+		""" Tests the same seed gives the same flight - and save / load """
+		first = synthetic.generate('vibration', 1.5, RATE, seed=7)
+		second = synthetic.generate('vibration', 1.5, RATE, seed=7)
+		numpy.testing.assert_array_equal(first.gyro, second.gyro)
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, 'flight.npz')
+			first.save(filename)
+			loaded = synthetic.Dataset.load(filename)
+		self.assertEqual(loaded.name, 'vibration-7')
+		numpy.testing.assert_array_equal(loaded.attitude, first.attitude)
+		with self.assertRaises(Exception):
+			synthetic.generate('loop', 1, RATE)
+
+	def test_harness(self):
+		""" Tests the metrics - an ideal estimator is close to the truth on
+		small angles, the MotionEstimator runs on every flight """
+		datasets = [synthetic.generate('hover', 4, RATE,
+									synthetic.ImuModel.ideal())]
+		result, = synthetic.run_harness(datasets, {'oracle': OracleEstimator},
+										block_size=256)
+		self.assertEqual(result.samples, 4 * RATE)
+		self.assertLess(result.attitude_rms.max(), 0.1)
+		self.assertGreater(result.elapsed, 0)
+		results = synthetic.run_harness(synthetic.generate_all(3, RATE))
+		self.assertEqual([result.dataset for result in results],
+						['hover-0', 'steps-0', 'aggressive-0', 'vibration-0'])
+		for result in results:
+			self.assertTrue(numpy.all(numpy.isfinite(result.attitude_rms)))
+		self.assertIn('samples/s', synthetic.format_results(results))
+
+	def test_scenario(self):
+		""" Tests a dataset can be used by the parameter tuning """
+		scenario = synthetic.generate('steps', 3, RATE).to_scenario()
+		result = tuning.evaluate({'samplecount': 100}, [scenario], 'none',
+								'none')
+		self.assertTrue(numpy.isfinite(result.error))
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,186 @@
+import unittest
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.clock as clock
+import autopylot.telemetry as telemetry
+
+
+def attitude_channel(encoding='delta', rate=50):
+	return telemetry.Channel('attitude', telemetry.ATTITUDE,
+							['x', 'y', 'z'], 100, rate, encoding,
+							keyframe_interval=10)
+
+
+class TestTelemetry(unittest.TestCase):
+	""" Class to test the telemetry frames, the rates and the receiver """
+
+	def setUp(self):
+		self.receiver = telemetry.TelemetryReceiver(
+			'127.0.0.1:0', [attitude_channel(),
+							telemetry.Channel('loop', telemetry.LOOP,
+											['count'], 1, 10, counters=True)],
+			history=8)
+		self.channel = attitude_channel()
+
+	def tearDown(self):
+		self.receiver.close()
+
+	def _decode(self, values, now):
+		self.channel.values[:] = values
+		return self.receiver.decode(bytes(self.channel.serialize(now)))
+
+	def test_delta_encoding(self):
+		""" Tests small changes go as int8 deltas and large ones as a key
+		frame - the receiver gets the quantized values back """
+		frame = self.channel.serialize(0.0)
+		self.assertEqual(len(frame), self.channel.keyframe_size)
+		self.assertTrue(self.receiver.decode(bytes(frame)))
+		self.channel.values[:] = [0.5, -1.23, 0.004]
+		frame = self.channel.serialize(0.02)
+		self.assertEqual(len(frame), telemetry.HEADER.size + 3)
+		self.assertTrue(self.receiver.decode(bytes(frame)))
+		self.channel.values[:] = [100, -1.23, 0]
+		self.assertEqual(len(self.channel.serialize(0.04)),
+						self.channel.keyframe_size)
+		times, values = self.receiver.get('attitude')
+		numpy.testing.assert_allclose(times, [0, 0.02])
+		numpy.testing.assert_allclose(values[1], [0.5, -1.23, 0])
+
+	def test_quantized_and_missing(self):
+		""" Tests the quantized encoding, saturation and NaN values """
+		self.channel = attitude_channel('quantized')
+		self.receiver.channels[telemetry.ATTITUDE] = self.channel
+		for now in (0.0, 0.02):
+			self.assertTrue(self._decode([numpy.nan, 1000, -0.011], now))
+		_, values = self.receiver.get('attitude')
+		self.assertEqual(len(values), 2)
+		self.assertTrue(numpy.isnan(values[1][0]))
+		self.assertAlmostEqual(values[1][1], 327.67)
+		self.assertAlmostEqual(values[1][2], -0.01)
+
+	def test_lost_frame(self):
+		""" Tests deltas after a lost frame are skipped until the next key
+		frame """
+		for index in range(10):
+			self.channel.values[:] = [index / 100, 0, 0]
+			frame = bytes(self.channel.serialize(index * 0.02))
+			if index != 3:
+				self.receiver.decode(frame)
+		self.assertEqual(self.receiver.statistics['lost'], 1)
+		self.assertEqual(self.receiver.statistics['skipped'], 6)
+		self.assertTrue(self._decode([0.5, 0, 0], 0.2))
+		self.assertEqual(self.receiver.latest('attitude')['x'], 0.5)
+		self.assertFalse(self.receiver.decode(b'\xa7\x01'))
+		self.assertEqual(self.receiver.statistics['malformed'], 1)
+
+	def test_history(self):
+		""" Tests the ring keeps the last frames oldest first """
+		for index in range(11):
+			self._decode([index, 0, 0], float(index))
+		times, values = self.receiver.get('attitude')
+		self.assertEqual(list(times), list(range(3, 11)))
+		self.assertEqual(list(values[:, 0]), list(range(3, 11)))
+
+	def test_counters(self):
+		""" Tests counters are sent as rates """
+		channel = telemetry.Channel('loop', telemetry.LOOP, ['count'], 1, 10,
+									counters=True)
+		channel.values[:] = [100]
+		self.receiver.decode(bytes(channel.serialize(1.0)))
+		channel.values[:] = [150]
+		self.receiver.decode(bytes(channel.serialize(1.5)))
+		_, values = self.receiver.get('loop')
+		self.assertTrue(numpy.isnan(values[0][0]))
+		self.assertEqual(values[1][0], 100)
+
+	def test_publisher(self):
+		""" Tests the channel rates and the sources over loopback """
+		slow = telemetry.Channel('loop', telemetry.LOOP, ['count'], 1, 16,
+								counters=True)
+		publisher = telemetry.TelemetryPublisher(
+			'{!s}:{!s}'.format(*self.receiver.address),
+			[attitude_channel(rate=64), slow])
+		calls = []
+
+		def source(values):
+			calls.append(True)
+			values[:] = [1, 2, 3]
+		publisher.attach('attitude', source)
+		try:
+			sent = sum(publisher.publish(index / 128) for index in range(32))
+		finally:
+			publisher.close()
+		# attitude at 64 Hz, loop at 16 Hz over 0.25 s
+		self.assertEqual(len(calls), 16)
+		self.assertEqual(sent, 20)
+		self.assertEqual(self.receiver.poll(1), 20)
+		self.assertEqual(self.receiver.latest('attitude'),
+						{'x': 1, 'y': 2, 'z': 3})
+		self.assertEqual(publisher.statistics['dropped'], 0)
+
+	def test_unix_socket(self):
+		""" Tests a Unix datagram socket - without a receiver the frames are
+		dropped instead of blocking """
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'telemetry')
+			publisher = telemetry.TelemetryPublisher(path, [attitude_channel()])
+			self.assertEqual(publisher.publish(0.0), 0)
+			self.assertEqual(publisher.statistics['dropped'], 1)
+			receiver = telemetry.TelemetryReceiver(path, [attitude_channel()])
+			try:
+				publisher.update('attitude', [4, 5, 6])
+				self.assertEqual(publisher.publish(1.0), 1)
+				self.assertEqual(receiver.poll(1), 1)
+				self.assertEqual(receiver.latest('attitude')['z'], 6)
+			finally:
+				publisher.close()
+				receiver.close()
+			self.assertFalse(os.path.exists(path))
+
+	def test_no_allocation(self):
+		""" Tests serializing does not allocate per frame """
+		self.channel.values[:] = [1, 2, 3]
+		for index in range(20):
+			self.channel.serialize(index * 0.02)
+		tracemalloc.start()
+		try:
+			before = tracemalloc.take_snapshot()
+			for index in range(1000):
+				self.channel.values[0] = (index % 7) / 10
+				self.channel.serialize(1 + index * 0.02)
+			after = tracemalloc.take_snapshot()
+		finally:
+			tracemalloc.stop()
+		growth = sum(stat.size_diff for stat in after.compare_to(before,
+																'filename'))
+		self.assertLess(growth, 1024)
+
+	def test_loop_statistics(self):
+		""" Tests the loop rate and durations on a virtual clock """
+		previous = clock.set_clock(clock.VirtualClock(5.0))
+		try:
+			statistics = telemetry.LoopStatistics()
+			for _ in range(4):
+				statistics.begin()
+				clock.sleep(0.001)
+				statistics.end()
+				clock.sleep(0.009)
+			values = numpy.zeros(3)
+			statistics(values)
+		finally:
+			clock.set_clock(previous)
+		numpy.testing.assert_allclose(values, [100, 1000, 1000])
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
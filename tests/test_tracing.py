@@ -0,0 +1,107 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.tracing as tracing
+import autopylot.fakes as fakes
+
+
+class FakeClock():
+	""" Clock which only advances when told to (seconds) """
+
+	def __init__(self):
+		self.now = 0.0
+
+	def __call__(self):
+		return self.now
+
+	def advance(self, ms):
+		self.now += ms / 1000
+
+
+class TestCommandTracer(unittest.TestCase):
+	""" Class to test the command latency tracer """
+
+	def setUp(self):
+		self.clock = FakeClock()
+		self.tracer = tracing.CommandTracer(capacity=16, clock=self.clock)
+		self.pi = fakes.FakePi()
+
+	def tearDown(self):
+		self.pi.stop()
+
+	def _send(self, pins=(4, 17, 22, 27), mix=1, submit=2, ack=0.5):
+		""" Traces a command the way the Quadcopter sends it with PWM (one
+		pigpio call per motor) """
+		command = self.tracer.begin()
+		self.clock.advance(mix)
+		self.tracer.mark(command, tracing.MIXED)
+		self.clock.advance(submit)
+		self.tracer.mark(command, tracing.SUBMITTED)
+		for pin in pins:
+			self.pi.set_servo_pulsewidth(pin, 1500)
+			self.clock.advance(ack)
+		self.tracer.mark(command, tracing.ACKNOWLEDGED)
+		return command
+
+	def test_stages(self):
+		""" Tests submit is before the first and acknowledgement after the last
+		motor """
+		self._send()
+		spans = self.tracer.get_spans()
+		self.assertEqual(spans.shape, (1, 4))
+		created, mixed, submitted, acknowledged = spans[0] * 1000
+		self.assertAlmostEqual(mixed - created, 1)
+		self.assertAlmostEqual(submitted - mixed, 2)
+		self.assertAlmostEqual(acknowledged - submitted, 2)
+		self.assertEqual(self.pi.get_servo_pulsewidth(27), 1500)
+
+	def test_report(self):
+		""" Tests the percentiles per stage and end to end """
+		for ack in range(1, 11):
+			self._send(pins=(4,), ack=ack)
+		report = self.tracer.report()
+		self.assertEqual(list(report), ['created->mixed', 'mixed->submitted',
+										'submitted->acknowledged', 'total'])
+		self.assertEqual(report['total']['count'], 10)
+		self.assertAlmostEqual(report['created->mixed']['p99'], 1)
+		self.assertAlmostEqual(report['submitted->acknowledged']['p50'], 5.5)
+		self.assertAlmostEqual(report['submitted->acknowledged']['max'], 10)
+		self.assertAlmostEqual(report['total']['max'], 13)
+		self.assertIn('total', self.tracer.format_report())
+
+	def test_incomplete_commands(self):
+		""" Tests commands which were never sent only count where they got """
+		self.tracer.begin()
+		self._send()
+		report = self.tracer.report()
+		self.assertEqual(report['created->mixed']['count'], 1)
+		self.assertEqual(report['total']['count'], 1)
+		self.tracer.mark(None, tracing.MIXED)  # untraced command
+
+	def test_ring_buffer(self):
+		""" Tests the oldest commands are overwritten """
+		for _ in range(20):
+			last = self._send(pins=(4,))
+		self.assertEqual(len(self.tracer), 16)
+		self.assertEqual(last, 19)
+		spans = self.tracer.get_spans()
+		self.assertEqual(len(spans), 16)
+		# oldest first
+		self.assertTrue((spans[1:, 0] > spans[:-1, 0]).all())
+		self.assertEqual(self.tracer.report()['total']['count'], 16)
+
+	def test_empty_report(self):
+		""" Tests the report without any commands """
+		report = self.tracer.report()
+		self.assertEqual(report['total'], {'count': 0})
+		self.assertEqual(len(self.tracer.format_report().splitlines()), 5)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
@@ -0,0 +1,94 @@
+import unittest
+import os
+import sys
+import tempfile
+import configparser
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.config as config
+import autopylot.tuning as tuning
+
+GYRO_SPEC = 'dynnotch:150 lowpass:100'
+ACCEL_SPEC = 'lowpass:30'
+
+
+class TestTuning(unittest.TestCase):
+	""" Class to test the parameter search """
+
+	def setUp(self):
+		self.scenarios = [tuning.simulate_flight(duration=2.0, seed=seed)
+						for seed in range(2)]
+		self.tuner = tuning.Tuner(self.scenarios, workers=2,
+								gyro_spec=GYRO_SPEC, accel_spec=ACCEL_SPEC)
+
+	def test_candidates(self):
+		""" Tests the grid and the random candidates stay in the space """
+		grid = tuning.grid_candidates({'samplecount': [50, 100],
+									'deadzoneblur': [0.1, 0.2, 0.3]})
+		self.assertEqual(len(grid), 6)
+		self.assertIn({'samplecount': 100, 'deadzoneblur': 0.3}, grid)
+		for candidate in tuning.random_candidates(20, seed=1):
+			for name, (low, high) in tuning.SEARCH_SPACE.items():
+				self.assertGreaterEqual(candidate[name], low)
+				self.assertLessEqual(candidate[name], high)
+			self.assertIsInstance(candidate['samplecount'], int)
+		self.assertEqual(tuning.random_candidates(5, seed=1),
+						tuning.random_candidates(5, seed=1))
+
+	def test_filter_specs(self):
+		""" Tests the low-pass stage of the spec is replaced """
+		self.assertEqual(tuning.candidate_specs(
+			{'gyrolowpass': 80.0, 'accellowpass': 12.5}, GYRO_SPEC, 'none'),
+			('dynnotch:150 lowpass:80', 'lowpass:12.5'))
+
+	def test_parallel_matches_sequential(self):
+		""" Tests the pool gives the same scores as a direct evaluation """
+		candidates = tuning.random_candidates(4, seed=2)
+		results = self.tuner.evaluate(candidates)
+		for candidate, result in zip(candidates, results):
+			direct = tuning.evaluate(candidate, self.scenarios, GYRO_SPEC,
+									ACCEL_SPEC)
+			self.assertEqual(result.params, candidate)
+			self.assertAlmostEqual(result.score, direct.score)
+
+	def test_random_search(self):
+		""" Tests the results are ranked (best first) """
+		results = self.tuner.random_search(4)
+		self.assertEqual(len(results), 4)
+		scores = [result.score for result in results]
+		self.assertEqual(scores, sorted(scores))
+		self.assertGreater(results[0].error, 0)
+
+	def test_bayesian_search(self):
+		""" Tests the Bayesian search is at least as good as its start """
+		results = self.tuner.bayesian_search(6, initial=4)
+		self.assertEqual(len(results), 6)
+		start = self.tuner.random_search(4)
+		self.assertLessEqual(results[0].score, start[0].score)
+
+	def test_config_fragment(self):
+		""" Tests the best parameters are written as valid config.ini
+		sections """
+		result = tuning.TuningResult({'samplecount': 150,
+									'deadzoneblur': 0.25,
+									'gyrolowpass': 90.0}, 1.0, 0.5, 1.0)
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, 'tuned.ini')
+			tuning.write_config_fragment(result, filename, GYRO_SPEC,
+										ACCEL_SPEC)
+			fragment = configparser.ConfigParser()
+			fragment.read(filename)
+		self.assertTrue(config.verify_config_ini(fragment))
+		self.assertEqual(fragment['ESTIMATOR']['samplecount'], '150')
+		self.assertEqual(fragment['ESTIMATOR']['deadzoneblur'], '0.250')
+		self.assertEqual(fragment['FILTER']['gyro'],
+						'dynnotch:150 lowpass:90')
+		self.assertEqual(fragment['FILTER']['accel'], ACCEL_SPEC)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab
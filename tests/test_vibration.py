@@ -0,0 +1,82 @@
+import unittest
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import autopylot
+import autopylot.filters as filters
+import autopylot.vibration as vibration
+
+SAMPLE_RATE = 1000
+
+
+def _vibration(frequencies, count=4096, seed=0):
+	""" Returns (count, 3) gyro data - a sine per axis plus noise """
+	t = numpy.arange(count) / SAMPLE_RATE
+	noise = numpy.random.RandomState(seed).normal(0, 0.05, (count, 3))
+	return noise + numpy.column_stack([numpy.sin(2 * numpy.pi * frequency * t)
+									for frequency in frequencies])
+
+
+class TestVibration(unittest.TestCase):
+	""" Class to test the vibration analysis """
+
+	def test_ring_buffer(self):
+		""" Tests the ring buffer wraps around correctly """
+		ring = vibration.RingBuffer(8)
+		data = numpy.arange(39, dtype=float).reshape(-1, 3)
+		for start in range(0, 13, 5):
+			ring.extend(data[start:start + 5])
+		numpy.testing.assert_array_equal(ring.latest(8), data[-8:])
+		ring.extend(numpy.zeros((20, 3)))
+		numpy.testing.assert_array_equal(ring.latest(8), numpy.zeros((8, 3)))
+
+	def test_peaks_and_retune(self):
+		""" The notch should be retuned to the vibration of each axis """
+		analyzer = vibration.VibrationAnalyzer(SAMPLE_RATE, window=512,
+											interval=1000, budget=1.0)
+		notch = filters.AdaptiveNotch(150, SAMPLE_RATE)
+		analyzer.attach(notch)
+		data = _vibration((120, 180, 240))
+		for start in range(0, len(data), 100):
+			analyzer.push(data[start:start + 100])
+		self.assertEqual(analyzer.passes, 4)
+		resolution = SAMPLE_RATE / 512
+		for axis, frequency in enumerate((120, 180, 240)):
+			self.assertAlmostEqual(analyzer.peaks[axis, 0], frequency,
+								delta=resolution)
+			self.assertAlmostEqual(notch.frequencies[axis], frequency,
+								delta=resolution)
+
+		frequencies, magnitudes = analyzer.spectrum
+		self.assertEqual(magnitudes.shape, (len(frequencies), 3))
+
+		# the retuned notch removes most of the vibration
+		filtered = notch.process(data)[1000:]
+		self.assertLess(numpy.abs(filtered).max(), 0.5)
+
+	def test_no_retune_on_noise(self):
+		""" Plain noise has no prominent peak - the notch stays """
+		analyzer = vibration.VibrationAnalyzer(SAMPLE_RATE, interval=256,
+											budget=1.0)
+		notch = filters.AdaptiveNotch(150, SAMPLE_RATE)
+		analyzer.attach(notch)
+		analyzer.push(numpy.random.RandomState(1).normal(0, 1, (1024, 3)))
+		self.assertEqual(notch.frequencies, [150.0] * 3)
+
+	def test_budget(self):
+		""" Exceeding the budget should shrink the window """
+		analyzer = vibration.VibrationAnalyzer(SAMPLE_RATE, window=256,
+											interval=256, budget=0.0)
+		analyzer.push(_vibration((100, 100, 100), count=256))
+		self.assertEqual(analyzer.window, 128)
+		self.assertGreater(analyzer.max_analysis_time, 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
+
+# vim: tabstop=4 shiftwidth=4 noexpandtab